@@ -0,0 +1,134 @@
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from typing import Optional, Union
+
+import librosa
+import numpy as np
+import torch
+
+
+class AudioCodeCache:
+    """Content-addressed cache of the audio codes of reference audios.
+
+    The codes are keyed by a hash of the audio bytes (i.e. the encoded file, before decoding) and of the audio
+    tokenizer config, so the same voice prompt is only tokenized once. The cache has two tiers:
+
+    - An in-memory LRU of the most recently used codes.
+    - An optional on-disk tier of `.npy` files under `cache_dir`, which can be shared between processes and hosts.
+      The files are written atomically, and the loaded array is wrapped in a tensor without another copy.
+
+    Args:
+        audio_tokenizer (`HiggsAudioTokenizer`):
+            The audio tokenizer used to encode the cache misses.
+        cache_dir (`str`, *optional*):
+            The directory of the on-disk tier. If not set, only the in-memory tier is used.
+        max_memory_entries (`int`):
+            The maximum number of codes kept in memory.
+    """
+
+    def __init__(self, audio_tokenizer, cache_dir: Optional[str] = None, max_memory_entries: int = 256):
+        self.audio_tokenizer = audio_tokenizer
+        self.cache_dir = cache_dir
+        self.max_memory_entries = max_memory_entries
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, torch.Tensor] = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        tokenizer_config = {
+            "config": getattr(audio_tokenizer, "config", None),
+            "sampling_rate": audio_tokenizer.sampling_rate,
+            "tps": audio_tokenizer.tps,
+            "num_codebooks": audio_tokenizer.num_codebooks,
+            "codebook_size": audio_tokenizer.codebook_size,
+        }
+        self.tokenizer_fingerprint = hashlib.sha256(
+            json.dumps(tokenizer_config, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_entries": len(self._entries),
+        }
+
+    def get_key(self, audio_bytes: bytes) -> str:
+        hasher = hashlib.sha256(self.tokenizer_fingerprint.encode())
+        hasher.update(audio_bytes)
+        return hasher.hexdigest()
+
+    def _get_disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npy")
+
+    def _load_from_disk(self, key: str) -> Optional[torch.Tensor]:
+        if self.cache_dir is None or not os.path.exists(self._get_disk_path(key)):
+            return None
+        return torch.from_numpy(np.load(self._get_disk_path(key)))
+
+    def _save_to_disk(self, key: str, codes: torch.Tensor):
+        if self.cache_dir is None:
+            return
+        path = self._get_disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first, so that concurrent readers never see a partial file.
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".npy", delete=False) as f:
+            np.save(f, codes.numpy())
+        os.replace(f.name, path)
+
+    def _put_in_memory(self, key: str, codes: torch.Tensor):
+        with self._lock:
+            self._entries[key] = codes
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_memory_entries:
+                self._entries.popitem(last=False)
+
+    def encode(self, audio: Union[str, bytes]) -> torch.Tensor:
+        """Returns the audio codes of an audio file, given its path or its bytes.
+
+        The codes are on CPU and have shape (num_codebooks, num_frames).
+        """
+        if isinstance(audio, str):
+            with open(audio, "rb") as f:
+                audio = f.read()
+        key = self.get_key(audio)
+
+        with self._lock:
+            codes = self._entries.get(key)
+            if codes is not None:
+                self.memory_hits += 1
+                self._entries.move_to_end(key)
+                return codes
+
+        codes = self._load_from_disk(key)
+        if codes is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            raw_audio, _ = librosa.load(BytesIO(audio), sr=self.audio_tokenizer.sampling_rate)
+            codes = self.audio_tokenizer.encode(raw_audio, self.audio_tokenizer.sampling_rate)
+            codes = codes.squeeze(0).cpu()
+            self._save_to_disk(key, codes)
+        self._put_in_memory(key, codes)
+        return codes
+
+    def warm_up(self, audio_dir: str, pattern: str = "*.wav") -> int:
+        """Encodes all the audio files matching `pattern` in `audio_dir`, e.g. `examples/voice_prompts/`.
+
+        Returns the number of files added to the cache.
+        """
+        audio_paths = sorted(glob.glob(os.path.join(audio_dir, pattern)))
+        for audio_path in audio_paths:
+            self.encode(audio_path)
+        return len(audio_paths)
@@ -18,6 +18,7 @@ from huggingface_hub import snapshot_download
 from vector_quantize_pytorch import ResidualFSQ
 from .descriptaudiocodec.dac.model import dac as dac2
 from .quantization.vq import ResidualVectorQuantizer
+from .streaming_decoder import StreamingDACDecoder
 from .semantic_module import Encoder, Decoder
 
 
@@ -293,7 +294,7 @@ class HiggsAudioTokenizer(nn.Module):
         # return codes
         return EncodedResult(codes)
 
-    def decode(self, vq_code: torch.Tensor) -> torch.Tensor:
+    def _get_quantized_acoustic(self, vq_code: torch.Tensor) -> torch.Tensor:
         vq_code = vq_code.to(self.device)
 
         if self.quantizer_type == "RVQ":
@@ -303,11 +304,35 @@ class HiggsAudioTokenizer(nn.Module):
         else:
             vq_code = vq_code.permute(0, 2, 1)
             quantized = self.quantizer.get_output_from_indices(vq_code)
-        quantized_acoustic = self.fc_post2(quantized).transpose(1, 2)
+        return self.fc_post2(quantized).transpose(1, 2)
+
+    def decode(self, vq_code: torch.Tensor) -> torch.Tensor:
+        quantized_acoustic = self._get_quantized_acoustic(vq_code)
 
         o = self.decoder_2(quantized_acoustic)
         return o.detach().cpu().numpy()
 
+    def create_streaming_decoder(self) -> StreamingDACDecoder:
+        """Creates the state of a chunked decode, see `decode_chunk()`."""
+        return StreamingDACDecoder(self.decoder_2)
+
+    def decode_chunk(
+        self, vq_code: torch.Tensor, streaming_decoder: StreamingDACDecoder, is_final: bool = False
+    ) -> np.ndarray:
+        """Decodes the next frames of a sequence of codes, of shape (batch_size, num_codebooks, num_frames).
+
+        Every frame is only decoded once, and the concatenation of the outputs of all the chunks matches `decode()` on
+        the whole sequence. Since the decoder is not causal, the samples of the last frames of a chunk are only
+        returned with the next chunk, or with the last chunk (`is_final=True`), which also resets `streaming_decoder`.
+        """
+        o = [streaming_decoder.decode(self._get_quantized_acoustic(vq_code)) if vq_code.shape[-1] > 0 else None]
+        if is_final:
+            o.append(streaming_decoder.flush())
+        o = [chunk for chunk in o if chunk is not None]
+        if len(o) == 0:
+            return np.zeros((vq_code.shape[0], 1, 0), dtype=np.float32)
+        return torch.cat(o, dim=-1).detach().cpu().numpy()
+
 
 def load_higgs_audio_tokenizer(tokenizer_name_or_path, device="cuda"):
     is_local = os.path.exists(tokenizer_name_or_path)
@@ -322,6 +347,8 @@ def load_higgs_audio_tokenizer(tokenizer_name_or_path, device="cuda"):
         **config,
         device=device,
     )
+    # Keep the config to identify the tokenizer, e.g. in the audio code cache
+    model.config = config
     parameter_dict = torch.load(model_path, map_location=device)
     model.load_state_dict(parameter_dict, strict=False)
     model.to(device)
@@ -0,0 +1,246 @@
+from typing import List, Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.weight_norm import WeightNorm
+
+from .descriptaudiocodec.dac.model import dac as dac2
+
+
+def _get_weight(module: nn.Module) -> torch.Tensor:
+    # The weight of a weight-normed conv is only recomputed in its forward pre-hook, so it is stale after the
+    # state dict has been loaded.
+    for hook in module._forward_pre_hooks.values():
+        if isinstance(hook, WeightNorm):
+            return hook.compute_weight(module)
+    return module.weight
+
+
+def _cat(chunks: List[Optional[torch.Tensor]]) -> Optional[torch.Tensor]:
+    chunks = [chunk for chunk in chunks if chunk is not None]
+    if len(chunks) == 0:
+        return None
+    return torch.cat(chunks, dim=-1)
+
+
+class _StreamingPointwise:
+    def __init__(self, module: nn.Module):
+        self.module = module
+
+    def reset(self):
+        pass
+
+    def step(self, x: torch.Tensor) -> Optional[torch.Tensor]:
+        return self.module(x)
+
+    def flush(self) -> Optional[torch.Tensor]:
+        return None
+
+
+class _StreamingConv1d:
+    """A stride-1 `Conv1d` that keeps the last `dilation * (kernel_size - 1)` inputs between calls."""
+
+    def __init__(self, conv: nn.Conv1d):
+        if conv.stride[0] != 1 or conv.groups != 1:
+            raise ValueError("Only stride-1 convolutions without groups can be streamed.")
+        self.conv = conv
+        self.padding = conv.padding[0]
+        self.dilation = conv.dilation[0]
+        self.context = self.dilation * (conv.kernel_size[0] - 1)
+        self.reset()
+
+    def reset(self):
+        self.weight = _get_weight(self.conv)
+        self._inputs: Optional[torch.Tensor] = None
+
+    def step(self, x: torch.Tensor) -> Optional[torch.Tensor]:
+        if self._inputs is None:
+            # The left padding of the full convolution
+            self._inputs = x.new_zeros(x.shape[0], x.shape[1], self.padding)
+        inputs = torch.cat([self._inputs, x], dim=-1)
+        self._inputs = inputs[..., max(inputs.shape[-1] - self.context, 0) :]
+        if inputs.shape[-1] <= self.context:
+            return None
+        return F.conv1d(inputs, self.weight, self.conv.bias, dilation=self.dilation)
+
+    def flush(self) -> Optional[torch.Tensor]:
+        if self._inputs is None:
+            return None
+        # The right padding of the full convolution
+        inputs = self._inputs
+        out = self.step(inputs.new_zeros(inputs.shape[0], inputs.shape[1], self.padding))
+        self._inputs = None
+        return out
+
+
+class _StreamingConvTranspose1d:
+    """A `ConvTranspose1d` that overlap-adds the outputs of consecutive calls.
+
+    The last `kernel_size - stride` outputs of a call also depend on the next input, so they are kept until then.
+    """
+
+    def __init__(self, conv: nn.ConvTranspose1d):
+        if conv.dilation[0] != 1 or conv.groups != 1 or conv.kernel_size[0] < conv.stride[0]:
+            raise ValueError(
+                "Only transposed convolutions with kernel_size >= stride and no dilation or groups can be streamed."
+            )
+        self.conv = conv
+        self.stride = conv.stride[0]
+        self.padding = conv.padding[0]
+        # The number of outputs left after the last input
+        self.num_final_outputs = conv.kernel_size[0] - self.stride - self.padding + conv.output_padding[0]
+        self.reset()
+
+    def reset(self):
+        self.weight = _get_weight(self.conv)
+        self._tail: Optional[torch.Tensor] = None
+        self._num_skipped = 0
+
+    def _add_bias(self, x: torch.Tensor) -> torch.Tensor:
+        if self.conv.bias is None:
+            return x
+        return x + self.conv.bias[None, :, None]
+
+    def step(self, x: torch.Tensor) -> Optional[torch.Tensor]:
+        out = F.conv_transpose1d(x, self.weight, stride=self.stride)
+        if self._tail is not None:
+            out[..., : self._tail.shape[-1]] += self._tail
+        num_ready = x.shape[-1] * self.stride
+        self._tail = out[..., num_ready:]
+        out = out[..., :num_ready]
+        # The first `padding` outputs are cropped by the full transposed convolution
+        num_skip = min(self.padding - self._num_skipped, out.shape[-1])
+        self._num_skipped += num_skip
+        out = out[..., num_skip:]
+        if out.shape[-1] == 0:
+            return None
+        return self._add_bias(out)
+
+    def flush(self) -> Optional[torch.Tensor]:
+        if self._tail is None:
+            return None
+        tail = self._tail
+        if tail.shape[-1] < self.num_final_outputs:
+            tail = F.pad(tail, (0, self.num_final_outputs - tail.shape[-1]))
+        out = self._add_bias(tail[..., : self.num_final_outputs])
+        self._tail = None
+        self._num_skipped = 0
+        return out
+
+
+class _StreamingResidualUnit:
+    """A `ResidualUnit` that delays its inputs by the lookahead of its block before adding them."""
+
+    def __init__(self, unit: dac2.ResidualUnit):
+        self.block = _build_streaming_module(unit.block)
+        self.reset()
+
+    def reset(self):
+        self.block.reset()
+        self._inputs: Optional[torch.Tensor] = None
+
+    def _add_inputs(self, y: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+        if y is None:
+            return None
+        out = self._inputs[..., : y.shape[-1]] + y
+        self._inputs = self._inputs[..., y.shape[-1] :]
+        return out
+
+    def step(self, x: torch.Tensor) -> Optional[torch.Tensor]:
+        self._inputs = _cat([self._inputs, x])
+        return self._add_inputs(self.block.step(x))
+
+    def flush(self) -> Optional[torch.Tensor]:
+        out = self._add_inputs(self.block.flush())
+        self._inputs = None
+        return out
+
+
+class _StreamingSequential:
+    def __init__(self, modules: List):
+        self.modules = modules
+
+    def reset(self):
+        for module in self.modules:
+            module.reset()
+
+    def step(self, x: torch.Tensor) -> Optional[torch.Tensor]:
+        for module in self.modules:
+            x = module.step(x)
+            if x is None:
+                return None
+        return x
+
+    def flush(self) -> Optional[torch.Tensor]:
+        x = None
+        for module in self.modules:
+            # The remaining outputs of the previous modules are the last inputs of this one.
+            out = module.step(x) if x is not None else None
+            x = _cat([out, module.flush()])
+        return x
+
+
+def _build_streaming_module(module: nn.Module):
+    if isinstance(module, nn.Sequential):
+        return _StreamingSequential([_build_streaming_module(m) for m in module])
+    if isinstance(module, dac2.Decoder):
+        return _build_streaming_module(module.model)
+    if isinstance(module, dac2.DecoderBlock):
+        return _build_streaming_module(module.block)
+    if isinstance(module, dac2.ResidualUnit):
+        return _StreamingResidualUnit(module)
+    if isinstance(module, nn.ConvTranspose1d):
+        return _StreamingConvTranspose1d(module)
+    if isinstance(module, nn.Conv1d):
+        return _StreamingConv1d(module)
+    if isinstance(module, (dac2.Snake1d, nn.Tanh, nn.Identity)):
+        return _StreamingPointwise(module)
+    raise ValueError(f"{type(module).__name__} is not supported by the streaming decoder.")
+
+
+class StreamingDACDecoder:
+    """Stateful chunked decoding with a DAC `Decoder`.
+
+    The latent frames are fed to the decoder in chunks of any size. Every convolution keeps the tail of its inputs
+    (its left receptive field) between calls, and the transposed convolutions overlap-add their outputs, so no frame
+    is decoded twice. Each call returns exactly the new samples that no later frame can change, and the
+    concatenation of all the outputs, including `flush()`, matches the decode of the whole sequence up to floating
+    point errors.
+
+    The DAC decoder is not causal: its convolutions are centered, so the last samples of a chunk depend on the next
+    few frames and are only returned with the next chunk (or by `flush()`).
+
+    Args:
+        decoder (`dac.Decoder`):
+            The decoder, e.g. `HiggsAudioTokenizer.decoder_2`.
+    """
+
+    def __init__(self, decoder: dac2.Decoder):
+        self.decoder = decoder
+        self._module = _build_streaming_module(decoder)
+
+    def reset(self):
+        """Clears the state, e.g. at the start of a new sequence. Also reloads the weights of the decoder."""
+        self._module.reset()
+
+    @torch.no_grad()
+    def decode(self, x: torch.Tensor) -> torch.Tensor:
+        """Decodes the next latent frames, of shape (batch_size, channels, num_frames).
+
+        Returns the new audio samples, of shape (batch_size, 1, num_samples).
+        """
+        out = self._module.step(x) if x.shape[-1] > 0 else None
+        if out is None:
+            return x.new_zeros(x.shape[0], 1, 0)
+        return out
+
+    @torch.no_grad()
+    def flush(self) -> Optional[torch.Tensor]:
+        """Returns the last audio samples at the end of the sequence and resets the state.
+
+        Returns `None` if no frame has been decoded.
+        """
+        out = self._module.flush()
+        self.reset()
+        return out
@@ -0,0 +1,110 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple, Union
+
+import numpy as np
+import torch
+
+
+class WhisperFeatureCache:
+    """LRU cache of the whisper features of the audio-in chunks.
+
+    When `encode_whisper_embed` is enabled, every audio-in is resampled, split into chunks of `chunk_size_seconds`,
+    turned into log-mel features by the whisper feature extractor and encoded by the audio tower. The cache keeps both
+    results so that the same audio, e.g. a meeting recording that is asked several questions, is only processed once:
+
+    - The "mel" entries hold the features and attention mask of each chunk. They are filled and read by
+      `HiggsAudioSampleCollator`, which then also skips the resampling.
+    - The "embed" entries hold the output of the audio tower and projector for each chunk, with its length. They are
+      filled and read by `HiggsAudioModel._apply_audio_tower`.
+
+    Both are keyed by a hash of the waveform and its sampling rate, plus the chunk index. The entries depend on the
+    feature extractor and on the model weights, so a cache should only be shared by one collator and one model. The
+    least recently used entries are evicted once the cached tensors exceed `max_bytes`.
+
+    Args:
+        max_bytes (`int`):
+            The memory budget of the cached tensors, in bytes. The embeddings stay on the device of the model.
+    """
+
+    def __init__(self, max_bytes: int = 1024**3):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = {"mel": 0, "embed": 0}
+        self.misses = {"mel": 0, "embed": 0}
+        self._entries: OrderedDict[Tuple[str, str, int], Tuple[torch.Tensor, ...]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "mel_hits": self.hits["mel"],
+            "mel_misses": self.misses["mel"],
+            "embed_hits": self.hits["embed"],
+            "embed_misses": self.misses["embed"],
+            "num_entries": len(self._entries),
+            "num_bytes": self.num_bytes,
+        }
+
+    @staticmethod
+    def get_key(waveform: Union[torch.Tensor, np.ndarray], sampling_rate: int) -> str:
+        """Returns the content hash of a waveform, before it is resampled."""
+        if isinstance(waveform, torch.Tensor):
+            waveform = waveform.detach().cpu().numpy()
+        waveform = np.ascontiguousarray(waveform)
+        hasher = hashlib.sha256(f"{waveform.dtype}:{waveform.shape}:{int(sampling_rate)}".encode())
+        hasher.update(waveform.tobytes())
+        return hasher.hexdigest()
+
+    @staticmethod
+    def _get_nbytes(value: Tuple[torch.Tensor, ...]) -> int:
+        return sum(t.numel() * t.element_size() for t in value)
+
+    def get(self, kind: str, key: str, chunk_idx: int) -> Optional[Tuple[torch.Tensor, ...]]:
+        with self._lock:
+            value = self._entries.get((kind, key, chunk_idx))
+            if value is None:
+                self.misses[kind] += 1
+                return None
+            self.hits[kind] += 1
+            self._entries.move_to_end((kind, key, chunk_idx))
+            return value
+
+    def put(self, kind: str, key: str, chunk_idx: int, value: Tuple[torch.Tensor, ...]) -> None:
+        nbytes = self._get_nbytes(value)
+        with self._lock:
+            if (kind, key, chunk_idx) in self._entries or nbytes > self.max_bytes:
+                return
+            while self.num_bytes + nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.num_bytes -= self._get_nbytes(evicted)
+            self._entries[(kind, key, chunk_idx)] = value
+            self.num_bytes += nbytes
+
+    def get_mel_features(self, key: str) -> Optional[list]:
+        """Returns the (features, attention_mask) of each chunk of an audio, or `None` if any chunk is missing."""
+        first = self.get("mel", key, 0)
+        if first is None:
+            return None
+        num_chunks = int(first[2])
+        chunks = [first[:2]]
+        for chunk_idx in range(1, num_chunks):
+            value = self.get("mel", key, chunk_idx)
+            if value is None:
+                return None
+            chunks.append(value[:2])
+        return chunks
+
+    def put_mel_features(
+        self, key: str, chunk_idx: int, num_chunks: int, features: torch.Tensor, attention_mask: torch.Tensor
+    ) -> None:
+        self.put("mel", key, chunk_idx, (features, attention_mask, torch.tensor(num_chunks)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
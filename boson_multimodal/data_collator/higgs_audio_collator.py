@@ -1,4 +1,5 @@
 import librosa
+import numpy as np
 import torch
 import torch.nn.functional as F
 import math
@@ -8,6 +9,7 @@ from dataclasses import dataclass
 from typing import List, Optional
 from transformers.models.whisper.processing_whisper import WhisperProcessor
 
+from ..audio_processing.whisper_feature_cache import WhisperFeatureCache
 from ..dataset.chatml_dataset import ChatMLDatasetSample
 from ..model.higgs_audio.utils import build_delay_pattern_mask
 
@@ -42,6 +44,20 @@ class HiggsAudioBatchInput:
     label_ids: Optional[torch.LongTensor]  # shape (bsz, seq_len)
     label_audio_ids: Optional[torch.LongTensor]  # shape (num_codebooks, audio_out_total_length)
     reward: Optional[float] = None
+    # The (content hash, chunk index) of each row of audio_features, when the collator has a whisper feature cache.
+    audio_feature_cache_keys: Optional[List[Tuple[str, int]]] = None
+
+
+@dataclass
+class _AudioInChunk:
+    """A chunk of an audio-in, with its whisper features once they are extracted or read from the cache."""
+
+    cache_key: Optional[str]
+    chunk_idx: int
+    num_chunks: int
+    waveform: Optional[np.ndarray] = None
+    features: Optional[torch.Tensor] = None  # shape (feature_dim, max_mel_seq_len)
+    attention_mask: Optional[torch.Tensor] = None  # shape (max_mel_seq_len,)
 
 
 class HiggsAudioSampleCollator:
@@ -62,6 +78,8 @@ class HiggsAudioSampleCollator:
         chunk_size_seconds (int): The chunk size in seconds.
         add_new_bos_eos_for_long_chunk (bool): Whether to add new bos and eos tokens for long chunks.
         mask_audio_out_token_label (bool): Whether to always mask the label associated with <|AUDIO_OUT|> token. Since we will always have `<|AUDIO_OUT|>` after `<|audio_bos|>`, we can safely mask <|AUDIO_OUT|>.
+        whisper_feature_cache (WhisperFeatureCache): The cache of the whisper features of the audio-in chunks. The
+            cached audios are not resampled again, and the cache keys are returned for the audio tower.
 
     """
 
@@ -83,6 +101,7 @@ class HiggsAudioSampleCollator:
         chunk_size_seconds=30,  # Maximum duration for each chunk
         add_new_bos_eos_for_long_chunk=True,
         mask_audio_out_token_label=True,
+        whisper_feature_cache: Optional[WhisperFeatureCache] = None,
     ):
         self.whisper_processor = whisper_processor
         self.round_to = round_to
@@ -105,6 +124,7 @@ class HiggsAudioSampleCollator:
         self.disable_audio_codes_transform = disable_audio_codes_transform
         self.add_new_bos_eos_for_long_chunk = add_new_bos_eos_for_long_chunk
         self.mask_audio_out_token_label = mask_audio_out_token_label
+        self.whisper_feature_cache = whisper_feature_cache if encode_whisper_embed else None
 
     def _process_and_duplicate_audio_tokens(
         self, input_ids: torch.Tensor, audio_idx: int, wv: torch.Tensor, sr: int, labels: Optional[torch.Tensor] = None
@@ -127,9 +147,15 @@ class HiggsAudioSampleCollator:
         # Calculate number of chunks needed
         total_samples = len(wv)
         num_chunks = math.ceil(total_samples / self.chunk_size_samples)
+        new_input_ids, new_labels = self._duplicate_audio_tokens(input_ids, audio_idx, num_chunks, labels)
+        return new_input_ids, new_labels, max(num_chunks, 1)
 
+    def _duplicate_audio_tokens(
+        self, input_ids: torch.Tensor, audio_idx: int, num_chunks: int, labels: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """Duplicate the <|audio_bos|><|AUDIO|><|audio_eos|> tokens around `audio_idx` for each chunk."""
         if num_chunks <= 1:
-            return input_ids, labels, 1
+            return input_ids, labels
 
         # Get the three tokens: <|audio_bos|><|AUDIO|><|audio_eos|>
         audio_token_seq = input_ids[audio_idx - 1 : audio_idx + 2]
@@ -146,7 +172,7 @@ class HiggsAudioSampleCollator:
             duplicated_labels = label_seq.repeat(num_chunks)
             new_labels = torch.cat([labels[: audio_idx - 1], duplicated_labels, labels[audio_idx + 2 :]])
 
-        return new_input_ids, new_labels, num_chunks
+        return new_input_ids, new_labels
 
     def __call__(self, batch: List[ChatMLDatasetSample]):
         """Collate the input data with support for long audio processing."""
@@ -162,6 +188,8 @@ class HiggsAudioSampleCollator:
             # Process each sample in the batch to handle long audio
             # TODO(?) The implementation here can be optimized.
             processed_batch = []
+            # The whisper chunks of all the audio-in, in the order of the <|AUDIO|> tokens of the processed batch.
+            audio_in_chunks: List[_AudioInChunk] = []
             for i in range(len(batch)):
                 sample = batch[i]
                 audio_in_mask = sample.input_ids == self.audio_in_token_id
@@ -181,6 +209,26 @@ class HiggsAudioSampleCollator:
                 for idx, audio_idx in enumerate(audio_in_indices):
                     # Get the audio for this token
                     wv, sr = sample.get_wv(idx)  # Use idx since we want the original audio index
+                    token_pos = audio_idx + offset
+                    cache_key = cached_features = None
+                    if self.whisper_feature_cache is not None:
+                        cache_key = self.whisper_feature_cache.get_key(wv, sr)
+                        cached_features = self.whisper_feature_cache.get_mel_features(cache_key)
+                    if cached_features is not None:
+                        # The features of all the chunks are cached, so the audio is neither resampled nor chunked.
+                        num_chunks = len(cached_features)
+                        modified_input_ids, modified_labels = self._duplicate_audio_tokens(
+                            modified_input_ids, token_pos, num_chunks, modified_labels
+                        )
+                        for chunk_idx, (features, attention_mask) in enumerate(cached_features):
+                            audio_in_chunks.append(
+                                _AudioInChunk(
+                                    cache_key, chunk_idx, num_chunks, features=features, attention_mask=attention_mask
+                                )
+                            )
+                        offset += (num_chunks - 1) * 3
+                        continue
+
                     if sr != self.whisper_processor.feature_extractor.sampling_rate:
                         resampled_wv = librosa.resample(
                             wv.cpu().numpy(),
@@ -193,7 +241,6 @@ class HiggsAudioSampleCollator:
                     sr = self.whisper_processor.feature_extractor.sampling_rate
 
                     # Process and duplicate tokens if necessary
-                    token_pos = audio_idx + offset
                     modified_input_ids, modified_labels, num_chunks = self._process_and_duplicate_audio_tokens(
                         modified_input_ids, token_pos, wv, sr, modified_labels
                     )
@@ -204,6 +251,9 @@ class HiggsAudioSampleCollator:
                         chunk_end = min((chunk_idx + 1) * self.chunk_size_samples, len(wv))
                         chunk_wv = wv[chunk_start:chunk_end]
                         modified_waveforms_concat.append(chunk_wv)
+                        audio_in_chunks.append(
+                            _AudioInChunk(cache_key, chunk_idx, num_chunks, waveform=chunk_wv.cpu().numpy())
+                        )
                         modified_waveforms_start.append(curr_wv_offset)
                         curr_wv_offset += len(chunk_wv)
                         modified_sample_rate.append(sr)
@@ -240,7 +290,6 @@ class HiggsAudioSampleCollator:
         max_seq_length = _ceil_to_nearest(max([len(sample.input_ids) for sample in processed_batch]), self.round_to)
 
         # Get the ids for audio-in and audio-out for each batch
-        audio_in_wv_l = []
         audio_in_ids_l = []
         audio_out_ids_l = []
         audio_out_ids_group_loc_l = []
@@ -297,16 +346,6 @@ class HiggsAudioSampleCollator:
                     ]
                 )
 
-            if self.encode_whisper_embed:
-                for idx in audio_in_ids:
-                    wv, sr = processed_batch[i].get_wv(idx)
-                    resampled_wv = wv.cpu().numpy()
-                    # Split long audio into chunks
-                    total_samples = len(resampled_wv)
-                    for chunk_start in range(0, total_samples, self.chunk_size_samples):
-                        chunk_end = min(chunk_start + self.chunk_size_samples, total_samples)
-                        chunk = resampled_wv[chunk_start:chunk_end]
-                        audio_in_wv_l.append(chunk)
             # assert len(audio_in_wv_l) == processed_batch[i].num_audios(), \
             #     f"Assertion failed: Mismatch in number of audios. " \
             #     f"Expected {processed_batch[i].num_audios()}, but got {len(audio_in_wv_l)} at index {i}."
@@ -315,15 +354,32 @@ class HiggsAudioSampleCollator:
             audio_out_no_train_flag = torch.cat(audio_out_no_train_flag, dim=0)
 
         # Process all audio features
-        if len(audio_in_wv_l) > 0:
-            feature_ret = self.whisper_processor.feature_extractor(
-                audio_in_wv_l,
-                sampling_rate=self.whisper_processor.feature_extractor.sampling_rate,
-                return_attention_mask=True,
-                padding="max_length",
-            )
-            audio_features = torch.from_numpy(feature_ret["input_features"])
-            audio_feature_attention_mask = torch.from_numpy(feature_ret["attention_mask"])
+        audio_feature_cache_keys = None
+        if self.encode_whisper_embed and len(audio_in_chunks) > 0:
+            missing_chunks = [chunk for chunk in audio_in_chunks if chunk.features is None]
+            if len(missing_chunks) > 0:
+                feature_ret = self.whisper_processor.feature_extractor(
+                    [chunk.waveform for chunk in missing_chunks],
+                    sampling_rate=self.whisper_processor.feature_extractor.sampling_rate,
+                    return_attention_mask=True,
+                    padding="max_length",
+                )
+                for j, chunk in enumerate(missing_chunks):
+                    chunk.features = torch.from_numpy(feature_ret["input_features"][j])
+                    chunk.attention_mask = torch.from_numpy(feature_ret["attention_mask"][j])
+                    if chunk.cache_key is not None:
+                        # Copy the rows, so that the cache does not hold on to the features of the whole batch
+                        self.whisper_feature_cache.put_mel_features(
+                            chunk.cache_key,
+                            chunk.chunk_idx,
+                            chunk.num_chunks,
+                            chunk.features.clone(),
+                            chunk.attention_mask.clone(),
+                        )
+            audio_features = torch.stack([chunk.features for chunk in audio_in_chunks])
+            audio_feature_attention_mask = torch.stack([chunk.attention_mask for chunk in audio_in_chunks])
+            if self.whisper_feature_cache is not None:
+                audio_feature_cache_keys = [(chunk.cache_key, chunk.chunk_idx) for chunk in audio_in_chunks]
         else:
             if self.encode_whisper_embed:
                 audio_features = torch.zeros(
@@ -506,4 +562,5 @@ class HiggsAudioSampleCollator:
             label_ids=label_ids,
             label_audio_ids=label_audio_ids,
             reward=reward,
+            audio_feature_cache_keys=audio_feature_cache_keys,
         )
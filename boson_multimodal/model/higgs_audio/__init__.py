@@ -2,6 +2,7 @@ from transformers import AutoConfig, AutoModel
 
 from .configuration_higgs_audio import HiggsAudioConfig, HiggsAudioEncoderConfig
 from .modeling_higgs_audio import HiggsAudioModel
+from .paged_kv_cache import PagedKVCache
 
 
 AutoConfig.register("higgs_audio_encoder", HiggsAudioEncoderConfig)
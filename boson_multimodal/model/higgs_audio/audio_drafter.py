@@ -0,0 +1,69 @@
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+class NGramAudioDrafter:
+    """Proposes the next audio tokens of a sequence by looking up its last audio tokens in its previous ones.
+
+    The audio tokens are handled one (delayed) column of `num_codebooks` codes at a time. The last `n` columns are
+    matched against the earlier columns, from `max_ngram_size` down to `min_ngram_size`, and the columns that followed
+    the most recent match are proposed. Speech often repeats short patterns (silences, sustained sounds), and voice
+    cloning repeats the codes of the prompt, which are looked up as well.
+
+    The columns are kept on the host, with one index per n-gram size, so that `extend()` and `propose()` cost O(1)
+    lookups per column.
+
+    Args:
+        num_draft_frames (`int`):
+            The maximum number of columns proposed at once.
+        max_ngram_size (`int`):
+            The number of trailing columns matched first.
+        min_ngram_size (`int`):
+            The smallest number of trailing columns matched before giving up.
+    """
+
+    def __init__(self, num_draft_frames: int, max_ngram_size: int = 3, min_ngram_size: int = 1):
+        if not 1 <= min_ngram_size <= max_ngram_size:
+            raise ValueError(
+                f"The n-gram sizes should satisfy 1 <= min_ngram_size <= max_ngram_size, got {min_ngram_size} and "
+                f"{max_ngram_size}."
+            )
+        self.num_draft_frames = num_draft_frames
+        self.max_ngram_size = max_ngram_size
+        self.min_ngram_size = min_ngram_size
+        self.reset()
+
+    def reset(self):
+        """Clears the history, e.g. at the start of a new sequence."""
+        self._frames: List[Tuple[int, ...]] = []
+        # For each n-gram size, the end of the most recent occurrence of each n-gram, except the trailing one.
+        self._ngram_ends: Dict[int, Dict[Tuple[Tuple[int, ...], ...], int]] = {
+            n: {} for n in range(self.min_ngram_size, self.max_ngram_size + 1)
+        }
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def extend(self, frames: Iterable[Sequence[int]]):
+        """Adds columns of audio tokens, each a sequence of `num_codebooks` codes, to the history."""
+        for frame in frames:
+            # The trailing n-grams become lookup candidates once a column follows them.
+            end = len(self._frames)
+            for n, ngram_ends in self._ngram_ends.items():
+                if end >= n:
+                    ngram_ends[tuple(self._frames[end - n : end])] = end
+            self._frames.append(tuple(frame))
+
+    def propose(self, max_frames: Optional[int] = None) -> List[Tuple[int, ...]]:
+        """Returns up to `max_frames` (by default `num_draft_frames`) columns that may follow the history.
+
+        Returns an empty list if the trailing columns have not been seen before.
+        """
+        max_frames = self.num_draft_frames if max_frames is None else min(max_frames, self.num_draft_frames)
+        if max_frames <= 0:
+            return []
+        num_frames = len(self._frames)
+        for n in range(min(self.max_ngram_size, num_frames), self.min_ngram_size - 1, -1):
+            end = self._ngram_ends[n].get(tuple(self._frames[num_frames - n :]))
+            if end is not None:
+                return self._frames[end : end + max_frames]
+        return []
@@ -43,12 +43,15 @@ class HiggsAudioDecoderProjector(HiggsAudioPreTrainedModel):
         label_audio_ids=None,
         attention_mask=None,
         position_ids=None,
+        position_embeddings=None,
         past_key_values=None,
         use_cache=None,
         output_attentions=None,
         output_hidden_states=None,
         output_audio_hidden_states=False,
         cache_position=None,
+        is_decoding_audio_token=None,
+        num_logits_to_keep=0,
     ):
         """
         Args:
@@ -62,14 +65,29 @@ class HiggsAudioDecoderProjector(HiggsAudioPreTrainedModel):
                 Mask to avoid performing attention on padding token indices
             position_ids (`torch.Tensor` of shape `(batch_size, seq_len)`):
                 Position ids for the input tokens
+            position_embeddings (`Tuple[torch.Tensor, torch.Tensor]`, *optional*):
+                The cos and sin of the rotary embeddings of the input tokens, shared with the LLM component. Computed
+                from `position_ids` if not given.
+            is_decoding_audio_token (`bool`, *optional*):
+                When decoding a single token per sequence, whether all the tokens are audio tokens. If `True`, only the
+                audio logits are computed. If `False`, only the text logits are computed.
+            num_logits_to_keep (`int`, *optional*):
+                Calculate the logits for the last `num_logits_to_keep` positions only, e.g. 1 for inference, so that
+                the logits of the whole sequence are never materialized. If `0`, calculate the logits for all the
+                positions.
 
         Returns:
             logits (`torch.Tensor` of shape `(batch_size, seq_len, vocab_size)`):
-                Logits for text tokens
+                Logits for text tokens. `None` if `is_decoding_audio_token` is `True`.
             audio_logits (`torch.Tensor` of shape `(num_audio_out_tokens, audio_num_codebooks * audio_codebook_size)`):
-                Logits for audio tokens. We ensure `num_text_tokens + num_audio_tokens == batch_size * seq_len`
+                Logits for audio tokens. We ensure `num_text_tokens + num_audio_tokens == batch_size * seq_len`. With
+                `num_logits_to_keep`, only the audio tokens of the last `num_logits_to_keep` positions are included.
         """
-        logits = self.text_lm_head(hidden_states)
+        if is_decoding_audio_token:
+            # The text token is forced to <|AUDIO_OUT|> when decoding audio, so the text logits are not needed.
+            logits = None
+        else:
+            logits = self.text_lm_head(hidden_states[:, -num_logits_to_keep:, :])
 
         all_hidden_states = () if output_hidden_states else None
         all_self_attns = () if output_attentions else None
@@ -77,7 +95,8 @@ class HiggsAudioDecoderProjector(HiggsAudioPreTrainedModel):
 
         if self.config.audio_decoder_proj_num_layers > 0:
             # create position embeddings to be shared across the decoder layers
-            position_embeddings = self.rotary_emb(hidden_states, position_ids)
+            if position_embeddings is None:
+                position_embeddings = self.rotary_emb(hidden_states, position_ids)
             for decoder_layer in self.transformer_layers:
                 if output_hidden_states:
                     all_hidden_states += (hidden_states,)
@@ -119,11 +138,16 @@ class HiggsAudioDecoderProjector(HiggsAudioPreTrainedModel):
 
         next_cache = next_decoder_cache if use_cache else None
 
-        audio_logits = self.audio_lm_head(hidden_states[audio_out_mask])
-
-        if output_audio_hidden_states:
-            audio_hidden_states = hidden_states[audio_out_mask]
+        if is_decoding_audio_token is None:
+            audio_hidden_states = hidden_states[:, -num_logits_to_keep:][audio_out_mask[:, -num_logits_to_keep:]]
+        elif is_decoding_audio_token:
+            # All the positions are audio positions, so we avoid the boolean indexing.
+            audio_hidden_states = hidden_states.reshape(-1, hidden_states.shape[-1])
         else:
+            audio_hidden_states = hidden_states.new_zeros((0, hidden_states.shape[-1]))
+        audio_logits = self.audio_lm_head(audio_hidden_states)
+
+        if not output_audio_hidden_states:
             audio_hidden_states = None
 
         return logits, audio_logits, all_self_attns, all_hidden_states, audio_hidden_states, next_cache
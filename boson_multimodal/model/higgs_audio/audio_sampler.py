@@ -0,0 +1,124 @@
+from typing import Dict, Optional, Tuple
+
+import torch
+from transformers.generation import LogitsProcessorList
+from transformers.generation.logits_process import TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+
+
+class FusedAudioSampler:
+    """Applies temperature, top-k and top-p to the audio logits in one pass, and samples from them.
+
+    This is equivalent to the `TemperatureLogitsWarper`, `TopKLogitsWarper` and `TopPLogitsWarper` of the logits
+    processor list, but:
+
+    - top-k only partially sorts the logits with `torch.topk`;
+    - top-p only sorts the top-k candidates (the whole row when top-k is not set);
+    - the scores and probabilities are written to buffers that are reused at every step.
+
+    The only difference is that ties with the k-th logit are dropped, while `TopKLogitsWarper` keeps them.
+
+    Args:
+        temperature (`float`):
+            The value used to divide the logits.
+        top_k (`int`, *optional*):
+            The number of highest probability tokens to keep.
+        top_p (`float`, *optional*):
+            The cumulative probability of the most probable tokens to keep.
+        min_tokens_to_keep (`int`):
+            The minimum number of tokens that top-p cannot remove.
+    """
+
+    def __init__(
+        self,
+        temperature: float = 1.0,
+        top_k: Optional[int] = None,
+        top_p: Optional[float] = None,
+        min_tokens_to_keep: int = 1,
+    ):
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.min_tokens_to_keep = min_tokens_to_keep
+        self._buffers: Dict[str, torch.Tensor] = {}
+
+    @classmethod
+    def from_logits_processor(cls, logits_processor: LogitsProcessorList) -> Optional["FusedAudioSampler"]:
+        """Creates the sampler equivalent to `logits_processor`.
+
+        Returns `None` if `logits_processor` contains other processors, or if they are not in the order of
+        `GenerationMixin`, in which case the logits processor should be used as is.
+        """
+        kwargs = {}
+        for processor in logits_processor:
+            if isinstance(processor, TemperatureLogitsWarper) and len(kwargs) == 0:
+                kwargs["temperature"] = processor.temperature
+            elif isinstance(processor, TopKLogitsWarper) and "top_k" not in kwargs and "top_p" not in kwargs:
+                if processor.filter_value != -float("inf"):
+                    return None
+                kwargs["top_k"] = processor.top_k
+            elif isinstance(processor, TopPLogitsWarper) and "top_p" not in kwargs:
+                if processor.filter_value != -float("inf"):
+                    return None
+                kwargs["top_p"] = processor.top_p
+                kwargs["min_tokens_to_keep"] = processor.min_tokens_to_keep
+            else:
+                return None
+        return cls(**kwargs)
+
+    def _get_buffer(self, name: str, shape: Tuple[int, ...], like: torch.Tensor) -> torch.Tensor:
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.device != like.device or buffer.dtype != like.dtype:
+            buffer = torch.empty(shape, dtype=like.dtype, device=like.device)
+            self._buffers[name] = buffer
+        return buffer
+
+    def process(self, logits: torch.Tensor) -> torch.Tensor:
+        """Returns the scores of the logits, of shape (num_rows, codebook_size), after temperature, top-k and top-p.
+
+        The scores are written to a buffer that is overwritten by the next call.
+        """
+        scores = self._get_buffer("scores", logits.shape, logits)
+        torch.div(logits, self.temperature, out=scores)
+        vocab_size = scores.shape[-1]
+        top_k = min(self.top_k, vocab_size) if self.top_k is not None else vocab_size
+        if top_k == vocab_size and self.top_p is None:
+            return scores
+
+        # The candidates, sorted by decreasing score
+        if top_k < vocab_size:
+            values, indices = torch.topk(scores, top_k, dim=-1)
+        else:
+            values, indices = torch.sort(scores, dim=-1, descending=True)
+        if self.top_p is not None:
+            # Same as `TopPLogitsWarper`, which accumulates the probabilities in increasing order.
+            cumulative_probs = values.flip(-1).softmax(dim=-1).cumsum(dim=-1).flip(-1)
+            to_remove = cumulative_probs <= (1 - self.top_p)
+            to_remove[..., : self.min_tokens_to_keep] = False
+            values = values.masked_fill(to_remove, -float("inf"))
+        scores.fill_(-float("inf"))
+        scores.scatter_(-1, indices, values)
+        return scores
+
+    def sample(
+        self,
+        scores: torch.Tensor,
+        torch_generator: Optional[torch.Generator],
+        fallback_logits: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """Samples one token per row of the scores returned by `process()`.
+
+        If `fallback_logits` is given, one token per row is also sampled from them, without temperature, in the same
+        call. Returns the tokens and the fallback tokens.
+        """
+        num_rows = scores.shape[0]
+        num_prob_rows = num_rows if fallback_logits is None else 2 * num_rows
+        probs = self._get_buffer("probs", (num_prob_rows, scores.shape[1]), scores)
+        # The probabilities do not need to be normalized for `torch.multinomial`.
+        for rows, row_scores in [(probs[:num_rows], scores), (probs[num_rows:], fallback_logits)]:
+            if row_scores is not None:
+                torch.sub(row_scores, row_scores.amax(dim=-1, keepdim=True), out=rows)
+                rows.exp_()
+        tokens = torch.multinomial(probs, num_samples=1, generator=torch_generator).squeeze(1)
+        if fallback_logits is None:
+            return tokens, None
+        return tokens[:num_rows], tokens[num_rows:]
@@ -33,10 +33,15 @@ from .common import HiggsAudioPreTrainedModel
 from .utils import (
     merge_input_ids_with_audio_features,
     count_parameters,
+    GrowableTensor,
+    split_stop_strings,
 )
 from .configuration_higgs_audio import HiggsAudioConfig, HiggsAudioEncoderConfig
 from .custom_modules import PartiallyFrozenLinear, PartiallyFrozenEmbedding
 from .cuda_graph_runner import CUDAGraphRunner
+from .paged_kv_cache import PagedKVCache
+from .audio_drafter import NGramAudioDrafter
+from .audio_sampler import FusedAudioSampler
 from .audio_head import HiggsAudioDecoderProjector
 
 logger = logging.get_logger(__name__)
@@ -160,6 +165,177 @@ def _prepare_4d_causal_attention_mask_with_cache_position(
     return causal_mask
 
 
+def _get_text_positions(
+    audio_out_mask: torch.BoolTensor, num_text_tokens: int
+) -> Optional[Tuple[torch.LongTensor, torch.BoolTensor]]:
+    """Returns the positions of the text tokens of each sequence, of shape `(batch_size, num_text_tokens)`, and
+    whether they are text tokens.
+
+    `num_text_tokens` is an upper bound of the number of text tokens of the sequences, known on the host. The sequences
+    with fewer text tokens are padded with the positions of their first audio tokens. Returns `None` if all the tokens
+    can be text tokens.
+    """
+    if num_text_tokens >= audio_out_mask.shape[1]:
+        return None
+    positions = torch.sort(audio_out_mask.long(), dim=1, stable=True).indices[:, :num_text_tokens]
+    return positions, ~audio_out_mask.gather(1, positions)
+
+
+def _gather_positions(x: torch.Tensor, positions: torch.LongTensor) -> torch.Tensor:
+    """Gathers the `positions` of shape `(batch_size, num_positions)` along the second dimension of `x`."""
+    x = x.expand(positions.shape[0], *x.shape[1:])
+    return x.gather(1, positions.view(*positions.shape, *([1] * (x.dim() - 2))).expand(-1, -1, *x.shape[2:]))
+
+
+class _ScatteredKVCache:
+    """Caches the keys and values of some positions of the input tokens, and zeros for the other positions.
+
+    It wraps the KV cache passed to an attention layer that only processes the tokens at `positions` of shape
+    `(batch_size, num_positions)`, so that the cache stays aligned with the `target_length` input tokens.
+    """
+
+    def __init__(self, cache: Cache, positions: torch.LongTensor, target_length: int):
+        self.cache = cache
+        self.positions = positions
+        self.target_length = target_length
+
+    def _scatter(self, states: torch.Tensor) -> torch.Tensor:
+        batch_size, num_heads, _, head_dim = states.shape
+        index = self.positions[:, None, :, None].expand(-1, num_heads, -1, head_dim)
+        return states.new_zeros(batch_size, num_heads, self.target_length, head_dim).scatter_(2, index, states)
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.cache.update(self._scatter(key_states), self._scatter(value_states), layer_idx, cache_kwargs)
+
+
+class StaticKVCacheMasks:
+    """The attention masks of the decoded token when decoding with a static KV cache, updated in place.
+
+    With a static KV cache, the masks span the whole cache, so building them from scratch costs O(kv_cache_len) per
+    decoded token. Since the decoded token attends to the same keys as the previous token plus itself, we keep the
+    rows of the causal mask, of the fast-forward mask and of the audio attention mask, and only write the column of
+    the new token at each step.
+
+    The fast-forward mask masks the audio keys and the audio attention mask masks the text keys. Both are fully
+    masked when the decoded token is respectively an audio token or a text token, in which case a constant fully
+    masked row is returned. When a batch decodes both audio and text tokens, the rows are picked for each sequence.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.causal_mask = None
+        self.fast_forward_attention_mask = None
+        self.audio_attention_mask = None
+        self.fully_masked = None
+        self.is_audio_token = None
+        self.num_positions = 0
+
+    def can_update(self, position: int, batch_size: int, kv_cache_len: int, dtype: torch.dtype) -> bool:
+        """Whether the masks of the token at `position` can be obtained by updating the masks of the previous one."""
+        return (
+            self.causal_mask is not None
+            and self.num_positions == position
+            and self.causal_mask.shape[0] == batch_size
+            and self.causal_mask.shape[-1] == kv_cache_len
+            and self.causal_mask.dtype == dtype
+        )
+
+    def init(self, causal_mask: torch.Tensor, audio_discrete_codes_mask: torch.Tensor):
+        """Initializes the rows from the causal mask of the last forward pass, of shape
+        (batch_size, 1, query_length, kv_cache_len), and the audio discrete codes mask of all the tokens so far."""
+        min_dtype = torch.finfo(causal_mask.dtype).min
+        num_positions = audio_discrete_codes_mask.shape[1]
+        pad = (0, causal_mask.shape[-1] - num_positions)
+        self.causal_mask = causal_mask[:, :, -1:, :].clone()
+        self.fast_forward_attention_mask = self.causal_mask.masked_fill(
+            torch.nn.functional.pad(audio_discrete_codes_mask, pad, value=True)[:, None, None, :], min_dtype
+        )
+        self.audio_attention_mask = self.causal_mask.masked_fill(
+            torch.nn.functional.pad(~audio_discrete_codes_mask, pad, value=False)[:, None, None, :], min_dtype
+        )
+        self.fully_masked = torch.full_like(self.causal_mask, min_dtype)
+        self.is_audio_token = audio_discrete_codes_mask[:, -1:]
+        self.num_positions = num_positions
+
+    def update(self, attention_mask: torch.Tensor, audio_discrete_codes_mask: torch.Tensor):
+        """Adds the column of the decoded token, given its attention mask and audio discrete codes mask, both of
+        shape (batch_size, 1)."""
+        min_dtype = torch.finfo(self.causal_mask.dtype).min
+        position = self.num_positions
+        causal_column = self.causal_mask[:, 0, 0, position : position + 1]
+        causal_column.copy_(torch.where(attention_mask.bool(), 0.0, min_dtype))
+        self.fast_forward_attention_mask[:, 0, 0, position : position + 1] = causal_column.masked_fill(
+            audio_discrete_codes_mask, min_dtype
+        )
+        self.audio_attention_mask[:, 0, 0, position : position + 1] = causal_column.masked_fill(
+            ~audio_discrete_codes_mask, min_dtype
+        )
+        self.is_audio_token = audio_discrete_codes_mask
+        self.num_positions += 1
+
+    def get(self, is_decoding_audio_token: Optional[bool]) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Returns the causal mask, the fast-forward mask and the audio attention mask of the decoded token.
+
+        `is_decoding_audio_token` is `None` if the batch decodes both audio and text tokens.
+        """
+        if is_decoding_audio_token is None:
+            is_audio_token = self.is_audio_token[:, None, None, :]
+            return (
+                self.causal_mask,
+                torch.where(is_audio_token, self.fully_masked, self.fast_forward_attention_mask),
+                torch.where(is_audio_token, self.audio_attention_mask, self.fully_masked),
+            )
+        if is_decoding_audio_token:
+            return self.causal_mask, self.fully_masked, self.audio_attention_mask
+        return self.causal_mask, self.fast_forward_attention_mask, self.fully_masked
+
+
+class RotaryEmbeddingTable:
+    """The cos and sin of the rotary embeddings of the positions `[0, length)`, computed once and indexed by position.
+
+    `LlamaRotaryEmbedding` recomputes the angles, their cos and sin, and their casts for every forward pass, i.e. for
+    every decoded token. The table is computed with the same module, so the gathered values are identical to the ones
+    it returns. It doubles when a longer sequence is seen.
+
+    The captured CUDA graphs read the table of the time of their capture, so a table is never freed or refilled:
+    the replaced tables are kept alive when the table grows, and each dtype and device has its own table, which is
+    reused when the model is cast back. With the doubling, the replaced tables take less memory than the current one.
+    """
+
+    def __init__(self, rotary_emb: LlamaRotaryEmbedding):
+        self.rotary_emb = rotary_emb
+        self.cos = None
+        self.sin = None
+        self._tables: Dict[Tuple[torch.dtype, torch.device], Tuple[torch.Tensor, torch.Tensor]] = {}
+        self._replaced_tables = []
+
+    def reserve(self, length: int, like: torch.Tensor):
+        """Makes sure that the table covers the positions `[0, length)`, in the dtype and on the device of `like`."""
+        key = (like.dtype, like.device)
+        table = self._tables.get(key)
+        if table is None or table[0].shape[0] < length:
+            if table is not None:
+                self._replaced_tables.append(table)
+                length = max(length, 2 * table[0].shape[0])
+            positions = torch.arange(length, device=like.device)[None, :]
+            cos, sin = self.rotary_emb(like, positions)
+            table = self._tables[key] = (cos[0], sin[0])
+        self.cos, self.sin = table
+
+    def get(self, position_ids: torch.LongTensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns the cos and sin of `position_ids` of shape (batch_size, seq_len), which must be covered by the
+        table."""
+        return self.cos[position_ids], self.sin[position_ids]
+
+
 class HiggsAudioFeatureProjector(nn.Module):
     """Projector that maps audio features extracted by Whisper to hidden state of the text model."""
 
@@ -442,6 +618,7 @@ class HiggsAudioDualFFNDecoderLayer(nn.Module):
         cache_position: Optional[torch.LongTensor] = None,
         position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,  # will become mandatory in v4.46
         is_using_cuda_graph: Optional[bool] = False,
+        text_positions: Optional[Tuple[torch.LongTensor, torch.BoolTensor]] = None,
         **kwargs,
     ):
         """
@@ -477,6 +654,9 @@ class HiggsAudioDualFFNDecoderLayer(nn.Module):
                 with `head_dim` being the embedding dimension of each attention head.
             is_using_cuda_graph (`bool`, *optional*):
                 Indicates whether the model is running by cuda graph.
+            text_positions (`Tuple[torch.LongTensor, torch.BoolTensor]`, *optional*):
+                The positions of the text tokens among the input tokens, as returned by `_get_text_positions`. If
+                given, a fast-forward layer only processes the text tokens.
             kwargs (`dict`, *optional*):
                 Arbitrary kwargs to be ignored, used for FSDP and other methods that injects code
                 into the model
@@ -500,7 +680,6 @@ class HiggsAudioDualFFNDecoderLayer(nn.Module):
         audio_out_mask_sq = audio_out_mask
 
         if self.fast_forward and has_audio_out:
-            original_hidden_states = hidden_states.clone()
             min_dtype = torch.finfo(hidden_states.dtype).min
             if attention_mask is None:
                 attention_mask = ~audio_out_mask
@@ -556,6 +735,25 @@ class HiggsAudioDualFFNDecoderLayer(nn.Module):
                 # Details: https://github.com/pytorch/pytorch/issues/110213
                 attention_mask = AttentionMaskConverter._unmask_unattended(attention_mask, min_dtype)
 
+            if (
+                text_positions is not None
+                and attention_mask is not None
+                and attention_mask.dim() == 4
+                and position_embeddings is not None
+                and not output_attentions
+            ):
+                return self._forward_text_positions(
+                    hidden_states,
+                    attention_mask=attention_mask,
+                    text_positions=text_positions,
+                    past_key_value=past_key_value,
+                    use_cache=use_cache,
+                    cache_position=cache_position,
+                    position_embeddings=position_embeddings,
+                    **kwargs,
+                )
+            original_hidden_states = hidden_states.clone()
+
         if has_audio_out and not self.fast_forward:
             # Apply separate layernorm layers for audio tokens and text tokens
             if use_cache:
@@ -676,8 +874,9 @@ class HiggsAudioDualFFNDecoderLayer(nn.Module):
             else:
                 real_audio_out_mask = audio_out_mask_sq
 
-            # Make whole graph in decode stage
-            if decode_stage and is_using_cuda_graph:
+            # Make whole graph in decode stage. The token type is also known when decoding with a static cache, in which
+            # case we avoid the boolean indexing, which synchronizes with the host.
+            if decode_stage and (is_using_cuda_graph or (use_static_cache and is_decoding_audio_token is not None)):
                 assert is_decoding_audio_token is not None, (
                     "is_decoding_audio_token should be present in the decoding stage."
                 )
@@ -727,6 +926,81 @@ class HiggsAudioDualFFNDecoderLayer(nn.Module):
 
         return outputs
 
+    def _forward_text_positions(
+        self,
+        hidden_states: torch.Tensor,
+        attention_mask: torch.Tensor,
+        text_positions: Tuple[torch.LongTensor, torch.BoolTensor],
+        past_key_value: Optional[Cache],
+        use_cache: bool,
+        cache_position: Optional[torch.LongTensor],
+        position_embeddings: Tuple[torch.Tensor, torch.Tensor],
+        **kwargs,
+    ):
+        """The forward pass of a fast-forward layer on the text tokens only.
+
+        The outputs of the audio tokens are their inputs and their keys and values are masked out, so the attention
+        and the MLP only process the gathered text tokens, and their outputs are scattered back. The keys and values
+        of the audio tokens are cached as zeros, so that the KV cache stays aligned with the input tokens.
+
+        Args:
+            attention_mask (`torch.Tensor` of shape `(batch_size, 1, query_length, key_length)`):
+                The fast-forward attention mask, in which the audio tokens are masked.
+        """
+        positions, is_text = text_positions
+        batch_size, target_length, _ = hidden_states.shape
+        if positions.shape[1] == 0:
+            # All the input tokens are audio tokens, e.g. the drafts of speculative decoding.
+            if past_key_value is not None:
+                cos, sin = position_embeddings
+                zeros = hidden_states.new_zeros(
+                    batch_size, self.self_attn.num_key_value_heads, target_length, self.self_attn.head_dim
+                )
+                past_key_value.update(
+                    zeros, zeros, self.self_attn.layer_idx, {"sin": sin, "cos": cos, "cache_position": cache_position}
+                )
+            return (hidden_states, past_key_value) if use_cache else (hidden_states,)
+
+        attention_mask = _gather_positions(attention_mask.transpose(1, 2), positions).transpose(1, 2)
+        if past_key_value is not None:
+            past_key_value = _ScatteredKVCache(past_key_value, positions, target_length)
+        else:
+            # Without the KV cache, the keys are the text tokens as well.
+            attention_mask = attention_mask.gather(
+                3, positions[:, None, None, :].expand(-1, attention_mask.shape[1], attention_mask.shape[2], -1)
+            )
+
+        original_hidden_states = _gather_positions(hidden_states, positions)
+        residual = original_hidden_states
+        text_hidden_states = self.input_layernorm(original_hidden_states)
+        text_hidden_states, _, _ = self.self_attn(
+            hidden_states=text_hidden_states,
+            attention_mask=attention_mask,
+            past_key_value=past_key_value,
+            output_attentions=False,
+            use_cache=use_cache,
+            cache_position=cache_position,
+            position_embeddings=tuple(_gather_positions(x, positions) for x in position_embeddings),
+            **kwargs,
+        )
+        text_hidden_states = residual + text_hidden_states
+
+        residual = text_hidden_states
+        text_hidden_states = self.post_attention_layernorm(text_hidden_states)
+        text_hidden_states = self.mlp(text_hidden_states)
+        text_hidden_states = residual + text_hidden_states
+
+        # The padding positions of the sequences with fewer text tokens are audio tokens, which keep their inputs.
+        text_hidden_states = torch.where(is_text[:, :, None], text_hidden_states, original_hidden_states)
+        hidden_states = hidden_states.scatter(
+            1, positions[:, :, None].expand(-1, -1, hidden_states.shape[-1]), text_hidden_states
+        )
+
+        outputs = (hidden_states,)
+        if use_cache:
+            outputs += (past_key_value.cache if past_key_value is not None else None,)
+        return outputs
+
 
 @dataclass
 class HiggsAudioModelOutputWithPast(ModelOutput):
@@ -759,18 +1033,19 @@ class HiggsAudioGenerationOutput(ModelOutput):
             if all batches finished early due to the `eos_token_id`.
         audio_sequences (`tuple(torch.LongTensor)` *optional*):
             The generated discrete audio codes. These codes can be used to fill-in related locations of <|AUDIO_OUT|> at input sequences.
+            When batch_size > 1, it contains the list of audio codes of each sequence.
         scores (`tuple(torch.FloatTensor)` *optional*, returned when `output_scores=True`):
             Processed prediction scores of the language modeling head (scores for each vocabulary token before SoftMax)
             at each generation step. Tuple of `torch.FloatTensor` with up to `max_new_tokens` elements (one element for
             each generated token).
             If the generated token is a text token, the tensor will have shape `(batch_size, config.vocab_size)`.
-            If the generated token is an audio token, the tensor will have shape `(config.audio_num_codebooks, self.audio_codebook_size)`
+            If the generated token is an audio token, the tensor will have shape `(batch_size, config.audio_num_codebooks, self.audio_codebook_size)`
         logits (`tuple(torch.FloatTensor)` *optional*, returned when `output_logits=True`):
             Unprocessed prediction scores of the language modeling head or the audio head (scores for each vocabulary token before SoftMax)
             at each generation step. Tuple of `torch.FloatTensor` with up to `max_new_tokens` elements (one element for
             each generated token).
             If the generated token is a text token, the tensor will have shape `(batch_size, config.vocab_size)`.
-            If the generated token is an audio token, the tensor will have shape `(config.audio_num_codebooks, self.audio_codebook_size)`
+            If the generated token is an audio token, the tensor will have shape `(batch_size, config.audio_num_codebooks, self.audio_codebook_size)`
         attentions (`tuple(tuple(torch.FloatTensor))`, *optional*, returned when `output_attentions=True`):
             Tuple (one element for each generated token) of tuples (one element for each layer of the decoder) of
             `torch.FloatTensor` of shape `(batch_size, num_heads, generated_length, sequence_length)`.
@@ -780,6 +1055,15 @@ class HiggsAudioGenerationOutput(ModelOutput):
         past_key_values (`tuple(tuple(torch.FloatTensor)))`, *optional*, returned when `use_cache=True`):
             Returns the model cache, used to speed up decoding. Different models have a different cache format, check
             the model's documentation. Usually, a [`~cache_utils.Cache`] instance.
+        cache_audio_discrete_codes_mask (`torch.BoolTensor` of shape `(batch_size, num_cached_tokens)`, *optional*, returned when `use_cache=True`):
+            Whether each token in `past_key_values` is an audio discrete code. Along with `past_key_values`, it can be
+            passed back to `generate` to continue the conversation without prefilling it again.
+        audio_draft_acceptance_rate (`float`, *optional*, returned when `num_audio_draft_frames` is set):
+            The fraction of the drafted audio tokens that speculative audio decoding accepted. `None` if no draft was
+            proposed.
+        audio_tokens_per_forward (`float`, *optional*, returned when `num_audio_draft_frames` is set):
+            The average number of audio tokens generated by each forward pass that verified drafts. `None` if no draft
+            was proposed.
     """
 
     sequences: torch.LongTensor = None
@@ -789,6 +1073,9 @@ class HiggsAudioGenerationOutput(ModelOutput):
     attentions: Optional[Tuple[Tuple[torch.FloatTensor]]] = None
     hidden_states: Optional[Tuple[Tuple[torch.FloatTensor]]] = None
     past_key_values: Optional[Tuple[Tuple[Tuple[torch.FloatTensor]]]] = None
+    cache_audio_discrete_codes_mask: Optional[torch.BoolTensor] = None
+    audio_draft_acceptance_rate: Optional[float] = None
+    audio_tokens_per_forward: Optional[float] = None
 
 
 class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
@@ -827,6 +1114,10 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
 
         self.embed_tokens = nn.Embedding(self.vocab_size, config.text_config.hidden_size, self.padding_idx)
 
+        # The `LlamaDecoderLayer`s are built from the text config, but the causal mask is built for the attention
+        # implementation of the model, e.g. no mask at all for SDPA, so both must be the same.
+        config.text_config._attn_implementation = config._attn_implementation
+
         if config.audio_adapter_type == "dual_ffn":
             layer_idx = 0
             layers = []
@@ -878,6 +1169,7 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
         self.decode_graph_runners = defaultdict(dict[bool, CUDAGraphRunner])
         self.norm = LlamaRMSNorm(config.text_config.hidden_size, eps=config.text_config.rms_norm_eps)
         self.rotary_emb = LlamaRotaryEmbedding(config=config.text_config)
+        self.rotary_emb_table = RotaryEmbeddingTable(self.rotary_emb)
 
         if not config.skip_audio_tower:
             self.audio_tower = HiggsAudioEncoder(config.audio_encoder_config)
@@ -902,6 +1194,7 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
         self.audio_codebook_weights = (
             torch.ones(config.audio_num_codebooks) / config.audio_num_codebooks
         )  # default to equal weights
+        self.audio_feature_cache = None
         self.post_init()
 
     def set_num_activation_checkpointing_layers(self, num_layers):
@@ -911,6 +1204,10 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
         self.config.use_delay_pattern = True
         self.use_delay_pattern = True
 
+    def set_audio_feature_cache(self, audio_feature_cache):
+        """Set the `WhisperFeatureCache` that holds the audio tower outputs of the audio-in chunks."""
+        self.audio_feature_cache = audio_feature_cache
+
     def set_audio_special_tokens(self, tokenizer: AutoTokenizer):
         self.audio_out_bos_token_id = tokenizer.convert_tokens_to_ids("<|audio_out_bos|>")
         self.audio_eos_token_id = tokenizer.convert_tokens_to_ids("<|audio_eos|>")
@@ -927,17 +1224,23 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
         codebook_shift = (
             torch.arange(self.config.audio_num_codebooks, device=audio_ids.device) * self.audio_codebook_size
         )
-        audio_embed = self.audio_codebook_embeddings(audio_ids + codebook_shift.unsqueeze(-1))
-        if self.config.audio_embed_avg:
-            audio_embed = torch.mean(audio_embed, dim=0)
-        else:
-            audio_embed = torch.sum(audio_embed, dim=0)
+        # Each position is a bag of one code per codebook, which is reduced while gathering the embeddings instead of
+        # materializing a (num_codebooks, audio_in_total_length, hidden_size) tensor.
+        audio_embed = nn.functional.embedding_bag(
+            (audio_ids + codebook_shift.unsqueeze(-1)).t(),
+            self.audio_codebook_embeddings.weight,
+            mode="mean" if self.config.audio_embed_avg else "sum",
+        )
         if self.use_audio_out_embed_projector:
             audio_embed = self.audio_out_embed_projector(audio_embed)
         return audio_embed
 
-    def _apply_audio_tower(self, audio_features, audio_feature_attention_mask):
-        """Apply the audio tower to the audio features"""
+    def _apply_audio_tower(self, audio_features, audio_feature_attention_mask, audio_feature_cache_keys=None):
+        """Apply the audio tower to the audio features
+
+        When the model has an audio feature cache and the (content hash, chunk index) key of each audio feature is
+        given, the cached embeddings are reused and only the missing ones go through the audio tower.
+        """
 
         if audio_features.shape[0] == 0:
             if torch.is_grad_enabled():
@@ -954,6 +1257,33 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
             else:
                 return None, None
 
+        use_cache = (
+            self.audio_feature_cache is not None
+            and audio_feature_cache_keys is not None
+            and not torch.is_grad_enabled()
+        )
+        if use_cache:
+            cached = [
+                self.audio_feature_cache.get("embed", key, chunk_idx) for key, chunk_idx in audio_feature_cache_keys
+            ]
+            missing = [i for i, value in enumerate(cached) if value is None]
+            if len(missing) > 0:
+                missing_idx = torch.tensor(missing, dtype=torch.long, device=audio_features.device)
+                missing_embed, missing_lengths = self._encode_audio_features(
+                    audio_features[missing_idx], audio_feature_attention_mask[missing_idx]
+                )
+                for row, i in enumerate(missing):
+                    # Copy the rows, so that the cache does not hold on to the embeddings of the whole batch
+                    cached[i] = (missing_embed[row].clone(), missing_lengths[row].clone())
+                    self.audio_feature_cache.put("embed", *audio_feature_cache_keys[i], cached[i])
+            audio_features_embed = torch.stack([embed for embed, _ in cached])
+            audio_feat_out_lengths = torch.stack([length for _, length in cached])
+            return audio_features_embed, audio_feat_out_lengths
+
+        return self._encode_audio_features(audio_features, audio_feature_attention_mask)
+
+    def _encode_audio_features(self, audio_features, audio_feature_attention_mask):
+        """Encode a non-empty batch of audio features with the audio tower and the projector"""
         audio_feat_lengths, audio_feat_out_lengths = self.audio_tower._get_feat_extract_output_lengths(
             audio_feature_attention_mask.sum(-1)
         )
@@ -1048,6 +1378,19 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
 
         return causal_mask
 
+    @staticmethod
+    def _is_decoding_audio_token(
+        is_single_audio_token: Optional[bool], audio_discrete_codes_mask: torch.BoolTensor
+    ) -> Optional[bool]:
+        """Whether all the decoded tokens, given their audio discrete codes mask of shape (batch_size, 1), are audio
+        tokens, or all are text tokens. Returns `None` if a batch decodes both, in which case the decoder layers pick
+        the audio or text path of each token."""
+        if is_single_audio_token is not None:
+            return is_single_audio_token
+        if audio_discrete_codes_mask.shape[0] == 1:
+            return audio_discrete_codes_mask.item()
+        return None
+
     def _prepare_all_static_kv_cache_masks(self, hidden_states, attention_mask, audio_out_mask, past_key_values):
         target_length = hidden_states.shape[1]
         cur_pos = audio_out_mask.shape[1]
@@ -1075,6 +1418,33 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
         audio_attention_mask = attention_mask.masked_fill(no_audio_out_mask, min_dtype)
         return fast_forward_attention_mask, audio_attention_mask
 
+    def _get_position_embeddings(
+        self,
+        hidden_states: torch.Tensor,
+        position_ids: torch.Tensor,
+        cache_position: torch.Tensor,
+        past_key_values: Optional[Union[Cache, List[torch.FloatTensor]]],
+        use_cache: bool,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns the cos and sin of the rotary embeddings of the input tokens, gathered from `rotary_emb_table`."""
+        # When past_key_values is passed in, we need to offset the position ids when calculating the position embeddings.
+        # Therefore, cache_position is used.
+        position_id_offset = cache_position[0] if use_cache else 0
+        if "dynamic" in self.rotary_emb.rope_type:
+            # The frequencies depend on the sequence length, so they cannot be tabulated.
+            return self.rotary_emb(hidden_states, position_ids + position_id_offset)
+
+        # The positions are bounded by the length of the KV cache, which is known on the host.
+        max_length = hidden_states.shape[1]
+        if use_cache and isinstance(past_key_values, Cache):
+            max_cache_len = past_key_values.get_max_cache_shape()
+            if max_cache_len is None:
+                max_length += past_key_values.get_seq_length()
+            else:
+                max_length = max(max_length, max_cache_len)
+        self.rotary_emb_table.reserve(max_length, hidden_states)
+        return self.rotary_emb_table.get(position_ids + position_id_offset)
+
     def _forward_core(
         self,
         hidden_states: torch.Tensor,
@@ -1090,12 +1460,26 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
         output_hidden_states: bool,
         is_decoding_audio_token: Optional[bool] = None,
         is_using_cuda_graph: Optional[bool] = False,
+        max_num_text_tokens: Optional[int] = None,
     ):
         # create position embeddings to be shared across the decoder layers
-        # When past_key_values is passed in, we need to offset the position ids when calculating the position embeddings.
-        # Therefore, cache_position is used.
-        position_id_offset = cache_position[0] if use_cache else 0
-        position_embeddings = self.rotary_emb(hidden_states, position_ids + position_id_offset)
+        position_embeddings = self._get_position_embeddings(
+            hidden_states, position_ids, cache_position, past_key_values, use_cache
+        )
+
+        # When several tokens are fed, e.g. in the prefill, the fast-forward layers only process the text tokens.
+        text_positions = None
+        if (
+            hidden_states.shape[1] > 1
+            and self.config.audio_adapter_type == "dual_ffn_fast_forward"
+            and audio_discrete_codes_mask.shape[0] > 0
+            and self.config._attn_implementation != "flash_attention_2"
+            and not output_attentions
+            and max_num_text_tokens is not None
+        ):
+            text_positions = _get_text_positions(
+                audio_discrete_codes_mask[:, -hidden_states.shape[1] :], max_num_text_tokens
+            )
 
         # decoder layers
         all_hidden_states = () if output_hidden_states else None
@@ -1119,6 +1503,7 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
                     cache_position=cache_position,
                     position_embeddings=position_embeddings,
                     is_using_cuda_graph=is_using_cuda_graph,
+                    text_positions=text_positions,
                 )
             else:
                 layer_outputs = decoder_layer(
@@ -1162,7 +1547,12 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
         cache_position: Optional[torch.LongTensor] = None,
         cache_audio_discrete_codes_mask: Optional[torch.LongTensor] = None,
         past_key_values_buckets: Optional[OrderedDict[int, Cache]] = None,
+        num_cached_tokens: Optional[int] = None,
+        static_kv_cache_masks: Optional[StaticKVCacheMasks] = None,
+        is_decoding_audio_token: Optional[bool] = None,
+        num_logits_to_keep: int = 0,
         reward: Optional[torch.FloatTensor] = None,
+        audio_feature_cache_keys: Optional[List[Tuple[str, int]]] = None,
     ):
         """Forward pass for the Higgs-Audio model.
 
@@ -1211,6 +1601,24 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
                 The cached audio discrete codes mask. It will only be used when use_cache is turned on.
             past_key_values_buckets (:obj:`OrderedDict`):
                 The buckets of past key values.
+            num_cached_tokens (:obj:`int`):
+                The number of leading tokens of the merged prompt whose key values are already in `past_key_values`,
+                e.g. restored from a prefix cache. Only the remaining tokens are fed to the decoder layers, and
+                `cache_audio_discrete_codes_mask` should cover the cached tokens.
+            static_kv_cache_masks (:obj:`StaticKVCacheMasks`):
+                The attention masks of the previous token when decoding with a static KV cache. If given, they are
+                updated with the column of the new token instead of being rebuilt over the whole cache.
+            is_decoding_audio_token (:obj:`bool`):
+                Whether the single new token is an audio token, when it is known on the host, e.g. by the generation
+                loop. When decoding with a static KV cache, it is otherwise read from the device. When it is known,
+                only the logits of this type of token are computed, and the text logits are `None` for audio tokens.
+            num_logits_to_keep (:obj:`int`):
+                Calculate the text and audio logits for the last `num_logits_to_keep` positions only. If `0`,
+                calculate the logits for all the positions. `generate()` sets it to 1, so that the prefill never
+                materializes the logits of the whole prompt.
+            audio_feature_cache_keys (:obj:`List[Tuple[str, int]]`):
+                The (content hash, chunk index) of each audio feature, as returned by the collator. If given, the
+                audio tower outputs are read from and added to the audio feature cache of the model.
         """
         target_device = input_ids.device
 
@@ -1229,7 +1637,7 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
             audio_features_embed = audio_features_length = None
         else:
             audio_features_embed, audio_features_length = self._apply_audio_tower(
-                audio_features, audio_feature_attention_mask
+                audio_features, audio_feature_attention_mask, audio_feature_cache_keys
             )
 
         if self.config.encode_audio_in_tokens:
@@ -1249,84 +1657,179 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
 
         # 3. Merge text, audio-in embeddings, and audio-out embeddings
 
+        # During incremental decoding, the attention mask covers all the cached tokens while input_ids only contains
+        # the new tokens. We merge the trailing part and re-attach the cached part afterwards, so that left-padded
+        # sequences in a batch get the correct position ids.
+        past_attention_mask = None
+        if use_cache and attention_mask is not None and attention_mask.shape[1] > input_ids.shape[1]:
+            past_attention_mask = attention_mask[:, : -input_ids.shape[1]]
+            attention_mask = attention_mask[:, -input_ids.shape[1] :]
+
         # use_cache is turned on during inference time, we should set round_to to 1 to avoid extra padding in the end.
         round_to = 1 if use_cache else 8
         left_padding = True if use_cache or input_ids.shape[0] == 1 else False
-        (
-            inputs_embeds,
-            attention_mask,
-            labels,
-            position_ids,
-            input_ids,
-            audio_in_mask,
-            audio_in_discrete_codes_mask,
-            audio_out_mask,
-        ) = merge_input_ids_with_audio_features(
-            audio_features_embed,
-            audio_features_length,
-            audio_in_embed,
-            audio_in_ids_start,
-            audio_out_embed,
-            audio_out_ids_start,
-            self.audio_in_token_idx,
-            self.audio_out_token_idx,
-            inputs_embeds,
-            input_ids,
-            attention_mask,
-            label_ids,
-            pad_token_id=self.padding_idx,
-            round_to=round_to,
-            left_padding=left_padding,
-        )
+        # Whether the single new token of every sequence is an audio token, when it is known on the host.
+        is_single_audio_token = None
+        if (
+            use_cache
+            and input_ids.shape[1] == 1
+            and attention_mask is not None
+            and label_ids is None
+            and (audio_features_embed is None or audio_features_embed.shape[0] == 0)
+            and (audio_in_embed is None or audio_in_embed.shape[0] == 0)
+            and audio_out_embed.shape[0] in (0, input_ids.shape[0])
+        ):
+            # When decoding one token per sequence, either all the tokens are text tokens, or all the tokens are
+            # <|AUDIO_OUT|> tokens that are each replaced by one audio-out embedding. The merge would not change the
+            # length of the sequences, so it is skipped.
+            is_single_audio_token = audio_out_embed.shape[0] > 0
+            if is_single_audio_token:
+                inputs_embeds = audio_out_embed.view(input_ids.shape[0], 1, -1).to(inputs_embeds.dtype)
+                attention_mask = torch.ones_like(attention_mask)
+            labels = None
+            position_ids = (attention_mask.cumsum(-1) - 1).masked_fill_((attention_mask == 0), 1)
+            audio_out_mask = torch.full_like(input_ids, is_single_audio_token, dtype=torch.bool)
+            audio_in_mask = torch.zeros_like(audio_out_mask)
+            audio_in_discrete_codes_mask = torch.zeros_like(audio_out_mask)
+            max_num_text_tokens = None
+        else:
+            (
+                inputs_embeds,
+                attention_mask,
+                labels,
+                position_ids,
+                input_ids,
+                audio_in_mask,
+                audio_in_discrete_codes_mask,
+                audio_out_mask,
+                max_num_text_tokens,
+            ) = merge_input_ids_with_audio_features(
+                audio_features_embed,
+                audio_features_length,
+                audio_in_embed,
+                audio_in_ids_start,
+                audio_out_embed,
+                audio_out_ids_start,
+                self.audio_in_token_idx,
+                self.audio_out_token_idx,
+                inputs_embeds,
+                input_ids,
+                attention_mask,
+                label_ids,
+                pad_token_id=self.padding_idx,
+                round_to=round_to,
+                left_padding=left_padding,
+            )
+
+        if num_cached_tokens:
+            # The cached prefix only contributes to the attention mask and the position ids.
+            past_attention_mask = attention_mask[:, :num_cached_tokens]
+            attention_mask = attention_mask[:, num_cached_tokens:]
+            inputs_embeds = inputs_embeds[:, num_cached_tokens:]
+            input_ids = input_ids[:, num_cached_tokens:]
+            audio_in_mask = audio_in_mask[:, num_cached_tokens:]
+            audio_in_discrete_codes_mask = audio_in_discrete_codes_mask[:, num_cached_tokens:]
+            audio_out_mask = audio_out_mask[:, num_cached_tokens:]
+            if max_num_text_tokens is not None:
+                max_num_text_tokens = min(max_num_text_tokens, inputs_embeds.shape[1])
+            if labels is not None:
+                labels = labels[:, num_cached_tokens:]
 
         # re-check if we use the correct kv cache bucket after
         # the input_embeds has been merged with audio features
-        if past_key_values_buckets is not None and inputs_embeds.shape[1] > past_key_values.get_max_cache_shape():
+        num_tokens = (num_cached_tokens or 0) + inputs_embeds.shape[1]
+        if past_key_values_buckets is not None and num_tokens > past_key_values.get_max_cache_shape():
+            # The cached tokens are copied to the new bucket.
+            current_bucket = getattr(self, "current_past_key_values_bucket", None) if num_cached_tokens else None
             past_key_values, self.current_past_key_values_bucket = self._prepare_kv_cache(
-                inputs_embeds.shape[1], None, past_key_values_buckets
+                num_tokens, current_bucket, past_key_values_buckets
             )
 
         if use_cache and past_key_values is None:
             past_key_values = DynamicCache()
 
+        # Whether the static cache masks of the previous token can be updated, instead of being built from scratch.
+        update_static_kv_cache_masks = False
         if cache_position is None:
-            past_seen_tokens = past_key_values.get_seq_length() if past_key_values is not None else 0
+            if past_attention_mask is not None:
+                # The attention mask is aligned with the KV cache. Unlike `get_seq_length()`, this does not depend on
+                # the first layer being updated, which is not the case when it is a skipped fast-forward layer.
+                past_seen_tokens = past_attention_mask.shape[1]
+            else:
+                past_seen_tokens = past_key_values.get_seq_length() if past_key_values is not None else 0
             cache_position = torch.arange(
                 past_seen_tokens, past_seen_tokens + inputs_embeds.shape[1], device=inputs_embeds.device
             )
+            if isinstance(past_key_values, PagedKVCache):
+                # Allocate the blocks of the new tokens, the cached keys and values are not moved.
+                past_key_values.reserve(int(past_seen_tokens) + inputs_embeds.shape[1])
             if isinstance(past_key_values, StaticCache) and past_seen_tokens >= past_key_values.get_max_cache_shape():
                 raise ValueError(
                     f"The current sequence length ({past_seen_tokens}) exceeds "
                     f"the maximum cache shape. "
                     f"Please consider increasing the cache size."
                 )
+            update_static_kv_cache_masks = (
+                static_kv_cache_masks is not None
+                and isinstance(past_key_values, StaticCache)
+                and past_attention_mask is not None
+                and inputs_embeds.shape[1] == 1
+                and self.config._attn_implementation != "flash_attention_2"
+                and static_kv_cache_masks.can_update(
+                    past_attention_mask.shape[1],
+                    inputs_embeds.shape[0],
+                    past_key_values.get_max_cache_shape(),
+                    inputs_embeds.dtype,
+                )
+            )
+
+        if past_attention_mask is not None:
+            attention_mask = torch.cat([past_attention_mask, attention_mask], dim=1)
+            # `_forward_core` offsets the position ids by `cache_position[0]`, so we keep them relative to it.
+            position_ids = (attention_mask.cumsum(-1) - 1)[:, -inputs_embeds.shape[1] :] - cache_position[0]
 
         # Use torch compile
         use_static_cache = isinstance(past_key_values, StaticCache)
 
-        # Apply the LLM component
-        causal_mask = self._update_causal_mask(
-            attention_mask, inputs_embeds, cache_position, past_key_values, output_attentions
-        )
-
         hidden_states = inputs_embeds
 
         audio_discrete_codes_mask = audio_in_discrete_codes_mask | audio_out_mask
-        if cache_audio_discrete_codes_mask is not None and use_cache:
-            audio_discrete_codes_mask = torch.concat(
-                [cache_audio_discrete_codes_mask, audio_discrete_codes_mask], dim=1
+
+        if update_static_kv_cache_masks:
+            # Only the column of the new token changes, so the masks over the whole cache are not rebuilt.
+            static_kv_cache_masks.update(attention_mask[:, -1:], audio_discrete_codes_mask)
+            if is_decoding_audio_token is None:
+                is_decoding_audio_token = self._is_decoding_audio_token(
+                    is_single_audio_token, audio_discrete_codes_mask
+                )
+            causal_mask, fast_forward_attention_mask, audio_attention_mask = static_kv_cache_masks.get(
+                is_decoding_audio_token
             )
+        else:
+            # Apply the LLM component
+            causal_mask = self._update_causal_mask(
+                attention_mask, inputs_embeds, cache_position, past_key_values, output_attentions
+            )
+            if cache_audio_discrete_codes_mask is not None and use_cache:
+                audio_discrete_codes_mask = torch.concat(
+                    [cache_audio_discrete_codes_mask, audio_discrete_codes_mask], dim=1
+                )
 
         # Generate the audio attention mask outside the layer to avoid recompilation
-        if use_static_cache:
+        if use_static_cache and not update_static_kv_cache_masks:
             fast_forward_attention_mask, audio_attention_mask = self._prepare_all_static_kv_cache_masks(
                 hidden_states, causal_mask, audio_discrete_codes_mask, past_key_values
             )
+            if static_kv_cache_masks is not None:
+                static_kv_cache_masks.init(causal_mask, audio_discrete_codes_mask)
             # Set the audio out mask to the last token
             if hidden_states.shape[1] == 1:
                 audio_discrete_codes_mask = audio_discrete_codes_mask[:, -1:]
                 audio_discrete_codes_mask = audio_discrete_codes_mask.reshape((-1, 1)).contiguous()
-                is_decoding_audio_token = audio_discrete_codes_mask.item()
+                if is_decoding_audio_token is None:
+                    is_decoding_audio_token = self._is_decoding_audio_token(
+                        is_single_audio_token, audio_discrete_codes_mask
+                    )
             else:
                 is_decoding_audio_token = False
 
@@ -1336,6 +1839,8 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
             past_key_values is not None
             and past_key_values.get_max_cache_shape() in self.decode_graph_runners
             and (input_ids.shape[-1] == 1)
+            and is_decoding_audio_token is not None
+            and (not isinstance(past_key_values, PagedKVCache) or past_key_values.is_contiguous)
         ):
             _forward_core = self.decode_graph_runners[past_key_values.get_max_cache_shape()][is_decoding_audio_token]
             is_using_cuda_graph = True
@@ -1357,6 +1862,7 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             is_using_cuda_graph=is_using_cuda_graph,
+            max_num_text_tokens=max_num_text_tokens,
         )
         hidden_states = self.norm(hidden_states)
 
@@ -1364,6 +1870,13 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
         if output_hidden_states:
             all_hidden_states += (hidden_states,)
 
+        # The transformer layers of the audio decoder projector share the position embeddings of the LLM component.
+        position_embeddings = None
+        if self.config.audio_decoder_proj_num_layers > 0:
+            position_embeddings = self._get_position_embeddings(
+                hidden_states, position_ids, cache_position, past_key_values, use_cache
+            )
+
         # Apply the audio decoder projector
         logits, audio_logits, decoder_all_self_attns, decoder_all_hidden_states, audio_hidden_states, _ = (
             self.audio_decoder_proj(
@@ -1372,11 +1885,14 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
                 label_audio_ids=label_audio_ids,
                 attention_mask=causal_mask,
                 position_ids=position_ids,
+                position_embeddings=position_embeddings,
                 past_key_values=past_key_values,
                 use_cache=use_cache,
                 output_attentions=output_attentions,
                 output_audio_hidden_states=output_audio_hidden_states,
                 cache_position=cache_position,
+                is_decoding_audio_token=is_decoding_audio_token if inputs_embeds.shape[1] == 1 else None,
+                num_logits_to_keep=num_logits_to_keep,
             )
         )
 
@@ -1424,29 +1940,56 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
         is_encoder_decoder: bool = False,
         num_new_tokens: int = 1,
         extend_attention_mask: bool = True,
+        buffers: Optional[Dict[str, GrowableTensor]] = None,
     ) -> Dict[str, Any]:
-        """Update the model kwargs for each step."""
+        """Update the model kwargs for each step.
+
+        If `buffers` is given, the attention mask and the cached audio discrete codes mask are kept in growable buffers
+        instead of being concatenated at every step. `num_new_tokens` is then the number of input ids that were fed
+        to the model at this step, after the tokens in the KV cache.
+        """
         model_kwargs["past_key_values"] = outputs.past_key_values
 
         # update attention mask
         if "attention_mask" in model_kwargs:
-            attention_mask = model_kwargs["attention_mask"]
-            if extend_attention_mask:
-                model_kwargs["attention_mask"] = torch.cat(
-                    [attention_mask, attention_mask.new_ones((attention_mask.shape[0], 1))], dim=-1
-                )
+            # The attention mask returned by forward is merged with the audio features, so it is aligned with the KV cache.
+            attention_mask = outputs.attention_mask
+            if buffers is not None:
+                if "attention_mask" not in buffers:
+                    buffers["attention_mask"] = GrowableTensor(attention_mask)
+                else:
+                    # Only the mask of the new tokens has been merged, the mask of the cached tokens is unchanged.
+                    attention_mask_buffer = buffers["attention_mask"]
+                    num_cached_tokens = len(attention_mask_buffer) - num_new_tokens
+                    attention_mask_buffer.truncate(num_cached_tokens)
+                    attention_mask_buffer.append(attention_mask[:, num_cached_tokens:])
+                attention_mask = buffers["attention_mask"].tensor
+                if extend_attention_mask:
+                    attention_mask = buffers["attention_mask"].append(
+                        attention_mask.new_ones((attention_mask.shape[0], 1))
+                    )
+                model_kwargs["attention_mask"] = attention_mask
+            else:
+                model_kwargs["attention_mask"] = attention_mask
+                if extend_attention_mask:
+                    model_kwargs["attention_mask"] = torch.cat(
+                        [attention_mask, attention_mask.new_ones((attention_mask.shape[0], 1))], dim=-1
+                    )
         if "cache_audio_discrete_codes_mask" in model_kwargs:
+            audio_discrete_codes_mask = outputs.audio_in_discrete_codes_mask | outputs.audio_out_mask
             if model_kwargs["cache_audio_discrete_codes_mask"] is None:
-                model_kwargs["cache_audio_discrete_codes_mask"] = (
-                    outputs.audio_in_discrete_codes_mask | outputs.audio_out_mask
+                model_kwargs["cache_audio_discrete_codes_mask"] = audio_discrete_codes_mask
+            elif buffers is not None:
+                if "cache_audio_discrete_codes_mask" not in buffers:
+                    buffers["cache_audio_discrete_codes_mask"] = GrowableTensor(
+                        model_kwargs["cache_audio_discrete_codes_mask"]
+                    )
+                model_kwargs["cache_audio_discrete_codes_mask"] = buffers["cache_audio_discrete_codes_mask"].append(
+                    audio_discrete_codes_mask
                 )
             else:
                 model_kwargs["cache_audio_discrete_codes_mask"] = torch.concat(
-                    [
-                        model_kwargs["cache_audio_discrete_codes_mask"],
-                        outputs.audio_in_discrete_codes_mask | outputs.audio_out_mask,
-                    ],
-                    1,
+                    [model_kwargs["cache_audio_discrete_codes_mask"], audio_discrete_codes_mask], 1
                 )
 
         return model_kwargs
@@ -1472,6 +2015,9 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
     ) -> Tuple[Optional[Cache], Optional[int]]:
         """Prepare the KV cache for the current sequence length."""
         for cache_length in past_key_values_buckets.keys():
+            # Never move to a smaller bucket, which would drop the cached tokens.
+            if current_past_key_values_bucket is not None and cache_length < current_past_key_values_bucket:
+                continue
             if cache_length >= current_sequence_length:
                 # Promote to the next KV cache bucket, copy the current KV cache bucket
                 # to the new one.
@@ -1497,73 +2043,129 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
         device: torch.device,
         torch_generator: Optional[torch.Generator],
         generation_config: GenerationConfig,
-        num_delay: int,
-        num_remaining_delays: Optional[int],
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, int, Optional[int]]:
-        """Sample audio tokens and its corresponding text tokens from the logits"""
+        num_delay: torch.LongTensor,
+        num_remaining_delays: torch.LongTensor,
+        audio_sampler: Optional[FusedAudioSampler] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.LongTensor, torch.LongTensor]:
+        """Sample audio tokens and its corresponding text tokens from the logits
+
+        Args:
+            audio_logits (`torch.Tensor` of shape `(batch_size, num_codebooks, codebook_size)`):
+                The audio logits of the last position of each sequence.
+            audio_out_ids (`torch.LongTensor` of shape `(batch_size, num_codebooks, num_previous_tokens)`):
+                The most recent audio tokens of each sequence, in any order, used by repetition aware sampling.
+                Negative values are treated as padding.
+            num_delay (`torch.LongTensor` of shape `(batch_size,)`):
+                The number of codebooks that have been started in the delay pattern.
+            num_remaining_delays (`torch.LongTensor` of shape `(batch_size,)`):
+                The number of steps left before all the codebooks reach the audio stream eos. -1 means that no
+                codebook has reached the eos yet.
+            audio_sampler (`FusedAudioSampler`, *optional*):
+                The sampler equivalent to `logits_processor`. If set, it replaces `logits_processor`. The returned
+                scores are then overwritten by the next call.
+        """
 
         # parameters related to repetition aware sampling
         ras_win_len = generation_config.generation_kwargs.get("ras_win_len", None)
         ras_win_max_num_repeat = generation_config.generation_kwargs.get("ras_win_max_num_repeat", 2)
         audio_eos_token_id = generation_config.generation_kwargs.get("audio_eos_token_id", None)
+        batch_size, num_codebooks, codebook_size = audio_logits.shape
         # In the audio generation mode, we sample from audio_logits and keep updating audio_out_ids.
-        next_audio_token_logits = audio_logits.clone()[-1, :, :].float().to(device)
-        # TopP, TopK logits processor supports empty input_ids
-        next_audio_token_scores = logits_processor(None, next_audio_token_logits)
+        next_audio_token_logits = audio_logits.clone().float().to(device).view(-1, codebook_size)
+        if audio_sampler is not None:
+            next_audio_token_scores = audio_sampler.process(next_audio_token_logits)
+        else:
+            # TopP, TopK logits processor supports empty input_ids
+            next_audio_token_scores = logits_processor(None, next_audio_token_logits)
 
         # token selection
-        if do_sample:
+        # With repetition aware sampling, the tokens sampled without temperature are drawn for all the rows along with
+        # the regular ones, so that the repeated rows are replaced without selecting them on the host.
+        ras_logits = next_audio_token_logits if ras_win_len is not None else None
+        ras_probs = (
+            nn.functional.softmax(ras_logits, dim=-1) if ras_logits is not None and audio_sampler is None else None
+        )
+        if audio_sampler is not None:
+            if do_sample:
+                next_audio_tokens, ras_next_tokens = audio_sampler.sample(
+                    next_audio_token_scores, torch_generator, fallback_logits=ras_logits
+                )
+            else:
+                next_audio_tokens = torch.argmax(next_audio_token_scores, dim=-1)
+                if ras_logits is not None:
+                    ras_next_tokens, _ = audio_sampler.sample(ras_logits, torch_generator)
+        elif do_sample:
             # next_audio_token_scores has been applied top_p, top_k, and temperature.
             probs = nn.functional.softmax(next_audio_token_scores, dim=-1)
+            if ras_probs is not None:
+                probs = torch.cat([probs, ras_probs], dim=0)
             # TODO (joao): this OP throws "skipping cudagraphs due to ['incompatible ops']", find solution
             next_audio_tokens = torch.multinomial(probs, num_samples=1, generator=torch_generator).squeeze(1)
+            if ras_probs is not None:
+                next_audio_tokens, ras_next_tokens = next_audio_tokens.split(batch_size * num_codebooks)
         else:
             next_audio_tokens = torch.argmax(next_audio_token_scores, dim=-1)
+            if ras_probs is not None:
+                ras_next_tokens = torch.multinomial(ras_probs, num_samples=1, generator=torch_generator).squeeze(1)
 
-        # next_tokens: (num_codebooks, )
+        # next_audio_tokens: (batch_size * num_codebooks, )
         if ras_win_len is not None:
             # check if there are repetitions over a window of tokens.
-            rep_num = (audio_out_ids[:, -ras_win_len:] == next_audio_tokens.unsqueeze(1)).sum(dim=1)
+            rep_num = (audio_out_ids[:, :, -ras_win_len:] == next_audio_tokens.view(batch_size, num_codebooks, 1)).sum(
+                dim=-1
+            )
 
             # if we saw repeated tokens in the most recent window of tokens, resample without temperature.
-            row_indices = torch.nonzero(rep_num >= ras_win_max_num_repeat).squeeze(1)
-            resampled_next_tokens = (
-                next_audio_token_logits[row_indices]
-                .softmax(dim=-1)
-                .multinomial(1, replacement=True, generator=torch_generator)
-                .squeeze(1)
+            next_audio_tokens = torch.where(
+                rep_num.view(-1) >= ras_win_max_num_repeat, ras_next_tokens, next_audio_tokens
             )
-            next_audio_tokens[row_indices] = resampled_next_tokens
+
+        next_audio_tokens = next_audio_tokens.view(batch_size, num_codebooks)
+        next_audio_token_logits = next_audio_token_logits.view(batch_size, num_codebooks, codebook_size)
+        next_audio_token_scores = next_audio_token_scores.view(batch_size, num_codebooks, codebook_size)
 
         # Force the next text tokens to be <|AUDIO_OUT|> in audio generation mode
         next_tokens = torch.full(
-            (audio_logits.shape[0],),
+            (batch_size,),
             self.config.audio_out_token_idx,
             dtype=torch.long,
             device=device,
         )
 
-        # Handle delay_pattern
+        # Handle delay_pattern. The counters are tracked per sequence, so we use masks instead of branches.
         if self.use_delay_pattern:
-            if num_delay + 1 < next_audio_tokens.shape[0]:
-                next_audio_tokens[(num_delay + 1) :] = self.config.audio_stream_bos_id
-                num_delay += 1
-            if num_remaining_delays is not None:
-                next_audio_tokens[: (self.audio_num_codebooks - num_remaining_delays)] = (
-                    self.config.audio_stream_eos_id
-                )
-                num_remaining_delays -= 1
-            else:
-                all_eos_indices = (next_audio_tokens == self.config.audio_stream_eos_id).nonzero()
-                if torch.numel(all_eos_indices) > 0:
-                    all_eos_indices = all_eos_indices[0]
-                    last_eos_idx = all_eos_indices[-1]
-                    next_audio_tokens[:last_eos_idx] = self.config.audio_stream_eos_id
-                    num_remaining_delays = self.audio_num_codebooks - last_eos_idx - 1
-            if num_remaining_delays is not None and num_remaining_delays <= 0:
-                next_tokens[...] = audio_eos_token_id
-                num_delay = 0
-                num_remaining_delays = None
+            codebook_idx = torch.arange(num_codebooks, device=device)
+            # Start one more codebook at each step until all the codebooks have been started.
+            is_delaying = num_delay + 1 < num_codebooks
+            next_audio_tokens = next_audio_tokens.masked_fill(
+                is_delaying[:, None] & (codebook_idx[None, :] > num_delay[:, None]),
+                self.config.audio_stream_bos_id,
+            )
+            num_delay = num_delay + is_delaying.long()
+
+            # Once a codebook reaches the eos, we end the codebooks one after another.
+            is_ending = num_remaining_delays >= 0
+            eos_mask = next_audio_tokens == self.config.audio_stream_eos_id
+            first_eos_idx = eos_mask.long().argmax(dim=-1)
+            starts_ending = ~is_ending & eos_mask.any(dim=-1)
+            num_eos_codebooks = torch.where(
+                is_ending,
+                num_codebooks - num_remaining_delays,
+                torch.where(starts_ending, first_eos_idx, 0),
+            )
+            next_audio_tokens = next_audio_tokens.masked_fill(
+                codebook_idx[None, :] < num_eos_codebooks[:, None], self.config.audio_stream_eos_id
+            )
+            num_remaining_delays = torch.where(
+                is_ending,
+                num_remaining_delays - 1,
+                torch.where(starts_ending, num_codebooks - first_eos_idx - 1, num_remaining_delays),
+            )
+
+            is_finished = num_remaining_delays == 0
+            next_tokens = next_tokens.masked_fill(is_finished, audio_eos_token_id)
+            num_delay = num_delay.masked_fill(is_finished, 0)
+            num_remaining_delays = num_remaining_delays.masked_fill(is_finished, -1)
 
         return (
             next_tokens,
@@ -1574,6 +2176,124 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
             num_remaining_delays,
         )
 
+    def _verify_audio_drafts(
+        self,
+        audio_logits: torch.Tensor,
+        draft_audio_tokens: torch.LongTensor,
+        ras_window: torch.LongTensor,
+        ras_window_pos: torch.LongTensor,
+        do_sample: bool,
+        logits_processor: LogitsProcessorList,
+        device: torch.device,
+        torch_generator: Optional[torch.Generator],
+        generation_config: GenerationConfig,
+        num_delay: torch.LongTensor,
+        num_remaining_delays: torch.LongTensor,
+        audio_sampler: Optional[FusedAudioSampler] = None,
+    ) -> Tuple[
+        int,
+        List[List[int]],
+        torch.Tensor,
+        torch.Tensor,
+        Tuple[torch.Tensor, ...],
+        Tuple[torch.Tensor, ...],
+        torch.LongTensor,
+        torch.LongTensor,
+        torch.LongTensor,
+        torch.LongTensor,
+    ]:
+        """Samples the audio tokens of a speculative step of a single sequence and accepts the matching drafts.
+
+        The current audio tokens and the `k` drafts were fed at once, so position `i` of the logits predicts the
+        audio tokens that follow the first `i` drafts. The tokens of each position are sampled like in a regular step,
+        from the repetition aware sampling window and delay pattern states that follow the previous drafts. Draft
+        `i + 1` is accepted if it equals the tokens sampled at position `i` and the audio goes on, so the sampling
+        stops at the first mismatch. Since the drafts are deterministic, the accepted tokens follow exactly the
+        distribution of regular decoding, including the tokens forced by the delay pattern.
+
+        Args:
+            audio_logits (`torch.Tensor` of shape `(k + 1, num_codebooks, codebook_size)`):
+                The audio logits of the current audio tokens and of the drafts.
+            draft_audio_tokens (`torch.LongTensor` of shape `(k, num_codebooks)`):
+                The drafts.
+            ras_window (`torch.LongTensor` of shape `(1, num_codebooks, ras_win_len)`):
+                The repetition aware sampling ring buffer, which is not modified.
+
+        Returns:
+            The number of accepted drafts `a`, the `a + 1` audio tokens emitted on the host, the emitted text tokens of
+            shape `(1, a + 1)` and audio tokens of shape `(1, a + 1, num_codebooks)`, the audio logits and scores of
+            each emitted step, and the states that follow the emitted tokens: `ras_window`, `ras_window_pos`,
+            `num_delay` and `num_remaining_delays`.
+        """
+        ras_win_len = generation_config.generation_kwargs.get("ras_win_len", None)
+        batch_idx = torch.arange(1, device=device)
+        steps = []
+        for position in range(audio_logits.shape[0]):
+            (
+                next_tokens,
+                next_audio_tokens,
+                next_audio_token_logits,
+                next_audio_token_scores,
+                num_delay,
+                num_remaining_delays,
+            ) = self._sample_audio_tokens(
+                hidden_states=None,
+                audio_logits=audio_logits[position : position + 1],
+                audio_out_ids=ras_window,
+                do_sample=do_sample,
+                logits_processor=logits_processor,
+                device=device,
+                torch_generator=torch_generator,
+                generation_config=generation_config,
+                num_delay=num_delay,
+                num_remaining_delays=num_remaining_delays,
+                audio_sampler=audio_sampler,
+            )
+            if ras_win_len is not None:
+                ras_window = ras_window.clone()
+                ras_window[batch_idx, :, ras_window_pos] = next_audio_tokens
+                ras_window_pos = (ras_window_pos + 1) % ras_win_len
+            if audio_sampler is not None:
+                # The scores of the fused sampler are overwritten by the next call.
+                next_audio_token_scores = next_audio_token_scores.clone()
+            steps.append(
+                (
+                    next_tokens,
+                    next_audio_tokens,
+                    next_audio_token_logits,
+                    next_audio_token_scores,
+                    ras_window,
+                    ras_window_pos,
+                    num_delay,
+                    num_remaining_delays,
+                )
+            )
+
+        next_tokens = torch.stack([step[0] for step in steps], dim=1)
+        next_audio_tokens = torch.stack([step[1] for step in steps], dim=1)
+        is_accepted = (next_audio_tokens[0, :-1] == draft_audio_tokens).all(dim=-1) & (
+            next_tokens[0, :-1] == self.audio_out_token_idx
+        )
+        # The number of accepted drafts and all the sampled audio tokens are read at once.
+        num_accepted, *sampled_audio_tokens = torch.cat(
+            [is_accepted.long().cumprod(dim=0).sum()[None], next_audio_tokens.flatten()]
+        ).tolist()
+        num_emitted = num_accepted + 1
+        num_codebooks = next_audio_tokens.shape[-1]
+        emitted_audio_tokens = [
+            sampled_audio_tokens[i * num_codebooks : (i + 1) * num_codebooks] for i in range(num_emitted)
+        ]
+        emitted_steps = steps[:num_emitted]
+        return (
+            num_accepted,
+            emitted_audio_tokens,
+            next_tokens[:, :num_emitted],
+            next_audio_tokens[:, :num_emitted],
+            tuple(step[2] for step in emitted_steps),
+            tuple(step[3] for step in emitted_steps),
+            *emitted_steps[-1][4:],
+        )
+
     def _sample_text_tokens(
         self,
         logits: torch.Tensor,
@@ -1587,7 +2307,7 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
         """Sample text tokens from the logits"""
         # Clone is needed to avoid keeping a hanging ref to outputs.logits which may be very large for first iteration
         # (the clone itself is always small)
-        next_token_logits = logits.clone()[:, -1, :].float()
+        next_token_logits = logits[:, -1, :].clone().float()
         next_token_logits = next_token_logits.to(input_ids.device)
 
         # pre-process distribution
@@ -1619,6 +2339,12 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
 
         return next_tokens, next_audio_tokens, next_token_logits, next_token_scores
 
+    def _get_generation_stages(self, is_audio_init: torch.Tensor, is_audio_generation: torch.Tensor) -> torch.Tensor:
+        """Returns whether any sequence is respectively starting the audio, generating audio and generating text."""
+        return torch.stack(
+            [is_audio_init.any(), is_audio_generation.any(), (~is_audio_init & ~is_audio_generation).any()]
+        )
+
     # Built on top of GenerationMixin._sample.
     # We revise the implementation to support generating both audio / text.
     def _sample(
@@ -1644,6 +2370,16 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
 
         Otherwise, we will keep generating the text tokens.
 
+        The sequences in a batch are tracked independently, i.e., each row has its own generation mode and
+        delay-pattern counters. The batch should be left-padded. The text and audio tokens are sampled for all the
+        rows and selected with the per-row generation mode.
+
+        If `num_audio_draft_frames` is set in the generation kwargs, the audio tokens are decoded speculatively: an
+        `NGramAudioDrafter` proposes up to that many next audio tokens from the previous ones (including the audio of
+        the prompt), they are fed along with the current audio tokens in a single forward pass, and the drafts are
+        accepted as long as they match the tokens sampled from the logits. The accepted tokens follow the same
+        distribution as without speculation. This is only supported for batch_size=1 with the dynamic KV cache.
+
         Parameters:
             input_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`):
                 The sequence used as a prompt for the generation.
@@ -1671,9 +2407,27 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
             [`~generation.GenerateDecoderOnlyOutput`] if `model.config.is_encoder_decoder=False` and
             `return_dict_in_generate=True` or a [`~generation.GenerateEncoderDecoderOutput`] if
             `model.config.is_encoder_decoder=True`.
+            The audio sequences are a list of audio segments when batch_size=1, or a list with the audio segments
+            of each sequence otherwise.
         """
-        assert input_ids.shape[0] == 1, "Only support batch_size=1 in _sample()"
+        batch_size = input_ids.shape[0]
+        if batch_size > 1:
+            if past_key_values_buckets is not None:
+                raise ValueError(
+                    "The static KV cache buckets only support batch_size=1. Please use the dynamic cache."
+                )
+            if streamer is not None:
+                raise ValueError("The streamer only supports batch_size=1.")
+            if not generation_config.use_cache:
+                raise ValueError("Generating without the KV cache only supports batch_size=1.")
         audio_out_bos_token_id = generation_config.generation_kwargs.get("audio_out_bos_token_id", None)
+        ras_win_len = generation_config.generation_kwargs.get("ras_win_len", None)
+        tokenizer_length = generation_config.generation_kwargs.get("tokenizer_length", None)
+        stop_token_ids = generation_config.generation_kwargs.get("stop_token_ids", None)
+        if stop_token_ids:
+            stop_token_ids = torch.tensor(stop_token_ids, dtype=torch.long, device=input_ids.device)
+        else:
+            stop_token_ids = None
 
         # torch generator for sampling
         seed = generation_config.generation_kwargs.get("seed", None)
@@ -1681,19 +2435,46 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
             torch_generator = torch.Generator(device=input_ids.device).manual_seed(seed)
         else:
             torch_generator = None
+        # The temperature, top-k and top-p of the audio tokens are applied by a fused sampler when possible.
+        audio_sampler = FusedAudioSampler.from_logits_processor(logits_processor)
+        # With speculative decoding, the audio tokens proposed by the drafter are verified in one forward pass.
+        num_audio_draft_frames = generation_config.generation_kwargs.get("num_audio_draft_frames", None)
+        audio_drafter = None
+        if num_audio_draft_frames:
+            if (
+                batch_size > 1
+                or not generation_config.use_cache
+                or past_key_values_buckets is not None
+                or isinstance(model_kwargs.get("past_key_values"), StaticCache)
+            ):
+                raise ValueError(
+                    "Speculative audio decoding only supports batch_size=1 with the dynamic KV cache, as the "
+                    "rejected tokens are cropped from the cache."
+                )
+            audio_drafter = NGramAudioDrafter(
+                num_audio_draft_frames,
+                max_ngram_size=generation_config.generation_kwargs.get("audio_draft_max_ngram_size", 3),
+            )
+        num_draft_audio_tokens = num_accepted_audio_tokens = num_speculative_steps = 0
 
         # init values
         pad_token_id = generation_config._pad_token_tensor
+        if pad_token_id is None:
+            pad_token_id = self.padding_idx
         output_attentions = generation_config.output_attentions
         output_hidden_states = generation_config.output_hidden_states
         output_scores = generation_config.output_scores
         output_logits = generation_config.output_logits
         return_dict_in_generate = generation_config.return_dict_in_generate
         max_length = generation_config.max_length
-        has_eos_stopping_criteria = any(hasattr(criteria, "eos_token_id") for criteria in stopping_criteria)
         do_sample = generation_config.do_sample
         # Used to track which past_key_va
         self.current_past_key_values_bucket = None
+        if past_key_values_buckets is not None and model_kwargs.get("num_cached_tokens"):
+            # The cached tokens are in the bucket that is passed as `past_key_values`, e.g. by a previous call.
+            for cache_length, cache in past_key_values_buckets.items():
+                if cache is model_kwargs.get("past_key_values"):
+                    self.current_past_key_values_bucket = cache_length
 
         # init attention / hidden states / scores tuples
         scores = () if (return_dict_in_generate and output_scores) else None
@@ -1703,69 +2484,136 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
         decoder_hidden_states = () if (return_dict_in_generate and output_hidden_states) else None
 
         # keep track of which sequences are already finished
-        batch_size, cur_len = input_ids.shape
+        cur_len = input_ids.shape[1]
+        prompt_len = cur_len
+        device = input_ids.device
         this_peer_finished = False
-        unfinished_sequences = torch.ones(batch_size, dtype=torch.long, device=input_ids.device)
+        unfinished_sequences = torch.ones(batch_size, dtype=torch.long, device=device)
+        # The prompt prefix may already be in the KV cache, in which case the mask of the cached tokens is given.
+        num_cached_tokens = model_kwargs.pop("num_cached_tokens", None)
+        num_logits_to_keep = model_kwargs.get("num_logits_to_keep", 0)
         if generation_config.use_cache:
-            model_kwargs["cache_audio_discrete_codes_mask"] = None
+            model_kwargs.setdefault("cache_audio_discrete_codes_mask", None)
+            model_kwargs["static_kv_cache_masks"] = StaticKVCacheMasks()
+        # The sequences and the masks grow by one token per step, so they are kept in buffers with spare capacity
+        # instead of being copied at every step.
+        input_ids_buffer = GrowableTensor(input_ids)
+        model_kwargs_buffers = {} if generation_config.use_cache else None
 
         init_model_input = True
-        num_delay = 0
-        num_remaining_delays = None
-        audio_sequences = []
-        # A tensor to keep track of all the audio placeholder tokens.
-        input_ids_full = input_ids.clone()
+        # Per-sequence states of the delay pattern. -1 in `num_remaining_delays` means that no codebook has ended.
+        num_delay = torch.zeros(batch_size, dtype=torch.long, device=device)
+        num_remaining_delays = torch.full((batch_size,), -1, dtype=torch.long, device=device)
+        # The most recent audio tokens of each sequence, used by repetition aware sampling. -1 is used as padding.
+        # It is a ring buffer updated in place, where `ras_window_pos` is the position of the oldest token.
+        ras_window = torch.full(
+            (batch_size, self.audio_num_codebooks, ras_win_len or 0), -1, dtype=torch.long, device=device
+        )
+        ras_window_pos = torch.zeros(batch_size, dtype=torch.long, device=device)
+        batch_idx = torch.arange(batch_size, device=device)
+        # The audio tokens generated at each step, the sequences that generated them,
+        # and the sequences that started a new audio segment.
+        audio_steps, audio_step_masks, audio_step_starts = [], [], []
+        prompt_audio_sequences = [None] * batch_size
+        # The audio tokens to feed at the next step, for the sequences in the audio generation mode.
+        next_audio_tokens = None
 
         # Initialize the audio variables based on the input prompt.
-        if input_ids[0][-1] == self.config.audio_out_token_idx:
-            audio_sequences = [model_kwargs["audio_out_ids"][:, model_kwargs["audio_out_ids_start"][-1] :]]
-            if self.use_delay_pattern:
-                num_delay = (
-                    self.audio_num_codebooks
-                    - (model_kwargs["audio_out_ids"][:, -1] == self.config.audio_stream_bos_id).sum()
-                )
-                all_eos_indices = (model_kwargs["audio_out_ids"][:, -1] == self.config.audio_stream_eos_id).nonzero()
-                if torch.numel(all_eos_indices) > 0:
-                    all_eos_indices = all_eos_indices[0]
-                    last_eos_idx = all_eos_indices[-1]
-                    num_remaining_delays = self.audio_num_codebooks - last_eos_idx - 1
+        if model_kwargs.get("audio_out_ids") is not None and model_kwargs["audio_out_ids"].shape[-1] > 0:
+            audio_out_ids = model_kwargs["audio_out_ids"]
+            audio_out_ids_start = model_kwargs["audio_out_ids_start"].tolist()
+            audio_out_ids_end = audio_out_ids_start[1:] + [audio_out_ids.shape[1]]
+            # The audio segments are assigned to the <|AUDIO_OUT|> tokens in order.
+            segment_rows = torch.nonzero(input_ids == self.audio_out_token_idx)[:, 0].tolist()
+            for row in range(batch_size):
+                row_segments = [
+                    audio_out_ids[:, start:end]
+                    for start, end, segment_row in zip(audio_out_ids_start, audio_out_ids_end, segment_rows)
+                    if segment_row == row
+                ]
+                if len(row_segments) == 0:
+                    continue
+                if ras_win_len is not None:
+                    row_audio_ids = torch.cat(row_segments, dim=1)[:, -ras_win_len:]
+                    ras_window[row, :, ras_win_len - row_audio_ids.shape[1] :] = row_audio_ids
+                if audio_drafter is not None:
+                    audio_drafter.extend(torch.cat(row_segments, dim=1).transpose(0, 1).tolist())
+                if input_ids[row, -1] == self.audio_out_token_idx:
+                    # Continue the last audio segment in the prompt.
+                    prompt_audio_sequences[row] = row_segments[-1]
+                    last_audio_tokens = row_segments[-1][:, -1]
+                    if self.use_delay_pattern:
+                        num_delay[row] = (
+                            self.audio_num_codebooks - (last_audio_tokens == self.config.audio_stream_bos_id).sum()
+                        )
+                        all_eos_indices = (last_audio_tokens == self.config.audio_stream_eos_id).nonzero()
+                        if torch.numel(all_eos_indices) > 0:
+                            num_remaining_delays[row] = self.audio_num_codebooks - all_eos_indices[0, 0] - 1
+
+        # Check which multimodal stage each sequence is in. The stages are also tracked on the host, so that the loop
+        # only synchronizes once per step, when reading them along with the stopping criteria.
+        is_audio_init = input_ids[:, -1] == audio_out_bos_token_id
+        is_audio_generation = input_ids[:, -1] == self.audio_out_token_idx
+        has_audio_init, has_audio_generation, has_text_generation = self._get_generation_stages(
+            is_audio_init, is_audio_generation
+        ).tolist()
 
         while self._has_unfinished_sequences(
-            this_peer_finished, synced_gpus, device=input_ids.device, cur_len=cur_len, max_length=max_length
+            this_peer_finished, synced_gpus, device=device, cur_len=cur_len, max_length=max_length
         ):
-            # Check which multimodal stage we are in
-            # FIXME: Assume single input generation
-            if input_ids[0][-1] == audio_out_bos_token_id:
-                generation_mode = GenerationMode.AUDIO_INIT
-            elif input_ids[0][-1] == self.audio_out_token_idx:
-                generation_mode = GenerationMode.AUDIO_IN_PROGRESS
-            else:
-                generation_mode = GenerationMode.TEXT
-
-            is_audio_generation_mode = generation_mode == GenerationMode.AUDIO_IN_PROGRESS
-
-            if init_model_input or not generation_config.use_cache:
+            draft_audio_tokens = None
+            if init_model_input:
                 model_inputs = {"input_ids": input_ids, **model_kwargs}
+                if num_cached_tokens:
+                    model_inputs["num_cached_tokens"] = num_cached_tokens
+            elif not generation_config.use_cache:
+                # Without the KV cache, we feed the whole sequence with one <|AUDIO_OUT|> token per audio segment.
+                generated_ids = input_ids[:, prompt_len:][:, self._get_generated_token_mask(input_ids, prompt_len)[0]]
+                model_inputs = {
+                    "input_ids": torch.cat([input_ids[:, :prompt_len], generated_ids], dim=1),
+                    **model_kwargs,
+                }
             else:
                 model_inputs = {"input_ids": input_ids[:, -1:], **model_kwargs}
+                if batch_size == 1:
+                    model_inputs["is_decoding_audio_token"] = has_audio_generation
 
-                if is_audio_generation_mode and generation_config.use_cache:
-                    model_inputs["audio_out_ids"] = model_kwargs["audio_out_ids"][:, -1:]
-                    model_inputs["audio_out_ids_start"] = torch.tensor([0], dtype=torch.long, device=input_ids.device)
-                elif not is_audio_generation_mode:
+                if has_audio_generation:
+                    if has_audio_init or has_text_generation:
+                        model_inputs["audio_out_ids"] = next_audio_tokens[is_audio_generation].transpose(0, 1)
+                    else:
+                        model_inputs["audio_out_ids"] = next_audio_tokens.transpose(0, 1)
+                    # The drafts are fed after the current audio tokens, with one <|AUDIO_OUT|> token each. The last
+                    # step may emit one more audio token than the number of drafts.
+                    drafts = audio_drafter.propose(max_length - cur_len - 1) if audio_drafter is not None else []
+                    if len(drafts) > 0:
+                        draft_audio_tokens = torch.tensor(drafts, dtype=torch.long, device=device)
+                        model_inputs["input_ids"] = input_ids[:, -1:].repeat(1, len(drafts) + 1)
+                        model_inputs["audio_out_ids"] = torch.cat(
+                            [model_inputs["audio_out_ids"], draft_audio_tokens.transpose(0, 1)], dim=1
+                        )
+                        if "attention_mask" in model_inputs:
+                            model_inputs["attention_mask"] = model_kwargs_buffers["attention_mask"].append(
+                                input_ids.new_ones((1, len(drafts)), dtype=model_inputs["attention_mask"].dtype)
+                            )
+                        if num_logits_to_keep:
+                            model_inputs["num_logits_to_keep"] = len(drafts) + 1
+                    model_inputs["audio_out_ids_start"] = torch.arange(
+                        model_inputs["audio_out_ids"].shape[1], dtype=torch.long, device=device
+                    )
+                else:
                     del model_inputs["audio_out_ids"]
                     del model_inputs["audio_out_ids_start"]
 
-                if generation_config.use_cache:
-                    if "audio_features" in model_inputs and model_inputs["audio_features"] is not None:
-                        model_inputs["audio_features"] = model_inputs["audio_features"][:0, ...]
-                        model_inputs["audio_feature_attention_mask"] = model_inputs["audio_feature_attention_mask"][
-                            :0, ...
-                        ]
+                if "audio_features" in model_inputs and model_inputs["audio_features"] is not None:
+                    model_inputs["audio_features"] = model_inputs["audio_features"][:0, ...]
+                    model_inputs["audio_feature_attention_mask"] = model_inputs["audio_feature_attention_mask"][
+                        :0, ...
+                    ]
 
-                    if "audio_in_ids" in model_inputs and model_inputs["audio_in_ids"] is not None:
-                        model_inputs["audio_in_ids"] = None
-                        model_inputs["audio_in_ids_start"] = None
+                if "audio_in_ids" in model_inputs and model_inputs["audio_in_ids"] is not None:
+                    model_inputs["audio_in_ids"] = None
+                    model_inputs["audio_in_ids_start"] = None
 
             # prepare variable output controls (note: some models won't accept all output controls)
             model_inputs.update({"output_attentions": output_attentions} if output_attentions else {})
@@ -1782,16 +2630,20 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
             # forward pass to get next token
             outputs = self(**model_inputs, return_dict=True)
 
-            # Update the actual sequence length after the first forward pass
+            # Update the actual sequence length after the first forward pass. The attention mask returned by the model
+            # covers the merged sequence, while `get_seq_length()` misses the audio tokens of a first layer that is a
+            # skipped fast-forward layer.
             if init_model_input and past_key_values_buckets is not None:
-                cur_len = past_key_values_buckets[self.current_past_key_values_bucket].get_seq_length().item()
+                cur_len = outputs.attention_mask.shape[1]
 
             # synced_gpus: don't waste resources running the code we don't need; kwargs must be updated before skipping
             model_kwargs = self._update_model_kwargs_for_generation(
                 outputs,
                 model_kwargs,
                 is_encoder_decoder=self.config.is_encoder_decoder,
+                num_new_tokens=model_inputs["input_ids"].shape[1],
                 extend_attention_mask=True,
+                buffers=model_kwargs_buffers,
             )
 
             # After the first forward pass, we can set init_model_input to False.
@@ -1800,87 +2652,169 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
             if synced_gpus and this_peer_finished:
                 continue
 
-            if is_audio_generation_mode:
+            # In text generation mode, we sample the text tokens from text logits.
+            # It might also generate the audio placeholder token to start the audio generation.
+            # The sequences that just saw the audio bos token will generate the audio placeholder token
+            # and the corresponding audio stream bos token to start the audio generation.
+            if has_text_generation or not has_audio_generation:
+                next_tokens, _, next_token_logits, next_token_scores = self._sample_text_tokens(
+                    input_ids=input_ids,
+                    logits=outputs.logits,
+                    do_sample=do_sample,
+                    logits_processor=logits_processor,
+                    device=device,
+                    generation_mode=GenerationMode.TEXT if has_text_generation else GenerationMode.AUDIO_INIT,
+                    torch_generator=torch_generator,
+                )
+                next_tokens = next_tokens.masked_fill(is_audio_init, self.audio_out_token_idx)
+            else:
+                next_tokens = torch.full((batch_size,), self.audio_out_token_idx, dtype=torch.long, device=device)
+                next_token_logits = next_token_scores = None
+            next_audio_tokens = torch.full(
+                (batch_size, self.audio_num_codebooks),
+                self.config.audio_stream_bos_id,
+                dtype=torch.long,
+                device=device,
+            )
+
+            if draft_audio_tokens is not None:
+                # The single sequence is in audio generation mode, and emits the accepted drafts and one more step.
+                (
+                    num_accepted_drafts,
+                    emitted_audio_tokens,
+                    step_tokens,
+                    step_audio_tokens,
+                    step_audio_token_logits,
+                    step_audio_token_scores,
+                    ras_window,
+                    ras_window_pos,
+                    num_delay,
+                    num_remaining_delays,
+                ) = self._verify_audio_drafts(
+                    audio_logits=outputs.audio_logits,
+                    draft_audio_tokens=draft_audio_tokens,
+                    ras_window=ras_window,
+                    ras_window_pos=ras_window_pos,
+                    do_sample=do_sample,
+                    logits_processor=logits_processor,
+                    device=device,
+                    torch_generator=torch_generator,
+                    generation_config=generation_config,
+                    num_delay=num_delay,
+                    num_remaining_delays=num_remaining_delays,
+                    audio_sampler=audio_sampler,
+                )
+                # Drop the keys, values and masks of the rejected drafts.
+                num_rejected_drafts = draft_audio_tokens.shape[0] - num_accepted_drafts
+                if num_rejected_drafts > 0:
+                    model_kwargs["past_key_values"].crop(-num_rejected_drafts)
+                    for name, buffer in model_kwargs_buffers.items():
+                        model_kwargs[name] = buffer.truncate(len(buffer) - num_rejected_drafts)
+                audio_drafter.extend(emitted_audio_tokens)
+                num_draft_audio_tokens += draft_audio_tokens.shape[0]
+                num_accepted_audio_tokens += num_accepted_drafts
+                num_speculative_steps += 1
+                next_tokens = step_tokens[:, -1]
+                next_audio_tokens = step_audio_tokens[:, -1]
+            elif has_audio_generation:
                 # In audio generation mode, we sample the audio tokens from audio logits.
                 # It might also generate the audio eos token to end the audio generation.
+                # The audio logits only cover the audio positions, so we pick the one of the last token in each row.
+                # Only the audio positions among the last `num_logits_to_keep` ones have audio logits.
+                audio_out_mask = outputs.audio_out_mask[:, -num_logits_to_keep:]
+                last_audio_position = (audio_out_mask.flatten().cumsum(0) - 1).view(audio_out_mask.shape)[:, -1]
                 (
-                    next_tokens,
-                    next_audio_tokens,
+                    next_audio_tokens_sampled,
+                    next_audio_tokens_from_audio,
                     next_audio_token_logits,
                     next_audio_token_scores,
-                    num_delay,
-                    num_remaining_delays,
+                    next_num_delay,
+                    next_num_remaining_delays,
                 ) = self._sample_audio_tokens(
                     hidden_states=outputs.audio_hidden_states,
-                    audio_logits=outputs.audio_logits,
-                    audio_out_ids=model_kwargs["audio_out_ids"],
+                    audio_logits=outputs.audio_logits[last_audio_position.clamp(min=0)],
+                    audio_out_ids=ras_window,
                     do_sample=do_sample,
                     logits_processor=logits_processor,
-                    device=input_ids.device,
+                    device=device,
                     torch_generator=torch_generator,
                     generation_config=generation_config,
                     num_delay=num_delay,
                     num_remaining_delays=num_remaining_delays,
+                    audio_sampler=audio_sampler,
                 )
-
-                # update generated ids, model inputs, and length for next step
-                model_kwargs["audio_out_ids"] = torch.cat(
-                    [model_kwargs["audio_out_ids"], next_audio_tokens[:, None]], dim=-1
+                next_tokens = torch.where(is_audio_generation, next_audio_tokens_sampled, next_tokens)
+                next_audio_tokens = torch.where(
+                    is_audio_generation[:, None], next_audio_tokens_from_audio, next_audio_tokens
                 )
-                audio_sequences[-1] = torch.cat([audio_sequences[-1], next_audio_tokens[:, None]], dim=-1)
-
-                if streamer is not None:
-                    streamer.put(next_audio_tokens.cpu())
-            else:
-                # In text generation mode, we sample the text tokens from text logits.
-                # It might also generate the audio placeholder token to start the audio generation.
-                next_tokens, next_audio_tokens, next_token_logits, next_token_scores = self._sample_text_tokens(
-                    input_ids=input_ids,
-                    logits=outputs.logits,
-                    do_sample=do_sample,
-                    logits_processor=logits_processor,
-                    device=input_ids.device,
-                    generation_mode=generation_mode,
-                    torch_generator=torch_generator,
+                num_delay = torch.where(is_audio_generation, next_num_delay, num_delay)
+                num_remaining_delays = torch.where(
+                    is_audio_generation, next_num_remaining_delays, num_remaining_delays
                 )
 
-                if streamer is not None:
-                    streamer.put(next_tokens.cpu())
-
-                if next_audio_tokens is not None:
-                    # If the token is audio bos token, we will generate the audio placeholder token
-                    # and the corrensponding audio stream bos token to start the audio generation.
-                    audio_sequences.append(next_audio_tokens[:, None])
-                    if streamer is not None:
-                        streamer.put(next_audio_tokens.cpu())
-                    if model_kwargs["audio_out_ids"] is None or model_kwargs["audio_out_ids"].shape[0] == 0:
-                        # Initialize audio_out_ids
-                        model_kwargs["audio_out_ids"] = next_audio_tokens[:, None]
-                        model_kwargs["audio_out_ids_start"] = torch.tensor(
-                            [0], dtype=torch.long, device=input_ids.device
-                        )
+            if draft_audio_tokens is None:
+                step_tokens = next_tokens[:, None]
+                step_audio_tokens = next_audio_tokens[:, None]
+
+            # Keep track of the audio tokens of the unfinished sequences. A new audio segment starts with the audio
+            # stream bos tokens whenever <|AUDIO_OUT|> is emitted outside of the audio generation mode, which includes
+            # the text steps that sample <|AUDIO_OUT|>.
+            is_audio_start = (next_tokens == self.audio_out_token_idx) & ~is_audio_generation
+            has_audio_tokens = (is_audio_start | is_audio_generation) & unfinished_sequences.bool()
+            for audio_tokens in step_audio_tokens.unbind(1):
+                audio_steps.append(audio_tokens)
+                audio_step_masks.append(has_audio_tokens)
+                audio_step_starts.append(is_audio_start)
+            if ras_win_len is not None and draft_audio_tokens is None:
+                ras_window[batch_idx, :, ras_window_pos] = torch.where(
+                    has_audio_tokens[:, None], next_audio_tokens, ras_window[batch_idx, :, ras_window_pos]
+                )
+                ras_window_pos = (ras_window_pos + has_audio_tokens.long()) % ras_win_len
+            if not generation_config.use_cache:
+                # Without the KV cache, the whole sequence is fed to the model again, so we keep all the audio tokens.
+                if has_audio_init:
+                    if model_kwargs.get("audio_out_ids") is None or model_kwargs["audio_out_ids"].shape[0] == 0:
+                        model_kwargs["audio_out_ids"] = next_audio_tokens.transpose(0, 1)
+                        model_kwargs["audio_out_ids_start"] = torch.tensor([0], dtype=torch.long, device=device)
                     else:
                         model_kwargs["audio_out_ids_start"] = torch.concat(
                             [
                                 model_kwargs["audio_out_ids_start"],
                                 torch.tensor(
-                                    [model_kwargs["audio_out_ids"].shape[1]], dtype=torch.long, device=input_ids.device
+                                    [model_kwargs["audio_out_ids"].shape[1]], dtype=torch.long, device=device
                                 ),
                             ],
                             dim=0,
                         )
                         model_kwargs["audio_out_ids"] = torch.concat(
-                            [model_kwargs["audio_out_ids"], next_audio_tokens[:, None]], dim=1
+                            [model_kwargs["audio_out_ids"], next_audio_tokens.transpose(0, 1)], dim=1
                         )
+                elif has_audio_generation:
+                    model_kwargs["audio_out_ids"] = torch.cat(
+                        [model_kwargs["audio_out_ids"], next_audio_tokens.transpose(0, 1)], dim=-1
+                    )
+
+            if streamer is not None:
+                if has_audio_generation:
+                    for audio_tokens in step_audio_tokens[0].cpu():
+                        streamer.put(audio_tokens)
+                else:
+                    streamer.put(next_tokens.cpu())
+                    if has_audio_init:
+                        streamer.put(next_audio_tokens[0].cpu())
 
             if return_dict_in_generate:
                 if output_scores:
-                    if is_audio_generation_mode:
-                        scores += (next_audio_token_scores,)
+                    if draft_audio_tokens is not None:
+                        scores += step_audio_token_scores
+                    elif has_audio_generation:
+                        scores += (next_audio_token_scores.clone(),)
                     else:
                         scores += (next_token_scores,)
                 if output_logits:
-                    if is_audio_generation_mode:
+                    if draft_audio_tokens is not None:
+                        raw_logits += step_audio_token_logits
+                    elif has_audio_generation:
                         raw_logits += (next_audio_token_logits,)
                     else:
                         raw_logits += (next_token_logits,)
@@ -1890,24 +2824,49 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
                     decoder_hidden_states += (outputs.hidden_states,)
 
             # finished sentences should have their next token be a padding token
-            if has_eos_stopping_criteria:
-                next_tokens = next_tokens * unfinished_sequences + pad_token_id * (1 - unfinished_sequences)
-
-            if "tokenizer_length" in generation_config.generation_kwargs:
-                tokenizer_length = generation_config.generation_kwargs["tokenizer_length"]
-                if torch.max(next_tokens) >= tokenizer_length:
-                    raise ValueError(
-                        f"Next generated token has max value {torch.max(next_tokens)} which is greater than the tokenizer's vocabulary size {tokenizer_length}, this is undesired behavior."
-                    )
+            step_tokens = step_tokens * unfinished_sequences[:, None] + pad_token_id * (
+                1 - unfinished_sequences[:, None]
+            )
+            next_tokens = step_tokens[:, -1]
 
             # update generated ids, model inputs, and length for next step
-            if not is_audio_generation_mode or next_tokens[0] != self.audio_out_token_idx:
-                # We only add one <|AUDIO_OUT|> token to the input_ids for simplicity.
-                input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
-            input_ids_full = torch.cat([input_ids_full, next_tokens[:, None]], dim=-1)
-            unfinished_sequences = unfinished_sequences & ~stopping_criteria(input_ids_full, scores)
-            this_peer_finished = unfinished_sequences.max() == 0
-            cur_len += 1
+            input_ids = input_ids_buffer.append(step_tokens)
+            unfinished_sequences = unfinished_sequences & ~stopping_criteria(input_ids, scores)
+            if stop_token_ids is not None and (has_text_generation or not has_audio_generation):
+                # Only the steps that sample text tokens can emit a stop token. The result is read on the host along
+                # with the generation stages below.
+                unfinished_sequences = unfinished_sequences & ~torch.isin(next_tokens, stop_token_ids)
+            cur_len += step_tokens.shape[1]
+
+            is_audio_init = next_tokens == audio_out_bos_token_id
+            is_audio_generation = next_tokens == self.audio_out_token_idx
+            # The range of the sampled tokens is checked on the device and read along with the generation stages.
+            if tokenizer_length is not None:
+                is_out_of_vocabulary = step_tokens.max()[None] >= tokenizer_length
+            else:
+                is_out_of_vocabulary = torch.zeros(1, dtype=torch.bool, device=device)
+            step_states = [
+                self._get_generation_stages(is_audio_init, is_audio_generation),
+                unfinished_sequences.max()[None] == 0,
+                is_out_of_vocabulary,
+            ]
+            if audio_drafter is not None and draft_audio_tokens is None:
+                # The drafter matches the audio tokens on the host, so the new ones are read along with the stages.
+                step_states = [state.long() for state in step_states] + [has_audio_tokens.long(), next_audio_tokens[0]]
+            (
+                has_audio_init,
+                has_audio_generation,
+                has_text_generation,
+                this_peer_finished,
+                has_out_of_vocabulary_tokens,
+                *new_audio_tokens,
+            ) = torch.cat(step_states).tolist()
+            if has_out_of_vocabulary_tokens:
+                raise ValueError(
+                    f"Next generated token has max value {torch.max(step_tokens)} which is greater than the tokenizer's vocabulary size {tokenizer_length}, this is undesired behavior."
+                )
+            if len(new_audio_tokens) > 0 and new_audio_tokens[0]:
+                audio_drafter.extend([new_audio_tokens[1:]])
 
             # This is needed to properly delete outputs.logits which may be very large for first iteration
             # Otherwise a reference to outputs is kept which keeps the logits alive in the next iteration
@@ -1916,6 +2875,47 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
         if streamer is not None:
             streamer.end()
 
+        audio_draft_acceptance_rate = audio_tokens_per_forward = None
+        if num_speculative_steps > 0:
+            audio_draft_acceptance_rate = num_accepted_audio_tokens / num_draft_audio_tokens
+            audio_tokens_per_forward = (num_accepted_audio_tokens + num_speculative_steps) / num_speculative_steps
+            logger.info(
+                f"Speculative audio decoding accepted {num_accepted_audio_tokens} of {num_draft_audio_tokens} drafts, "
+                f"{audio_tokens_per_forward:.2f} audio tokens per forward pass over {num_speculative_steps} "
+                f"speculative steps."
+            )
+
+        # We only keep one <|AUDIO_OUT|> token per audio segment in the returned sequences.
+        generated_token_mask = self._get_generated_token_mask(input_ids, prompt_len)
+        sorted_mask, sorted_indices = torch.sort(generated_token_mask.long(), dim=1, descending=True, stable=True)
+        generated_ids = input_ids[:, prompt_len:].gather(1, sorted_indices).masked_fill(sorted_mask == 0, pad_token_id)
+        input_ids = torch.cat([input_ids[:, :prompt_len], generated_ids[:, : sorted_mask.sum(dim=1).max()]], dim=1)
+
+        # Split the generated audio tokens into the audio segments of each sequence.
+        batch_audio_sequences = [[] for _ in range(batch_size)]
+        if len(audio_steps) > 0:
+            audio_steps = torch.stack(audio_steps, dim=2)
+            audio_step_masks = torch.stack(audio_step_masks, dim=1).tolist()
+            audio_step_starts = torch.stack(audio_step_starts, dim=1).tolist()
+            for row in range(batch_size):
+                # A sequence that continues the audio in the prompt starts with the last audio segment of the prompt.
+                segment_steps = [] if prompt_audio_sequences[row] is None else [[]]
+                for step, (has_audio_tokens, is_start) in enumerate(
+                    zip(audio_step_masks[row], audio_step_starts[row])
+                ):
+                    if is_start:
+                        segment_steps.append([])
+                    if has_audio_tokens:
+                        segment_steps[-1].append(step)
+                for i, steps in enumerate(segment_steps):
+                    segment = audio_steps[row][:, steps]
+                    if i == 0 and prompt_audio_sequences[row] is not None:
+                        segment = torch.cat([prompt_audio_sequences[row], segment], dim=1)
+                    batch_audio_sequences[row].append(segment)
+        else:
+            batch_audio_sequences = [[seq] if seq is not None else [] for seq in prompt_audio_sequences]
+        audio_sequences = batch_audio_sequences[0] if batch_size == 1 else batch_audio_sequences
+
         if return_dict_in_generate:
             return HiggsAudioGenerationOutput(
                 sequences=input_ids,
@@ -1925,10 +2925,20 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
                 attentions=decoder_attentions,
                 hidden_states=decoder_hidden_states,
                 past_key_values=model_kwargs.get("past_key_values"),
+                cache_audio_discrete_codes_mask=model_kwargs.get("cache_audio_discrete_codes_mask"),
+                audio_draft_acceptance_rate=audio_draft_acceptance_rate,
+                audio_tokens_per_forward=audio_tokens_per_forward,
             )
         else:
             return input_ids, audio_sequences
 
+    def _get_generated_token_mask(self, input_ids: torch.LongTensor, prompt_len: int) -> torch.BoolTensor:
+        """Mask out the repeated <|AUDIO_OUT|> tokens that are generated in the audio generation mode."""
+        return ~(
+            (input_ids[:, prompt_len - 1 : -1] == self.audio_out_token_idx)
+            & (input_ids[:, prompt_len:] == self.audio_out_token_idx)
+        )
+
     @torch.inference_mode()
     def generate(
         self,
@@ -1952,11 +2962,15 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
         for sample_step in 1, 2, 3, 4, 5, ...
             ...
 
+        Rows of a batch can be in different modes (text, audio, finished) at the same step. Each row generates the
+        same tokens as it would alone with greedy decoding, but the random draws of sampling are shared by the batch.
+
+        Note that a given `seed` does not reproduce the outputs of earlier versions:
+            - The repetition aware sampling (`ras_win_len`) draws its fallback tokens for all the rows and codebooks
+              at each audio step, instead of only for the repeated ones, to avoid a host sync.
+            - An <|AUDIO_OUT|> sampled in the text generation mode starts an audio segment, like <|audio_out_bos|>.
         """
         # Right now, it's a very simplified version of generate, we should revisit this after our model architecture stabilizes.
-        assert input_ids.shape[0] == 1, (
-            "Currently HiggsAudioModel.generate() only supports batch_size=1. See the implementation of "
-        )
         generation_config, kwargs = self._prepare_generation_config(kwargs.pop("generation_config", None), **kwargs)
         if audio_out_bos_token_id is not None:
             generation_config.generation_kwargs["audio_out_bos_token_id"] = audio_out_bos_token_id
@@ -1979,6 +2993,8 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
 
         generation_config.generation_kwargs["ras_win_len"] = kwargs.pop("ras_win_len", None)
         generation_config.generation_kwargs["ras_win_max_num_repeat"] = kwargs.pop("ras_win_max_num_repeat", 2)
+        generation_config.generation_kwargs["num_audio_draft_frames"] = kwargs.pop("num_audio_draft_frames", None)
+        generation_config.generation_kwargs["audio_draft_max_ngram_size"] = kwargs.pop("audio_draft_max_ngram_size", 3)
         # Set generation seed if determinstic generation is required
         if seed is not None:
             generation_config.generation_kwargs["seed"] = seed
@@ -1987,6 +3003,16 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
         if "tokenizer" in kwargs:
             generation_config.generation_kwargs["tokenizer_length"] = len(kwargs["tokenizer"])
 
+        # The stop strings that are special tokens, e.g. <|eot_id|>, are checked against the sampled text tokens on the
+        # device, instead of matching the strings over the end of the sequence at every step.
+        stop_token_ids = list(kwargs.pop("stop_token_ids", None) or [])
+        if generation_config.stop_strings is not None and "tokenizer" in kwargs:
+            compiled_stop_token_ids, generation_config.stop_strings = split_stop_strings(
+                generation_config.stop_strings, kwargs["tokenizer"]
+            )
+            stop_token_ids += compiled_stop_token_ids
+        generation_config.generation_kwargs["stop_token_ids"] = stop_token_ids
+
         # input_ids: [bsz, seq_len]
         # The merging of audio features happens inside the forward path. The input_ids does not need to change.
         # TODO: prepare the final input embeddings to improve generation performance
@@ -2243,10 +3269,20 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
         """Capture CUDA graphs for the model's forward pass with different KV cache lengths.
 
         Args:
-            past_key_values: List of KV caches to capture graphs for
+            past_key_values: List of KV caches to capture graphs for. A `PagedKVCache` is captured for each of its
+                `cache_lengths`.
         """
+        cache_and_lengths = []
         for past_key_value in past_key_values:
-            kv_cache_length = past_key_value.get_max_cache_shape()
+            if isinstance(past_key_value, PagedKVCache):
+                cache_and_lengths.extend((past_key_value, length) for length in past_key_value.cache_lengths)
+            else:
+                cache_and_lengths.append((past_key_value, past_key_value.get_max_cache_shape()))
+
+        for past_key_value, kv_cache_length in cache_and_lengths:
+            if isinstance(past_key_value, PagedKVCache):
+                # The graph reads the view of the paged cache, so we grow it to the captured length first.
+                past_key_value.reserve(kv_cache_length)
             # We capture two graphs, one for decoding audio tokens and one for decoding text tokens
             for is_decoding_audio_token in [True, False]:
                 runner = CUDAGraphRunner(self._forward_core)
@@ -2287,3 +3323,7 @@ class HiggsAudioModel(HiggsAudioPreTrainedModel, GenerationMixin):
                 )
 
                 self.decode_graph_runners[kv_cache_length][is_decoding_audio_token] = runner
+
+        for past_key_value, _ in cache_and_lengths:
+            if isinstance(past_key_value, PagedKVCache):
+                past_key_value.reset()
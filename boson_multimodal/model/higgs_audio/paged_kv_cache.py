@@ -0,0 +1,222 @@
+import heapq
+import math
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from transformers.cache_utils import Cache, StaticCache
+from transformers.configuration_utils import PretrainedConfig
+
+
+class PagedKVCache(StaticCache):
+    """Block-based KV cache shared by all the layers of the model.
+
+    The keys and values of every layer live in a single pool of `num_blocks` fixed-size blocks. Each sequence owns a
+    block table that maps its logical positions to physical slots in the pool. Growing a sequence only allocates new
+    blocks, the existing keys and values are never copied.
+
+    The cache behaves like a `StaticCache` whose `max_cache_len` is the length of the view the attention layers see.
+    The view grows on `reserve()` to the smallest of `cache_lengths` that fits the sequence (or to a multiple of
+    `block_size` when no length fits), so the static attention masks and the captured CUDA graphs keep the same
+    shapes as with the static cache buckets.
+
+    When the cache holds a single sequence whose blocks are contiguous in the pool, the view is a slice of the pool.
+    Otherwise the view is gathered from the pool through the block tables.
+
+    Args:
+        config (`PretrainedConfig`):
+            The configuration of the model. `num_hidden_layers` should count the audio attention layers of the
+            dual-FFN decoder layers, since they have their own KV cache.
+        num_blocks (`int`):
+            The number of blocks in the pool.
+        block_size (`int`):
+            The number of tokens stored in each block.
+        cache_lengths (`List[int]`, *optional*):
+            The lengths the view can take. When set, the view is rounded up to one of these lengths, e.g. the
+            lengths for which CUDA graphs have been captured.
+        max_batch_size (`int`):
+            The maximum number of sequences in the cache.
+        device (`torch.device` or `str`, *optional*):
+            The device of the pool.
+        dtype (`torch.dtype`):
+            The dtype of the pool.
+    """
+
+    def __init__(
+        self,
+        config: PretrainedConfig,
+        num_blocks: int,
+        block_size: int = 16,
+        cache_lengths: Optional[List[int]] = None,
+        max_batch_size: int = 1,
+        device: Optional[torch.device] = None,
+        dtype: torch.dtype = torch.float32,
+    ) -> None:
+        # The pool replaces the preallocated buffers of `StaticCache`, so we skip its `__init__`.
+        Cache.__init__(self)
+        self.batch_size = max_batch_size
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.cache_lengths = sorted(cache_lengths) if cache_lengths is not None else []
+        self.max_cache_len = 0
+        self.device = device
+        self.dtype = dtype
+
+        self.head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        self.num_key_value_heads = (
+            config.num_attention_heads
+            if getattr(config, "num_key_value_heads", None) is None
+            else config.num_key_value_heads
+        )
+        # The pools are stored as (num_heads, num_slots, head_dim) so that the view of a contiguous sequence has the
+        # same memory layout as a slice of the static cache.
+        pool_shape = (self.num_key_value_heads, num_blocks * block_size, self.head_dim)
+        self.key_pool: List[torch.Tensor] = []
+        self.value_pool: List[torch.Tensor] = []
+        for _ in range(config.num_hidden_layers):
+            self.key_pool.append(torch.zeros(pool_shape, dtype=dtype, device=device))
+            self.value_pool.append(torch.zeros(pool_shape, dtype=dtype, device=device))
+
+        self.block_tables: List[List[int]] = [[] for _ in range(max_batch_size)]
+        # Maps (sequence, logical position) to the slot in the pool. It is updated in place so that its address stays
+        # the same for the captured CUDA graphs.
+        self.slot_mapping = torch.zeros((max_batch_size, num_blocks * block_size), dtype=torch.long, device=device)
+        self._free_blocks = list(range(num_blocks))
+        self._is_contiguous = True
+
+    @property
+    def num_used_blocks(self) -> int:
+        """The number of blocks allocated to the sequences."""
+        return self.num_blocks - len(self._free_blocks)
+
+    @property
+    def num_free_blocks(self) -> int:
+        """The number of blocks that can still be allocated."""
+        return len(self._free_blocks)
+
+    @property
+    def is_contiguous(self) -> bool:
+        """Whether the view is a slice of the pool starting at the first slot, as assumed by the CUDA graphs."""
+        return self._is_contiguous
+
+    def reserve(self, length: int) -> None:
+        """Grow the view so that every sequence can hold `length` tokens.
+
+        The view never shrinks until the cache is reset. Raises a `ValueError` if the pool runs out of blocks.
+        """
+        if length <= self.max_cache_len:
+            return
+        view_len = next((cache_len for cache_len in self.cache_lengths if cache_len >= length), None)
+        if view_len is None:
+            view_len = math.ceil(length / self.block_size) * self.block_size
+        num_blocks_per_seq = math.ceil(view_len / self.block_size)
+        num_new_blocks = sum(max(num_blocks_per_seq - len(table), 0) for table in self.block_tables)
+        if num_new_blocks > len(self._free_blocks):
+            raise ValueError(
+                f"The paged KV cache does not have enough free blocks for {length} tokens: "
+                f"{num_new_blocks} blocks are needed but only {len(self._free_blocks)} are free. "
+                f"Please consider increasing the number of blocks."
+            )
+
+        seq_indices, positions, slots = [], [], []
+        for seq_idx, table in enumerate(self.block_tables):
+            for logical_block in range(len(table), num_blocks_per_seq):
+                # Popping the smallest free block keeps a single sequence contiguous in the pool.
+                physical_block = heapq.heappop(self._free_blocks)
+                table.append(physical_block)
+                seq_indices.extend([seq_idx] * self.block_size)
+                positions.extend(range(logical_block * self.block_size, (logical_block + 1) * self.block_size))
+                slots.extend(range(physical_block * self.block_size, (physical_block + 1) * self.block_size))
+        if len(slots) > 0:
+            self.slot_mapping[seq_indices, positions] = torch.tensor(slots, dtype=torch.long).to(self.device)
+
+        self.max_cache_len = view_len
+        self._is_contiguous = self.batch_size == 1 and self.block_tables[0] == list(range(num_blocks_per_seq))
+
+    def get_prefix(self, length: int) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        """Returns copies of the keys and values of the first `length` tokens of the first sequence.
+
+        The keys and values of each layer have shape (num_heads, length, head_dim).
+        """
+        slots = self.slot_mapping[0, :length]
+        return [k_pool[:, slots] for k_pool in self.key_pool], [v_pool[:, slots] for v_pool in self.value_pool]
+
+    def set_prefix(self, key_states: List[torch.Tensor], value_states: List[torch.Tensor]) -> None:
+        """Writes the keys and values returned by `get_prefix()` to the first tokens of the first sequence.
+
+        `key_states` and `value_states` may skip the last layers of the pool, which the model does not use when the
+        audio self-attention is disabled.
+        """
+        length = key_states[0].shape[1]
+        self.reserve(length)
+        slots = self.slot_mapping[0, :length]
+        for layer_idx in range(len(key_states)):
+            self.key_pool[layer_idx].index_copy_(1, slots, key_states[layer_idx])
+            self.value_pool[layer_idx].index_copy_(1, slots, value_states[layer_idx])
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Writes the new `key_states` and `value_states` to the slots of `cache_position` and returns the view of the
+        keys and values of the layer `layer_idx`.
+
+        Parameters:
+            key_states (`torch.Tensor`):
+                The new key states to cache, of shape (batch_size, num_heads, seq_len, head_dim).
+            value_states (`torch.Tensor`):
+                The new value states to cache, of shape (batch_size, num_heads, seq_len, head_dim).
+            layer_idx (`int`):
+                The index of the layer to cache the states for.
+            cache_kwargs (`Dict[str, Any]`, `optional`):
+                Needs the `cache_position` input to know where to write in the cache.
+
+        Return:
+            A tuple containing the keys and values of the view, of shape (batch_size, num_heads, max_cache_len,
+            head_dim).
+        """
+        cache_position = cache_kwargs.get("cache_position")
+        batch_size, num_heads, _, head_dim = key_states.shape
+        k_pool = self.key_pool[layer_idx]
+        v_pool = self.value_pool[layer_idx]
+
+        slots = self.slot_mapping[:batch_size, cache_position].reshape(-1)
+        k_pool.index_copy_(1, slots, key_states.transpose(0, 1).reshape(num_heads, -1, head_dim))
+        v_pool.index_copy_(1, slots, value_states.transpose(0, 1).reshape(num_heads, -1, head_dim))
+
+        if self._is_contiguous:
+            return k_pool[None, :, : self.max_cache_len], v_pool[None, :, : self.max_cache_len]
+
+        view_slots = self.slot_mapping[:batch_size, : self.max_cache_len].reshape(-1)
+        k_out = k_pool[:, view_slots].view(num_heads, batch_size, self.max_cache_len, head_dim).transpose(0, 1)
+        v_out = v_pool[:, view_slots].view(num_heads, batch_size, self.max_cache_len, head_dim).transpose(0, 1)
+        return k_out, v_out
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        """Returns the sequence length of the cached states that were seen by the model."""
+        # Same as `StaticCache.get_seq_length`, limited to the view of the first sequence.
+        if self.max_cache_len == 0:
+            return 0
+        view_slots = self.slot_mapping[0, : self.max_cache_len]
+        return self.key_pool[layer_idx][0, view_slots].any(dim=-1).sum()
+
+    def reset(self):
+        """Zeros the allocated blocks and returns them to the pool."""
+        used_blocks = [block for table in self.block_tables for block in table]
+        if len(used_blocks) > 0:
+            used_slots = (
+                torch.tensor(used_blocks, dtype=torch.long)[:, None] * self.block_size
+                + torch.arange(self.block_size)[None, :]
+            ).reshape(-1)
+            used_slots = used_slots.to(self.device)
+            for layer_idx in range(len(self.key_pool)):
+                # In-place ops prevent breaking the static address
+                self.key_pool[layer_idx].index_fill_(1, used_slots, 0)
+                self.value_pool[layer_idx].index_fill_(1, used_slots, 0)
+        self.block_tables = [[] for _ in range(self.batch_size)]
+        self._free_blocks = list(range(self.num_blocks))
+        self.max_cache_len = 0
+        self._is_contiguous = True
@@ -1,7 +1,10 @@
 import contextlib
+from collections import Counter
 from contextlib import contextmanager
 from functools import wraps
+from typing import Optional
 import torch
+from torch.utils._python_dispatch import TorchDispatchMode
 from transformers.integrations import is_deepspeed_available
 
 if is_deepspeed_available():
@@ -107,6 +110,141 @@ def revert_delay_pattern(data):
     return torch.cat(out_l, dim=0)
 
 
+def split_stop_strings(stop_strings, tokenizer):
+    """Split the stop strings into the ids of the ones that are added tokens, e.g. `<|eot_id|>`, and the others.
+
+    An added token is never split or merged by the tokenizer, so the generated text ends with it exactly when the last
+    generated token is its id. The other stop strings still need to be matched on the decoded text.
+
+    Returns:
+        stop_token_ids (`List[int]`): The ids of the stop strings that are added tokens.
+        stop_strings (`List[str]`, *optional*): The remaining stop strings, or `None` if there are none.
+    """
+    if isinstance(stop_strings, str):
+        stop_strings = [stop_strings]
+    added_vocab = tokenizer.get_added_vocab()
+    stop_token_ids = [added_vocab[stop_string] for stop_string in stop_strings if stop_string in added_vocab]
+    remaining_stop_strings = [stop_string for stop_string in stop_strings if stop_string not in added_vocab]
+    return stop_token_ids, remaining_stop_strings or None
+
+
+class GrowableTensor:
+    """A tensor that grows along its last dimension, e.g. the input ids during generation.
+
+    The values live in a preallocated buffer whose capacity doubles when it is full, so appending costs amortized O(1)
+    copies instead of the O(n) copy of `torch.cat`. `tensor` is a view of the buffer. Appending never changes the
+    values seen by the previous views, but `truncate()` followed by `append()` does.
+
+    Args:
+        values (:obj:`torch.Tensor`):
+            The initial values. They are copied to the buffer.
+        capacity (:obj:`int`, *optional*):
+            The initial capacity of the buffer. Defaults to twice the length of `values`.
+    """
+
+    def __init__(self, values: torch.Tensor, capacity: Optional[int] = None):
+        length = values.shape[-1]
+        capacity = max(capacity if capacity is not None else 2 * length, length, 1)
+        self._buffer = values.new_empty(values.shape[:-1] + (capacity,))
+        self._buffer[..., :length] = values
+        self._length = length
+        self.num_reallocations = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    @property
+    def capacity(self) -> int:
+        return self._buffer.shape[-1]
+
+    @property
+    def tensor(self) -> torch.Tensor:
+        return self._buffer[..., : self._length]
+
+    def append(self, values: torch.Tensor) -> torch.Tensor:
+        """Appends `values` along the last dimension and returns the view of all the values."""
+        new_length = self._length + values.shape[-1]
+        if new_length > self.capacity:
+            buffer = self._buffer.new_empty(self._buffer.shape[:-1] + (max(2 * self.capacity, new_length),))
+            buffer[..., : self._length] = self.tensor
+            self._buffer = buffer
+            self.num_reallocations += 1
+        self._buffer[..., self._length : new_length] = values
+        self._length = new_length
+        return self.tensor
+
+    def truncate(self, length: int) -> torch.Tensor:
+        """Drops the values after the first `length` ones and returns the view of the remaining values."""
+        self._length = min(length, self._length)
+        return self.tensor
+
+
+class HostSyncCounter(TorchDispatchMode):
+    """Counts the operations that make the host wait for the device, e.g. to check the number of synchronizations
+    per generated token.
+
+    The counted operations are the reads of tensor values on the host (`item()`, `tolist()`, `bool()`, `int()`,
+    ...), the copies to the CPU, and the operations whose output shape depends on the values (`nonzero()`, boolean
+    indexing, ...). They are counted on any device, including the CPU where they do not actually synchronize, so
+    that the count does not depend on where the model runs.
+
+    Example::
+
+        with HostSyncCounter() as counter:
+            model.generate(...)
+        print(counter.num_syncs, counter.counts)
+    """
+
+    # The methods that read the values on the host. They are wrapped, because they do not always go through the
+    # dispatcher, e.g. for inference tensors.
+    _READ_METHODS = ("item", "tolist", "numpy", "__bool__", "__int__", "__float__")
+    # The operations whose output shape depends on the values of their inputs
+    _DATA_DEPENDENT_OPS = {"aten::nonzero", "aten::masked_select", "aten::unique_consecutive", "aten::_unique2"}
+
+    def __init__(self):
+        super().__init__()
+        self.counts = Counter()
+
+    @property
+    def num_syncs(self) -> int:
+        return sum(self.counts.values())
+
+    def __enter__(self):
+        self._original_methods = {name: getattr(torch.Tensor, name) for name in self._READ_METHODS}
+        for name, method in self._original_methods.items():
+            setattr(torch.Tensor, name, self._wrap_method(name, method))
+        return super().__enter__()
+
+    def __exit__(self, *args):
+        for name, method in self._original_methods.items():
+            setattr(torch.Tensor, name, method)
+        return super().__exit__(*args)
+
+    def _wrap_method(self, name, method):
+        @wraps(method)
+        def wrapper(tensor, *args, **kwargs):
+            self.counts[f"Tensor.{name}"] += 1
+            return method(tensor, *args, **kwargs)
+
+        return wrapper
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        name = func._schema.name
+        if name in self._DATA_DEPENDENT_OPS:
+            self.counts[name] += 1
+        elif name in ("aten::index", "aten::index_put", "aten::index_put_") and any(
+            isinstance(index, torch.Tensor) and index.dtype == torch.bool for index in args[1] if index is not None
+        ):
+            self.counts[f"{name} (boolean mask)"] += 1
+        elif name in ("aten::_to_copy", "aten::copy_"):
+            source = args[1] if name == "aten::copy_" else args[0]
+            target_device = args[0].device if name == "aten::copy_" else kwargs.get("device")
+            if target_device is not None and torch.device(target_device).type == "cpu" and source.device.type != "cpu":
+                self.counts["device to host copy"] += 1
+        return func(*args, **kwargs)
+
+
 def merge_input_ids_with_audio_features(
     audio_features_embed,
     audio_features_length,
@@ -179,6 +317,9 @@ def merge_input_ids_with_audio_features(
             Mask for audio-in discrete tokens
         final_audio_out_mask
             Mask for audio-out embeddings
+        max_num_text_tokens
+            The largest number of positions of a merged sequence that are not audio discrete codes, as an `int` on
+            the host
 
     Explanation:
         each audio has variable length embeddings, with length specified by
@@ -233,6 +374,8 @@ def merge_input_ids_with_audio_features(
         audio_in_embed = None
     if audio_out_embed is not None and audio_out_embed.shape[0] == 0:
         audio_out_embed = None
+    has_audio_in = audio_features_embed is not None or audio_in_embed is not None
+    has_audio_out = audio_out_embed is not None
 
     batch_size, sequence_length, embed_dim = inputs_embeds.shape
 
@@ -245,180 +388,153 @@ def merge_input_ids_with_audio_features(
     text_token_mask = (input_ids != audio_in_token_idx) & (input_ids != audio_out_token_idx)
 
     # 1. Calculate the number of tokens for each placeholder (like [<|AUDIO|>, <|AUDIO_OUT|>]).
-    token_placeholder_num = torch.ones_like(input_ids)
-
+    # The i-th placeholder of each type, in row-major order, is filled with the i-th audio of this type. The audio-in
+    # placeholders are filled with the audio features followed by the audio-in tokens.
+    def _get_audio_idx(token_mask):
+        return (token_mask.view(-1).cumsum(0) - 1).clamp(min=0).view(batch_size, sequence_length)
+
+    def _get_codes_length(ids_start, embed):
+        last_length = torch.tensor([embed.shape[0]], device=ids_start.device, dtype=torch.long) - ids_start[-1:]
+        return torch.concat([ids_start[1:] - ids_start[:-1], last_length], dim=0).long().to(target_device)
+
+    audio_in_idx = _get_audio_idx(audio_in_token_mask)
+    audio_out_idx = _get_audio_idx(audio_out_token_mask)
+    audio_features_num = torch.zeros_like(input_ids)
+    audio_in_codes_num = torch.zeros_like(input_ids)
+    audio_out_codes_num = torch.zeros_like(input_ids)
     if audio_features_embed is not None:
-        num_audios, max_audio_tokens, _ = audio_features_embed.shape
-        audio_in_features_mask = torch.arange(max_audio_tokens).expand(num_audios, max_audio_tokens).to(
-            audio_features_length.device
-        ) < audio_features_length.unsqueeze(1)
-        masked_audio_in_features = audio_features_embed[audio_in_features_mask].view(-1, embed_dim)
-        token_placeholder_num[audio_in_token_mask] = audio_features_length.long()
-
+        audio_features_num = audio_features_length.long().to(target_device)[audio_in_idx]
     if audio_in_embed is not None:
-        audio_in_codes_length = torch.concat(
-            [
-                audio_in_ids_start[1:] - audio_in_ids_start[:-1],
-                torch.tensor(
-                    [audio_in_embed.shape[0] - audio_in_ids_start[-1]],
-                    device=audio_in_ids_start.device,
-                    dtype=torch.long,
-                ),
-            ],
-            dim=0,
+        audio_in_codes_num = _get_codes_length(audio_in_ids_start, audio_in_embed)[audio_in_idx]
+    if audio_out_embed is not None:
+        audio_out_codes_num = _get_codes_length(audio_out_ids_start, audio_out_embed)[audio_out_idx]
+
+    # The placeholders of a type without audio keep one token, which is left empty.
+    token_placeholder_num = torch.ones_like(input_ids)
+    if has_audio_in:
+        token_placeholder_num = torch.where(
+            audio_in_token_mask, audio_features_num + audio_in_codes_num, token_placeholder_num
         )
+    if has_audio_out:
+        token_placeholder_num = torch.where(audio_out_token_mask, audio_out_codes_num, token_placeholder_num)
+
+    # The last and first positions of the tokens of each placeholder, before padding
+    token_ends = torch.cumsum(token_placeholder_num, -1) - 1
+    token_starts = token_ends - token_placeholder_num + 1
+    num_tokens = token_ends[:, -1] + 1
+
+    # 2. Find the length of the merged sequences, after removing the columns that are only padding. The attended
+    # tokens are the attended text tokens and the audio tokens.
+    is_audio_token = (audio_in_token_mask & has_audio_in) | (audio_out_token_mask & has_audio_out)
+    is_attended = (text_token_mask & (attention_mask != 0)) | (is_audio_token & (token_placeholder_num > 0))
+    first_attended = torch.where(is_attended, token_starts, torch.iinfo(token_starts.dtype).max).amin(-1)
+    last_attended = torch.where(is_attended, token_ends, -1).amax(-1)
+    # The number of audio discrete codes of each sequence, which are all attended.
+    num_codes = torch.zeros_like(num_tokens)
+    if has_audio_in:
+        num_codes = num_codes + torch.where(audio_in_token_mask, audio_in_codes_num, 0).sum(-1)
+    if has_audio_out:
+        num_codes = num_codes + torch.where(audio_out_token_mask, audio_out_codes_num, 0).sum(-1)
+    # This is the only synchronization with the device.
+    num_tokens_list, first_attended_list, last_attended_list, num_codes_list = torch.stack(
+        [num_tokens, first_attended, last_attended, num_codes]
+    ).tolist()
+
+    max_token_num = _ceil_to_nearest(max(num_tokens_list), round_to)
+    if left_padding:
+        # The sequences are aligned to the right, so trim the padding columns on the left.
+        first_attended_locs = [
+            max_token_num - n + loc
+            for n, loc, last in zip(num_tokens_list, first_attended_list, last_attended_list)
+            if last >= 0
+        ]
+        first_non_zero_loc = (min(first_attended_locs) // round_to) * round_to if first_attended_locs else 0
+        merged_length = max_token_num - first_non_zero_loc
+        # The position of the first token of each sequence in the merged sequences
+        sequence_starts = max_token_num - first_non_zero_loc - num_tokens
+    else:
+        # We have done right padding, so we need to trim the mask
+        last_non_zero_loc = max(last_attended_list) + 1
+        last_non_zero_loc = ((last_non_zero_loc + round_to - 1) // round_to) * round_to
+        merged_length = last_non_zero_loc if 0 < last_non_zero_loc < max_token_num else max_token_num
+        sequence_starts = torch.zeros_like(num_tokens)
+
+    # 3. Find the token that fills each position of the merged sequences, and the offset of the position in its span
+    seq_indices = torch.arange(merged_length, device=target_device).unsqueeze(0) - sequence_starts.unsqueeze(1)
+    token_indices = torch.searchsorted(token_ends.contiguous(), seq_indices.contiguous())
+    is_valid = (seq_indices >= 0) & (token_indices < sequence_length)
+    token_indices = token_indices.clamp(max=sequence_length - 1)
+    token_offsets = seq_indices - token_starts.gather(1, token_indices)
+
+    is_text = is_valid & text_token_mask.gather(1, token_indices)
+    final_audio_in_mask = is_valid & audio_in_token_mask.gather(1, token_indices) & has_audio_in
+    final_audio_out_mask = is_valid & audio_out_token_mask.gather(1, token_indices) & has_audio_out
+    is_audio_features = final_audio_in_mask & (token_offsets < audio_features_num.gather(1, token_indices))
+    final_audio_in_discrete_codes_mask = final_audio_in_mask & ~is_audio_features
+
+    # 4. Scatter the text embeddings, the audio features, the audio-in embeddings and the audio-out embeddings to
+    # their positions in the flattened merged sequences. The rows that are not kept are written to an extra last row.
+    dump_loc = batch_size * merged_length
+    token_positions = sequence_starts.unsqueeze(1) + token_starts
+    token_locs = torch.where(
+        (token_positions >= 0) & (token_positions < merged_length),
+        torch.arange(batch_size, device=target_device).unsqueeze(1) * merged_length + token_positions,
+        dump_loc,
+    )
+    final_embedding = inputs_embeds.new_zeros((dump_loc + 1, embed_dim))
+    final_embedding[torch.where(text_token_mask, token_locs, dump_loc).view(-1)] = inputs_embeds.reshape(-1, embed_dim)
+
+    def _get_placeholder_locs(token_mask, audio_idx, num_audios):
+        # The location of the first token of each placeholder, or of the extra last row for the missing ones
+        placeholder_locs = token_locs.new_full((num_audios + 1,), dump_loc)
+        return placeholder_locs.scatter_(
+            0, torch.where(token_mask, audio_idx, num_audios).view(-1), token_locs.view(-1)
+        )[:num_audios]
+
+    def _scatter_codes(embed, ids_start, placeholder_locs, offsets):
+        rows = torch.arange(embed.shape[0], device=target_device)
+        audio_indices = torch.searchsorted(ids_start, rows, right=True) - 1
+        locs = placeholder_locs[audio_indices]
+        locs = torch.where(locs == dump_loc, dump_loc, locs + offsets[audio_indices] + rows - ids_start[audio_indices])
+        final_embedding[locs] = embed.to(inputs_embeds.dtype)
+
+    if has_audio_in:
+        num_audios = (audio_in_ids_start if audio_in_embed is not None else audio_features_length).shape[0]
+        audio_in_locs = _get_placeholder_locs(audio_in_token_mask, audio_in_idx, num_audios)
+        # The audio-in tokens follow the audio features.
+        audio_in_codes_offsets = torch.zeros_like(audio_in_locs)
         if audio_features_embed is not None:
-            token_placeholder_num[audio_in_token_mask] += audio_in_codes_length.long()
-        else:
-            token_placeholder_num[audio_in_token_mask] = audio_in_codes_length.long()
-
+            max_audio_tokens = audio_features_embed.shape[1]
+            audio_in_codes_offsets = audio_features_length.long().to(target_device)
+            feature_offsets = torch.arange(max_audio_tokens, device=target_device).unsqueeze(0)
+            feature_locs = torch.where(
+                (feature_offsets < audio_in_codes_offsets.unsqueeze(1)) & (audio_in_locs != dump_loc).unsqueeze(1),
+                audio_in_locs.unsqueeze(1) + feature_offsets,
+                dump_loc,
+            )
+            final_embedding[feature_locs.view(-1)] = audio_features_embed.reshape(-1, embed_dim).to(
+                inputs_embeds.dtype
+            )
+        if audio_in_embed is not None:
+            _scatter_codes(audio_in_embed, audio_in_ids_start.to(target_device), audio_in_locs, audio_in_codes_offsets)
     if audio_out_embed is not None:
-        audio_out_codes_length = torch.concat(
-            [
-                audio_out_ids_start[1:] - audio_out_ids_start[:-1],
-                torch.tensor(
-                    [audio_out_embed.shape[0] - audio_out_ids_start[-1]],
-                    device=audio_out_ids_start.device,
-                    dtype=torch.long,
-                ),
-            ],
-            dim=0,
+        num_audios = audio_out_ids_start.shape[0]
+        audio_out_locs = _get_placeholder_locs(audio_out_token_mask, audio_out_idx, num_audios)
+        _scatter_codes(
+            audio_out_embed, audio_out_ids_start.to(target_device), audio_out_locs, torch.zeros_like(audio_out_locs)
         )
-        token_placeholder_num[audio_out_token_mask] = audio_out_codes_length.long()
-
-    new_token_positions = torch.cumsum(token_placeholder_num, -1) - 1
-    max_token_num = _ceil_to_nearest(token_placeholder_num.sum(-1).max(), round_to)
-    nb_audio_pad = max_token_num - 1 - new_token_positions[:, -1]
-
-    if left_padding:
-        new_token_positions += nb_audio_pad[:, None]  # offset for left padding
+    final_embedding = final_embedding[:dump_loc].view(batch_size, merged_length, embed_dim)
 
-    # 2. Create the full embedding, already padded to the maximum position
-    final_embedding = torch.zeros(
-        (batch_size, max_token_num, embed_dim), dtype=inputs_embeds.dtype, device=inputs_embeds.device
-    )
-    final_attention_mask = torch.zeros(
-        (batch_size, max_token_num), dtype=attention_mask.dtype, device=inputs_embeds.device
-    )
-    final_input_ids = torch.full(
-        (batch_size, max_token_num), pad_token_id, dtype=input_ids.dtype, device=inputs_embeds.device
-    )
+    # 5. Gather the input ids, the labels and the attention mask. The audio tokens keep the id of their placeholder.
+    is_audio = final_audio_in_mask | final_audio_out_mask
+    final_input_ids = torch.where(is_text | is_audio, input_ids.gather(1, token_indices), pad_token_id)
     if skip_labels:
         final_labels = None
     else:
-        final_labels = torch.full(
-            (batch_size, max_token_num), ignore_index, dtype=label_ids.dtype, device=inputs_embeds.device
-        )
-
-    final_audio_in_mask = torch.full((batch_size, max_token_num), False, dtype=torch.bool, device=inputs_embeds.device)
-    final_audio_in_discrete_codes_mask = torch.full(
-        (batch_size, max_token_num), False, dtype=torch.bool, device=inputs_embeds.device
-    )
-    final_audio_out_mask = torch.full(
-        (batch_size, max_token_num), False, dtype=torch.bool, device=inputs_embeds.device
+        final_labels = torch.where(is_text, label_ids.gather(1, token_indices), ignore_index)
+    final_attention_mask = torch.where(is_text, attention_mask.gather(1, token_indices), is_audio).to(
+        attention_mask.dtype
     )
-    # 3. Get the audio-in token positions and audio-out token positions
-    batch_id = torch.arange(batch_size, device=target_device).unsqueeze(1).expand(batch_size, sequence_length)
-    audio_in_batch_id = batch_id[audio_in_token_mask]  # Shape (num_audio_in,)
-    audio_out_batch_id = batch_id[audio_out_token_mask]  # Shape (num_audio_out,)
-    audio_features_token_ends = new_token_positions[audio_in_token_mask]  # Shape (num_audio_in,)
-    audio_out_embed_ends = new_token_positions[audio_out_token_mask]  # Shape (num_audio_out,)
-
-    if audio_in_embed is not None:
-        # Fill in the audio-in embeddings
-        seq_indices = (
-            torch.arange(max_token_num, device=target_device)
-            .unsqueeze(0)
-            .expand(audio_in_ids_start.shape[0], max_token_num)
-        )
-        audio_in_embed_token_starts = audio_features_token_ends - audio_in_codes_length + 1
-        batch_indices, col_indices = torch.where(
-            (seq_indices >= audio_in_embed_token_starts.unsqueeze(1))
-            & (seq_indices <= audio_features_token_ends.unsqueeze(1))
-        )
-        batch_indices = audio_in_batch_id[batch_indices]
-        final_embedding[batch_indices, col_indices] = audio_in_embed
-        final_input_ids[batch_indices, col_indices] = audio_in_token_idx
-        if not skip_labels:
-            final_labels[batch_indices, col_indices] = ignore_index
-        final_audio_in_mask[batch_indices, col_indices] = True
-        final_audio_in_discrete_codes_mask[batch_indices, col_indices] = True
-        audio_features_token_ends = audio_features_token_ends - audio_in_codes_length
-
-    if audio_features_embed is not None:
-        # Fill in the audio features
-        seq_indices = (
-            torch.arange(max_token_num, device=target_device)
-            .unsqueeze(0)
-            .expand(audio_features_embed.shape[0], max_token_num)
-        )
-        audio_features_token_starts = audio_features_token_ends - audio_features_length + 1
-        batch_indices, col_indices = torch.where(
-            (seq_indices >= audio_features_token_starts.unsqueeze(1))
-            & (seq_indices <= audio_features_token_ends.unsqueeze(1))
-        )
-        batch_indices = audio_in_batch_id[batch_indices]
-        final_embedding[batch_indices, col_indices] = masked_audio_in_features
-        final_input_ids[batch_indices, col_indices] = audio_in_token_idx
-        if not skip_labels:
-            final_labels[batch_indices, col_indices] = ignore_index
-        final_audio_in_mask[batch_indices, col_indices] = True
-
-    if audio_out_embed is not None:
-        # Fill in the audio-out embeddings
-        seq_indices = (
-            torch.arange(max_token_num, device=target_device)
-            .unsqueeze(0)
-            .expand(audio_out_ids_start.shape[0], max_token_num)
-        )
-        audio_out_embed_token_starts = audio_out_embed_ends - audio_out_codes_length + 1
-        batch_indices, col_indices = torch.where(
-            (seq_indices >= audio_out_embed_token_starts.unsqueeze(1))
-            & (seq_indices <= audio_out_embed_ends.unsqueeze(1))
-        )
-        batch_indices = audio_out_batch_id[batch_indices]
-        final_embedding[batch_indices, col_indices] = audio_out_embed
-        final_input_ids[batch_indices, col_indices] = audio_out_token_idx
-        if not skip_labels:
-            final_labels[batch_indices, col_indices] = ignore_index
-        final_audio_out_mask[batch_indices, col_indices] = True
-
-    # Fill in the original text embeddings and labels
-    batch_indices, non_audio_indices = torch.where(text_token_mask)
-    text_to_overwrite = new_token_positions[batch_indices, non_audio_indices]
-    final_embedding[batch_indices, text_to_overwrite] = inputs_embeds[batch_indices, non_audio_indices]
-    if not skip_labels:
-        final_labels[batch_indices, text_to_overwrite] = label_ids[batch_indices, non_audio_indices]
-    final_input_ids[batch_indices, text_to_overwrite] = input_ids[batch_indices, non_audio_indices]
-    final_attention_mask[batch_indices, text_to_overwrite] = attention_mask[batch_indices, non_audio_indices]
-    final_attention_mask = final_attention_mask | final_audio_in_mask | final_audio_out_mask
-
-    # Trim the tensor if there are redundant padding tokens
-    if left_padding:
-        first_non_zero_loc = final_attention_mask.sum(0).nonzero()[0]
-        first_non_zero_loc = (first_non_zero_loc // round_to) * round_to
-        if first_non_zero_loc > 0:
-            final_attention_mask = final_attention_mask[:, first_non_zero_loc:]
-            final_embedding = final_embedding[:, first_non_zero_loc:]
-            if not skip_labels:
-                final_labels = final_labels[:, first_non_zero_loc:]
-            final_input_ids = final_input_ids[:, first_non_zero_loc:]
-            final_audio_in_mask = final_audio_in_mask[:, first_non_zero_loc:]
-            final_audio_in_discrete_codes_mask = final_audio_in_discrete_codes_mask[:, first_non_zero_loc:]
-            final_audio_out_mask = final_audio_out_mask[:, first_non_zero_loc:]
-    else:
-        # We have done right padding, so we need to trim the mask
-        last_non_zero_loc = final_attention_mask.sum(0).nonzero()[-1] + 1
-        last_non_zero_loc = ((last_non_zero_loc + round_to - 1) // round_to) * round_to
-        if last_non_zero_loc < max_token_num:
-            final_attention_mask = final_attention_mask[:, :last_non_zero_loc]
-            final_embedding = final_embedding[:, :last_non_zero_loc]
-            if not skip_labels:
-                final_labels = final_labels[:, :last_non_zero_loc]
-            final_input_ids = final_input_ids[:, :last_non_zero_loc]
-            final_audio_in_mask = final_audio_in_mask[:, :last_non_zero_loc]
-            final_audio_in_discrete_codes_mask = final_audio_in_discrete_codes_mask[:, :last_non_zero_loc]
-            final_audio_out_mask = final_audio_out_mask[:, :last_non_zero_loc]
 
     position_ids = (final_attention_mask.cumsum(-1) - 1).masked_fill_((final_attention_mask == 0), 1)
     return (
@@ -430,6 +546,7 @@ def merge_input_ids_with_audio_features(
         final_audio_in_mask,
         final_audio_in_discrete_codes_mask,
         final_audio_out_mask,
+        merged_length - min(num_codes_list),
     )
 
 
@@ -0,0 +1,168 @@
+from typing import List, Optional
+
+import numpy as np
+import torch
+
+
+class StreamingAudioDecoder:
+    """Incrementally turns the delayed audio tokens of a single audio segment into PCM chunks.
+
+    The audio tokens arrive one delayed column at a time, as produced by `HiggsAudioModel` with the delay pattern.
+    A frame of codes is complete once the last codebook has caught up, so frames are un-delayed as soon as their last
+    column arrives. The first frame (audio stream bos) and the last frame (audio stream eos) are dropped, like
+    `revert_delay_pattern(...)[:, 1:-1]` does on the whole segment.
+
+    If the audio tokenizer supports chunked decoding (`create_streaming_decoder()`), every `chunk_frames` new frames
+    are decoded once by the stateful decoder, which returns exactly the samples that the next frames cannot change.
+
+    Otherwise, every `chunk_frames` new frames, a window of frames is decoded by the audio tokenizer. The decoder is
+    not causal, so each window also covers `context_frames` frames of left context and `lookahead_frames` frames of
+    right context, whose samples are discarded. The last `overlap_frames` frames before the lookahead are held back
+    and cross-faded with the next window using the two halves of a Hamming window. The lookahead is therefore bounded
+    by `chunk_frames + lookahead_frames` frames.
+
+    Args:
+        audio_tokenizer (`HiggsAudioTokenizer`):
+            The audio tokenizer used to decode the codes.
+        num_codebooks (`int`):
+            The number of codebooks.
+        codebook_size (`int`):
+            The size of the codebooks. The codes are clipped to it, like the stream bos and eos codes of the delay
+            pattern.
+        samples_per_frame (`int`):
+            The number of audio samples decoded for each frame.
+        hamming_window_len (`int`):
+            The length in samples of the Hamming window. Its halves are the fade-out and fade-in of the overlap, so
+            the overlap is `hamming_window_len // 2` samples, rounded down to whole frames.
+        chunk_frames (`int`):
+            The number of new frames decoded at once.
+        context_frames (`int`, *optional*):
+            The number of extra frames decoded before the overlap. Defaults to the number of overlap frames.
+        lookahead_frames (`int`, *optional*):
+            The number of frames decoded after the held back frames. Defaults to the number of overlap frames.
+    """
+
+    def __init__(
+        self,
+        audio_tokenizer,
+        num_codebooks: int,
+        codebook_size: int,
+        samples_per_frame: int,
+        hamming_window_len: int,
+        chunk_frames: int = 16,
+        context_frames: Optional[int] = None,
+        lookahead_frames: Optional[int] = None,
+    ):
+        self.audio_tokenizer = audio_tokenizer
+        self.num_codebooks = num_codebooks
+        self.codebook_size = codebook_size
+        self.samples_per_frame = samples_per_frame
+        self.chunk_frames = chunk_frames
+        self.overlap_frames = min(max(hamming_window_len // 2 // samples_per_frame, 1), chunk_frames)
+        self.context_frames = self.overlap_frames if context_frames is None else context_frames
+        self.lookahead_frames = self.overlap_frames if lookahead_frames is None else lookahead_frames
+
+        overlap_len = self.overlap_frames * samples_per_frame
+        window = torch.hamming_window(2 * overlap_len, periodic=True, dtype=torch.float64).numpy()
+        # The halves of a periodic Hamming window sum to a constant, which we normalize to 1.
+        self.fade_in = (window[:overlap_len] / (window[:overlap_len] + window[overlap_len:])).astype(np.float32)
+        self.fade_out = 1.0 - self.fade_in
+
+        self._streaming_decoder = None
+        if hasattr(audio_tokenizer, "create_streaming_decoder"):
+            self._streaming_decoder = audio_tokenizer.create_streaming_decoder()
+        self.reset()
+
+    def reset(self):
+        """Clears the state, e.g. at the start of a new audio segment."""
+        self._columns: List[torch.Tensor] = []
+        self._num_columns = 0
+        self._frames: List[torch.Tensor] = []
+        self._last_frame: Optional[torch.Tensor] = None
+        self._decoded_frames = 0
+        self._tail: Optional[np.ndarray] = None
+        if self._streaming_decoder is not None:
+            self._streaming_decoder.reset()
+
+    def _get_codes(self, start: int, end: int) -> torch.Tensor:
+        if start == end:
+            return torch.zeros((1, self.num_codebooks, 0), dtype=torch.long)
+        codes = torch.stack(self._frames[start:end], dim=1)
+        return codes.clip(0, self.codebook_size - 1).unsqueeze(0)
+
+    def _decode_chunk(self, is_final: bool) -> Optional[np.ndarray]:
+        codes = self._get_codes(self._decoded_frames, len(self._frames))
+        audio = self.audio_tokenizer.decode_chunk(codes, self._streaming_decoder, is_final=is_final)[0, 0]
+        self._decoded_frames = len(self._frames)
+        return audio if audio.shape[0] > 0 else None
+
+    def _decode(self, end: int, is_final: bool) -> Optional[np.ndarray]:
+        start = max(self._decoded_frames - self.overlap_frames - self.context_frames, 0)
+        audio = self.audio_tokenizer.decode(self._get_codes(start, end))[0, 0]
+
+        def to_sample(frame_idx):
+            return (frame_idx - start) * self.samples_per_frame
+
+        chunks = []
+        if self._tail is not None:
+            overlap = audio[to_sample(self._decoded_frames - self.overlap_frames) : to_sample(self._decoded_frames)]
+            chunks.append(self._tail * self.fade_out + overlap * self.fade_in)
+        if is_final:
+            chunks.append(audio[to_sample(self._decoded_frames) :])
+            self._tail = None
+            self._decoded_frames = end
+        else:
+            # The frames of the lookahead are only decoded to give right context to the held back frames.
+            ready = end - self.lookahead_frames
+            chunks.append(audio[to_sample(self._decoded_frames) : to_sample(ready - self.overlap_frames)])
+            self._tail = audio[to_sample(ready - self.overlap_frames) : to_sample(ready)]
+            self._decoded_frames = ready
+        return np.concatenate(chunks)
+
+    def put(self, audio_tokens: torch.Tensor) -> Optional[np.ndarray]:
+        """Adds a column of delayed audio tokens, of shape (num_codebooks,), or several columns, of shape
+        (num_codebooks, num_columns).
+
+        Returns the PCM samples that became final, if any.
+        """
+        if audio_tokens.dim() == 1:
+            return self._put_column(audio_tokens)
+        chunks = [self._put_column(column) for column in audio_tokens.cpu().unbind(1)]
+        chunks = [chunk for chunk in chunks if chunk is not None]
+        return np.concatenate(chunks) if len(chunks) > 0 else None
+
+    def _put_column(self, audio_tokens: torch.Tensor) -> Optional[np.ndarray]:
+        self._columns = (self._columns + [audio_tokens.cpu()])[-self.num_codebooks :]
+        self._num_columns += 1
+        frame_idx = self._num_columns - self.num_codebooks
+        if frame_idx < 0:
+            return None
+        frame = torch.stack([self._columns[i][i] for i in range(self.num_codebooks)])
+        if frame_idx == 0:
+            # Skip the audio stream bos frame
+            return None
+        # We only know that the previous frame is not the last one (audio stream eos) once this one is complete.
+        if self._last_frame is not None:
+            self._frames.append(self._last_frame)
+        self._last_frame = frame
+
+        if self._streaming_decoder is not None:
+            if len(self._frames) - self._decoded_frames >= self.chunk_frames:
+                return self._decode_chunk(is_final=False)
+            return None
+        if len(self._frames) - self._decoded_frames >= self.chunk_frames + self.lookahead_frames:
+            return self._decode(len(self._frames), is_final=False)
+        return None
+
+    def flush(self) -> Optional[np.ndarray]:
+        """Decodes the remaining frames at the end of the audio segment and resets the state."""
+        audio = None
+        if self._streaming_decoder is not None:
+            if len(self._frames) > 0:
+                audio = self._decode_chunk(is_final=True)
+        elif len(self._frames) > self._decoded_frames:
+            audio = self._decode(len(self._frames), is_final=True)
+        elif self._tail is not None:
+            audio = self._tail
+        self.reset()
+        return audio
@@ -0,0 +1,51 @@
+from typing import List
+
+
+class IncrementalDetokenizer:
+    """Turns a stream of text token ids into text deltas.
+
+    Decoding each token on its own breaks the characters whose UTF-8 bytes are split over several byte-level tokens,
+    e.g. most CJK characters, into replacement characters. Decoding the whole sequence again for each token is
+    quadratic. Instead, like the detokenizer of vLLM, only the window of tokens after `prefix_offset` is decoded:
+
+    - `prefix_offset:read_offset` are the tokens whose text was already returned. They are decoded again so that the
+      tokenizer sees the context of the new tokens, e.g. for the leading spaces of SentencePiece tokens.
+    - `read_offset:` are the new tokens. Their text is the difference between the two decodes. It is held back while it
+      ends with an incomplete character, i.e. a replacement character, until the next tokens complete it.
+
+    Args:
+        tokenizer (`AutoTokenizer`):
+            The tokenizer used to decode the token ids.
+        decode_kwargs (`dict`, *optional*):
+            Additional keyword arguments to pass to the tokenizer's `decode` method.
+    """
+
+    def __init__(self, tokenizer, **decode_kwargs):
+        self.tokenizer = tokenizer
+        self.decode_kwargs = decode_kwargs
+        self.token_ids: List[int] = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def _decode(self, token_ids: List[int]) -> str:
+        if len(token_ids) == 0:
+            return ""
+        return self.tokenizer.decode(token_ids, **self.decode_kwargs)
+
+    def add(self, token_ids: List[int]) -> str:
+        """Adds new token ids and returns the text that they complete, which may be empty."""
+        self.token_ids.extend(token_ids)
+        prefix_text = self._decode(self.token_ids[self.prefix_offset : self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset :])
+        if len(new_text) <= len(prefix_text) or new_text.endswith("�"):
+            return ""
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text) :]
+
+    def flush(self) -> str:
+        """Returns the text of the held back tokens, with replacement characters for the incomplete ones."""
+        prefix_text = self._decode(self.token_ids[self.prefix_offset : self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset :])
+        self.prefix_offset = self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text) :]
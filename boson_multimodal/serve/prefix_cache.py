@@ -0,0 +1,111 @@
+import hashlib
+import torch
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+
+@dataclass
+class PrefixCacheEntry:
+    """The KV states of a prompt prefix.
+
+    The keys and values of each layer have shape (num_heads, num_tokens, head_dim), where `num_tokens` is the length
+    of the prefix after the audio codes have been merged into the sequence.
+    """
+
+    key_states: List[torch.Tensor]
+    value_states: List[torch.Tensor]
+    audio_discrete_codes_mask: torch.Tensor  # shape (1, num_tokens)
+    num_prompt_tokens: int  # The number of input ids in the prefix
+
+    @property
+    def num_tokens(self) -> int:
+        return self.audio_discrete_codes_mask.shape[1]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(t.numel() * t.element_size() for t in self.key_states + self.value_states)
+
+
+def get_prefix_inputs(
+    inputs: Dict[str, Optional[torch.Tensor]], prefix_len: int, audio_in_token_id: int, audio_out_token_id: int
+) -> Dict[str, Optional[torch.Tensor]]:
+    """Slice the model inputs of a single sample to its first `prefix_len` input ids.
+
+    The prefix should not end in the middle of an audio segment, i.e., every audio placeholder in the prefix keeps
+    all its audio codes or features.
+    """
+    input_ids = inputs["input_ids"][:, :prefix_len]
+    prefix_inputs = {
+        "input_ids": input_ids,
+        "attention_mask": inputs["attention_mask"][:, :prefix_len],
+    }
+    num_audio_in = int((input_ids == audio_in_token_id).sum())
+    num_audio_out = int((input_ids == audio_out_token_id).sum())
+    for name, num_segments in [("audio_in", num_audio_in), ("audio_out", num_audio_out)]:
+        ids, ids_start = inputs.get(f"{name}_ids"), inputs.get(f"{name}_ids_start")
+        if ids_start is not None and ids_start.shape[0] > 0:
+            end = ids_start[num_segments].item() if num_segments < ids_start.shape[0] else ids.shape[1]
+            prefix_inputs[f"{name}_ids"] = ids[:, :end]
+            prefix_inputs[f"{name}_ids_start"] = ids_start[:num_segments]
+    if inputs.get("audio_features") is not None:
+        prefix_inputs["audio_features"] = inputs["audio_features"][:num_audio_in]
+        prefix_inputs["audio_feature_attention_mask"] = inputs["audio_feature_attention_mask"][:num_audio_in]
+    return prefix_inputs
+
+
+class PrefixKVCache:
+    """LRU cache of the KV states of prompt prefixes, e.g. a shared system message and reference voice.
+
+    The entries are keyed by a hash of the prefix inputs, i.e. the token ids plus the audio codes (and the audio
+    features, if any). The least recently used entries are evicted once the KV states exceed `max_bytes`.
+
+    Args:
+        max_bytes (`int`):
+            The memory budget of the cached KV states, in bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.num_hits = 0
+        self.num_misses = 0
+        self._entries: OrderedDict[str, PrefixCacheEntry] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def compute_key(prefix_inputs: Dict[str, Optional[torch.Tensor]]) -> str:
+        hasher = hashlib.sha256()
+        for name in sorted(prefix_inputs.keys()):
+            value = prefix_inputs[name]
+            if value is None:
+                continue
+            value = value.detach().cpu().contiguous()
+            hasher.update(f"{name}:{value.dtype}:{tuple(value.shape)}".encode())
+            # Hash the raw bytes, which also works for the dtypes that numpy does not support, e.g. bfloat16
+            hasher.update(value.view(torch.uint8).numpy().tobytes())
+        return hasher.hexdigest()
+
+    def get(self, key: str) -> Optional[PrefixCacheEntry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.num_misses += 1
+            return None
+        self.num_hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, entry: PrefixCacheEntry) -> None:
+        if key in self._entries or entry.nbytes > self.max_bytes:
+            return
+        while self.num_bytes + entry.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.num_bytes -= evicted.nbytes
+        self._entries[key] = entry
+        self.num_bytes += entry.nbytes
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.num_bytes = 0
@@ -0,0 +1,553 @@
+import time
+import torch
+import torch.nn.functional as F
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, Hashable, List, Optional, Set
+
+from transformers.cache_utils import DynamicCache
+from transformers.generation import GenerationConfig
+from transformers.generation.logits_process import (
+    LogitsProcessorList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from ..model.higgs_audio import HiggsAudioModel
+from ..model.higgs_audio.modeling_higgs_audio import GenerationMode
+from ..model.higgs_audio.utils import GrowableTensor
+from .prefix_cache import PrefixCacheEntry, PrefixKVCache, get_prefix_inputs
+
+
+@dataclass
+class HiggsAudioSequence:
+    """The generation state of a single request handled by the `HiggsAudioScheduler`.
+
+    Each sequence keeps its own generation mode, delay-pattern counters and audio history, so sequences that sit in
+    different stages (text, audio) can share the same decoding step. The sequences with the same `sampling_key` are
+    sampled together.
+    """
+
+    request_id: str
+    inputs: dict
+    max_new_tokens: int
+    generation_config: GenerationConfig
+    logits_processor: LogitsProcessorList
+    stop_token_ids: Set[int]
+    sampling_key: Hashable
+    torch_generator: Optional[torch.Generator] = None
+    prefix_len: Optional[int] = None  # The number of input ids of the prompt prefix shared with other requests
+
+    # Generation state
+    generation_mode: GenerationMode = GenerationMode.TEXT
+    next_token_id: Optional[int] = None
+    next_tokens: Optional[torch.Tensor] = None  # The next token id on the device, shape (1,)
+    next_audio_tokens: Optional[torch.Tensor] = None
+    # The most recent audio tokens, used by repetition aware sampling. It is a ring buffer updated in place.
+    ras_window: Optional[torch.Tensor] = None
+    ras_window_pos: int = 0
+    num_delay: Optional[torch.Tensor] = None
+    num_remaining_delays: Optional[torch.Tensor] = None
+    output_token_ids: List[int] = field(default_factory=list)
+    audio_segments: List[GrowableTensor] = field(default_factory=list)
+    num_generated_tokens: int = 0
+    num_cached_prompt_tokens: int = 0  # The number of prompt tokens read from the prefix cache
+    finish_reason: Optional[str] = None
+
+    # Timing statistics
+    arrival_time: float = field(default_factory=time.perf_counter)
+    first_token_time: Optional[float] = None
+    finish_time: Optional[float] = None
+
+    @property
+    def num_prompt_tokens(self) -> int:
+        return self.inputs["input_ids"].shape[1]
+
+    @property
+    def audio_sequences(self) -> List[torch.Tensor]:
+        """The audio codes of each generated audio segment, with shape (num_codebooks, num_steps)."""
+        return [segment.tensor for segment in self.audio_segments]
+
+    @property
+    def is_finished(self) -> bool:
+        return self.finish_reason is not None
+
+    @property
+    def time_to_first_token(self) -> Optional[float]:
+        """Seconds between the arrival of the request and its first generated token."""
+        if self.first_token_time is None:
+            return None
+        return self.first_token_time - self.arrival_time
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        """Decoding speed of the request, measured after the first generated token."""
+        if self.finish_time is None or self.num_generated_tokens <= 1:
+            return None
+        elapsed = self.finish_time - self.first_token_time
+        return (self.num_generated_tokens - 1) / elapsed if elapsed > 0 else None
+
+
+class HiggsAudioScheduler:
+    """Iteration-level (continuous batching) scheduler for `HiggsAudioModel`.
+
+    Requests are queued with `add_request()`. Every call to `step()`:
+
+    1. admits waiting requests as long as the running batch has fewer than `max_batch_size` sequences. Each admitted
+       request is prefilled on its own and its KV cache is merged into the running batch with left padding.
+    2. runs a single batched forward pass that decodes one token for every running sequence. Each sequence samples
+       from the text or the audio logits depending on its own generation mode. The sequences that share the same
+       sampling parameters are sampled in one call, and the sampled token ids are read on the host once per step.
+    3. retires the finished sequences from the batch and returns them.
+
+    The batch uses a `DynamicCache`, so the sequences never need to be padded to a fixed length.
+
+    With a `prefix_cache`, the prefill of a request with a `prefix_len` reads the KV states of its prompt prefix from
+    the cache, or computes and adds them on a miss, and only runs the model on the rest of the prompt.
+
+    Parameters:
+        model (`HiggsAudioModel`):
+            The model used for generation. The audio special tokens should have been set with
+            `set_audio_special_tokens()`.
+        max_batch_size (`int`, *optional*, defaults to 8):
+            The maximum number of sequences that are decoded together.
+        prefix_cache (`PrefixKVCache`, *optional*):
+            The cache of the KV states of the prompt prefixes. It can be shared with a `HiggsAudioServeEngine`.
+    """
+
+    def __init__(self, model: HiggsAudioModel, max_batch_size: int = 8, prefix_cache: Optional[PrefixKVCache] = None):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        # The number of layers with KV states. The audio self-attention layers come right after their decoder layer.
+        config = model.config
+        self.num_cache_layers = config.text_config.num_hidden_layers
+        if config.use_audio_out_self_attention:
+            self.num_cache_layers += len(config.audio_dual_ffn_layers)
+        self.waiting: Deque[HiggsAudioSequence] = deque()
+        self.running: List[HiggsAudioSequence] = []
+
+        # States of the running batch. The attention mask and the audio codes mask are aligned with the KV cache.
+        self.past_key_values: Optional[DynamicCache] = None
+        self.attention_mask: Optional[torch.Tensor] = None
+        self.audio_discrete_codes_mask: Optional[torch.Tensor] = None
+        self.decode_kwargs: Dict[str, Optional[torch.Tensor]] = {}
+
+    def add_request(
+        self,
+        request_id: str,
+        inputs: dict,
+        max_new_tokens: int,
+        temperature: float = 0.7,
+        top_k: Optional[int] = None,
+        top_p: float = 0.95,
+        stop_token_ids: Optional[List[int]] = None,
+        ras_win_len: Optional[int] = 7,
+        ras_win_max_num_repeat: int = 2,
+        seed: Optional[int] = None,
+        prefix_len: Optional[int] = None,
+    ) -> HiggsAudioSequence:
+        """Queue a request. `inputs` are the model inputs of a single sample, as returned by the collator.
+
+        `prefix_len` is the number of input ids of the prompt prefix whose KV states are read from the prefix cache.
+        The prefix should not end in the middle of an audio segment.
+        """
+        assert inputs["input_ids"].shape[0] == 1, "Each request should contain a single sample."
+        if ras_win_len is not None and ras_win_len <= 0:
+            ras_win_len = None
+
+        do_sample = temperature != 0.0
+        generation_config = GenerationConfig(
+            do_sample=do_sample,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            max_new_tokens=max_new_tokens,
+            generation_kwargs={
+                "ras_win_len": ras_win_len,
+                "ras_win_max_num_repeat": ras_win_max_num_repeat,
+                "audio_eos_token_id": self.model.audio_eos_token_id,
+            },
+        )
+        # Follow the order of the warpers in `GenerationMixin._get_logits_processor`.
+        logits_processor = LogitsProcessorList()
+        if do_sample:
+            if temperature != 1.0:
+                logits_processor.append(TemperatureLogitsWarper(temperature))
+            if top_k is not None and top_k != 0:
+                logits_processor.append(TopKLogitsWarper(top_k=top_k, min_tokens_to_keep=1))
+            if top_p is not None and top_p < 1.0:
+                logits_processor.append(TopPLogitsWarper(top_p=top_p, min_tokens_to_keep=1))
+
+        if seed is not None:
+            torch_generator = torch.Generator(device=inputs["input_ids"].device).manual_seed(seed)
+        else:
+            torch_generator = None
+
+        seq = HiggsAudioSequence(
+            request_id=request_id,
+            inputs=inputs,
+            max_new_tokens=max_new_tokens,
+            generation_config=generation_config,
+            logits_processor=logits_processor,
+            stop_token_ids=set(stop_token_ids or []),
+            # A sequence with its own seed is sampled on its own, so that its tokens only depend on the seed.
+            sampling_key=(do_sample, temperature, top_k, top_p, ras_win_len, ras_win_max_num_repeat)
+            if torch_generator is None
+            else request_id,
+            torch_generator=torch_generator,
+            prefix_len=prefix_len,
+        )
+        self.waiting.append(seq)
+        return seq
+
+    def has_unfinished_requests(self) -> bool:
+        return len(self.waiting) > 0 or len(self.running) > 0
+
+    @torch.inference_mode()
+    def step(self) -> List[HiggsAudioSequence]:
+        """Run one scheduling iteration and return the sequences that finished in this iteration."""
+        finished = []
+        while self.waiting and len(self.running) < self.max_batch_size:
+            seq = self.waiting.popleft()
+            self._prefill(seq)
+            if seq.is_finished:
+                finished.append(seq)
+
+        if self.running:
+            self._decode()
+            finished.extend(self._retire_finished())
+        return finished
+
+    def run(self) -> List[HiggsAudioSequence]:
+        """Keep stepping until all the queued requests are finished. Returns the sequences in completion order."""
+        finished = []
+        while self.has_unfinished_requests():
+            finished.extend(self.step())
+        return finished
+
+    def _prefill(self, seq: HiggsAudioSequence):
+        inputs = seq.inputs
+        input_ids = inputs["input_ids"]
+        model = self.model
+
+        # Initialize the audio variables based on the input prompt, following `HiggsAudioModel._sample`.
+        seq.num_delay = torch.zeros(1, dtype=torch.long, device=input_ids.device)
+        seq.num_remaining_delays = torch.full((1,), -1, dtype=torch.long, device=input_ids.device)
+        if input_ids[0, -1] == model.audio_out_bos_token_id:
+            seq.generation_mode = GenerationMode.AUDIO_INIT
+        elif input_ids[0, -1] == model.audio_out_token_idx:
+            seq.generation_mode = GenerationMode.AUDIO_IN_PROGRESS
+            seq.audio_segments = [GrowableTensor(inputs["audio_out_ids"][:, inputs["audio_out_ids_start"][-1] :])]
+            if model.use_delay_pattern:
+                last_audio_tokens = inputs["audio_out_ids"][:, -1]
+                seq.num_delay[0] = (
+                    model.audio_num_codebooks - (last_audio_tokens == model.config.audio_stream_bos_id).sum()
+                )
+                all_eos_indices = (last_audio_tokens == model.config.audio_stream_eos_id).nonzero()
+                if torch.numel(all_eos_indices) > 0:
+                    seq.num_remaining_delays[0] = model.audio_num_codebooks - all_eos_indices[0, 0] - 1
+        ras_win_len = seq.generation_config.generation_kwargs["ras_win_len"]
+        if ras_win_len is not None:
+            # -1 is used as padding, and `ras_window_pos` is the position of the oldest token.
+            seq.ras_window = torch.full(
+                (model.audio_num_codebooks, ras_win_len), -1, dtype=torch.long, device=input_ids.device
+            )
+            if inputs["audio_out_ids"] is not None and inputs["audio_out_ids"].shape[1] > 0:
+                prompt_audio_tokens = inputs["audio_out_ids"][:, -ras_win_len:]
+                seq.ras_window[:, ras_win_len - prompt_audio_tokens.shape[1] :] = prompt_audio_tokens
+
+        past_key_values = DynamicCache()
+        prefix_kwargs = {}
+        if self.prefix_cache is not None and seq.prefix_len:
+            entry = self._prefill_prefix(seq, past_key_values)
+            prefix_kwargs = {
+                "num_cached_tokens": entry.num_tokens,
+                "cache_audio_discrete_codes_mask": entry.audio_discrete_codes_mask,
+            }
+        outputs = model(
+            **inputs,
+            **prefix_kwargs,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+            num_logits_to_keep=1,
+        )
+        audio_discrete_codes_mask = outputs.audio_in_discrete_codes_mask | outputs.audio_out_mask
+        if prefix_kwargs:
+            # The masks of the outputs only cover the tokens after the cached prefix.
+            audio_discrete_codes_mask = torch.cat(
+                [prefix_kwargs["cache_audio_discrete_codes_mask"], audio_discrete_codes_mask], dim=1
+            )
+
+        if not self.decode_kwargs:
+            # The decoding steps do not carry any new audio features, but the model expects them to have the same type.
+            for key in ["audio_features", "audio_feature_attention_mask"]:
+                if inputs.get(key) is not None:
+                    self.decode_kwargs[key] = inputs[key][:0, ...]
+
+        self._sample_next_tokens([seq], outputs.logits[:, -1:], outputs.audio_logits[-1:])
+        if not seq.is_finished:
+            self._add_to_batch(seq, outputs.past_key_values, outputs.attention_mask, audio_discrete_codes_mask)
+
+    def _prefill_prefix(self, seq: HiggsAudioSequence, past_key_values: DynamicCache) -> PrefixCacheEntry:
+        """Fill `past_key_values` with the KV states of the prompt prefix, from the prefix cache or computed on a miss."""
+        model = self.model
+        prefix_inputs = get_prefix_inputs(
+            seq.inputs,
+            seq.prefix_len,
+            audio_in_token_id=model.config.audio_in_token_idx,
+            audio_out_token_id=model.config.audio_out_token_idx,
+        )
+        key = self.prefix_cache.compute_key(prefix_inputs)
+        entry = self.prefix_cache.get(key)
+        if entry is not None:
+            # The entries of a `PagedKVCache` also hold the unused layers of its pool, which come last.
+            for layer_idx in range(self.num_cache_layers):
+                past_key_values.update(
+                    entry.key_states[layer_idx][None], entry.value_states[layer_idx][None], layer_idx
+                )
+            seq.num_cached_prompt_tokens = entry.num_prompt_tokens
+            return entry
+
+        # Only the KV states of the prefix are needed, so we do not compute the logits of all its tokens.
+        outputs = model(**prefix_inputs, past_key_values=past_key_values, use_cache=True, num_logits_to_keep=1)
+        entry = PrefixCacheEntry(
+            key_states=[key_states[0] for key_states in past_key_values.key_cache],
+            value_states=[value_states[0] for value_states in past_key_values.value_cache],
+            audio_discrete_codes_mask=outputs.audio_in_discrete_codes_mask | outputs.audio_out_mask,
+            num_prompt_tokens=seq.prefix_len,
+        )
+        self.prefix_cache.put(key, entry)
+        return entry
+
+    def _add_to_batch(
+        self,
+        seq: HiggsAudioSequence,
+        past_key_values: DynamicCache,
+        attention_mask: torch.Tensor,
+        audio_discrete_codes_mask: torch.Tensor,
+    ):
+        if not self.running:
+            self.running = [seq]
+            self.past_key_values = past_key_values
+            self.attention_mask = attention_mask
+            self.audio_discrete_codes_mask = audio_discrete_codes_mask
+            return
+
+        # Left-pad the shorter one, so that the last positions of all the sequences are aligned.
+        cur_len = self.attention_mask.shape[1]
+        new_len = attention_mask.shape[1]
+        batch_pad = max(new_len - cur_len, 0)
+        seq_pad = max(cur_len - new_len, 0)
+
+        def _pad(tensor: torch.Tensor, pad: int, dim: int, value=0):
+            if pad == 0:
+                return tensor
+            padding = [0, 0] * (tensor.dim() - dim - 1) + [pad, 0]
+            return F.pad(tensor, padding, value=value)
+
+        for layer_idx in range(len(self.past_key_values.key_cache)):
+            for batch_cache, seq_cache in [
+                (self.past_key_values.key_cache, past_key_values.key_cache),
+                (self.past_key_values.value_cache, past_key_values.value_cache),
+            ]:
+                if len(batch_cache[layer_idx]) == 0:
+                    continue
+                batch_cache[layer_idx] = torch.cat(
+                    [_pad(batch_cache[layer_idx], batch_pad, dim=2), _pad(seq_cache[layer_idx], seq_pad, dim=2)],
+                    dim=0,
+                )
+        self.past_key_values._seen_tokens = max(cur_len, new_len)
+        self.attention_mask = torch.cat(
+            [_pad(self.attention_mask, batch_pad, dim=1), _pad(attention_mask, seq_pad, dim=1)], dim=0
+        )
+        self.audio_discrete_codes_mask = torch.cat(
+            [
+                _pad(self.audio_discrete_codes_mask, batch_pad, dim=1, value=False),
+                _pad(audio_discrete_codes_mask, seq_pad, dim=1, value=False),
+            ],
+            dim=0,
+        )
+        self.running.append(seq)
+
+    def _decode(self):
+        device = self.attention_mask.device
+        input_ids = torch.cat([seq.next_tokens for seq in self.running])[:, None]
+
+        # Only the sequences in the audio generation mode feed a new audio token.
+        audio_rows = [seq for seq in self.running if seq.generation_mode == GenerationMode.AUDIO_IN_PROGRESS]
+        if audio_rows:
+            audio_out_ids = torch.stack([seq.next_audio_tokens for seq in audio_rows], dim=1)
+            audio_out_ids_start = torch.arange(len(audio_rows), dtype=torch.long, device=device)
+        else:
+            audio_out_ids = None
+            audio_out_ids_start = None
+
+        # When all the sequences decode the same type of token, only the logits of this type are computed.
+        if len(audio_rows) == len(self.running):
+            is_decoding_audio_token = True
+        elif len(audio_rows) == 0:
+            is_decoding_audio_token = False
+        else:
+            is_decoding_audio_token = None
+
+        attention_mask = torch.cat([self.attention_mask, self.attention_mask.new_ones((len(self.running), 1))], dim=1)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            audio_out_ids=audio_out_ids,
+            audio_out_ids_start=audio_out_ids_start,
+            past_key_values=self.past_key_values,
+            cache_audio_discrete_codes_mask=self.audio_discrete_codes_mask,
+            use_cache=True,
+            return_dict=True,
+            is_decoding_audio_token=is_decoding_audio_token,
+            **self.decode_kwargs,
+        )
+        self.attention_mask = outputs.attention_mask
+        self.audio_discrete_codes_mask = torch.cat(
+            [self.audio_discrete_codes_mask, outputs.audio_in_discrete_codes_mask | outputs.audio_out_mask], dim=1
+        )
+
+        self._sample_next_tokens(self.running, outputs.logits, outputs.audio_logits)
+
+    def _sample_next_tokens(
+        self, seqs: List[HiggsAudioSequence], logits: Optional[torch.Tensor], audio_logits: Optional[torch.Tensor]
+    ):
+        """Sample the next token of each sequence and update its state.
+
+        `logits` has one row per sequence, with shape (num_seqs, 1, vocab_size). `audio_logits` has one row per
+        sequence in the audio generation mode, in the same order. Each group of sequences with the same sampling
+        parameters is sampled with one call, and the token ids of all the sequences are read on the host at the end.
+        """
+        model = self.model
+        device = seqs[0].inputs["input_ids"].device
+        # The sequences that just saw the audio bos token emit <|AUDIO_OUT|> and the audio stream bos tokens. The
+        # audio stream bos tokens also start the audio segments of the text steps that sample <|AUDIO_OUT|>.
+        next_tokens = torch.full((len(seqs),), model.audio_out_token_idx, dtype=torch.long, device=device)
+        next_audio_tokens = torch.full(
+            (len(seqs), model.audio_num_codebooks), model.config.audio_stream_bos_id, dtype=torch.long, device=device
+        )
+
+        groups: Dict[Hashable, List[int]] = {}
+        audio_logits_indices = {}
+        for row, seq in enumerate(seqs):
+            if seq.generation_mode == GenerationMode.AUDIO_IN_PROGRESS:
+                audio_logits_indices[row] = len(audio_logits_indices)
+            if seq.generation_mode != GenerationMode.AUDIO_INIT:
+                groups.setdefault((seq.generation_mode, seq.sampling_key), []).append(row)
+
+        for (generation_mode, _), rows in groups.items():
+            group = [seqs[row] for row in rows]
+            generation_config = group[0].generation_config
+            rows_tensor = torch.tensor(rows, dtype=torch.long, device=device)
+            if generation_mode == GenerationMode.AUDIO_IN_PROGRESS:
+                audio_rows = torch.tensor([audio_logits_indices[row] for row in rows], dtype=torch.long, device=device)
+                ras_window = (
+                    torch.stack([seq.ras_window for seq in group]) if group[0].ras_window is not None else None
+                )
+                (
+                    group_tokens,
+                    group_audio_tokens,
+                    _,
+                    _,
+                    num_delay,
+                    num_remaining_delays,
+                ) = model._sample_audio_tokens(
+                    hidden_states=None,
+                    audio_logits=audio_logits[audio_rows],
+                    audio_out_ids=ras_window,
+                    do_sample=generation_config.do_sample,
+                    logits_processor=group[0].logits_processor,
+                    device=device,
+                    torch_generator=group[0].torch_generator,
+                    generation_config=generation_config,
+                    num_delay=torch.cat([seq.num_delay for seq in group]),
+                    num_remaining_delays=torch.cat([seq.num_remaining_delays for seq in group]),
+                )
+                next_audio_tokens[rows_tensor] = group_audio_tokens
+                for idx, seq in enumerate(group):
+                    seq.num_delay = num_delay[idx : idx + 1]
+                    seq.num_remaining_delays = num_remaining_delays[idx : idx + 1]
+            else:
+                group_tokens, _, _, _ = model._sample_text_tokens(
+                    logits=logits[rows_tensor],
+                    input_ids=rows_tensor[:, None],
+                    do_sample=generation_config.do_sample,
+                    logits_processor=group[0].logits_processor,
+                    device=device,
+                    generation_mode=generation_mode,
+                    torch_generator=group[0].torch_generator,
+                )
+            next_tokens[rows_tensor] = group_tokens
+
+        # The only read of the step on the host.
+        next_token_ids = next_tokens.tolist()
+        now = time.perf_counter()
+        for row, (seq, next_token_id) in enumerate(zip(seqs, next_token_ids)):
+            is_audio_generation = seq.generation_mode == GenerationMode.AUDIO_IN_PROGRESS
+            if is_audio_generation or next_token_id == model.audio_out_token_idx:
+                audio_tokens = next_audio_tokens[row]
+                if is_audio_generation:
+                    seq.audio_segments[-1].append(audio_tokens[:, None])
+                else:
+                    # Start a new audio segment with the audio stream bos tokens. Same as `HiggsAudioModel._sample`,
+                    # this also happens when <|AUDIO_OUT|> is sampled in the text generation mode.
+                    seq.audio_segments.append(GrowableTensor(audio_tokens[:, None]))
+                if seq.ras_window is not None:
+                    seq.ras_window[:, seq.ras_window_pos] = audio_tokens
+                    seq.ras_window_pos = (seq.ras_window_pos + 1) % seq.ras_window.shape[1]
+                seq.next_audio_tokens = audio_tokens
+            else:
+                seq.next_audio_tokens = None
+
+            if not is_audio_generation or next_token_id != model.audio_out_token_idx:
+                # Same as `HiggsAudioModel._sample`, we only keep one <|AUDIO_OUT|> token per audio segment.
+                seq.output_token_ids.append(next_token_id)
+            seq.next_token_id = next_token_id
+            seq.next_tokens = next_tokens[row : row + 1]
+            seq.num_generated_tokens += 1
+
+            if seq.first_token_time is None:
+                seq.first_token_time = now
+
+            if next_token_id == model.audio_out_bos_token_id:
+                seq.generation_mode = GenerationMode.AUDIO_INIT
+            elif next_token_id == model.audio_out_token_idx:
+                seq.generation_mode = GenerationMode.AUDIO_IN_PROGRESS
+            else:
+                seq.generation_mode = GenerationMode.TEXT
+
+            if next_token_id in seq.stop_token_ids:
+                seq.finish_reason = "stop"
+            elif seq.num_generated_tokens >= seq.max_new_tokens:
+                seq.finish_reason = "length"
+            if seq.is_finished:
+                seq.finish_time = now
+
+    def _retire_finished(self) -> List[HiggsAudioSequence]:
+        finished = [seq for seq in self.running if seq.is_finished]
+        if not finished:
+            return []
+
+        keep = [row for row, seq in enumerate(self.running) if not seq.is_finished]
+        self.running = [self.running[row] for row in keep]
+        if not self.running:
+            self.past_key_values = None
+            self.attention_mask = None
+            self.audio_discrete_codes_mask = None
+            return finished
+
+        indices = torch.tensor(keep, dtype=torch.long, device=self.attention_mask.device)
+        # Drop the leading positions that only contain padding for the remaining sequences.
+        num_padding = int(self.attention_mask[indices].any(dim=0).int().argmax())
+        self.attention_mask = self.attention_mask[indices, num_padding:]
+        self.audio_discrete_codes_mask = self.audio_discrete_codes_mask[indices, num_padding:]
+        for cache in [self.past_key_values.key_cache, self.past_key_values.value_cache]:
+            for layer_idx in range(len(cache)):
+                if len(cache[layer_idx]) > 0:
+                    cache[layer_idx] = cache[layer_idx][indices, :, num_padding:]
+        self.past_key_values._seen_tokens = self.attention_mask.shape[1]
+        return finished
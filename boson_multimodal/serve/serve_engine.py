@@ -1,35 +1,47 @@
 import asyncio
 import base64
+import math
 import torch
 import numpy as np
-from io import BytesIO
 from dataclasses import dataclass
-from typing import List, Optional, Union
+from typing import List, Optional, Tuple, Union
 from copy import deepcopy
 from transformers import AutoTokenizer, AutoProcessor
-from transformers.cache_utils import StaticCache
 from transformers.generation.streamers import BaseStreamer
 from transformers.generation.stopping_criteria import StoppingCriteria
 from dataclasses import asdict
 from loguru import logger
 import threading
-import librosa
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 
 
 from ..dataset.chatml_dataset import ChatMLSample, ChatMLDatasetSample, prepare_chatml_sample
-from ..model.higgs_audio import HiggsAudioModel
+from ..model.higgs_audio import HiggsAudioModel, PagedKVCache
 from ..model.higgs_audio.utils import revert_delay_pattern
 from ..data_collator.higgs_audio_collator import HiggsAudioSampleCollator
 from ..audio_processing.higgs_audio_tokenizer import load_higgs_audio_tokenizer
+from ..audio_processing.audio_code_cache import AudioCodeCache
+from ..audio_processing.whisper_feature_cache import WhisperFeatureCache
+from .audio_streaming import StreamingAudioDecoder
+from .detokenizer import IncrementalDetokenizer
+from .prefix_cache import PrefixCacheEntry, PrefixKVCache, get_prefix_inputs
+from .scheduler import HiggsAudioScheduler
 
 
 @dataclass
 class HiggsAudioStreamerDelta:
-    """Represents a chunk of generated content, either text or audio tokens."""
+    """Represents a chunk of generated content, either text or audio tokens.
+
+    `audio_tokens` holds consecutive delayed columns of audio tokens, with shape (num_codebooks, num_columns).
+
+    When the audio is streamed as PCM, `audio` holds the float32 samples that became final with this delta, at the
+    sampling rate of the audio tokenizer.
+    """
 
     text: Optional[str] = None
     text_tokens: Optional[torch.Tensor] = None
     audio_tokens: Optional[torch.Tensor] = None
+    audio: Optional[np.ndarray] = None
     finish_reason: Optional[str] = None
 
 
@@ -45,6 +57,14 @@ class AsyncHiggsAudioStreamer(BaseStreamer):
             Whether to skip the prompt tokens in generation.
         timeout (`float`, *optional*):
             The timeout for the queue. If `None`, the queue will block indefinitely.
+        audio_chunk_frames (`int`, *optional*, defaults to 4):
+            The number of audio columns sent together in one delta. Every delta wakes up the event loop, so sending
+            several columns at once saves most of the per-column work of the loop when it serves many streams. Set it
+            to 1 to send every column right away.
+        audio_chunk_ms (`float`, *optional*, defaults to 50):
+            If set, the buffered audio columns are also sent by a timer of the event loop once the oldest one has
+            waited for this many milliseconds, so that a slow generation does not delay them. The buffered columns are
+            always sent right away before a text token and at the end of the generation.
         decode_kwargs (`dict`, *optional*):
             Additional keyword arguments to pass to the tokenizer's `decode` method.
 
@@ -79,6 +99,8 @@ class AsyncHiggsAudioStreamer(BaseStreamer):
         skip_prompt: bool = False,
         timeout: Optional[float] = None,
         audio_num_codebooks: int = 1,
+        audio_chunk_frames: int = 4,
+        audio_chunk_ms: Optional[float] = 50.0,
         **decode_kwargs,
     ):
         self.tokenizer = tokenizer
@@ -86,6 +108,8 @@ class AsyncHiggsAudioStreamer(BaseStreamer):
         self.timeout = timeout
         self.decode_kwargs = decode_kwargs
         self.audio_num_codebooks = audio_num_codebooks
+        self.audio_chunk_frames = audio_chunk_frames
+        self.audio_chunk_ms = audio_chunk_ms
         # Queue to store generated chunks
         self.queue = asyncio.Queue()
         self.stop_signal = None
@@ -96,19 +120,51 @@ class AsyncHiggsAudioStreamer(BaseStreamer):
 
         # State tracking
         self.next_tokens_are_prompt = True
+        self.detokenizer = IncrementalDetokenizer(tokenizer, **decode_kwargs)
+        # The audio columns are buffered by the generation thread and flushed by it or by a timer of the event loop.
+        self._audio_lock = threading.Lock()
+        self._audio_columns: List[torch.Tensor] = []
+        # Incremented at every flush, so that the timer of a chunk that was already sent does nothing.
+        self._audio_chunk_id = 0
+
+    def _send(self, delta: HiggsAudioStreamerDelta):
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, delta)
+
+    def _flush_audio(self):
+        """Sends the buffered audio columns as one delta. The caller holds `_audio_lock`."""
+        if len(self._audio_columns) == 0:
+            return
+        audio_tokens = torch.stack(self._audio_columns, dim=1)
+        self._audio_columns = []
+        self._audio_chunk_id += 1
+        self._send(HiggsAudioStreamerDelta(audio_tokens=audio_tokens))
+
+    def _start_flush_timer(self, audio_chunk_id: int):
+        # Runs in the event loop
+        self.loop.call_later(self.audio_chunk_ms / 1000, self._flush_audio_on_timer, audio_chunk_id)
+
+    def _flush_audio_on_timer(self, audio_chunk_id: int):
+        with self._audio_lock:
+            if audio_chunk_id == self._audio_chunk_id:
+                self._flush_audio()
 
     def put(self, value: torch.Tensor):
         """
         Receives tokens and processes them as either text or audio tokens.
-        For text tokens, decodes and caches them until complete words are formed.
-        For audio tokens, directly queues them.
+        For text tokens, decodes them incrementally. The text of a token that ends with an incomplete UTF-8 character
+        is held back and sent with the tokens that complete it, so the text of a delta may be empty.
+        For audio tokens, buffers them and queues `audio_chunk_frames` columns at once.
         """
         if value.shape[0] > 1 and not self.next_tokens_are_prompt:
             # This is likely audio tokens (shape: [audio_num_codebooks])
             assert value.shape[0] == self.audio_num_codebooks, "Number of codebooks mismatch"
-            delta = HiggsAudioStreamerDelta(audio_tokens=value)
-            if self.loop.is_running():
-                self.loop.call_soon_threadsafe(self.queue.put_nowait, delta)
+            with self._audio_lock:
+                self._audio_columns.append(value)
+                if len(self._audio_columns) >= self.audio_chunk_frames:
+                    self._flush_audio()
+                elif len(self._audio_columns) == 1 and self.audio_chunk_ms is not None and self.loop.is_running():
+                    self.loop.call_soon_threadsafe(self._start_flush_timer, self._audio_chunk_id)
             return
 
         # Skip prompt tokens if configured
@@ -120,16 +176,22 @@ class AsyncHiggsAudioStreamer(BaseStreamer):
         if len(value.shape) > 1:
             value = value[0]
 
-        text = self.tokenizer.decode(value, **self.decode_kwargs)
-        delta = HiggsAudioStreamerDelta(text=text, text_tokens=value)
-        if self.loop.is_running():
-            self.loop.call_soon_threadsafe(self.queue.put_nowait, delta)
+        # A text token ends the audio segment
+        text = self.detokenizer.add(value.tolist())
+        with self._audio_lock:
+            self._flush_audio()
+            self._send(HiggsAudioStreamerDelta(text=text, text_tokens=value))
 
     def end(self):
-        """Flushes any remaining text tokens and signals the end of generation."""
+        """Flushes any remaining audio and text tokens and signals the end of generation."""
         self.next_tokens_are_prompt = True
-        if self.loop.is_running():
-            self.loop.call_soon_threadsafe(self.queue.put_nowait, self.stop_signal)
+        text = self.detokenizer.flush()
+        with self._audio_lock:
+            self._flush_audio()
+            if text:
+                self._send(HiggsAudioStreamerDelta(text=text, text_tokens=torch.zeros(0, dtype=torch.long)))
+            if self.loop.is_running():
+                self.loop.call_soon_threadsafe(self.queue.put_nowait, self.stop_signal)
 
     def __aiter__(self):
         return self
@@ -176,6 +238,7 @@ class HiggsAudioResponse:
     generated_text: str = ""
     generated_text_tokens: Optional[np.ndarray] = None
     usage: Optional[dict] = None
+    metrics: Optional[dict] = None
 
 
 class HiggsAudioServeEngine:
@@ -187,6 +250,12 @@ class HiggsAudioServeEngine:
         device: str = "cuda",
         torch_dtype: Union[torch.dtype, str] = "auto",
         kv_cache_lengths: List[int] = [1024, 4096, 8192],  # Multiple KV cache sizes
+        kv_cache_block_size: int = 16,
+        prefix_cache_max_bytes: int = 1024**3,
+        audio_code_cache_dir: Optional[str] = None,
+        audio_code_cache_size: int = 256,
+        whisper_feature_cache_max_bytes: int = 1024**3,
+        num_preprocess_workers: int = 2,
     ):
         """
         Initialize the HiggsAudioServeEngine, a serving wrapper for the HiggsAudioModel.
@@ -202,7 +271,25 @@ class HiggsAudioServeEngine:
             device (str):
                 The device to use for the model.
             kv_cache_lengths (List[int]):
-                The lengths of the KV caches to use for the model. Used for cuda graph capture when device is cuda.
+                The lengths of the KV cache views to use for the model. Used for cuda graph capture when device is cuda.
+                The paged KV cache holds as many tokens as the largest length.
+            kv_cache_block_size (int):
+                The number of tokens in each block of the paged KV cache.
+            prefix_cache_max_bytes (int):
+                The memory budget of the KV states cached for the shared prompt prefixes. Set it to 0 to disable
+                the prefix cache.
+            audio_code_cache_dir (str):
+                The directory of the on-disk tier of the reference audio code cache, which can be shared between
+                engines. If not set, the audio codes are only cached in memory.
+            audio_code_cache_size (int):
+                The number of audio codes kept in memory. Use `self.audio_code_cache.warm_up(audio_dir)` to
+                pre-populate the cache, e.g. with `examples/voice_prompts/`.
+            whisper_feature_cache_max_bytes (int):
+                The memory budget of the whisper features and audio tower outputs cached for the audio inputs, when
+                the model encodes them with whisper. Set it to 0 to disable the whisper feature cache.
+            num_preprocess_workers (int):
+                The number of threads that prepare the inputs of the streamed requests, i.e. decode and tokenize the
+                reference audios and collate the samples, while the model generates.
             torch_dtype (Union[torch.dtype, str]):
                 The dtype to use for the model.
         """
@@ -227,26 +314,31 @@ class HiggsAudioServeEngine:
         self.audio_tokenizer_tps = self.audio_tokenizer.tps
         self.samples_per_token = int(self.audio_tokenizer.sampling_rate // self.audio_tokenizer_tps)
         self.hamming_window_len = 2 * self.audio_num_codebooks * self.samples_per_token
+        self.audio_code_cache = AudioCodeCache(
+            self.audio_tokenizer, cache_dir=audio_code_cache_dir, max_memory_entries=audio_code_cache_size
+        )
         # Set the audio special tokens
         self.model.set_audio_special_tokens(self.tokenizer)
 
-        # Prepare KV caches for different lengths
+        # Prepare the paged KV cache shared by all the lengths
         cache_config = deepcopy(self.model.config.text_config)
         cache_config.num_hidden_layers = self.model.config.text_config.num_hidden_layers
         if self.model.config.audio_dual_ffn_layers:
             cache_config.num_hidden_layers += len(self.model.config.audio_dual_ffn_layers)
-        # A list of KV caches for different lengths
-        self.kv_caches = {
-            length: StaticCache(
-                config=cache_config,
-                max_batch_size=1,
-                max_cache_len=length,
-                device=self.model.device,
-                dtype=self.model.dtype,
-            )
-            for length in sorted(kv_cache_lengths)
-        }
+        # The sequence grows block by block in a single pool instead of being copied between buckets
+        self.kv_cache = PagedKVCache(
+            config=cache_config,
+            num_blocks=math.ceil(max(kv_cache_lengths) / kv_cache_block_size),
+            block_size=kv_cache_block_size,
+            cache_lengths=kv_cache_lengths,
+            max_batch_size=1,
+            device=self.model.device,
+            dtype=self.model.dtype,
+        )
+        # The KV states of the prompt prefixes shared between requests, e.g. the system message and reference voices
+        self.prefix_cache = PrefixKVCache(prefix_cache_max_bytes) if prefix_cache_max_bytes > 0 else None
 
+        self.whisper_feature_cache = None
         if self.model.config.encode_whisper_embed:
             logger.info(f"Loading whisper processor")
             whisper_processor = AutoProcessor.from_pretrained(
@@ -254,6 +346,11 @@ class HiggsAudioServeEngine:
                 trust_remote=True,
                 device=self.device,
             )
+            if whisper_feature_cache_max_bytes > 0:
+                # Repeated audio inputs, e.g. the same recording with different questions, skip the feature
+                # extraction in the collator and the audio tower in the model
+                self.whisper_feature_cache = WhisperFeatureCache(whisper_feature_cache_max_bytes)
+                self.model.set_audio_feature_cache(self.whisper_feature_cache)
         else:
             whisper_processor = None
 
@@ -270,13 +367,22 @@ class HiggsAudioServeEngine:
             use_delay_pattern=self.model.config.use_delay_pattern,
             audio_num_codebooks=self.model.config.audio_num_codebooks,
             round_to=1,
+            whisper_feature_cache=self.whisper_feature_cache,
         )
 
+        # The streamed requests are prepared in a bounded thread pool, off the event loop, while the model executes
+        # the previous requests one at a time, since they share the KV cache.
+        self._preprocess_executor = ThreadPoolExecutor(
+            max_workers=num_preprocess_workers, thread_name_prefix="higgs-audio-preprocess"
+        )
+        self._execute_lock = threading.Lock()
+
         # Capture CUDA graphs for each KV cache length
         if device == "cuda":
             logger.info(f"Capturing CUDA graphs for each KV cache length")
-            self.model.capture_model(self.kv_caches.values())
+            self.model.capture_model([self.kv_cache])
 
+    @torch.no_grad()
     def _prepare_inputs(self, chat_ml_sample: ChatMLSample, force_audio_gen: bool = False):
         input_tokens, _, audio_contents, _ = prepare_chatml_sample(
             chat_ml_sample,
@@ -293,17 +399,9 @@ class HiggsAudioServeEngine:
         audio_ids_l = []
         for audio_content in audio_contents:
             if audio_content.audio_url not in ["placeholder", ""]:
-                raw_audio, _ = librosa.load(audio_content.audio_url, sr=self.audio_tokenizer.sampling_rate)
+                audio_ids_l.append(self.audio_code_cache.encode(audio_content.audio_url))
             elif audio_content.raw_audio is not None:
-                raw_audio, _ = librosa.load(
-                    BytesIO(base64.b64decode(audio_content.raw_audio)), sr=self.audio_tokenizer.sampling_rate
-                )
-            else:
-                raw_audio = None
-
-            if raw_audio is not None:
-                audio_ids = self.audio_tokenizer.encode(raw_audio, self.audio_tokenizer.sampling_rate)
-                audio_ids_l.append(audio_ids.squeeze(0).cpu())
+                audio_ids_l.append(self.audio_code_cache.encode(base64.b64decode(audio_content.raw_audio)))
 
         if len(audio_ids_l) > 0:
             audio_ids_start = torch.tensor(
@@ -335,8 +433,86 @@ class HiggsAudioServeEngine:
         return inputs
 
     def _prepare_kv_caches(self):
-        for kv_cache in self.kv_caches.values():
-            kv_cache.reset()
+        self.kv_cache.reset()
+
+    def _get_prefix_len(self, inputs: dict) -> Optional[int]:
+        """The number of input ids of the prompt prefix, or None if the prompt has a single message."""
+        eot_token_id = self.tokenizer.convert_tokens_to_ids("<|eot_id|>")
+        eot_positions = (inputs["input_ids"][0] == eot_token_id).nonzero()
+        if eot_positions.shape[0] < 2:
+            return None
+        # The prefix ends after the second to last <|eot_id|>, so it never splits an audio segment.
+        return eot_positions[-2, 0].item() + 1
+
+    def _prepare_prefix_kv_cache(self, inputs: dict) -> Tuple[dict, int]:
+        """Fill the KV cache with the prompt prefix, i.e. all the messages but the last one.
+
+        The KV states of the prefix are read from the prefix cache, or computed and added to it on a miss.
+
+        Returns the generation kwargs to skip the prefix and the number of prompt tokens read from the prefix cache.
+        """
+        if self.prefix_cache is None:
+            return {}, 0
+        prefix_len = self._get_prefix_len(inputs)
+        if prefix_len is None:
+            return {}, 0
+        prefix_inputs = get_prefix_inputs(
+            inputs,
+            prefix_len,
+            audio_in_token_id=self.model.config.audio_in_token_idx,
+            audio_out_token_id=self.model.config.audio_out_token_idx,
+        )
+        key = self.prefix_cache.compute_key(prefix_inputs)
+        entry = self.prefix_cache.get(key)
+        if entry is not None:
+            self.kv_cache.set_prefix(entry.key_states, entry.value_states)
+            num_cached_prompt_tokens = entry.num_prompt_tokens
+        else:
+            # Only the KV states of the prefix are needed, so we do not compute the logits of all its tokens.
+            outputs = self.model(**prefix_inputs, past_key_values=self.kv_cache, use_cache=True, num_logits_to_keep=1)
+            audio_discrete_codes_mask = outputs.audio_in_discrete_codes_mask | outputs.audio_out_mask
+            key_states, value_states = self.kv_cache.get_prefix(audio_discrete_codes_mask.shape[1])
+            entry = PrefixCacheEntry(
+                key_states=key_states,
+                value_states=value_states,
+                audio_discrete_codes_mask=audio_discrete_codes_mask,
+                num_prompt_tokens=prefix_len,
+            )
+            self.prefix_cache.put(key, entry)
+            num_cached_prompt_tokens = 0
+        generation_kwargs = {
+            "num_cached_tokens": entry.num_tokens,
+            "cache_audio_discrete_codes_mask": entry.audio_discrete_codes_mask,
+        }
+        return generation_kwargs, num_cached_prompt_tokens
+
+    def _get_prefix_cache_usage(self) -> dict:
+        """The numbers of prefix cache hits and misses since the engine was created."""
+        if self.prefix_cache is None:
+            return {"prefix_cache_hits": 0, "prefix_cache_misses": 0}
+        return {"prefix_cache_hits": self.prefix_cache.num_hits, "prefix_cache_misses": self.prefix_cache.num_misses}
+
+    def _decode_audio_sequences(self, audio_sequences: List[torch.Tensor]) -> Optional[np.ndarray]:
+        if len(audio_sequences) == 0:
+            return None
+        wv_list = []
+        for output_audio in audio_sequences:
+            vq_code = revert_delay_pattern(output_audio).clip(0, self.audio_codebook_size - 1)[:, 1:-1]
+            wv_numpy = self.audio_tokenizer.decode(vq_code.unsqueeze(0))[0, 0]
+            wv_list.append(wv_numpy)
+        return np.concatenate(wv_list)
+
+    def _get_stop_token_ids(self, stop_strings: List[str]) -> List[int]:
+        stop_token_ids = []
+        for stop_string in stop_strings:
+            token_ids = self.tokenizer.encode(stop_string, add_special_tokens=False)
+            if len(token_ids) != 1:
+                raise ValueError(
+                    f"The stop string {stop_string!r} is encoded into {len(token_ids)} tokens. "
+                    f"Only stop strings that map to a single token are supported in batch generation."
+                )
+            stop_token_ids.append(token_ids[0])
+        return stop_token_ids
 
     def generate(
         self,
@@ -366,6 +542,9 @@ class HiggsAudioServeEngine:
             A dictionary with the following keys:
                 audio: The generated audio.
                 sampling_rate: The sampling rate of the generated audio.
+                usage: The token counts, including the prompt tokens read from the prefix cache (`cached_tokens`)
+                    and the numbers of prefix cache hits and misses of the engine (`prefix_cache_hits` and
+                    `prefix_cache_misses`).
         """
         # Default stop strings
         if stop_strings is None:
@@ -377,33 +556,30 @@ class HiggsAudioServeEngine:
             inputs = self._prepare_inputs(chat_ml_sample, force_audio_gen=force_audio_gen)
             prompt_token_ids = inputs["input_ids"][0].cpu().numpy()
 
-            self._prepare_kv_caches()
-
-            outputs = self.model.generate(
-                **inputs,
-                max_new_tokens=max_new_tokens,
-                use_cache=True,
-                stop_strings=stop_strings,
-                tokenizer=self.tokenizer,
-                do_sample=False if temperature == 0.0 else True,
-                temperature=temperature,
-                top_k=top_k,
-                top_p=top_p,
-                past_key_values_buckets=self.kv_caches,
-                ras_win_len=ras_win_len,
-                ras_win_max_num_repeat=ras_win_max_num_repeat,
-                seed=seed,
-            )
+            with self._execute_lock:
+                self._prepare_kv_caches()
+                prefix_kwargs, num_cached_prompt_tokens = self._prepare_prefix_kv_cache(inputs)
+
+                outputs = self.model.generate(
+                    **inputs,
+                    **prefix_kwargs,
+                    max_new_tokens=max_new_tokens,
+                    use_cache=True,
+                    stop_strings=stop_strings,
+                    tokenizer=self.tokenizer,
+                    do_sample=False if temperature == 0.0 else True,
+                    temperature=temperature,
+                    top_k=top_k,
+                    top_p=top_p,
+                    past_key_values=self.kv_cache,
+                    ras_win_len=ras_win_len,
+                    ras_win_max_num_repeat=ras_win_max_num_repeat,
+                    seed=seed,
+                )
+                kv_cache_blocks_in_use = self.kv_cache.num_used_blocks
+                prefix_cache_usage = self._get_prefix_cache_usage()
 
-            if len(outputs[1]) > 0:
-                wv_list = []
-                for output_audio in outputs[1]:
-                    vq_code = revert_delay_pattern(output_audio).clip(0, self.audio_codebook_size - 1)[:, 1:-1]
-                    wv_numpy = self.audio_tokenizer.decode(vq_code.unsqueeze(0))[0, 0]
-                    wv_list.append(wv_numpy)
-                wv_numpy = np.concatenate(wv_list)
-            else:
-                wv_numpy = None
+            wv_numpy = self._decode_audio_sequences(outputs[1])
 
             # We only support one request at a time now
             generated_text_tokens = outputs[0][0].cpu().numpy()[len(prompt_token_ids) :]
@@ -421,10 +597,153 @@ class HiggsAudioServeEngine:
                     "total_tokens": (
                         prompt_token_ids.shape[0] + generated_text_tokens.shape[0] + generated_audio_tokens.shape[1]
                     ),
-                    "cached_tokens": 0,
+                    "cached_tokens": num_cached_prompt_tokens,
+                    **prefix_cache_usage,
                 },
+                metrics={"kv_cache_blocks_in_use": kv_cache_blocks_in_use},
             )
 
+    def generate_batch(
+        self,
+        chat_ml_samples: List[ChatMLSample],
+        max_new_tokens: int,
+        temperature: float = 0.7,
+        top_k: Optional[int] = None,
+        top_p: float = 0.95,
+        stop_strings: Optional[List[str]] = None,
+        force_audio_gen: bool = False,
+        ras_win_len: Optional[int] = 7,
+        ras_win_max_num_repeat: int = 2,
+        seed: Optional[int] = None,
+        max_batch_size: int = 8,
+    ) -> List[HiggsAudioResponse]:
+        """
+        Generate audio for multiple chatml samples with continuous batching.
+        The samples are prepared in the preprocessing thread pool, and each request is admitted into the running
+        decode batch as soon as its inputs are ready and there is a free slot. Finished requests are retired after
+        every step. The prompt prefixes are read from and added to the prefix cache of the engine. See
+        `HiggsAudioScheduler` for details.
+        The batch only holds `chat_ml_samples`: requests that arrive while it runs cannot join it. To admit them, drive
+        a `HiggsAudioScheduler` built with the `prefix_cache` of the engine directly, with `add_request()` and `step()`.
+        Args:
+            chat_ml_samples: A list of chatml samples.
+            max_new_tokens: The maximum number of new tokens to generate for each sample.
+            temperature: The temperature to use for the generation.
+            top_p: The top p to use for the generation.
+            stop_strings: A list of strings to stop the generation. Each string should map to a single token.
+            force_audio_gen: Whether to force audio generation. This ensures the model generates audio tokens rather than text tokens.
+            ras_win_len: The length of the RAS window. We use 7 by default. You can disable it by setting it to None or <=0.
+            ras_win_max_num_repeat: The maximum number of times to repeat the RAS window.
+            seed: The seed of the first sample. The i-th sample uses `seed + i`.
+            max_batch_size: The maximum number of samples that are decoded together.
+        Returns:
+            A list of `HiggsAudioResponse`, in the same order as `chat_ml_samples`. The `usage` field contains the
+            prompt tokens read from the prefix cache, as in `generate`. The `metrics` field contains the time to first
+            token (in seconds) and the decoding speed (in tokens/sec) of each request.
+        """
+        # Default stop strings
+        if stop_strings is None:
+            stop_strings = ["<|end_of_text|>", "<|eot_id|>"]
+        stop_token_ids = self._get_stop_token_ids(stop_strings)
+
+        with torch.no_grad():
+            scheduler = HiggsAudioScheduler(self.model, max_batch_size=max_batch_size, prefix_cache=self.prefix_cache)
+            preparations = {
+                self._preprocess_executor.submit(self._prepare_inputs, chat_ml_sample, force_audio_gen): i
+                for i, chat_ml_sample in enumerate(chat_ml_samples)
+            }
+            sequences = [None] * len(chat_ml_samples)
+            try:
+                while preparations or scheduler.has_unfinished_requests():
+                    if not scheduler.has_unfinished_requests():
+                        # Nothing to decode until the next request is prepared.
+                        wait(preparations, return_when=FIRST_COMPLETED)
+                    for preparation in [preparation for preparation in preparations if preparation.done()]:
+                        i = preparations.pop(preparation)
+                        inputs = preparation.result()
+                        sequences[i] = scheduler.add_request(
+                            request_id=str(i),
+                            inputs=inputs,
+                            max_new_tokens=max_new_tokens,
+                            temperature=temperature,
+                            top_k=top_k,
+                            top_p=top_p,
+                            stop_token_ids=stop_token_ids,
+                            ras_win_len=ras_win_len,
+                            ras_win_max_num_repeat=ras_win_max_num_repeat,
+                            seed=None if seed is None else seed + i,
+                            prefix_len=self._get_prefix_len(inputs),
+                        )
+                    # The steps take turns with the other generations, which share the model and the prefix cache.
+                    with self._execute_lock:
+                        scheduler.step()
+            finally:
+                for preparation in preparations:
+                    preparation.cancel()
+            prefix_cache_usage = self._get_prefix_cache_usage()
+
+            responses = []
+            for seq in sequences:
+                generated_text_tokens = np.array(seq.output_token_ids, dtype=np.int64)
+                num_audio_tokens = sum(audio.shape[1] for audio in seq.audio_sequences)
+                responses.append(
+                    HiggsAudioResponse(
+                        audio=self._decode_audio_sequences(seq.audio_sequences),
+                        generated_audio_tokens=(
+                            torch.cat(seq.audio_sequences, dim=1).cpu().numpy() if seq.audio_sequences else None
+                        ),
+                        sampling_rate=self.audio_tokenizer.sampling_rate,
+                        generated_text=self.tokenizer.decode(generated_text_tokens),
+                        generated_text_tokens=generated_text_tokens,
+                        usage={
+                            "prompt_tokens": seq.num_prompt_tokens,
+                            "completion_tokens": generated_text_tokens.shape[0] + num_audio_tokens,
+                            "total_tokens": seq.num_prompt_tokens + generated_text_tokens.shape[0] + num_audio_tokens,
+                            "cached_tokens": seq.num_cached_prompt_tokens,
+                            **prefix_cache_usage,
+                        },
+                        metrics={
+                            "finish_reason": seq.finish_reason,
+                            "time_to_first_token": seq.time_to_first_token,
+                            "tokens_per_second": seq.tokens_per_second,
+                        },
+                    )
+                )
+            return responses
+
+    async def prepare_inputs(self, chat_ml_sample: ChatMLSample, force_audio_gen: bool = False) -> dict:
+        """
+        Prepare the model inputs of a chatml sample in the preprocessing thread pool.
+        Loading and tokenizing the reference audios and collating the sample do not block the event loop, so they
+        overlap with the generation of the previous requests instead of stalling the delivery of their tokens.
+        Args:
+            chat_ml_sample: A chatml sample.
+            force_audio_gen: Whether to force audio generation. This ensures the model generates audio tokens rather than text tokens.
+        Returns:
+            The model inputs, to pass to `execute_delta_stream`.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._preprocess_executor, self._prepare_inputs, chat_ml_sample, force_audio_gen
+        )
+
+    def _execute(self, inputs: dict, generation_kwargs: dict, execution: Future):
+        """Generate from prepared inputs in the calling thread, after the requests that are already executing.
+
+        The outcome is set on `execution` once the lock is released for the next requests. On failure, the streamer is
+        also ended, so that its consumer does not wait forever.
+        """
+        try:
+            with self._execute_lock, torch.no_grad():
+                self._prepare_kv_caches()
+                prefix_kwargs, _ = self._prepare_prefix_kv_cache(inputs)
+                self.model.generate(**inputs, **prefix_kwargs, **generation_kwargs)
+        except Exception as e:
+            generation_kwargs["streamer"].end()
+            execution.set_exception(e)
+        else:
+            execution.set_result(None)
+
     async def generate_delta_stream(
         self,
         chat_ml_sample: ChatMLSample,
@@ -437,9 +756,14 @@ class HiggsAudioServeEngine:
         ras_win_len: Optional[int] = 7,
         ras_win_max_num_repeat: int = 2,
         seed: Optional[int] = None,
+        stream_pcm: bool = False,
+        stream_pcm_chunk_frames: int = 16,
+        stream_audio_chunk_frames: int = 4,
+        stream_audio_chunk_ms: Optional[float] = 50.0,
     ):
         """
         Generate audio from a chatml sample.
+        This is `prepare_inputs` followed by `execute_delta_stream`.
         Args:
             chat_ml_sample: A chatml sample.
             max_new_tokens: The maximum number of new tokens to generate.
@@ -449,6 +773,55 @@ class HiggsAudioServeEngine:
             force_audio_gen: Whether to force audio generation. This ensures the model generates audio tokens rather than text tokens.
             ras_win_len: The length of the RAS window. We use 7 by default. You can disable it by setting it to None or <=0.
             ras_win_max_num_repeat: The maximum number of times to repeat the RAS window.
+            stream_pcm: Whether to decode the audio tokens into PCM while generating. The samples are set in the `audio`
+                field of the deltas, every `stream_pcm_chunk_frames` audio frames and at the end of each audio segment.
+            stream_pcm_chunk_frames: The number of audio frames decoded at once when `stream_pcm` is set.
+            stream_audio_chunk_frames: The number of audio token columns sent together in one delta. The buffered
+                columns are always sent before a text token and at the end of the generation.
+            stream_audio_chunk_ms: If set, the buffered audio token columns are also sent by a timer once the oldest
+                one has waited for this many milliseconds.
+        Returns:
+             Delta AsyncGenerator
+        """
+        inputs = await self.prepare_inputs(chat_ml_sample, force_audio_gen=force_audio_gen)
+        async for delta in self.execute_delta_stream(
+            inputs,
+            max_new_tokens,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            stop_strings=stop_strings,
+            ras_win_len=ras_win_len,
+            ras_win_max_num_repeat=ras_win_max_num_repeat,
+            seed=seed,
+            stream_pcm=stream_pcm,
+            stream_pcm_chunk_frames=stream_pcm_chunk_frames,
+            stream_audio_chunk_frames=stream_audio_chunk_frames,
+            stream_audio_chunk_ms=stream_audio_chunk_ms,
+        ):
+            yield delta
+
+    async def execute_delta_stream(
+        self,
+        inputs: dict,
+        max_new_tokens: int,
+        temperature: float = 0.7,
+        top_k: Optional[int] = None,
+        top_p: float = 0.95,
+        stop_strings: Optional[List[str]] = None,
+        ras_win_len: Optional[int] = 7,
+        ras_win_max_num_repeat: int = 2,
+        seed: Optional[int] = None,
+        stream_pcm: bool = False,
+        stream_pcm_chunk_frames: int = 16,
+        stream_audio_chunk_frames: int = 4,
+        stream_audio_chunk_ms: Optional[float] = 50.0,
+    ):
+        """
+        Generate audio from the inputs returned by `prepare_inputs`.
+        The generation runs in its own thread once the previous requests are done, and the deltas are streamed back.
+        See `generate_delta_stream` for the arguments.
+        If the generation fails, its error is raised after the deltas generated before the failure.
         Returns:
              Delta AsyncGenerator
         """
@@ -458,34 +831,55 @@ class HiggsAudioServeEngine:
         if ras_win_len is not None and ras_win_len <= 0:
             ras_win_len = None
 
-        with torch.no_grad():
-            inputs = self._prepare_inputs(chat_ml_sample, force_audio_gen=force_audio_gen)
-
-            self._prepare_kv_caches()
-
-            streamer = AsyncHiggsAudioStreamer(
-                self.tokenizer,
-                audio_num_codebooks=self.model.config.audio_num_codebooks,
-                skip_prompt=True,
-            )
-            generation_kwargs = dict(
-                **inputs,
-                max_new_tokens=max_new_tokens,
-                use_cache=True,
-                stop_strings=stop_strings,
-                tokenizer=self.tokenizer,
-                do_sample=False if temperature == 0.0 else True,
-                temperature=temperature,
-                top_k=top_k,
-                top_p=top_p,
-                past_key_values_buckets=self.kv_caches,
-                ras_win_len=ras_win_len,
-                ras_win_max_num_repeat=ras_win_max_num_repeat,
-                seed=seed,
-                streamer=streamer,
+        streamer = AsyncHiggsAudioStreamer(
+            self.tokenizer,
+            audio_num_codebooks=self.model.config.audio_num_codebooks,
+            skip_prompt=True,
+            audio_chunk_frames=stream_audio_chunk_frames,
+            audio_chunk_ms=stream_audio_chunk_ms,
+        )
+        generation_kwargs = dict(
+            max_new_tokens=max_new_tokens,
+            use_cache=True,
+            stop_strings=stop_strings,
+            tokenizer=self.tokenizer,
+            do_sample=False if temperature == 0.0 else True,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            past_key_values=self.kv_cache,
+            ras_win_len=ras_win_len,
+            ras_win_max_num_repeat=ras_win_max_num_repeat,
+            seed=seed,
+            streamer=streamer,
+        )
+        execution = Future()
+        thread = threading.Thread(target=self._execute, args=(inputs, generation_kwargs, execution))
+        thread.start()
+
+        audio_decoder = None
+        if stream_pcm:
+            audio_decoder = StreamingAudioDecoder(
+                self.audio_tokenizer,
+                num_codebooks=self.audio_num_codebooks,
+                codebook_size=self.audio_codebook_size,
+                samples_per_frame=self.samples_per_token,
+                hamming_window_len=self.hamming_window_len,
+                chunk_frames=stream_pcm_chunk_frames,
             )
-            thread = threading.Thread(target=self.model.generate, kwargs=generation_kwargs)
-            thread.start()
-
-            async for delta in streamer:
-                yield delta
+        async for delta in streamer:
+            if audio_decoder is not None:
+                if delta.audio_tokens is not None:
+                    delta.audio = await asyncio.to_thread(audio_decoder.put, delta.audio_tokens)
+                else:
+                    # A text token ends the current audio segment
+                    pcm = await asyncio.to_thread(audio_decoder.flush)
+                    if pcm is not None:
+                        yield HiggsAudioStreamerDelta(audio=pcm)
+            yield delta
+        if audio_decoder is not None:
+            pcm = await asyncio.to_thread(audio_decoder.flush)
+            if pcm is not None:
+                yield HiggsAudioStreamerDelta(audio=pcm)
+        # Raise the error of the generation, if any, once its partial output is streamed
+        await asyncio.wrap_future(execution)
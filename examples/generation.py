@@ -18,16 +18,18 @@ from boson_multimodal.data_types import Message, ChatMLSample, AudioContent, Tex
 from boson_multimodal.model.higgs_audio import HiggsAudioConfig, HiggsAudioModel
 from boson_multimodal.data_collator.higgs_audio_collator import HiggsAudioSampleCollator
 from boson_multimodal.audio_processing.higgs_audio_tokenizer import load_higgs_audio_tokenizer
+from boson_multimodal.audio_processing.audio_code_cache import AudioCodeCache
 from boson_multimodal.dataset.chatml_dataset import (
     ChatMLDatasetSample,
     prepare_chatml_sample,
 )
 from boson_multimodal.model.higgs_audio.utils import revert_delay_pattern
+from boson_multimodal.serve.prefix_cache import get_prefix_inputs
 from typing import List
 from transformers import AutoConfig, AutoTokenizer
-from transformers.cache_utils import StaticCache
+from transformers.cache_utils import Cache, DynamicCache, StaticCache
 from typing import Optional
-from dataclasses import asdict
+from dataclasses import asdict, dataclass, replace
 import torch
 
 CURR_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -175,6 +177,22 @@ def _build_system_message_with_audio_prompt(system_message):
     return ret
 
 
+@dataclass
+class CachedContext:
+    """The context whose KV states are kept in the cache between two chunks of a long-form generation."""
+
+    input_ids: List[int]  # The input ids of the context, with one placeholder token per audio segment
+    past_key_values: Cache
+    audio_discrete_codes_mask: torch.Tensor  # shape (1, num_tokens)
+    # The audio codes of the last audio segment of the context, if the KV states of its last column are not cached
+    audio_out_ids: Optional[torch.Tensor] = None
+
+    @property
+    def num_tokens(self) -> int:
+        """The number of tokens in the KV cache, after the audio codes have been merged into the sequence."""
+        return self.audio_discrete_codes_mask.shape[1]
+
+
 class HiggsAudioModelClient:
     def __init__(
         self,
@@ -264,6 +282,48 @@ class HiggsAudioModelClient:
         for kv_cache in self.kv_caches.values():
             kv_cache.reset()
 
+    def _prefill_context(self, batch, num_context_ids) -> CachedContext:
+        """Reset the KV cache and fill it with the first `num_context_ids` input ids of the batch."""
+        if self._use_static_kv_cache:
+            self._prepare_kv_caches()
+            past_key_values = next(iter(self.kv_caches.values()))
+        else:
+            past_key_values = DynamicCache()
+        context_inputs = get_prefix_inputs(
+            batch,
+            num_context_ids,
+            audio_in_token_id=self._config.audio_in_token_idx,
+            audio_out_token_id=self._config.audio_out_token_idx,
+        )
+        outputs = self._model(
+            **context_inputs,
+            past_key_values=past_key_values,
+            past_key_values_buckets=self.kv_caches,
+            use_cache=True,
+        )
+        return CachedContext(
+            input_ids=batch["input_ids"][0, :num_context_ids].tolist(),
+            past_key_values=outputs.past_key_values,
+            audio_discrete_codes_mask=outputs.audio_in_discrete_codes_mask | outputs.audio_out_mask,
+        )
+
+    def _crop_context(self, context: CachedContext, num_ids: int, num_tokens: int) -> CachedContext:
+        """Only keep the KV states of the first `num_tokens` tokens, which are the first `num_ids` context ids."""
+        past_key_values = context.past_key_values
+        if isinstance(past_key_values, StaticCache):
+            # The static cache counts the non-zero keys to get the sequence length, so we zero the dropped ones.
+            for layer_idx in range(len(past_key_values.key_cache)):
+                past_key_values.key_cache[layer_idx][:, :, num_tokens:].zero_()
+                past_key_values.value_cache[layer_idx][:, :, num_tokens:].zero_()
+        else:
+            past_key_values.crop(num_tokens)
+        return replace(
+            context,
+            input_ids=context.input_ids[:num_ids],
+            audio_discrete_codes_mask=context.audio_discrete_codes_mask[:, :num_tokens],
+            audio_out_ids=None,
+        )
+
     @torch.inference_mode()
     def generate(
         self,
@@ -277,15 +337,29 @@ class HiggsAudioModelClient:
         ras_win_len=7,
         ras_win_max_num_repeat=2,
         seed=123,
+        reuse_kv_cache=False,
         *args,
         **kwargs,
     ):
+        """Generate the audio of the chunks one by one, each with the previous chunks in the context.
+
+        If `reuse_kv_cache` is set, the KV cache is kept between the chunks, so that each chunk only prefills the end of
+        the previous audio and its user message instead of the whole context. When the buffer evicts the oldest chunk,
+        the positions of all the following tokens change, so only the KV states of `messages`, e.g. the system message
+        and the reference audios, are kept and the buffered chunks are prefilled again.
+        """
         if ras_win_len is not None and ras_win_len <= 0:
             ras_win_len = None
+        if reuse_kv_cache and len(messages) == 0:
+            raise ValueError("Reusing the KV cache requires at least one message before the chunks.")
         sr = 24000
         audio_out_ids_l = []
         generated_audio_ids = []
         generation_messages = []
+        audio_out_bos_id, audio_eos_id = self._tokenizer.convert_tokens_to_ids(["<|audio_out_bos|>", "<|audio_eos|>"])
+        # The context whose KV states are in the cache, and the one of `messages` alone.
+        context = messages_context = None
+        num_prefilled_tokens = num_reused_tokens = 0
         for idx, chunk_text in tqdm.tqdm(
             enumerate(chunked_text), desc="Generating audio chunks", total=len(chunked_text)
         ):
@@ -329,7 +403,36 @@ class HiggsAudioModelClient:
                 if isinstance(v, torch.Tensor):
                     batch[k] = v.contiguous().to(self._device)
 
-            if self._use_static_kv_cache:
+            cache_kwargs = {}
+            if reuse_kv_cache:
+                num_chunk_reused_tokens = 0
+                if messages_context is None:
+                    num_messages_ids = len(prepare_chatml_sample(ChatMLSample(messages=messages), self._tokenizer)[0])
+                    messages_context = context = self._prefill_context(batch, num_messages_ids)
+                else:
+                    if context.audio_out_ids is not None:
+                        # The partly cached audio segment is the last one of the batch.
+                        audio_out_ids = batch["audio_out_ids"][:, batch["audio_out_ids_start"][-1] :]
+                        num_columns = context.audio_out_ids.shape[1]
+                        if not torch.equal(audio_out_ids[:, :num_columns], context.audio_out_ids):
+                            # The audio has been changed, e.g. cut at the end of a truncated generation, so we drop the
+                            # KV states of its columns.
+                            context = self._crop_context(
+                                context, len(context.input_ids) - 1, context.num_tokens - num_columns
+                            )
+                    if input_tokens[: len(context.input_ids)] != context.input_ids:
+                        # The buffer has evicted the oldest chunk, so the KV states after `messages` are dropped.
+                        context = self._crop_context(
+                            context, len(messages_context.input_ids), messages_context.num_tokens
+                        )
+                    num_chunk_reused_tokens = context.num_tokens
+                cache_kwargs = {
+                    "past_key_values": context.past_key_values,
+                    "num_cached_tokens": context.num_tokens,
+                    "cache_audio_discrete_codes_mask": context.audio_discrete_codes_mask,
+                    "return_dict_in_generate": True,
+                }
+            elif self._use_static_kv_cache:
                 self._prepare_kv_caches()
 
             # Generate audio
@@ -347,8 +450,43 @@ class HiggsAudioModelClient:
                 stop_strings=["<|end_of_text|>", "<|eot_id|>"],
                 tokenizer=self._tokenizer,
                 seed=seed,
+                **cache_kwargs,
             )
 
+            if reuse_kv_cache:
+                generated_ids = outputs.sequences[0, len(input_tokens) :].tolist()
+                num_audio_columns = [ele.shape[1] for ele in outputs.audio_sequences]
+                # Each step feeds the token sampled by the previous one, except the step that samples the last column
+                # of an audio segment, which also samples <|audio_eos|> and feeds it instead of the column.
+                num_text_ids = sum(token_id != self._config.audio_out_token_idx for token_id in generated_ids)
+                num_fed_tokens = num_text_ids + sum(num_audio_columns) - generated_ids.count(audio_eos_id) - 1
+                num_prompt_tokens = outputs.cache_audio_discrete_codes_mask.shape[1] - num_fed_tokens
+                num_prefilled_tokens += num_prompt_tokens - num_chunk_reused_tokens
+                num_reused_tokens += num_chunk_reused_tokens
+                logger.info(
+                    f"Chunk {idx}: prefilled {num_prompt_tokens - num_chunk_reused_tokens} prompt tokens, "
+                    f"reused the KV states of {num_chunk_reused_tokens} tokens"
+                )
+                context = replace(
+                    context,
+                    input_ids=list(input_tokens),
+                    past_key_values=outputs.past_key_values,
+                    audio_discrete_codes_mask=outputs.cache_audio_discrete_codes_mask,
+                )
+                if generated_ids[:2] == [audio_out_bos_id, self._config.audio_out_token_idx]:
+                    # The assistant message that is added to the context below is <|audio_out_bos|><|AUDIO_OUT|>
+                    # <|audio_eos|>, where the audio ends with the column that has never been fed, so we keep the KV
+                    # states of <|audio_out_bos|> and of the audio columns before it.
+                    num_cached_columns = num_audio_columns[0] - 1
+                    context = self._crop_context(
+                        context, len(input_tokens), num_prompt_tokens + 1 + num_cached_columns
+                    )
+                    context.input_ids.extend(generated_ids[:2])
+                    context.audio_out_ids = outputs.audio_sequences[0][:, :num_cached_columns]
+                else:
+                    # No audio segment was started, so we only keep the prompt.
+                    context = self._crop_context(context, len(input_tokens), num_prompt_tokens)
+
             step_audio_out_ids_l = []
             for ele in outputs[1]:
                 audio_out_ids = ele
@@ -369,6 +507,11 @@ class HiggsAudioModelClient:
                 generated_audio_ids = generated_audio_ids[-generation_chunk_buffer_size:]
                 generation_messages = generation_messages[(-2 * generation_chunk_buffer_size) :]
 
+        if reuse_kv_cache:
+            logger.info(
+                f"Prefilled {num_prefilled_tokens} of {num_prefilled_tokens + num_reused_tokens} prompt tokens, "
+                f"saved {num_reused_tokens} prefill tokens by reusing the KV cache"
+            )
         logger.info(f"========= Final Text output =========")
         logger.info(self._tokenizer.decode(outputs[0][0]))
         concat_audio_out_ids = torch.concat(audio_out_ids_l, dim=1)
@@ -384,10 +527,13 @@ class HiggsAudioModelClient:
         return concat_wv, sr, text_result
 
 
-def prepare_generation_context(scene_prompt, ref_audio, ref_audio_in_system_message, audio_tokenizer, speaker_tags):
+def prepare_generation_context(
+    scene_prompt, ref_audio, ref_audio_in_system_message, audio_tokenizer, speaker_tags, audio_code_cache=None
+):
     """Prepare the context for generation.
 
     The context contains the system message, user message, assistant message, and audio prompt if any.
+    If `audio_code_cache` is set, the voice prompts are tokenized through it.
     """
     system_message = None
     messages = []
@@ -440,7 +586,10 @@ def prepare_generation_context(scene_prompt, ref_audio, ref_audio_in_system_mess
                 assert os.path.exists(prompt_text_path), f"Voice prompt text file {prompt_text_path} does not exist."
                 with open(prompt_text_path, "r", encoding="utf-8") as f:
                     prompt_text = f.read().strip()
-                audio_tokens = audio_tokenizer.encode(prompt_audio_path)
+                if audio_code_cache is not None:
+                    audio_tokens = audio_code_cache.encode(prompt_audio_path)
+                else:
+                    audio_tokens = audio_tokenizer.encode(prompt_audio_path)
                 audio_ids.append(audio_tokens)
 
                 if not ref_audio_in_system_message:
@@ -616,6 +765,19 @@ def prepare_generation_context(scene_prompt, ref_audio, ref_audio_in_system_mess
     default=1,
     help="Whether to use static KV cache for faster generation. Only works when using GPU.",
 )
+@click.option(
+    "--reuse_kv_cache",
+    is_flag=True,
+    default=False,
+    help="Whether to keep the KV cache between the chunks, so that each chunk only prefills its own text.",
+    show_default=True,
+)
+@click.option(
+    "--audio_code_cache_dir",
+    type=str,
+    default=None,
+    help="The directory to cache the audio codes of the voice prompts, so that they are only tokenized once.",
+)
 @click.option(
     "--device",
     type=click.Choice(["auto", "cuda", "mps", "none"]),
@@ -643,6 +805,8 @@ def main(
     device_id,
     out_path,
     use_static_kv_cache,
+    reuse_kv_cache,
+    audio_code_cache_dir,
     device,
 ):
     # specifying a device_id implies CUDA
@@ -727,12 +891,16 @@ def main(
     if not any([transcript.endswith(c) for c in [".", "!", "?", ",", ";", '"', "'", "</SE_e>", "</SE>"]]):
         transcript += "."
 
+    audio_code_cache = None
+    if audio_code_cache_dir is not None:
+        audio_code_cache = AudioCodeCache(audio_tokenizer, cache_dir=audio_code_cache_dir)
     messages, audio_ids = prepare_generation_context(
         scene_prompt=scene_prompt,
         ref_audio=ref_audio,
         ref_audio_in_system_message=ref_audio_in_system_message,
         audio_tokenizer=audio_tokenizer,
         speaker_tags=speaker_tags,
+        audio_code_cache=audio_code_cache,
     )
     chunked_text = prepare_chunk_text(
         transcript,
@@ -758,6 +926,7 @@ def main(
         ras_win_len=ras_win_len,
         ras_win_max_num_repeat=ras_win_max_num_repeat,
         seed=seed,
+        reuse_kv_cache=reuse_kv_cache,
     )
 
     sf.write(out_path, concat_wv, sr)
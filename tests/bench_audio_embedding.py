@@ -0,0 +1,90 @@
+"""Compare the time and the allocated memory of embedding the audio codes with one embedding bag and with one lookup
+per codebook followed by a sum, as before.
+
+The lookups per codebook materialize a (num_codebooks, num_frames, hidden_size) tensor before reducing it, whereas the
+embedding bag reduces the codes of each frame while it gathers their rows. The default sizes are those of the released
+model: 8 codebooks of 1024 codes and a hidden size of 3072. It uses a randomly initialized model, so it runs on the CPU
+without any checkpoint. Run it from the root of the repository:
+
+    python -m tests.bench_audio_embedding --num_frames 1,8,750
+"""
+
+import time
+from functools import partial
+
+import click
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+from .utils import PAD_TOKEN_ID, tiny_model
+
+
+def _embed_audio_ids_per_codebook(model, audio_ids):
+    # The previous implementation, which embeds every codebook separately before reducing them.
+    codebook_shift = (
+        torch.arange(model.config.audio_num_codebooks, device=audio_ids.device) * model.audio_codebook_size
+    )
+    audio_embed = model.audio_codebook_embeddings(audio_ids + codebook_shift.unsqueeze(-1))
+    if model.config.audio_embed_avg:
+        return torch.mean(audio_embed, dim=0)
+    return torch.sum(audio_embed, dim=0)
+
+
+def _allocated_bytes(embed, audio_ids):
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as profiler:
+        embed(audio_ids)
+    # The allocations are positive and the frees negative, only the former are counted.
+    return sum(event.cpu_memory_usage for event in profiler.events() if event.cpu_memory_usage > 0)
+
+
+@click.command()
+@click.option("--num_frames", type=str, default="1,8,750")
+@click.option("--hidden_size", type=int, default=3072)
+@click.option("--audio_num_codebooks", type=int, default=8)
+@click.option("--audio_codebook_size", type=int, default=1024)
+@click.option("--dtype", type=click.Choice(["float32", "bfloat16"]), default="float32")
+@click.option("--num_runs", type=int, default=20)
+def main(num_frames, hidden_size, audio_num_codebooks, audio_codebook_size, dtype, num_runs):
+    # Only the audio codebook embeddings are used, so the text model is kept small.
+    text_config = dict(
+        model_type="llama",
+        vocab_size=64,
+        hidden_size=hidden_size,
+        intermediate_size=64,
+        num_hidden_layers=1,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        pad_token_id=PAD_TOKEN_ID,
+    )
+    model = tiny_model(
+        text_config=text_config,
+        audio_num_codebooks=audio_num_codebooks,
+        audio_codebook_size=audio_codebook_size,
+        audio_ffn_hidden_size=hidden_size,
+        audio_ffn_intermediate_size=64,
+        audio_dual_ffn_layers=[0],
+    ).to(getattr(torch, dtype))
+
+    def _time(embed, audio_ids):
+        # Warm up
+        embed(audio_ids)
+        start = time.perf_counter()
+        for _ in range(num_runs):
+            embed(audio_ids)
+        return (time.perf_counter() - start) / num_runs
+
+    print(f"{audio_num_codebooks} codebooks of {audio_codebook_size} codes, hidden size {hidden_size}, {dtype}")
+    print(f"{'Frames':>7} {'Per codebook':>24} {'Embedding bag':>24}")
+    with torch.inference_mode():
+        for length in [int(length) for length in num_frames.split(",")]:
+            audio_ids = torch.randint(0, audio_codebook_size, (audio_num_codebooks, length))
+            results = []
+            for embed in [partial(_embed_audio_ids_per_codebook, model), model._embed_audio_ids]:
+                results.append(
+                    f"{_time(embed, audio_ids) * 1e6:>9.1f} us {_allocated_bytes(embed, audio_ids) / 2**20:>8.2f} MB"
+                )
+            print(f"{length:>7} {results[0]:>24} {results[1]:>24}")
+
+
+if __name__ == "__main__":
+    main()
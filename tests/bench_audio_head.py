@@ -0,0 +1,77 @@
+"""Compare the FLOPs and the time of the projector of a decoding step, when it computes both the text and the audio
+logits and when `is_decoding_audio_token` tells it which ones are needed.
+
+When decoding audio, the text token is forced to <|AUDIO_OUT|>, so the text head, whose output spans the whole
+vocabulary, is skipped. When decoding text, the audio head is skipped. The default sizes are those of a 3B text model
+with 8 codebooks of 1024 codes. It uses a randomly initialized projector, so it runs on the CPU without any checkpoint.
+Run it from the root of the repository:
+
+    python -m tests.bench_audio_head --batch_size 8
+"""
+
+import time
+
+import click
+import torch
+
+from boson_multimodal.model.higgs_audio.audio_head import HiggsAudioDecoderProjector
+
+from .utils import PAD_TOKEN_ID, tiny_config
+
+
+@click.command()
+@click.option("--batch_size", type=int, default=8)
+@click.option("--hidden_size", type=int, default=3072)
+@click.option("--vocab_size", type=int, default=128256)
+@click.option("--audio_num_codebooks", type=int, default=8)
+@click.option("--audio_codebook_size", type=int, default=1024)
+@click.option("--num_runs", type=int, default=20)
+def main(batch_size, hidden_size, vocab_size, audio_num_codebooks, audio_codebook_size, num_runs):
+    text_config = dict(
+        model_type="llama",
+        vocab_size=vocab_size,
+        hidden_size=hidden_size,
+        intermediate_size=2 * hidden_size,
+        num_hidden_layers=1,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        pad_token_id=PAD_TOKEN_ID,
+    )
+    config = tiny_config(
+        text_config=text_config, audio_num_codebooks=audio_num_codebooks, audio_codebook_size=audio_codebook_size
+    )
+    projector = HiggsAudioDecoderProjector(config).eval()
+    hidden_states = torch.randn(batch_size, 1, hidden_size)
+    text_flops = 2 * batch_size * hidden_size * vocab_size
+    audio_flops = 2 * batch_size * hidden_size * audio_num_codebooks * (audio_codebook_size + 2)
+
+    def _time(audio_out_mask, is_decoding_audio_token):
+        # Warm up
+        projector(hidden_states, audio_out_mask, is_decoding_audio_token=is_decoding_audio_token, num_logits_to_keep=1)
+        start = time.perf_counter()
+        for _ in range(num_runs):
+            projector(
+                hidden_states, audio_out_mask, is_decoding_audio_token=is_decoding_audio_token, num_logits_to_keep=1
+            )
+        return (time.perf_counter() - start) / num_runs
+
+    print(f"Batch of {batch_size}, text head of {vocab_size} logits, {audio_num_codebooks} codebooks")
+    print(f"{'Decoded tokens':>14} {'Both heads':>20} {'Decoded type only':>20} {'FLOPs saved':>12}")
+    with torch.inference_mode():
+        for name, is_decoding_audio_token, flops in [
+            ("audio", True, audio_flops),
+            ("text", False, text_flops),
+        ]:
+            audio_out_mask = torch.full((batch_size, 1), is_decoding_audio_token)
+            both_time = _time(audio_out_mask, None)
+            # The text head runs on every token, the audio head on the audio tokens only.
+            both_flops = text_flops + (audio_flops if is_decoding_audio_token else 0)
+            decoded_time = _time(audio_out_mask, is_decoding_audio_token)
+            print(
+                f"{name:>14} {both_flops / 1e9:>6.2f} GFLOP {both_time * 1000:>5.2f} ms "
+                f"{flops / 1e9:>6.2f} GFLOP {decoded_time * 1000:>5.2f} ms {1 - flops / both_flops:>11.1%}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Compare the prefill time of a voice clone prompt, when the fast-forward layers only process its text tokens and when
+they process all its tokens.
+
+With `audio_adapter_type="dual_ffn_fast_forward"`, the outputs of the audio tokens of the fast-forward layers are their
+inputs. The prefill gathers the text tokens, so the attention and the MLP of these layers skip the reference audio. The
+dense prefill runs them on every token and discards the outputs of the audio tokens, as the prefill did before. It uses
+a randomly initialized model, so it runs on the CPU without any checkpoint. Run it from the root of the repository:
+
+    python -m tests.bench_fast_forward_prefill --reference_seconds 30 --num_text_tokens 64
+"""
+
+import time
+
+import click
+import torch
+from transformers.cache_utils import DynamicCache
+
+from boson_multimodal.model.higgs_audio import modeling_higgs_audio
+
+from .utils import AUDIO_OUT_BOS_TOKEN_ID, AUDIO_OUT_TOKEN_IDX, tiny_inputs, tiny_model
+
+
+def _dense_text_positions(audio_out_mask, num_text_tokens):
+    # The previous behavior: the fast-forward layers process all the tokens.
+    return None
+
+
+@click.command()
+@click.option("--reference_seconds", type=float, default=30.0)
+@click.option("--frame_rate", type=int, default=25)
+@click.option("--num_text_tokens", type=int, default=64)
+@click.option("--hidden_size", type=int, default=256)
+@click.option("--num_hidden_layers", type=int, default=8)
+@click.option("--num_dual_ffn_layers", type=int, default=2)
+@click.option("--num_runs", type=int, default=5)
+def main(
+    reference_seconds, frame_rate, num_text_tokens, hidden_size, num_hidden_layers, num_dual_ffn_layers, num_runs
+):
+    num_audio_tokens = int(reference_seconds * frame_rate)
+    text_config = dict(
+        model_type="llama",
+        vocab_size=64,
+        hidden_size=hidden_size,
+        intermediate_size=2 * hidden_size,
+        num_hidden_layers=num_hidden_layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=num_audio_tokens + num_text_tokens + 16,
+        pad_token_id=63,
+    )
+    model = tiny_model(
+        text_config=text_config,
+        audio_adapter_type="dual_ffn_fast_forward",
+        audio_ffn_hidden_size=hidden_size,
+        audio_ffn_intermediate_size=2 * hidden_size,
+        audio_dual_ffn_layers=list(range(num_dual_ffn_layers)),
+        # Same as `from_pretrained()`
+        attn_implementation="sdpa",
+    )
+    # A voice clone prompt: the reference audio, then the text to read.
+    audio_out_ids = torch.randint(0, 16, (4, num_audio_tokens))
+    input_ids = [1, AUDIO_OUT_BOS_TOKEN_ID, AUDIO_OUT_TOKEN_IDX] + [2] * num_text_tokens + [AUDIO_OUT_BOS_TOKEN_ID]
+    inputs = tiny_inputs(input_ids, audio_out_ids)
+
+    def _prefill():
+        return model(**inputs, past_key_values=DynamicCache(), use_cache=True, num_logits_to_keep=1)
+
+    def _run():
+        # Warm up
+        _prefill()
+        start = time.perf_counter()
+        for _ in range(num_runs):
+            outputs = _prefill()
+        return outputs, (time.perf_counter() - start) / num_runs
+
+    get_text_positions = modeling_higgs_audio._get_text_positions
+    with torch.inference_mode():
+        outputs, text_time = _run()
+        modeling_higgs_audio._get_text_positions = _dense_text_positions
+        try:
+            dense_outputs, dense_time = _run()
+        finally:
+            modeling_higgs_audio._get_text_positions = get_text_positions
+    max_diff = (outputs.logits - dense_outputs.logits).abs().max().item()
+
+    num_fast_forward_layers = num_hidden_layers - num_dual_ffn_layers
+    print(
+        f"Prompt: {reference_seconds:g}s of reference audio ({num_audio_tokens} tokens), {num_text_tokens} text tokens"
+    )
+    print(f"Fast-forward layers: {num_fast_forward_layers} of {num_hidden_layers}")
+    print(f"Dense prefill:            {dense_time * 1000:.1f} ms")
+    print(f"Prefill of text tokens:   {text_time * 1000:.1f} ms")
+    print(f"Speedup: {dense_time / text_time:.2f}x, max logits difference: {max_diff:.2e}")
+
+
+if __name__ == "__main__":
+    main()
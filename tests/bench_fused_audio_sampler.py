@@ -0,0 +1,94 @@
+"""Compare the per-step time of sampling the audio tokens with the fused sampler and with the logits processors of
+`GenerationMixin` (temperature, top-k and top-p), with repetition aware sampling.
+
+`FusedAudioSampler` applies the temperature, top-k and top-p in one pass over preallocated buffers, and draws the
+regular and the fallback tokens of repetition aware sampling from one `torch.multinomial` call. The default sizes are
+those of the released model: 8 codebooks of 1024 codes. Run it from the root of the repository:
+
+    python -m tests.bench_fused_audio_sampler --batch_sizes 1,4,16
+"""
+
+import time
+
+import click
+import torch
+from transformers.generation import GenerationConfig, LogitsProcessorList
+from transformers.generation.logits_process import TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+
+from boson_multimodal.model.higgs_audio.audio_sampler import FusedAudioSampler
+
+from .utils import AUDIO_EOS_TOKEN_ID, tiny_model
+
+
+@click.command()
+@click.option("--batch_sizes", type=str, default="1,4,16")
+@click.option("--audio_num_codebooks", type=int, default=8)
+@click.option("--audio_codebook_size", type=int, default=1024)
+@click.option("--temperature", type=float, default=0.7)
+@click.option("--top_k", type=int, default=50)
+@click.option("--top_p", type=float, default=0.95)
+@click.option("--ras_win_len", type=int, default=7)
+@click.option("--num_steps", type=int, default=200)
+def main(batch_sizes, audio_num_codebooks, audio_codebook_size, temperature, top_k, top_p, ras_win_len, num_steps):
+    model = tiny_model(audio_num_codebooks=audio_num_codebooks, audio_codebook_size=audio_codebook_size)
+    num_codes = audio_codebook_size + 2
+    # Same order as `GenerationMixin._get_logits_processor`
+    logits_processor = LogitsProcessorList(
+        [TemperatureLogitsWarper(temperature), TopKLogitsWarper(top_k), TopPLogitsWarper(top_p)]
+    )
+    audio_sampler = FusedAudioSampler.from_logits_processor(logits_processor)
+    generation_config = GenerationConfig(
+        generation_kwargs={
+            "ras_win_len": ras_win_len,
+            "ras_win_max_num_repeat": 2,
+            "audio_eos_token_id": AUDIO_EOS_TOKEN_ID,
+        }
+    )
+
+    def _step_time(batch_size, sampler):
+        generator = torch.Generator().manual_seed(0)
+        audio_logits = torch.randn(batch_size, audio_num_codebooks, num_codes, generator=generator) * 4
+        audio_out_ids = torch.randint(
+            0, num_codes, (batch_size, audio_num_codebooks, ras_win_len), generator=generator
+        )
+
+        def _sample():
+            return model._sample_audio_tokens(
+                hidden_states=None,
+                audio_logits=audio_logits,
+                audio_out_ids=audio_out_ids,
+                do_sample=True,
+                logits_processor=logits_processor,
+                device=audio_logits.device,
+                torch_generator=generator,
+                generation_config=generation_config,
+                num_delay=torch.full((batch_size,), audio_num_codebooks - 1),
+                num_remaining_delays=torch.full((batch_size,), -1),
+                audio_sampler=sampler,
+            )
+
+        # Warm up
+        _sample()
+        start = time.perf_counter()
+        for _ in range(num_steps):
+            _sample()
+        return (time.perf_counter() - start) / num_steps
+
+    print(
+        f"{audio_num_codebooks} codebooks of {audio_codebook_size} codes, temperature {temperature:g}, "
+        f"top-k {top_k}, top-p {top_p:g}, RAS window of {ras_win_len}"
+    )
+
+    print(f"{'Batch':>6} {'Logits processors':>18} {'Fused sampler':>14} {'Speedup':>8}")
+    with torch.inference_mode():
+        for batch_size in [int(batch_size) for batch_size in batch_sizes.split(",")]:
+            processors_time = _step_time(batch_size, None)
+            fused_time = _step_time(batch_size, audio_sampler)
+            print(
+                f"{batch_size:>6} {processors_time * 1e6:>15.1f} us {fused_time * 1e6:>11.1f} us "
+                f"{processors_time / fused_time:>7.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
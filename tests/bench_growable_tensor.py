@@ -0,0 +1,78 @@
+"""Compare the per-step cost of growing the input ids, the attention mask and the cached audio discrete codes mask of a
+generation, when they are concatenated with `torch.cat` at every step and when they are kept in a `GrowableTensor`.
+
+`torch.cat` copies the whole sequence at every step, so it allocates and copies O(n) values per step. The buffer of a
+`GrowableTensor` doubles its capacity when it is full, so it is reallocated O(log n) times over a generation. The
+allocated bytes are measured with the PyTorch profiler. Run it from the root of the repository:
+
+    python -m tests.bench_growable_tensor --prompt_lengths 256,1024,4096,16384 --num_steps 500
+"""
+
+import time
+
+import click
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+from boson_multimodal.model.higgs_audio.utils import GrowableTensor
+
+
+def _prompt(batch_size, prompt_length):
+    return dict(
+        input_ids=torch.ones(batch_size, prompt_length, dtype=torch.long),
+        attention_mask=torch.ones(batch_size, prompt_length, dtype=torch.long),
+        cache_audio_discrete_codes_mask=torch.zeros(batch_size, prompt_length, dtype=torch.bool),
+    )
+
+
+def _cat_steps(prompt, num_steps):
+    tensors = dict(prompt)
+    for _ in range(num_steps):
+        for name, tensor in tensors.items():
+            tensors[name] = torch.cat([tensor, tensor.new_ones((tensor.shape[0], 1))], dim=-1)
+    return 0
+
+
+def _buffer_steps(prompt, num_steps):
+    buffers = {name: GrowableTensor(tensor) for name, tensor in prompt.items()}
+    for _ in range(num_steps):
+        for buffer in buffers.values():
+            buffer.append(buffer.tensor.new_ones((buffer.tensor.shape[0], 1)))
+    return sum(buffer.num_reallocations for buffer in buffers.values())
+
+
+def _allocated_bytes(steps, prompt, num_steps):
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as profiler:
+        steps(prompt, num_steps)
+    # The allocations are positive and the frees negative, only the former are counted.
+    return sum(event.cpu_memory_usage for event in profiler.events() if event.cpu_memory_usage > 0)
+
+
+@click.command()
+@click.option("--prompt_lengths", type=str, default="256,1024,4096,16384")
+@click.option("--num_steps", type=int, default=500)
+@click.option("--batch_size", type=int, default=4)
+def main(prompt_lengths, num_steps, batch_size):
+    print(
+        f"{'Prompt':>8} {'cat / step':>11} {'buffer / step':>14} {'cat allocated':>14} {'buffer allocated':>17} "
+        f"{'reallocations':>14}"
+    )
+    for prompt_length in [int(prompt_length) for prompt_length in prompt_lengths.split(",")]:
+        prompt = _prompt(batch_size, prompt_length)
+        results = []
+        for steps in [_cat_steps, _buffer_steps]:
+            # Warm up
+            steps(prompt, num_steps)
+            start = time.perf_counter()
+            num_reallocations = steps(prompt, num_steps)
+            step_time = (time.perf_counter() - start) / num_steps
+            results.append((step_time, _allocated_bytes(steps, prompt, num_steps), num_reallocations))
+        (cat_time, cat_bytes, _), (buffer_time, buffer_bytes, num_reallocations) = results
+        print(
+            f"{prompt_length:>8} {cat_time * 1e6:>8.1f} us {buffer_time * 1e6:>11.1f} us "
+            f"{cat_bytes / 2**20:>11.1f} MB {buffer_bytes / 2**20:>14.1f} MB {num_reallocations:>14}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Compare the time of merging the audio embeddings into the text embeddings of a batch, with the vectorized
+`merge_input_ids_with_audio_features` and with the previous implementation, which loops over the audios.
+
+Each sample has `--num_audios` reference audios given as discrete codes (<|AUDIO|>) and as many generated audios
+(<|AUDIO_OUT|>) between its text tokens. The host syncs are counted too, since they are what makes the host wait for
+the device, which does not happen on the CPU. Run it from the root of the repository:
+
+    python -m tests.bench_merge_audio_features --batch_sizes 1,4,16 --num_audios 1,4,16
+"""
+
+import time
+
+import click
+import torch
+
+from boson_multimodal.model.higgs_audio.utils import HostSyncCounter, merge_input_ids_with_audio_features
+
+from . import reference_merge
+from .utils import AUDIO_IN_TOKEN_IDX, AUDIO_OUT_TOKEN_IDX, PAD_TOKEN_ID
+
+
+def _batch(batch_size, num_audios, num_frames, num_text_tokens, embed_dim):
+    # Text, then pairs of <|AUDIO|> and <|AUDIO_OUT|> separated by text tokens
+    row = [1] * num_text_tokens + [AUDIO_IN_TOKEN_IDX, 2, AUDIO_OUT_TOKEN_IDX, 3] * num_audios
+    input_ids = torch.tensor([row] * batch_size)
+    num_all_audios = batch_size * num_audios
+    audio_ids_start = torch.arange(num_all_audios) * num_frames
+    return dict(
+        audio_features_embed=None,
+        audio_features_length=None,
+        audio_in_embed=torch.randn(num_all_audios * num_frames, embed_dim),
+        audio_in_ids_start=audio_ids_start,
+        audio_out_embed=torch.randn(num_all_audios * num_frames, embed_dim),
+        audio_out_ids_start=audio_ids_start,
+        audio_in_token_idx=AUDIO_IN_TOKEN_IDX,
+        audio_out_token_idx=AUDIO_OUT_TOKEN_IDX,
+        inputs_embeds=torch.randn(batch_size, len(row), embed_dim),
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        label_ids=None,
+        pad_token_id=PAD_TOKEN_ID,
+    )
+
+
+@click.command()
+@click.option("--batch_sizes", type=str, default="1,4,16")
+@click.option("--num_audios", type=str, default="1,4,16")
+@click.option("--num_frames", type=int, default=50)
+@click.option("--num_text_tokens", type=int, default=32)
+@click.option("--embed_dim", type=int, default=1024)
+@click.option("--num_runs", type=int, default=10)
+def main(batch_sizes, num_audios, num_frames, num_text_tokens, embed_dim, num_runs):
+    def _run(merge, batch):
+        # Warm up
+        merge(**batch)
+        start = time.perf_counter()
+        for _ in range(num_runs):
+            merge(**batch)
+        merge_time = (time.perf_counter() - start) / num_runs
+        with HostSyncCounter() as counter:
+            merge(**batch)
+        return f"{merge_time * 1000:>8.2f} ms {counter.num_syncs:>6}"
+
+    print(f"{num_frames} frames per audio, {num_text_tokens} text tokens per sample, embedding size {embed_dim}")
+    print(f"{'':>14} {'Previous':>18} {'Vectorized':>18}")
+    print(f"{'Batch':>6} {'Audios':>7} {'Time':>11} {'Syncs':>6} {'Time':>11} {'Syncs':>6}")
+    with torch.inference_mode():
+        for batch_size in [int(batch_size) for batch_size in batch_sizes.split(",")]:
+            for num_audios_per_sample in [int(num_audio) for num_audio in num_audios.split(",")]:
+                batch = _batch(batch_size, num_audios_per_sample, num_frames, num_text_tokens, embed_dim)
+                reference = _run(reference_merge.merge_input_ids_with_audio_features, batch)
+                vectorized = _run(merge_input_ids_with_audio_features, batch)
+                print(f"{batch_size:>6} {num_audios_per_sample:>7} {reference} {vectorized}")
+
+
+if __name__ == "__main__":
+    main()
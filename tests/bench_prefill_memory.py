@@ -0,0 +1,71 @@
+"""Measure the peak memory of the prefill with and without `num_logits_to_keep`.
+
+`generate()` prefills the prompt with `num_logits_to_keep=1`, so that only the text and audio logits of the last
+position are computed. `num_logits_to_keep=0` computes the logits of every position, as the prefill did before. Each
+measurement runs in a fresh process and reports the increase of its peak RSS during the forward pass. Run it from the
+root of the repository:
+
+    python -m tests.bench_prefill_memory --num_audio_tokens 4096 --num_text_tokens 256
+"""
+
+import multiprocessing
+import resource
+
+import click
+import torch
+
+from .utils import AUDIO_OUT_BOS_TOKEN_ID, AUDIO_OUT_TOKEN_IDX, tiny_inputs, tiny_model
+
+
+def _measure(num_logits_to_keep, num_audio_tokens, num_text_tokens, vocab_size, num_codebooks, codebook_size):
+    text_config = dict(
+        model_type="llama",
+        vocab_size=vocab_size,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=num_audio_tokens + num_text_tokens + 16,
+        pad_token_id=vocab_size - 1,
+    )
+    model = tiny_model(
+        text_config=text_config,
+        audio_num_codebooks=num_codebooks,
+        audio_codebook_size=codebook_size,
+        audio_stream_bos_id=codebook_size,
+        audio_stream_eos_id=codebook_size + 1,
+        pad_token_id=vocab_size - 1,
+        # Same as `from_pretrained()`, so that the attention scores of the prompt are not materialized.
+        attn_implementation="sdpa",
+    )
+    # A voice clone prompt: the reference audio, then the text to read.
+    audio_out_ids = torch.randint(0, codebook_size, (num_codebooks, num_audio_tokens))
+    input_ids = [1, AUDIO_OUT_BOS_TOKEN_ID, AUDIO_OUT_TOKEN_IDX] + [2] * num_text_tokens + [AUDIO_OUT_BOS_TOKEN_ID]
+    inputs = tiny_inputs(input_ids, audio_out_ids)
+
+    peak_rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with torch.inference_mode():
+        model(**inputs, use_cache=True, num_logits_to_keep=num_logits_to_keep)
+    # `ru_maxrss` is in KiB on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak_rss_before) / 1024
+
+
+@click.command()
+@click.option("--num_audio_tokens", type=int, default=4096)
+@click.option("--num_text_tokens", type=int, default=256)
+@click.option("--vocab_size", type=int, default=128256)
+@click.option("--num_codebooks", type=int, default=8)
+@click.option("--codebook_size", type=int, default=1024)
+def main(num_audio_tokens, num_text_tokens, vocab_size, num_codebooks, codebook_size):
+    args = (num_audio_tokens, num_text_tokens, vocab_size, num_codebooks, codebook_size)
+    with multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+        all_logits = pool.apply(_measure, (0, *args))
+        last_logits = pool.apply(_measure, (1, *args))
+    print(f"Prompt: {num_audio_tokens} audio tokens, {num_text_tokens} text tokens")
+    print(f"Peak RSS increase, logits of all the positions: {all_logits:.0f} MiB")
+    print(f"Peak RSS increase, logits of the last position: {last_logits:.0f} MiB")
+
+
+if __name__ == "__main__":
+    main()
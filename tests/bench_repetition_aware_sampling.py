@@ -0,0 +1,125 @@
+"""Compare the per-step cost of sampling the audio tokens with repetition aware sampling (RAS), when the fallback tokens
+are drawn for all the rows and picked with `torch.where`, and when the repeated rows are selected on the host with
+`nonzero()` and resampled, as before.
+
+Selecting the rows makes the host wait for the device at every audio step, which the host sync count shows. On the
+CPU, where nothing actually waits, drawing the fallback for all the rows costs more than it saves. The default sizes are
+those of the released model: 8 codebooks of 1024 codes. Run it from the root of the repository:
+
+    python -m tests.bench_repetition_aware_sampling --batch_size 1 --do_sample
+"""
+
+import time
+
+import click
+import torch
+from transformers.generation import GenerationConfig, LogitsProcessorList
+from transformers.generation.logits_process import TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+
+from boson_multimodal.model.higgs_audio.utils import HostSyncCounter
+
+from .utils import AUDIO_EOS_TOKEN_ID, tiny_model
+
+
+def _scan_and_resample(
+    audio_logits, audio_out_ids, do_sample, logits_processor, torch_generator, ras_win_len, ras_win_max_num_repeat
+):
+    # The previous behavior: the repeated rows are selected on the host and resampled without temperature.
+    next_audio_token_logits = audio_logits.clone().float().view(-1, audio_logits.shape[-1])
+    next_audio_token_scores = logits_processor(None, next_audio_token_logits)
+    if do_sample:
+        probs = torch.nn.functional.softmax(next_audio_token_scores, dim=-1)
+        next_audio_tokens = torch.multinomial(probs, num_samples=1, generator=torch_generator).squeeze(1)
+    else:
+        next_audio_tokens = torch.argmax(next_audio_token_scores, dim=-1)
+    window = audio_out_ids.reshape(-1, audio_out_ids.shape[-1])[:, -ras_win_len:]
+    rep_num = (window == next_audio_tokens.unsqueeze(1)).sum(dim=1)
+    row_indices = torch.nonzero(rep_num >= ras_win_max_num_repeat).squeeze(1)
+    next_audio_tokens[row_indices] = (
+        next_audio_token_logits[row_indices]
+        .softmax(dim=-1)
+        .multinomial(1, replacement=True, generator=torch_generator)
+        .squeeze(1)
+    )
+    return next_audio_tokens
+
+
+@click.command()
+@click.option("--batch_size", type=int, default=1)
+@click.option("--audio_num_codebooks", type=int, default=8)
+@click.option("--audio_codebook_size", type=int, default=1024)
+@click.option("--ras_win_len", type=int, default=7)
+@click.option("--ras_win_max_num_repeat", type=int, default=2)
+@click.option("--do_sample/--greedy", default=True)
+@click.option("--num_steps", type=int, default=500)
+def main(
+    batch_size, audio_num_codebooks, audio_codebook_size, ras_win_len, ras_win_max_num_repeat, do_sample, num_steps
+):
+    model = tiny_model(audio_num_codebooks=audio_num_codebooks, audio_codebook_size=audio_codebook_size)
+    num_codes = audio_codebook_size + 2
+    logits_processor = LogitsProcessorList()
+    if do_sample:
+        # The defaults of the serve engine
+        logits_processor.extend([TemperatureLogitsWarper(0.7), TopKLogitsWarper(50), TopPLogitsWarper(0.95)])
+    generation_config = GenerationConfig(
+        generation_kwargs={
+            "ras_win_len": ras_win_len,
+            "ras_win_max_num_repeat": ras_win_max_num_repeat,
+            "audio_eos_token_id": AUDIO_EOS_TOKEN_ID,
+        }
+    )
+    generator = torch.Generator().manual_seed(0)
+    steps = []
+    for _ in range(num_steps):
+        audio_logits = torch.randn(batch_size, audio_num_codebooks, num_codes, generator=generator) * 4
+        # The window holds tokens drawn from the same distribution, so that some rows repeat.
+        probs = audio_logits.view(-1, num_codes).softmax(dim=-1)
+        audio_out_ids = torch.multinomial(probs, ras_win_len, replacement=True, generator=generator)
+        steps.append((audio_logits, audio_out_ids.view(batch_size, audio_num_codebooks, ras_win_len)))
+
+    def _sample(audio_logits, audio_out_ids, torch_generator):
+        return model._sample_audio_tokens(
+            hidden_states=None,
+            audio_logits=audio_logits,
+            audio_out_ids=audio_out_ids,
+            do_sample=do_sample,
+            logits_processor=logits_processor,
+            device=audio_logits.device,
+            torch_generator=torch_generator,
+            generation_config=generation_config,
+            num_delay=torch.full((batch_size,), audio_num_codebooks - 1),
+            num_remaining_delays=torch.full((batch_size,), -1),
+        )
+
+    def _scan(audio_logits, audio_out_ids, torch_generator):
+        return _scan_and_resample(
+            audio_logits,
+            audio_out_ids,
+            do_sample,
+            logits_processor,
+            torch_generator,
+            ras_win_len,
+            ras_win_max_num_repeat,
+        )
+
+    print(
+        f"Batch of {batch_size}, {audio_num_codebooks} codebooks of {audio_codebook_size} codes, "
+        f"RAS window of {ras_win_len}, {'sampling' if do_sample else 'greedy'}"
+    )
+    with torch.inference_mode():
+        for name, sample in [("scan and resample", _scan), ("sync-free", _sample)]:
+            torch_generator = torch.Generator().manual_seed(0)
+            # Warm up
+            for audio_logits, audio_out_ids in steps[:10]:
+                sample(audio_logits, audio_out_ids, torch_generator)
+            start = time.perf_counter()
+            for audio_logits, audio_out_ids in steps:
+                sample(audio_logits, audio_out_ids, torch_generator)
+            step_time = (time.perf_counter() - start) / num_steps
+            with HostSyncCounter() as counter:
+                sample(*steps[0], torch_generator)
+            print(f"{name:>18}: {step_time * 1e6:7.1f} us per step, {counter.num_syncs} host syncs per step")
+
+
+if __name__ == "__main__":
+    main()
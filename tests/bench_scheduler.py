@@ -0,0 +1,83 @@
+"""Compare the decoding throughput of `HiggsAudioScheduler` with calling `HiggsAudioModel.generate` on each request.
+
+It uses a randomly initialized model, so it runs on the CPU without any checkpoint. Run it from the root of the
+repository:
+
+    python -m tests.bench_scheduler --num_requests 8 --max_new_tokens 64
+"""
+
+import time
+
+import click
+import torch
+
+from boson_multimodal.serve.scheduler import HiggsAudioScheduler
+
+from .utils import AUDIO_OUT_BOS_TOKEN_ID, tiny_inputs, tiny_model
+
+
+def _prompts(num_requests: int):
+    # Half of the requests start an audio segment right away, the others generate text.
+    return [
+        tiny_inputs([1, 2, 3 + i, AUDIO_OUT_BOS_TOKEN_ID] if i % 2 == 0 else [1, 2, 3 + i, 4])
+        for i in range(num_requests)
+    ]
+
+
+@click.command()
+@click.option("--num_requests", type=int, default=8)
+@click.option("--max_new_tokens", type=int, default=64)
+@click.option("--hidden_size", type=int, default=256)
+@click.option("--num_hidden_layers", type=int, default=4)
+@click.option("--ras_win_len", type=int, default=7)
+@click.option("--device", type=str, default="cpu")
+def main(num_requests, max_new_tokens, hidden_size, num_hidden_layers, ras_win_len, device):
+    text_config = dict(
+        model_type="llama",
+        vocab_size=64,
+        hidden_size=hidden_size,
+        intermediate_size=2 * hidden_size,
+        num_hidden_layers=num_hidden_layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=4096,
+        pad_token_id=63,
+    )
+    model = tiny_model(
+        text_config=text_config,
+        audio_ffn_hidden_size=hidden_size,
+        audio_ffn_intermediate_size=2 * hidden_size,
+        audio_dual_ffn_layers=list(range(num_hidden_layers)),
+    ).to(device)
+    # There is no stop token, so each request generates exactly `max_new_tokens` tokens.
+    model.generation_config.eos_token_id = None
+    prompts = [
+        {k: v.to(device) if v is not None else None for k, v in inputs.items()} for inputs in _prompts(num_requests)
+    ]
+    sampling_kwargs = dict(temperature=1.0, top_k=5, top_p=0.95, ras_win_len=ras_win_len)
+
+    with torch.inference_mode():
+        # Warm up
+        model.generate(**prompts[0], max_new_tokens=4, do_sample=True, **sampling_kwargs)
+
+        start = time.perf_counter()
+        for inputs in prompts:
+            model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=True, **sampling_kwargs)
+        sequential_time = time.perf_counter() - start
+
+    scheduler = HiggsAudioScheduler(model, max_batch_size=num_requests)
+    for i, inputs in enumerate(prompts):
+        scheduler.add_request(f"request-{i}", inputs, max_new_tokens=max_new_tokens, **sampling_kwargs)
+    start = time.perf_counter()
+    finished = scheduler.run()
+    scheduler_time = time.perf_counter() - start
+    assert all(len(seq.output_token_ids) > 0 and seq.finish_reason == "length" for seq in finished)
+
+    num_tokens = num_requests * max_new_tokens
+    print(f"Sequential generate: {sequential_time:.2f}s, {num_tokens / sequential_time:.1f} tokens/s")
+    print(f"Scheduler:           {scheduler_time:.2f}s, {num_tokens / scheduler_time:.1f} tokens/s")
+    print(f"Speedup: {sequential_time / scheduler_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Compare the time of a decoding step with a static cache, when the attention masks are updated in place and when they
+are rebuilt from the attention mask of the whole cache.
+
+`StaticKVCacheMasks` updates the column of the decoded token in the causal, fast-forward and audio attention masks. When
+it cannot, as before, `_update_causal_mask` and `_prepare_all_static_kv_cache_masks` rebuild the masks of every position
+of the cache at each step, which costs more as the cache grows. It uses a randomly initialized model, so it runs on the
+CPU without any checkpoint. Run it from the root of the repository:
+
+    python -m tests.bench_static_kv_cache_masks --cache_lengths 1024,4096,8192
+"""
+
+import time
+from copy import deepcopy
+
+import click
+import torch
+from transformers.cache_utils import StaticCache
+
+from boson_multimodal.model.higgs_audio import modeling_higgs_audio
+
+from .utils import AUDIO_OUT_BOS_TOKEN_ID, tiny_inputs, tiny_model
+
+
+@click.command()
+@click.option("--cache_lengths", type=str, default="1024,4096,8192")
+@click.option("--num_steps", type=int, default=32)
+@click.option("--hidden_size", type=int, default=64)
+@click.option("--num_hidden_layers", type=int, default=4)
+@click.option("--audio_adapter_type", type=click.Choice(["dual_ffn", "dual_ffn_fast_forward"]), default="dual_ffn")
+def main(cache_lengths, num_steps, hidden_size, num_hidden_layers, audio_adapter_type):
+    cache_lengths = [int(cache_length) for cache_length in cache_lengths.split(",")]
+    text_config = dict(
+        model_type="llama",
+        vocab_size=64,
+        hidden_size=hidden_size,
+        intermediate_size=2 * hidden_size,
+        num_hidden_layers=num_hidden_layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=max(cache_lengths),
+        pad_token_id=63,
+    )
+    model = tiny_model(
+        text_config=text_config,
+        audio_adapter_type=audio_adapter_type,
+        audio_ffn_hidden_size=hidden_size,
+        audio_ffn_intermediate_size=2 * hidden_size,
+        audio_dual_ffn_layers=[num_hidden_layers - 1],
+        use_audio_out_self_attention=audio_adapter_type == "dual_ffn",
+        # Same as `from_pretrained()`
+        attn_implementation="sdpa",
+    )
+    model.generation_config.eos_token_id = None
+    cache_config = deepcopy(model.config.text_config)
+    cache_config.num_hidden_layers += len(model.config.audio_dual_ffn_layers)
+    forward = model.forward
+
+    def _step_time(cache_length):
+        # The prompt fills the cache but the generated tokens, whose decoding starts an audio segment.
+        inputs = tiny_inputs([1] * (cache_length - num_steps - 2) + [AUDIO_OUT_BOS_TOKEN_ID])
+        step_times = []
+
+        def _timed_forward(*args, **kwargs):
+            start = time.perf_counter()
+            outputs = forward(*args, **kwargs)
+            if kwargs["input_ids"].shape[1] == 1:
+                step_times.append(time.perf_counter() - start)
+            return outputs
+
+        model.forward = _timed_forward
+        try:
+            model.generate(
+                **inputs,
+                max_new_tokens=num_steps,
+                do_sample=False,
+                past_key_values=StaticCache(config=cache_config, batch_size=1, max_cache_len=cache_length),
+            )
+        finally:
+            model.forward = forward
+        # Skip the first steps as a warm up.
+        step_times = step_times[len(step_times) // 4 :]
+        return sum(step_times) / len(step_times)
+
+    can_update = modeling_higgs_audio.StaticKVCacheMasks.can_update
+    print(f"{'Cache length':>12} {'Rebuilt masks':>14} {'Updated masks':>14} {'Saved per step':>15}")
+    with torch.inference_mode():
+        for cache_length in cache_lengths:
+            updated_time = _step_time(cache_length)
+            modeling_higgs_audio.StaticKVCacheMasks.can_update = lambda *args: False
+            try:
+                rebuilt_time = _step_time(cache_length)
+            finally:
+                modeling_higgs_audio.StaticKVCacheMasks.can_update = can_update
+            print(
+                f"{cache_length:>12} {rebuilt_time * 1000:>11.2f} ms {updated_time * 1000:>11.2f} ms "
+                f"{(rebuilt_time - updated_time) * 1000:>12.2f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
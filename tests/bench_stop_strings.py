@@ -0,0 +1,100 @@
+"""Compare the decoding throughput of `HiggsAudioModel.generate` with the default stop strings, when they are checked
+by token id on the text steps and when they are matched on the text by `StopStringCriteria` at every step.
+
+It uses a randomly initialized model and a tokenizer trained on the fly, so it runs on the CPU without any checkpoint.
+Run it from the root of the repository:
+
+    python -m tests.bench_stop_strings --max_new_tokens 512
+"""
+
+import time
+
+import click
+import torch
+
+from boson_multimodal.model.higgs_audio import modeling_higgs_audio
+
+from .utils import AUDIO_OUT_BOS_TOKEN_ID, tiny_inputs, tiny_model, tiny_tokenizer
+
+
+STOP_STRINGS = ["<|end_of_text|>", "<|eot_id|>"]
+
+
+def _match_stop_strings_on_text(stop_strings, tokenizer):
+    # The previous behavior: every stop string is left to `StopStringCriteria`.
+    return [], stop_strings
+
+
+@click.command()
+@click.option("--max_new_tokens", type=int, default=512)
+@click.option("--num_runs", type=int, default=5)
+@click.option("--hidden_size", type=int, default=64)
+@click.option("--num_hidden_layers", type=int, default=2)
+def main(max_new_tokens, num_runs, hidden_size, num_hidden_layers):
+    tokenizer = tiny_tokenizer()
+    text_config = dict(
+        model_type="llama",
+        # The stop tokens come last in the tokenizer and are never sampled, so each run generates `max_new_tokens`.
+        vocab_size=min(tokenizer.convert_tokens_to_ids(STOP_STRINGS)),
+        hidden_size=hidden_size,
+        intermediate_size=2 * hidden_size,
+        num_hidden_layers=num_hidden_layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=4096,
+        pad_token_id=63,
+    )
+    model = tiny_model(
+        text_config=text_config,
+        audio_ffn_hidden_size=hidden_size,
+        audio_ffn_intermediate_size=2 * hidden_size,
+        audio_dual_ffn_layers=list(range(num_hidden_layers)),
+    )
+    model.generation_config.eos_token_id = None
+    # Half of the runs start an audio segment right away, the others generate text.
+    prompts = [tiny_inputs([1, 2, 3, AUDIO_OUT_BOS_TOKEN_ID]), tiny_inputs([1, 2, 3, 4])]
+
+    def _generate(inputs, seed):
+        return model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=True,
+            top_k=5,
+            seed=seed,
+            stop_strings=STOP_STRINGS,
+            tokenizer=tokenizer,
+            return_dict_in_generate=True,
+        )
+
+    def _run():
+        outputs, num_tokens = [], 0
+        start = time.perf_counter()
+        for i in range(num_runs):
+            output = _generate(prompts[i % 2], seed=i)
+            outputs.append(output)
+            num_tokens += output.sequences.shape[1] - prompts[i % 2]["input_ids"].shape[1]
+            num_tokens += sum(audio_ids.shape[1] for audio_ids in output.audio_sequences)
+        return outputs, num_tokens, time.perf_counter() - start
+
+    with torch.inference_mode():
+        # Warm up
+        _generate(prompts[0], seed=0)
+        token_id_outputs, token_id_tokens, token_id_time = _run()
+        split_stop_strings = modeling_higgs_audio.split_stop_strings
+        modeling_higgs_audio.split_stop_strings = _match_stop_strings_on_text
+        try:
+            _generate(prompts[0], seed=0)
+            text_outputs, text_tokens, text_time = _run()
+        finally:
+            modeling_higgs_audio.split_stop_strings = split_stop_strings
+
+    for output, expected in zip(token_id_outputs, text_outputs):
+        assert torch.equal(output.sequences, expected.sequences)
+
+    print(f"StopStringCriteria: {text_time:.2f}s, {text_tokens / text_time:.1f} tokens/s")
+    print(f"Stop token ids:     {token_id_time:.2f}s, {token_id_tokens / token_id_time:.1f} tokens/s")
+    print(f"Speedup: {text_time / token_id_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
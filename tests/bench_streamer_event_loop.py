@@ -0,0 +1,87 @@
+"""Measure the CPU time that the event loop spends per audio column when it serves many streams, depending on the
+number of audio columns sent together in one delta.
+
+Each stream is fed by its own thread, which puts one audio column every `--column_interval_ms` like a generation
+thread, while the event loop consumes the deltas of all the streams. Every delta wakes up the event loop, so sending
+several columns at once divides its work. Run it from the root of the repository:
+
+    python -m tests.bench_streamer_event_loop --num_streams 32 --audio_chunk_frames 1,4,16
+"""
+
+import asyncio
+import threading
+import time
+
+import click
+import torch
+
+from boson_multimodal.serve.serve_engine import AsyncHiggsAudioStreamer
+
+from .utils import tiny_tokenizer
+
+
+def _generate(streamer, num_columns, column_interval_ms):
+    streamer.put(torch.tensor([[0]]))  # The prompt
+    column = torch.arange(8)
+    for _ in range(num_columns):
+        time.sleep(column_interval_ms / 1000)
+        streamer.put(column)
+    streamer.end()
+
+
+async def _serve(tokenizer, num_streams, num_columns, column_interval_ms, audio_chunk_frames, audio_chunk_ms):
+    streamers = [
+        AsyncHiggsAudioStreamer(
+            tokenizer,
+            skip_prompt=True,
+            audio_num_codebooks=8,
+            audio_chunk_frames=audio_chunk_frames,
+            audio_chunk_ms=audio_chunk_ms,
+        )
+        for _ in range(num_streams)
+    ]
+    threads = [
+        threading.Thread(target=_generate, args=(streamer, num_columns, column_interval_ms)) for streamer in streamers
+    ]
+
+    async def _consume(streamer):
+        num_deltas = num_received_columns = 0
+        async for delta in streamer:
+            num_deltas += 1
+            num_received_columns += delta.audio_tokens.shape[1]
+        return num_deltas, num_received_columns
+
+    start = time.thread_time()
+    for thread in threads:
+        thread.start()
+    results = await asyncio.gather(*[_consume(streamer) for streamer in streamers])
+    loop_cpu_time = time.thread_time() - start
+    for thread in threads:
+        thread.join()
+    assert all(num_received_columns == num_columns for _, num_received_columns in results)
+    return loop_cpu_time, sum(num_deltas for num_deltas, _ in results)
+
+
+@click.command()
+@click.option("--num_streams", type=int, default=32)
+@click.option("--num_columns", type=int, default=200)
+@click.option("--column_interval_ms", type=float, default=2.0)
+@click.option("--audio_chunk_frames", type=str, default="1,4,16")
+@click.option("--audio_chunk_ms", type=float, default=50.0)
+def main(num_streams, num_columns, column_interval_ms, audio_chunk_frames, audio_chunk_ms):
+    tokenizer = tiny_tokenizer()
+    num_all_columns = num_streams * num_columns
+    print(f"{num_streams} streams of {num_columns} audio columns, one column every {column_interval_ms:g} ms")
+    print(f"{'Chunk frames':>12} {'Deltas':>8} {'Loop CPU':>10} {'Loop CPU / column':>18}")
+    for chunk_frames in [int(chunk_frames) for chunk_frames in audio_chunk_frames.split(",")]:
+        loop_cpu_time, num_deltas = asyncio.run(
+            _serve(tokenizer, num_streams, num_columns, column_interval_ms, chunk_frames, audio_chunk_ms)
+        )
+        print(
+            f"{chunk_frames:>12} {num_deltas:>8} {loop_cpu_time * 1000:>7.1f} ms "
+            f"{loop_cpu_time / num_all_columns * 1e6:>15.1f} us"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Measure the per-token cost of streaming text tokens, with the incremental detokenizer of the streamer, with the
+previous decoding of each token on its own, and with decoding the whole sequence again for each token.
+
+Decoding each token on its own is cheap but breaks the characters whose UTF-8 bytes are split over several tokens,
+which the column of broken characters shows. Decoding the whole sequence is correct but costs O(n) per token. The
+last column is the cost of `AsyncHiggsAudioStreamer.put()` on the generation thread, including the delta sent to the
+event loop. It uses a tokenizer trained on the fly. Run it from the root of the repository:
+
+    python -m tests.bench_streamer_text --num_tokens 256,1024,4096
+"""
+
+import asyncio
+import time
+
+import click
+import torch
+
+from boson_multimodal.serve.detokenizer import IncrementalDetokenizer
+from boson_multimodal.serve.serve_engine import AsyncHiggsAudioStreamer
+
+from .utils import tiny_tokenizer
+
+
+TEXT = "Mixed 你好 😀 text, 天气 🎉 mixed. こんにちは、世界。안녕하세요 세계. "
+
+
+def _decode_each_token(tokenizer, token_ids):
+    # The previous behavior
+    return [tokenizer.decode([token_id]) for token_id in token_ids]
+
+
+def _decode_all_tokens(tokenizer, token_ids):
+    deltas = []
+    text = ""
+    for i in range(len(token_ids)):
+        new_text = tokenizer.decode(token_ids[: i + 1])
+        # Hold back the incomplete characters, like the incremental detokenizer.
+        if new_text.endswith("�"):
+            deltas.append("")
+            continue
+        deltas.append(new_text[len(text) :])
+        text = new_text
+    deltas.append(tokenizer.decode(token_ids)[len(text) :])
+    return deltas
+
+
+def _decode_incrementally(tokenizer, token_ids):
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    deltas = [detokenizer.add([token_id]) for token_id in token_ids]
+    deltas.append(detokenizer.flush())
+    return deltas
+
+
+async def _stream(tokenizer, token_ids):
+    streamer = AsyncHiggsAudioStreamer(tokenizer, skip_prompt=True, audio_num_codebooks=8)
+    streamer.put(torch.tensor([[0]]))  # The prompt
+    start = time.perf_counter()
+    for token_id in token_ids:
+        streamer.put(torch.tensor([token_id]))
+    streamer.end()
+    put_time = time.perf_counter() - start
+    text = "".join([delta.text async for delta in streamer])
+    return put_time, text
+
+
+@click.command()
+@click.option("--num_tokens", type=str, default="256,1024,4096")
+def main(num_tokens):
+    tokenizer = tiny_tokenizer()
+    all_token_ids = tokenizer.encode(TEXT, add_special_tokens=False)
+    print(f"{'Tokens':>7} {'Each token':>11} {'Broken':>7} {'All tokens':>11} {'Incremental':>12} {'put()':>9}")
+    for length in [int(length) for length in num_tokens.split(",")]:
+        token_ids = (all_token_ids * (length // len(all_token_ids) + 1))[:length]
+        expected_text = tokenizer.decode(token_ids)
+        results = {}
+        for name, decode in [
+            ("each", _decode_each_token),
+            ("all", _decode_all_tokens),
+            ("incremental", _decode_incrementally),
+        ]:
+            start = time.perf_counter()
+            deltas = decode(tokenizer, token_ids)
+            results[name] = ((time.perf_counter() - start) / length, deltas)
+        put_time, streamed_text = asyncio.run(_stream(tokenizer, token_ids))
+        assert "".join(results["all"][1]) == "".join(results["incremental"][1]) == streamed_text == expected_text
+        num_broken = sum(delta.count("�") for delta in results["each"][1])
+        print(
+            f"{length:>7} {results['each'][0] * 1e6:>8.1f} us {num_broken:>7} {results['all'][0] * 1e6:>8.1f} us "
+            f"{results['incremental'][0] * 1e6:>9.1f} us {put_time / length * 1e6:>6.1f} us"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+import soundfile as sf
+import torch
+
+from boson_multimodal.audio_processing.audio_code_cache import AudioCodeCache
+
+
+class _AudioTokenizer:
+    """Encodes an audio into 4 codebooks, with one frame per 100 samples."""
+
+    sampling_rate = 16000
+    tps = 160
+    num_codebooks = 4
+    codebook_size = 16
+
+    def __init__(self, config=None):
+        self.config = config
+        self.num_calls = 0
+
+    def encode(self, raw_audio, sampling_rate):
+        self.num_calls += 1
+        num_frames = len(raw_audio) // 100
+        return (torch.arange(self.num_codebooks * num_frames) % self.codebook_size).reshape(1, -1, num_frames)
+
+
+@pytest.fixture
+def audio_path(tmp_path):
+    path = tmp_path / "voice.wav"
+    audio = np.random.default_rng(0).uniform(-0.5, 0.5, 16000).astype(np.float32)
+    sf.write(path, audio, 16000)
+    return str(path)
+
+
+def test_path_and_bytes_share_the_codes(audio_path):
+    tokenizer = _AudioTokenizer()
+    cache = AudioCodeCache(tokenizer)
+    codes = cache.encode(audio_path)
+    assert codes.shape == (4, 160)
+
+    with open(audio_path, "rb") as f:
+        audio_bytes = f.read()
+    assert torch.equal(cache.encode(audio_bytes), codes)
+    assert tokenizer.num_calls == 1
+    assert cache.stats == {"memory_hits": 1, "disk_hits": 0, "misses": 1, "memory_entries": 1}
+
+
+def test_codes_are_shared_on_disk(tmp_path, audio_path):
+    cache_dir = str(tmp_path / "codes")
+    codes = AudioCodeCache(_AudioTokenizer(), cache_dir=cache_dir).encode(audio_path)
+
+    # Another process finds the codes on disk.
+    tokenizer = _AudioTokenizer()
+    cache = AudioCodeCache(tokenizer, cache_dir=cache_dir)
+    disk_codes = cache.encode(audio_path)
+    assert torch.equal(disk_codes, codes)
+    assert tokenizer.num_calls == 0
+    assert cache.stats == {"memory_hits": 0, "disk_hits": 1, "misses": 0, "memory_entries": 1}
+    # The loaded codes can be modified like the encoded ones.
+    disk_codes[0, 0] += 1
+
+
+def test_tokenizer_config_changes_the_key(tmp_path, audio_path):
+    cache_dir = str(tmp_path / "codes")
+    cache = AudioCodeCache(_AudioTokenizer(config={"n_q": 4}), cache_dir=cache_dir)
+    cache.encode(audio_path)
+
+    other_cache = AudioCodeCache(_AudioTokenizer(config={"n_q": 8}), cache_dir=cache_dir)
+    assert other_cache.tokenizer_fingerprint != cache.tokenizer_fingerprint
+    assert other_cache.get_key(b"audio") != cache.get_key(b"audio")
+    # The codes of the other tokenizer are not reused.
+    other_cache.encode(audio_path)
+    assert other_cache.stats["misses"] == 1
+
+
+def test_least_recently_used_codes_are_evicted(tmp_path):
+    tokenizer = _AudioTokenizer()
+    cache = AudioCodeCache(tokenizer, max_memory_entries=2)
+    paths = []
+    for seed in range(3):
+        path = str(tmp_path / f"voice-{seed}.wav")
+        sf.write(path, np.random.default_rng(seed).uniform(-0.5, 0.5, 1600).astype(np.float32), 16000)
+        paths.append(path)
+        cache.encode(path)
+
+    assert cache.stats["memory_entries"] == 2
+    cache.encode(paths[0])
+    assert tokenizer.num_calls == 4
@@ -0,0 +1,123 @@
+import pytest
+import torch
+from transformers.cache_utils import DynamicCache
+
+from boson_multimodal.model.higgs_audio.audio_drafter import NGramAudioDrafter
+
+from .utils import AUDIO_OUT_BOS_TOKEN_ID, tiny_inputs, tiny_model
+
+
+def _frames(codes):
+    """One column of two codebooks per code."""
+    return [(code, code + 100) for code in codes]
+
+
+def test_propose_the_columns_that_followed_the_last_occurrence():
+    drafter = NGramAudioDrafter(num_draft_frames=3, max_ngram_size=2)
+    assert drafter.propose() == []
+
+    drafter.extend(_frames([1, 2, 3, 4, 5]))
+    assert len(drafter) == 5
+    # The trailing column 5 has not been seen before.
+    assert drafter.propose() == []
+
+    drafter.extend(_frames([2]))
+    assert drafter.propose() == _frames([3, 4, 5])
+    assert drafter.propose(max_frames=2) == _frames([3, 4])
+    # `max_frames` cannot exceed `num_draft_frames`.
+    assert drafter.propose(max_frames=10) == _frames([3, 4, 5])
+    assert drafter.propose(max_frames=0) == []
+
+
+def test_propose_prefers_longer_then_more_recent_ngrams():
+    drafter = NGramAudioDrafter(num_draft_frames=2, max_ngram_size=2)
+    # The unigram 2 last appeared before 9, but the bigram (1, 2) appeared before 7.
+    drafter.extend(_frames([1, 2, 7, 8, 3, 2, 9, 1, 2]))
+    assert drafter.propose() == _frames([7, 8])
+
+    # With unigrams only, the most recent occurrence of 2 wins.
+    drafter = NGramAudioDrafter(num_draft_frames=2, max_ngram_size=1)
+    drafter.extend(_frames([1, 2, 7, 8, 3, 2, 9, 1, 2]))
+    assert drafter.propose() == _frames([9, 1])
+
+
+def test_propose_respects_the_minimum_ngram_size():
+    drafter = NGramAudioDrafter(num_draft_frames=2, max_ngram_size=3, min_ngram_size=2)
+    drafter.extend(_frames([1, 2, 3, 4, 2]))
+    assert drafter.propose() == []
+
+    drafter.extend(_frames([3]))
+    assert drafter.propose() == _frames([4, 2])
+
+
+def test_propose_the_columns_of_a_repeating_pattern():
+    drafter = NGramAudioDrafter(num_draft_frames=4)
+    drafter.extend(_frames([5, 6]))
+    drafter.extend(_frames([5]))
+    # Fewer than `num_draft_frames` columns follow the match, the proposal stops at the end of the history.
+    assert drafter.propose() == _frames([6, 5])
+
+    # The most recent match of the trailing trigram (5, 6, 5) is followed by two columns only.
+    drafter.extend(_frames([6, 5, 6, 5]))
+    assert drafter.propose() == _frames([6, 5])
+
+
+def test_reset_clears_the_history():
+    drafter = NGramAudioDrafter(num_draft_frames=2)
+    drafter.extend(_frames([1, 2, 1]))
+    assert drafter.propose() == _frames([2, 1])
+
+    drafter.reset()
+    assert len(drafter) == 0
+    assert drafter.propose() == []
+    drafter.extend(_frames([1]))
+    assert drafter.propose() == []
+
+
+@pytest.mark.parametrize("min_ngram_size, max_ngram_size", [(0, 3), (3, 2)])
+def test_invalid_ngram_sizes_raise(min_ngram_size, max_ngram_size):
+    with pytest.raises(ValueError):
+        NGramAudioDrafter(num_draft_frames=2, max_ngram_size=max_ngram_size, min_ngram_size=min_ngram_size)
+
+
+def _generate(model, input_ids, **kwargs):
+    return model.generate(
+        **tiny_inputs(input_ids),
+        max_new_tokens=64,
+        do_sample=False,
+        past_key_values=DynamicCache(),
+        return_dict_in_generate=True,
+        output_logits=True,
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize("input_ids", [[1, 2, 3, AUDIO_OUT_BOS_TOKEN_ID], [1, 2, 3, 4]])
+@pytest.mark.parametrize("num_audio_draft_frames", [2, 4])
+def test_greedy_speculative_decoding_matches_decoding(input_ids, num_audio_draft_frames):
+    model = tiny_model()
+    model.generation_config.eos_token_id = None
+
+    outputs = _generate(model, input_ids)
+    speculative_outputs = _generate(model, input_ids, num_audio_draft_frames=num_audio_draft_frames)
+
+    # The generation runs through several audio segments, whose ends follow the delay pattern.
+    assert len(outputs.audio_sequences) == 2
+    assert torch.equal(speculative_outputs.sequences, outputs.sequences)
+    assert len(speculative_outputs.audio_sequences) == len(outputs.audio_sequences)
+    for speculative_audio, audio in zip(speculative_outputs.audio_sequences, outputs.audio_sequences):
+        assert torch.equal(speculative_audio, audio)
+    assert len(speculative_outputs.logits) == len(outputs.logits)
+    for speculative_logits, logits in zip(speculative_outputs.logits, outputs.logits):
+        torch.testing.assert_close(speculative_logits, logits)
+
+    # Some drafts are rejected, so the cache must have dropped their keys and values.
+    assert outputs.audio_draft_acceptance_rate is None
+    assert 0 < speculative_outputs.audio_draft_acceptance_rate < 1
+    assert speculative_outputs.audio_tokens_per_forward > 1
+    speculative_cache, cache = speculative_outputs.past_key_values, outputs.past_key_values
+    assert speculative_cache.get_seq_length() == cache.get_seq_length()
+    for layer_idx in range(len(cache)):
+        torch.testing.assert_close(speculative_cache.key_cache[layer_idx], cache.key_cache[layer_idx])
+        torch.testing.assert_close(speculative_cache.value_cache[layer_idx], cache.value_cache[layer_idx])
+    assert torch.equal(speculative_outputs.cache_audio_discrete_codes_mask, outputs.cache_audio_discrete_codes_mask)
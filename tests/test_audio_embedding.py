@@ -0,0 +1,72 @@
+import pytest
+import torch
+
+from .utils import AUDIO_OUT_BOS_TOKEN_ID, AUDIO_OUT_TOKEN_IDX, AUDIO_STREAM_BOS_ID, tiny_inputs, tiny_model
+
+
+def _embed_audio_ids_per_codebook(model, audio_ids):
+    # The previous implementation, which embeds every codebook separately before reducing them.
+    codebook_shift = torch.arange(model.config.audio_num_codebooks) * model.audio_codebook_size
+    audio_embed = model.audio_codebook_embeddings(audio_ids + codebook_shift.unsqueeze(-1))
+    if model.config.audio_embed_avg:
+        return torch.mean(audio_embed, dim=0)
+    return torch.sum(audio_embed, dim=0)
+
+
+@pytest.mark.parametrize("audio_embed_avg", [False, True])
+@pytest.mark.parametrize("length", [0, 1, 7, 50])
+def test_embed_audio_ids_matches_per_codebook_embeddings(audio_embed_avg, length):
+    model = tiny_model(audio_embed_avg=audio_embed_avg)
+    audio_ids = torch.randint(
+        0, model.audio_codebook_size, (model.audio_num_codebooks, length), generator=torch.Generator().manual_seed(0)
+    )
+
+    audio_embed = model._embed_audio_ids(audio_ids)
+    expected = _embed_audio_ids_per_codebook(model, audio_ids)
+    assert torch.equal(audio_embed, expected)
+
+    # The gradients of the embedding weights are the same too.
+    grad_output = torch.randn_like(expected)
+    (weight_grad,) = torch.autograd.grad((audio_embed * grad_output).sum(), model.audio_codebook_embeddings.weight)
+    (expected_weight_grad,) = torch.autograd.grad(
+        (expected * grad_output).sum(), model.audio_codebook_embeddings.weight
+    )
+    torch.testing.assert_close(weight_grad, expected_weight_grad)
+
+    # In bfloat16, both paths only round in a different order.
+    model = model.to(torch.bfloat16)
+    torch.testing.assert_close(
+        model._embed_audio_ids(audio_ids), _embed_audio_ids_per_codebook(model, audio_ids), atol=0, rtol=2**-7
+    )
+
+
+def test_generate_matches_per_codebook_embeddings(monkeypatch):
+    model = tiny_model()
+    model.generation_config.eos_token_id = None
+    audio_out_ids = torch.randint(0, 16, (4, 20), generator=torch.Generator().manual_seed(0))
+    audio_out_ids[:, 0] = AUDIO_STREAM_BOS_ID
+    # Voice clone: the reference audio is embedded in the prefill, the generated audio at each step.
+    inputs = tiny_inputs([1, AUDIO_OUT_BOS_TOKEN_ID, AUDIO_OUT_TOKEN_IDX, 2, 3, AUDIO_OUT_BOS_TOKEN_ID], audio_out_ids)
+
+    def _generate():
+        with torch.inference_mode():
+            return model.generate(
+                **inputs,
+                max_new_tokens=30,
+                do_sample=True,
+                top_k=5,
+                seed=0,
+                return_dict_in_generate=True,
+                output_logits=True,
+            )
+
+    outputs = _generate()
+    monkeypatch.setattr(model, "_embed_audio_ids", lambda audio_ids: _embed_audio_ids_per_codebook(model, audio_ids))
+    expected = _generate()
+
+    assert torch.equal(outputs.sequences, expected.sequences)
+    assert len(outputs.audio_sequences) == len(expected.audio_sequences) > 0
+    for audio_ids, expected_audio_ids in zip(outputs.audio_sequences, expected.audio_sequences):
+        assert torch.equal(audio_ids, expected_audio_ids)
+    for logits, expected_logits in zip(outputs.logits, expected.logits):
+        assert torch.equal(logits, expected_logits)
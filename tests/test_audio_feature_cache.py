@@ -0,0 +1,73 @@
+import pytest
+import torch
+
+from boson_multimodal.audio_processing.whisper_feature_cache import WhisperFeatureCache
+
+from .utils import AUDIO_IN_TOKEN_IDX, PAD_TOKEN_ID, tiny_model
+
+
+@pytest.fixture(scope="module")
+def model():
+    audio_encoder_config = dict(
+        num_mel_bins=128,
+        encoder_layers=1,
+        encoder_attention_heads=2,
+        encoder_ffn_dim=32,
+        d_model=16,
+        max_source_positions=30,
+        pad_token_id=PAD_TOKEN_ID,
+    )
+    return tiny_model(
+        audio_encoder_config=audio_encoder_config,
+        skip_audio_tower=False,
+        encode_whisper_embed=True,
+        encode_audio_in_tokens=False,
+    )
+
+
+def _forward(model, audio_features, audio_feature_attention_mask, audio_feature_cache_keys=None):
+    # One <|AUDIO|> placeholder per audio
+    input_ids = torch.tensor([[1, 2] + [AUDIO_IN_TOKEN_IDX, 3] * audio_features.shape[0]])
+    with torch.inference_mode():
+        outputs = model(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            audio_features=audio_features,
+            audio_feature_attention_mask=audio_feature_attention_mask,
+            audio_feature_cache_keys=audio_feature_cache_keys,
+            return_dict=True,
+        )
+    return outputs.logits
+
+
+def test_audio_feature_cache(model):
+    torch.manual_seed(0)
+    audio_features = torch.randn(2, 128, 60)
+    audio_feature_attention_mask = torch.ones(2, 60, dtype=torch.long)
+    # The second audio is shorter
+    audio_feature_attention_mask[1, 40:] = 0
+    keys = [("audio-0", 0), ("audio-1", 0)]
+
+    model.set_audio_feature_cache(None)
+    expected = _forward(model, audio_features, audio_feature_attention_mask)
+
+    cache = WhisperFeatureCache()
+    model.set_audio_feature_cache(cache)
+    try:
+        # Without the keys, the cache is not used.
+        torch.testing.assert_close(_forward(model, audio_features, audio_feature_attention_mask), expected)
+        assert len(cache) == 0
+
+        # The first call fills the cache, the second one only reads it.
+        torch.testing.assert_close(_forward(model, audio_features, audio_feature_attention_mask, keys), expected)
+        assert cache.stats["embed_misses"] == 2 and cache.stats["embed_hits"] == 0
+        torch.testing.assert_close(_forward(model, audio_features, audio_feature_attention_mask, keys), expected)
+        assert cache.stats["embed_misses"] == 2 and cache.stats["embed_hits"] == 2
+
+        # Only the missing audio goes through the audio tower.
+        cache.clear()
+        _forward(model, audio_features[1:], audio_feature_attention_mask[1:], keys[1:])
+        torch.testing.assert_close(_forward(model, audio_features, audio_feature_attention_mask, keys), expected)
+        assert cache.stats["embed_misses"] == 4 and cache.stats["embed_hits"] == 3
+    finally:
+        model.set_audio_feature_cache(None)
@@ -0,0 +1,58 @@
+import pytest
+import torch
+
+from .utils import tiny_model
+
+
+@pytest.fixture(scope="module")
+def projector():
+    return tiny_model().audio_decoder_proj
+
+
+def _decoded_hidden_states(batch_size=3):
+    """The hidden states of one decoded token per sequence."""
+    return torch.randn(batch_size, 1, 32, generator=torch.Generator().manual_seed(0))
+
+
+def test_decoding_audio_tokens_matches_the_masked_projection(projector):
+    hidden_states = _decoded_hidden_states()
+    audio_out_mask = torch.ones(hidden_states.shape[:2], dtype=torch.bool)
+    with torch.inference_mode():
+        logits, audio_logits, *_ = projector(hidden_states, audio_out_mask, num_logits_to_keep=1)
+        decoding_logits, decoding_audio_logits, *_ = projector(
+            hidden_states, audio_out_mask, is_decoding_audio_token=True, num_logits_to_keep=1
+        )
+
+    # The text logits are skipped.
+    assert logits.shape == (3, 1, 64)
+    assert decoding_logits is None
+    # 4 codebooks of 16 codes, plus the stream BOS and EOS
+    assert audio_logits.shape == (3, 4 * 18)
+    torch.testing.assert_close(decoding_audio_logits, audio_logits)
+
+
+def test_decoding_text_tokens_matches_the_masked_projection(projector):
+    hidden_states = _decoded_hidden_states()
+    audio_out_mask = torch.zeros(hidden_states.shape[:2], dtype=torch.bool)
+    with torch.inference_mode():
+        logits, audio_logits, *_ = projector(hidden_states, audio_out_mask, num_logits_to_keep=1)
+        decoding_logits, decoding_audio_logits, *_ = projector(
+            hidden_states, audio_out_mask, is_decoding_audio_token=False, num_logits_to_keep=1
+        )
+
+    torch.testing.assert_close(decoding_logits, logits)
+    # No audio token, so the audio head is skipped.
+    assert audio_logits.shape == decoding_audio_logits.shape == (0, 4 * 18)
+
+
+def test_mixed_tokens_are_projected_by_both_heads(projector):
+    hidden_states = _decoded_hidden_states()
+    audio_out_mask = torch.tensor([[True], [False], [True]])
+    with torch.inference_mode():
+        logits, audio_logits, *_ = projector(hidden_states, audio_out_mask, num_logits_to_keep=1)
+        _, all_audio_logits, *_ = projector(
+            hidden_states, torch.ones_like(audio_out_mask), is_decoding_audio_token=True, num_logits_to_keep=1
+        )
+
+    assert logits.shape == (3, 1, 64)
+    torch.testing.assert_close(audio_logits, all_audio_logits[[0, 2]])
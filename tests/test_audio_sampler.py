@@ -0,0 +1,176 @@
+import pytest
+import torch
+from transformers.generation import GenerationConfig, LogitsProcessorList
+from transformers.generation.logits_process import TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+
+from boson_multimodal.model.higgs_audio import modeling_higgs_audio
+from boson_multimodal.model.higgs_audio.audio_sampler import FusedAudioSampler
+
+from .utils import AUDIO_EOS_TOKEN_ID, AUDIO_OUT_BOS_TOKEN_ID, tiny_inputs, tiny_model
+
+
+SAMPLING_CONFIGS = [
+    dict(temperature=1.0, top_k=None, top_p=None),
+    dict(temperature=0.7, top_k=None, top_p=None),
+    dict(temperature=0.7, top_k=5, top_p=None),
+    dict(temperature=1.0, top_k=None, top_p=0.8),
+    dict(temperature=0.7, top_k=10, top_p=0.95),
+    dict(temperature=1.3, top_k=3, top_p=0.5),
+]
+
+
+def _logits_processor(temperature, top_k, top_p):
+    # Same order as `GenerationMixin._get_logits_processor`
+    logits_processor = LogitsProcessorList()
+    if temperature != 1.0:
+        logits_processor.append(TemperatureLogitsWarper(temperature))
+    if top_k is not None:
+        logits_processor.append(TopKLogitsWarper(top_k=top_k))
+    if top_p is not None:
+        logits_processor.append(TopPLogitsWarper(top_p=top_p))
+    return logits_processor
+
+
+@pytest.mark.parametrize("sampling_config", SAMPLING_CONFIGS)
+@pytest.mark.parametrize("ras_win_len", [None, 3])
+@pytest.mark.parametrize("do_sample", [True, False])
+def test_fused_audio_sampler_matches_logits_processor(sampling_config, ras_win_len, do_sample):
+    model = tiny_model()
+    batch_size, num_codebooks, codebook_size = 2, model.audio_num_codebooks, model.audio_codebook_size + 2
+    logits_processor = _logits_processor(**sampling_config)
+    audio_sampler = FusedAudioSampler.from_logits_processor(logits_processor)
+    assert audio_sampler is not None
+    generation_config = GenerationConfig(
+        generation_kwargs={
+            "ras_win_len": ras_win_len,
+            "ras_win_max_num_repeat": 1,
+            "audio_eos_token_id": AUDIO_EOS_TOKEN_ID,
+        }
+    )
+
+    generator = torch.Generator().manual_seed(0)
+    for step in range(20):
+        audio_logits = torch.randn(batch_size, num_codebooks, codebook_size, generator=generator) * 3
+        # Some of the previous tokens repeat, so that repetition aware sampling replaces them.
+        audio_out_ids = torch.randint(0, 4, (batch_size, num_codebooks, 3), generator=generator)
+        outputs = []
+        for sampler in [None, audio_sampler]:
+            outputs.append(
+                model._sample_audio_tokens(
+                    hidden_states=None,
+                    audio_logits=audio_logits,
+                    audio_out_ids=audio_out_ids,
+                    do_sample=do_sample,
+                    logits_processor=logits_processor,
+                    device=audio_logits.device,
+                    torch_generator=torch.Generator().manual_seed(step),
+                    generation_config=generation_config,
+                    num_delay=torch.full((batch_size,), num_codebooks - 1),
+                    num_remaining_delays=torch.full((batch_size,), -1),
+                    audio_sampler=sampler,
+                )
+            )
+        expected, fused = outputs
+        # The tokens, the audio tokens and the scores
+        for i in [0, 1, 3]:
+            assert torch.equal(fused[i], expected[i])
+
+
+@pytest.mark.parametrize("ras_win_len", [None, 3])
+def test_generate_with_the_fused_audio_sampler(monkeypatch, ras_win_len):
+    model = tiny_model()
+    model.generation_config.eos_token_id = None
+
+    def _generate():
+        outputs = []
+        for seed in range(3):
+            input_ids, audio_sequences = model.generate(
+                **tiny_inputs([1, 2, 3 + seed, AUDIO_OUT_BOS_TOKEN_ID]),
+                max_new_tokens=40,
+                do_sample=True,
+                temperature=0.7,
+                top_k=5,
+                top_p=0.95,
+                ras_win_len=ras_win_len,
+                seed=seed,
+                stop_token_ids=[AUDIO_EOS_TOKEN_ID],
+            )
+            outputs.append((input_ids.tolist(), [audio_ids.tolist() for audio_ids in audio_sequences]))
+        return outputs
+
+    fused = _generate()
+    monkeypatch.setattr(modeling_higgs_audio.FusedAudioSampler, "from_logits_processor", lambda *args: None)
+    expected = _generate()
+    assert fused == expected
+    assert any(len(audio_sequences) > 0 for _, audio_sequences in fused)
+
+
+def _scan_and_resample(audio_logits, audio_out_ids, ras_win_len, ras_win_max_num_repeat, torch_generator):
+    """The previous greedy repetition aware sampling, which selected the repeated rows on the host and resampled
+    them without temperature."""
+    next_audio_token_logits = audio_logits.reshape(-1, audio_logits.shape[-1])
+    next_audio_tokens = torch.argmax(next_audio_token_logits, dim=-1)
+    window = audio_out_ids.reshape(-1, audio_out_ids.shape[-1])[:, -ras_win_len:]
+    rep_num = (window == next_audio_tokens.unsqueeze(1)).sum(dim=1)
+    row_indices = torch.nonzero(rep_num >= ras_win_max_num_repeat).squeeze(1)
+    next_audio_tokens[row_indices] = (
+        next_audio_token_logits[row_indices]
+        .softmax(dim=-1)
+        .multinomial(1, replacement=True, generator=torch_generator)
+        .squeeze(1)
+    )
+    return next_audio_tokens.view(audio_logits.shape[:2])
+
+
+@pytest.mark.parametrize("fused", [False, True])
+def test_greedy_repetition_aware_sampling_matches_scan_and_resample(fused):
+    model = tiny_model(use_delay_pattern=False)
+    batch_size, num_codebooks, codebook_size = 2, model.audio_num_codebooks, model.audio_codebook_size + 2
+    ras_win_len, ras_win_max_num_repeat = 3, 2
+    generation_config = GenerationConfig(
+        generation_kwargs={
+            "ras_win_len": ras_win_len,
+            "ras_win_max_num_repeat": ras_win_max_num_repeat,
+            "audio_eos_token_id": AUDIO_EOS_TOKEN_ID,
+        }
+    )
+    generator = torch.Generator().manual_seed(0)
+    audio_logits = torch.randn(batch_size, num_codebooks, codebook_size, generator=generator)
+    greedy_tokens = audio_logits.argmax(dim=-1)
+    # The greedy token of these rows appears twice in the window, so it is replaced.
+    is_repeated = torch.tensor([[True, False, True, False], [False, True, False, False]])
+    audio_out_ids = torch.randint(0, codebook_size, (batch_size, num_codebooks, ras_win_len), generator=generator)
+    audio_out_ids[audio_out_ids == greedy_tokens[..., None]] = -1
+    audio_out_ids[..., :2] = torch.where(is_repeated[..., None], greedy_tokens[..., None], audio_out_ids[..., :2])
+
+    num_draws = 4000
+    counts, expected_counts = torch.zeros(2, int(is_repeated.sum()), codebook_size)
+    for seed in range(num_draws):
+        _, next_audio_tokens, *_ = model._sample_audio_tokens(
+            hidden_states=None,
+            audio_logits=audio_logits,
+            audio_out_ids=audio_out_ids,
+            do_sample=False,
+            logits_processor=LogitsProcessorList(),
+            device=audio_logits.device,
+            torch_generator=torch.Generator().manual_seed(seed),
+            generation_config=generation_config,
+            num_delay=torch.zeros(batch_size, dtype=torch.long),
+            num_remaining_delays=torch.full((batch_size,), -1),
+            audio_sampler=FusedAudioSampler() if fused else None,
+        )
+        expected_audio_tokens = _scan_and_resample(
+            audio_logits, audio_out_ids, ras_win_len, ras_win_max_num_repeat, torch.Generator().manual_seed(seed)
+        )
+        # The rows that do not repeat keep their greedy token.
+        assert torch.equal(next_audio_tokens[~is_repeated], greedy_tokens[~is_repeated])
+        assert torch.equal(expected_audio_tokens[~is_repeated], greedy_tokens[~is_repeated])
+        rows = torch.arange(counts.shape[0])
+        counts[rows, next_audio_tokens[is_repeated]] += 1
+        expected_counts[rows, expected_audio_tokens[is_repeated]] += 1
+
+    # The repeated rows are resampled from the same distribution, but the random draws are not consumed in the same
+    # order, so only the frequencies match.
+    probs = audio_logits[is_repeated].softmax(dim=-1)
+    torch.testing.assert_close(counts / num_draws, probs, atol=0.03, rtol=0)
+    torch.testing.assert_close(expected_counts / num_draws, probs, atol=0.03, rtol=0)
@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+import torch
+
+from boson_multimodal.serve.detokenizer import IncrementalDetokenizer
+from boson_multimodal.serve.serve_engine import AsyncHiggsAudioStreamer
+
+from .utils import tiny_tokenizer
+
+
+TEXTS = [
+    "你好，世界。今天天气很好。",
+    "こんにちは、世界。",
+    "안녕하세요 세계",
+    "Emoji: 😀🎉👍🏽 and 🇫🇷.",
+    "Mixed 你好 😀 text, 天气 🎉 mixed.",
+]
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_deltas_join_into_the_decoded_text(text):
+    tokenizer = tiny_tokenizer()
+    token_ids = tokenizer.encode(text, add_special_tokens=False)
+    # Most characters are split over several byte-level tokens.
+    assert "�" in "".join(tokenizer.decode([token_id]) for token_id in token_ids)
+
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    deltas = [detokenizer.add([token_id]) for token_id in token_ids]
+    deltas.append(detokenizer.flush())
+
+    assert "".join(deltas) == tokenizer.decode(token_ids) == text
+    assert all("�" not in delta for delta in deltas)
+
+
+def test_flush_returns_the_incomplete_characters():
+    tokenizer = tiny_tokenizer()
+    token_ids = tokenizer.encode("你好😀", add_special_tokens=False)[:-1]
+
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    text = "".join(detokenizer.add([token_id]) for token_id in token_ids)
+    text += detokenizer.flush()
+
+    assert text == tokenizer.decode(token_ids)
+    assert text.endswith("�")
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_streamer_text_deltas(text):
+    tokenizer = tiny_tokenizer()
+    token_ids = tokenizer.encode(text, add_special_tokens=False)
+
+    async def main():
+        streamer = AsyncHiggsAudioStreamer(tokenizer, skip_prompt=True, audio_num_codebooks=4)
+        streamer.put(torch.tensor([[0]]))  # The prompt
+        for token_id in token_ids:
+            streamer.put(torch.tensor([token_id]))
+        streamer.end()
+        return [delta async for delta in streamer]
+
+    deltas = asyncio.run(main())
+    assert "".join(delta.text for delta in deltas) == tokenizer.decode(token_ids)
+    assert sum(len(delta.text_tokens) for delta in deltas) == len(token_ids)
+
+
+def _audio_column(step):
+    return torch.arange(4) + 4 * step
+
+
+def _streamer_deltas(steps, **kwargs):
+    """Streams `steps`, which are audio column indices or text token ids given as strings, and returns the deltas as
+    ("audio", column indices) or ("text", token ids)."""
+
+    async def main():
+        streamer = AsyncHiggsAudioStreamer(tiny_tokenizer(), skip_prompt=True, audio_num_codebooks=4, **kwargs)
+        streamer.put(torch.tensor([[0]]))  # The prompt
+        for step in steps:
+            if isinstance(step, str):
+                streamer.put(torch.tensor([int(step)]))
+            else:
+                streamer.put(_audio_column(step))
+        streamer.end()
+        return [delta async for delta in streamer]
+
+    deltas = []
+    for delta in asyncio.run(main()):
+        if delta.audio_tokens is not None:
+            steps = (delta.audio_tokens[0] // 4).tolist()
+            assert torch.equal(delta.audio_tokens, torch.stack([_audio_column(step) for step in steps], dim=1))
+            deltas.append(("audio", steps))
+        else:
+            deltas.append(("text", delta.text_tokens.tolist()))
+    return deltas
+
+
+def test_streamer_sends_chunks_of_audio_columns():
+    deltas = _streamer_deltas(range(9), audio_chunk_frames=4, audio_chunk_ms=None)
+    # The last column is sent at the end of the generation.
+    assert deltas == [("audio", [0, 1, 2, 3]), ("audio", [4, 5, 6, 7]), ("audio", [8])]
+
+
+def test_streamer_sends_the_audio_columns_before_a_text_token():
+    deltas = _streamer_deltas([0, 1, 2, "10", "11", 3, 4], audio_chunk_frames=4, audio_chunk_ms=None)
+    assert deltas == [("audio", [0, 1, 2]), ("text", [10]), ("text", [11]), ("audio", [3, 4])]
+
+
+def test_streamer_sends_every_audio_column_without_chunks():
+    deltas = _streamer_deltas([0, 1, "10", 2], audio_chunk_frames=1)
+    assert deltas == [("audio", [0]), ("audio", [1]), ("text", [10]), ("audio", [2])]
+
+
+def test_streamer_sends_the_audio_columns_that_waited_for_the_timer():
+    async def main():
+        streamer = AsyncHiggsAudioStreamer(
+            tiny_tokenizer(), skip_prompt=True, audio_num_codebooks=4, audio_chunk_frames=4, audio_chunk_ms=10
+        )
+        streamer.put(torch.tensor([[0]]))  # The prompt
+        streamer.put(_audio_column(0))
+        streamer.put(_audio_column(1))
+        # The chunk is not full, but the timer sends it without waiting for the next column.
+        delta = await asyncio.wait_for(streamer.__anext__(), timeout=5)
+        assert torch.equal(delta.audio_tokens, torch.stack([_audio_column(0), _audio_column(1)], dim=1))
+
+        # The timer of the next chunk starts at its first column, and the chunk is sent once full before it fires.
+        for step in range(2, 6):
+            streamer.put(_audio_column(step))
+        streamer.put(_audio_column(6))
+        delta = await asyncio.wait_for(streamer.__anext__(), timeout=5)
+        assert delta.audio_tokens.shape == (4, 4)
+        await asyncio.sleep(0.05)
+        streamer.end()
+        return [delta.audio_tokens.shape async for delta in streamer]
+
+    # The remaining column is sent by its own timer, and not again at the end.
+    assert asyncio.run(main()) == [(4, 1)]
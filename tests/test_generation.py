@@ -0,0 +1,414 @@
+from copy import deepcopy
+
+import pytest
+import torch
+from transformers import LogitsProcessor
+from transformers.cache_utils import DynamicCache, StaticCache
+
+from boson_multimodal.model.higgs_audio import modeling_higgs_audio
+from boson_multimodal.model.higgs_audio.utils import GrowableTensor, HostSyncCounter
+
+from .utils import (
+    AUDIO_EOS_TOKEN_ID,
+    AUDIO_OUT_BOS_TOKEN_ID,
+    AUDIO_OUT_TOKEN_IDX,
+    AUDIO_STREAM_BOS_ID,
+    AUDIO_STREAM_EOS_ID,
+    PAD_TOKEN_ID,
+    tiny_config,
+    tiny_inputs,
+    tiny_model,
+    tiny_tokenizer,
+)
+
+
+@pytest.fixture(scope="module")
+def model():
+    model = tiny_model()
+    # Generate until `max_new_tokens`.
+    model.generation_config.eos_token_id = None
+    return model
+
+
+@pytest.mark.parametrize("ras_win_len", [None, 3])
+def test_one_audio_segment_per_audio_out_token(model, ras_win_len):
+    # The random model also samples <|AUDIO_OUT|> in the text generation mode, which starts an audio segment.
+    for seed in range(10):
+        input_ids, audio_sequences = model.generate(
+            **tiny_inputs([1, 2, 3 + seed, 4]),
+            max_new_tokens=64,
+            do_sample=True,
+            top_k=5,
+            ras_win_len=ras_win_len,
+            seed=seed,
+        )
+        assert (input_ids[0] == AUDIO_OUT_TOKEN_IDX).sum() == len(audio_sequences)
+        for audio_ids in audio_sequences:
+            assert (audio_ids[:, 0] == AUDIO_STREAM_BOS_ID).all()
+
+
+def _left_padded_batch(samples):
+    """Collates `tiny_inputs` of several samples with left padding."""
+    max_len = max(len(input_ids) for input_ids, _ in samples)
+    input_ids = torch.full((len(samples), max_len), PAD_TOKEN_ID, dtype=torch.long)
+    attention_mask = torch.zeros_like(input_ids)
+    audio_out_ids, audio_out_ids_start, num_audio_steps = [], [], 0
+    for row, (sample_ids, sample_audio_out_ids) in enumerate(samples):
+        input_ids[row, max_len - len(sample_ids) :] = torch.tensor(sample_ids)
+        attention_mask[row, max_len - len(sample_ids) :] = 1
+        if sample_audio_out_ids is not None:
+            audio_out_ids.append(sample_audio_out_ids)
+            audio_out_ids_start.append(num_audio_steps)
+            num_audio_steps += sample_audio_out_ids.shape[1]
+    inputs = tiny_inputs([])
+    inputs.update(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        audio_out_ids=torch.cat(audio_out_ids, dim=1) if audio_out_ids else None,
+        audio_out_ids_start=torch.tensor(audio_out_ids_start, dtype=torch.long) if audio_out_ids else None,
+    )
+    return inputs
+
+
+def test_batched_generation_matches_single_sample_generation():
+    model = tiny_model()
+    # The last sample generates this token after 3 steps and finishes while the others are still running.
+    model.generation_config.eos_token_id = 14
+    prompt_audio_out_ids = torch.tensor([[16, 3, 5], [16, 16, 4], [16, 16, 16], [16, 16, 16]])
+    samples = [
+        # Text generation mode, which later samples <|AUDIO_OUT|> to start an audio segment.
+        ([1, 2, 3, 4], None),
+        # Audio generation starts at the first step, with the audio stream bos tokens.
+        ([5, 6, AUDIO_OUT_BOS_TOKEN_ID], None),
+        # Audio generation continues the audio segment of the prompt, in the middle of the delay pattern.
+        ([7, AUDIO_OUT_BOS_TOKEN_ID, AUDIO_OUT_TOKEN_IDX], prompt_audio_out_ids),
+        # Text generation mode, which finishes early.
+        ([8, 9], None),
+    ]
+    generation_kwargs = dict(max_new_tokens=40, do_sample=False)
+
+    batch_input_ids, batch_audio_sequences = model.generate(**_left_padded_batch(samples), **generation_kwargs)
+    prompt_len = max(len(input_ids) for input_ids, _ in samples)
+    for row, (input_ids, audio_out_ids) in enumerate(samples):
+        single_input_ids, audio_sequences = model.generate(
+            **tiny_inputs(input_ids, audio_out_ids), **generation_kwargs
+        )
+        generated_ids = single_input_ids[0, len(input_ids) :]
+        batch_generated_ids = batch_input_ids[row, prompt_len:]
+        assert torch.equal(batch_generated_ids[: len(generated_ids)], generated_ids), row
+        # The rows that finish early are padded.
+        assert (batch_generated_ids[len(generated_ids) :] == PAD_TOKEN_ID).all(), row
+        assert len(batch_audio_sequences[row]) == len(audio_sequences), row
+        for batch_audio_ids, audio_ids in zip(batch_audio_sequences[row], audio_sequences):
+            assert torch.equal(batch_audio_ids, audio_ids), row
+    assert batch_input_ids[-1, prompt_len + 2] == 14 and len(batch_audio_sequences[-1]) == 0
+
+
+@pytest.mark.parametrize("audio_adapter_type", ["dual_ffn", "dual_ffn_fast_forward"])
+@pytest.mark.parametrize("prompt", [[1, 2, 3, AUDIO_OUT_BOS_TOKEN_ID], [1, 2, 3, 4]])
+@pytest.mark.parametrize("with_tokenizer", [False, True])
+def test_one_host_sync_per_decoding_step(audio_adapter_type, prompt, with_tokenizer):
+    model = tiny_model(audio_adapter_type=audio_adapter_type)
+    model.generation_config.eos_token_id = None
+    cache_config = deepcopy(model.config.text_config)
+    cache_config.num_hidden_layers += len(model.config.audio_dual_ffn_layers)
+    # The serve engine passes the tokenizer, which checks the range of the sampled tokens, and the stop strings.
+    tokenizer_kwargs = {}
+    if with_tokenizer:
+        tokenizer_kwargs = dict(tokenizer=tiny_tokenizer(), stop_strings=["<|end_of_text|>", "<|eot_id|>"])
+
+    counts = []
+    for max_new_tokens in [20, 40]:
+        past_key_values = StaticCache(config=cache_config, batch_size=1, max_cache_len=64)
+        with torch.inference_mode(), HostSyncCounter() as counter:
+            model.generate(
+                **tiny_inputs(prompt),
+                max_new_tokens=max_new_tokens,
+                do_sample=True,
+                top_k=5,
+                ras_win_len=3,
+                seed=0,
+                past_key_values=past_key_values,
+                **tokenizer_kwargs,
+            )
+        counts.append(counter.counts)
+    # With a static cache, the only sync of a decoding step reads the generation stages and the stopping criteria.
+    assert counts[1] - counts[0] == {"Tensor.tolist": 20}
+
+
+@pytest.mark.parametrize("prompt", [[1, 2, 3, AUDIO_OUT_BOS_TOKEN_ID], [1, 2, 3, 4]])
+def test_logarithmic_number_of_reallocations(monkeypatch, model, prompt):
+    buffers = []
+
+    class _GrowableTensor(GrowableTensor):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            buffers.append(self)
+
+    monkeypatch.setattr(modeling_higgs_audio, "GrowableTensor", _GrowableTensor)
+    num_reallocations = []
+    for max_new_tokens in [20, 40]:
+        buffers.clear()
+        with torch.inference_mode():
+            model.generate(
+                **tiny_inputs(prompt), max_new_tokens=max_new_tokens, do_sample=False, past_key_values=DynamicCache()
+            )
+        # The input ids, the attention mask and the cached audio discrete codes mask
+        assert len(buffers) == 3
+        for buffer in buffers:
+            assert len(buffer) > max_new_tokens
+            assert buffer.capacity < 2 * len(buffer)
+        num_reallocations.append([buffer.num_reallocations for buffer in buffers])
+    # The capacity doubles, so twice as many steps reallocate each buffer once more.
+    assert num_reallocations[0] == [2, 2, 2]
+    assert num_reallocations[1] == [3, 3, 3]
+
+
+MASK_NAMES = ["causal_mask", "fast_forward_attention_mask", "audio_attention_mask"]
+
+
+@pytest.mark.parametrize(
+    "model_kwargs",
+    [
+        dict(audio_adapter_type="dual_ffn", use_audio_out_self_attention=True),
+        dict(audio_adapter_type="dual_ffn_fast_forward"),
+    ],
+)
+@pytest.mark.parametrize("batched", [False, True])
+def test_static_kv_cache_masks_match_the_rebuilt_masks(monkeypatch, model_kwargs, batched):
+    model = tiny_model(**model_kwargs)
+    model.generation_config.eos_token_id = None
+    cache_config = deepcopy(model.config.text_config)
+    cache_config.num_hidden_layers += len(model.config.audio_dual_ffn_layers)
+    samples = [([1, 2, 3, AUDIO_OUT_BOS_TOKEN_ID], None)]
+    if batched:
+        # A left-padded sequence in the text generation mode, which starts an audio segment later.
+        samples.append(([4, 5, 6], None))
+    inputs = _left_padded_batch(samples)
+
+    forward_core = model._forward_core
+
+    def _generate(masks):
+        def _forward_core(**kwargs):
+            if kwargs["hidden_states"].shape[1] == 1:
+                # The incremental masks are updated in place.
+                step_masks = [kwargs[name].clone() for name in MASK_NAMES]
+                masks.append((kwargs["is_decoding_audio_token"], *step_masks))
+            return forward_core(**kwargs)
+
+        with monkeypatch.context() as m:
+            m.setattr(model, "_forward_core", _forward_core)
+            with torch.inference_mode():
+                return model.generate(
+                    **inputs,
+                    max_new_tokens=24,
+                    do_sample=False,
+                    past_key_values=StaticCache(config=cache_config, batch_size=len(samples), max_cache_len=64),
+                )
+
+    masks = []
+    num_updates = 0
+    update = modeling_higgs_audio.StaticKVCacheMasks.update
+
+    def _update(self, *args):
+        nonlocal num_updates
+        num_updates += 1
+        return update(self, *args)
+
+    with monkeypatch.context() as m:
+        m.setattr(modeling_higgs_audio.StaticKVCacheMasks, "update", _update)
+        input_ids, audio_sequences = _generate(masks)
+    # The masks of every decoding step are updated from those of the prefill.
+    assert num_updates == 23
+    # Build the masks of every decoding step from scratch, with `_update_causal_mask` and
+    # `_prepare_all_static_kv_cache_masks`.
+    rebuilt_masks = []
+    monkeypatch.setattr(modeling_higgs_audio.StaticKVCacheMasks, "can_update", lambda *args: False)
+    rebuilt_input_ids, rebuilt_audio_sequences = _generate(rebuilt_masks)
+
+    assert torch.equal(input_ids, rebuilt_input_ids)
+    for audio, rebuilt_audio in zip(audio_sequences, rebuilt_audio_sequences, strict=True):
+        if batched:
+            for audio_ids, rebuilt_audio_ids in zip(audio, rebuilt_audio, strict=True):
+                assert torch.equal(audio_ids, rebuilt_audio_ids)
+        else:
+            assert torch.equal(audio, rebuilt_audio)
+    assert len(masks) == len(rebuilt_masks) == 23
+    # The sequences decode both text and audio tokens.
+    assert len({is_decoding_audio_token for is_decoding_audio_token, *_ in masks}) == 2
+    for step, (step_masks, rebuilt_step_masks) in enumerate(zip(masks, rebuilt_masks)):
+        assert step_masks[0] == rebuilt_step_masks[0], step
+        for mask, rebuilt_mask in zip(step_masks[1:], rebuilt_step_masks[1:]):
+            assert torch.equal(mask, rebuilt_mask), step
+
+
+class _SmallTokenizer:
+    def __len__(self):
+        return 8
+
+
+def test_tokens_out_of_the_tokenizer_vocabulary_raise(model):
+    # The model samples from its 64 tokens, which are not all in the tokenizer.
+    with pytest.raises(ValueError, match="greater than the tokenizer's vocabulary size 8"):
+        model.generate(
+            **tiny_inputs([1, 2, 3, 4]), max_new_tokens=16, do_sample=True, seed=0, tokenizer=_SmallTokenizer()
+        )
+
+
+@pytest.mark.parametrize("ends_with_audio", [True, False])
+def test_prefill_only_computes_the_last_logits(model, ends_with_audio):
+    audio_out_ids = torch.randint(0, 16, (4, 40), generator=torch.Generator().manual_seed(0))
+    audio_out_ids[:, 0] = AUDIO_STREAM_BOS_ID
+    if ends_with_audio:
+        # Continue the audio segment of the prompt
+        inputs = tiny_inputs([1, 2, AUDIO_OUT_BOS_TOKEN_ID, AUDIO_OUT_TOKEN_IDX], audio_out_ids)
+    else:
+        inputs = tiny_inputs([1, AUDIO_OUT_BOS_TOKEN_ID, AUDIO_OUT_TOKEN_IDX, 2, 3], audio_out_ids)
+
+    with torch.inference_mode():
+        all_outputs = model(**inputs, use_cache=True, num_logits_to_keep=0)
+        last_outputs = model(**inputs, use_cache=True, num_logits_to_keep=1)
+
+    assert all_outputs.logits.shape[1] == all_outputs.attention_mask.shape[1]
+    assert last_outputs.logits.shape[1] == 1
+    torch.testing.assert_close(last_outputs.logits, all_outputs.logits[:, -1:])
+    assert all_outputs.audio_logits.shape[0] == audio_out_ids.shape[1]
+    # Only the last position can have audio logits.
+    expected_audio_logits = all_outputs.audio_logits[-1:] if ends_with_audio else all_outputs.audio_logits[:0]
+    torch.testing.assert_close(last_outputs.audio_logits, expected_audio_logits)
+
+
+@pytest.mark.parametrize("audio_adapter_type", ["dual_ffn", "dual_ffn_fast_forward", "stack"])
+def test_prefill_is_causal(audio_adapter_type):
+    model = tiny_model(audio_adapter_type=audio_adapter_type)
+    input_ids = [1, 2, 3, 4, 5, 6, 7, 8]
+
+    with torch.inference_mode():
+        outputs = model(**tiny_inputs(input_ids), use_cache=True, output_hidden_states=True)
+        prefix_outputs = model(**tiny_inputs(input_ids[:5]), use_cache=True, output_hidden_states=True)
+
+    # The hidden states of the prefix do not depend on the following tokens.
+    for hidden_states, prefix_hidden_states in zip(outputs.hidden_states, prefix_outputs.hidden_states):
+        torch.testing.assert_close(hidden_states[:, :5], prefix_hidden_states)
+
+
+@pytest.mark.parametrize("batched", [False, True])
+def test_fast_forward_prefill_of_the_text_tokens_matches_the_dense_prefill(monkeypatch, batched):
+    model = tiny_model(audio_adapter_type="dual_ffn_fast_forward")
+    model.generation_config.eos_token_id = None
+    generator = torch.Generator().manual_seed(0)
+    reference_audio_out_ids = torch.randint(0, 16, (4, 20), generator=generator)
+    reference_audio_out_ids[:, 0] = AUDIO_STREAM_BOS_ID
+    # A voice clone prompt, whose reference audio is skipped by the fast-forward layers in the prefill.
+    samples = [
+        ([1, AUDIO_OUT_BOS_TOKEN_ID, AUDIO_OUT_TOKEN_IDX, 2, 3, AUDIO_OUT_BOS_TOKEN_ID], reference_audio_out_ids)
+    ]
+    if batched:
+        # The text positions of the sequence with fewer text tokens are padded with the positions of audio tokens.
+        short_audio_out_ids = torch.randint(0, 16, (4, 7), generator=generator)
+        short_audio_out_ids[:, 0] = AUDIO_STREAM_BOS_ID
+        samples.append(([4, 5, 6, 7, 8, 9, AUDIO_OUT_BOS_TOKEN_ID, AUDIO_OUT_TOKEN_IDX], short_audio_out_ids))
+    inputs = _left_padded_batch(samples)
+
+    text_positions = []
+    get_text_positions = modeling_higgs_audio._get_text_positions
+
+    def _get_text_positions(*args, **kwargs):
+        text_positions.append(get_text_positions(*args, **kwargs))
+        return text_positions[-1]
+
+    def _run(get_text_positions):
+        with monkeypatch.context() as m:
+            m.setattr(modeling_higgs_audio, "_get_text_positions", get_text_positions)
+            with torch.inference_mode(), HostSyncCounter() as counter:
+                prefill_outputs = model(**inputs, past_key_values=DynamicCache(), use_cache=True, num_logits_to_keep=0)
+            # The number of text tokens is read along with the lengths of the merged sequences.
+            assert counter.counts["Tensor.item"] == 0
+            with torch.inference_mode():
+                generate_outputs = model.generate(
+                    **inputs,
+                    max_new_tokens=16,
+                    do_sample=False,
+                    past_key_values=DynamicCache(),
+                    return_dict_in_generate=True,
+                    output_logits=True,
+                )
+        return prefill_outputs, generate_outputs
+
+    prefill_outputs, generate_outputs = _run(_get_text_positions)
+    assert len(text_positions) == 2 and all(positions is not None for positions in text_positions)
+    # The dense prefill runs the fast-forward layers on all the tokens, and caches the keys and values of the audio
+    # tokens, which are masked out.
+    dense_prefill_outputs, dense_generate_outputs = _run(lambda *args, **kwargs: None)
+
+    is_attended = prefill_outputs.attention_mask.bool()
+    torch.testing.assert_close(prefill_outputs.logits[is_attended], dense_prefill_outputs.logits[is_attended])
+    torch.testing.assert_close(prefill_outputs.audio_logits, dense_prefill_outputs.audio_logits)
+    # The decoding steps find zeros in the cache instead of the keys and values of the audio tokens, which are masked.
+    assert torch.equal(generate_outputs.sequences, dense_generate_outputs.sequences)
+    for logits, dense_logits in zip(generate_outputs.logits, dense_generate_outputs.logits, strict=True):
+        torch.testing.assert_close(logits, dense_logits)
+    for audio_sequences, dense_audio_sequences in zip(
+        generate_outputs.audio_sequences, dense_generate_outputs.audio_sequences, strict=True
+    ):
+        if batched:
+            for audio_ids, dense_audio_ids in zip(audio_sequences, dense_audio_sequences, strict=True):
+                assert torch.equal(audio_ids, dense_audio_ids)
+        else:
+            assert torch.equal(audio_sequences, dense_audio_sequences)
+
+
+class _EndAudioSegment(LogitsProcessor):
+    """Samples the audio stream eos at the `num_audio_steps`-th audio step, and plain text tokens in the text mode."""
+
+    def __init__(self, num_audio_steps: int):
+        self.num_audio_steps = num_audio_steps
+        self.audio_step = 0
+
+    def __call__(self, input_ids, scores):
+        scores = scores.clone()
+        if input_ids is None:
+            self.audio_step += 1
+            if self.audio_step >= self.num_audio_steps:
+                scores[:, :AUDIO_STREAM_EOS_ID] = -float("inf")
+        else:
+            scores[:, 10:] = -float("inf")
+        return scores
+
+
+def test_continue_from_the_kv_cache_of_a_generated_audio(model):
+    prompt = [1, 2, 3, AUDIO_OUT_BOS_TOKEN_ID]
+    with torch.inference_mode():
+        outputs = model.generate(
+            **tiny_inputs(prompt),
+            max_new_tokens=16,
+            do_sample=True,
+            top_k=5,
+            seed=0,
+            logits_processor=[_EndAudioSegment(num_audio_steps=6)],
+            past_key_values=DynamicCache(),
+            return_dict_in_generate=True,
+        )
+    generated_ids = outputs.sequences[0, len(prompt) :].tolist()
+    (audio_out_ids,) = outputs.audio_sequences
+    assert generated_ids[:2] == [AUDIO_OUT_TOKEN_IDX, AUDIO_EOS_TOKEN_ID]
+    # The step that samples the last audio column also samples <|audio_eos|>, which is fed instead of the column.
+    num_fed_tokens = audio_out_ids.shape[1] - 1 + len(generated_ids[1:]) - 1
+    assert outputs.cache_audio_discrete_codes_mask.shape[1] == len(prompt) + num_fed_tokens
+
+    # Continue with the generated audio in the prompt, from the KV states of the prompt and all the audio columns but
+    # the last one.
+    next_inputs = tiny_inputs(prompt + [AUDIO_OUT_TOKEN_IDX, AUDIO_EOS_TOKEN_ID, 4, 5], audio_out_ids)
+    num_cached_tokens = len(prompt) + audio_out_ids.shape[1] - 1
+    outputs.past_key_values.crop(num_cached_tokens)
+    generation_kwargs = dict(max_new_tokens=1, do_sample=False, output_logits=True, return_dict_in_generate=True)
+    with torch.inference_mode():
+        cached_outputs = model.generate(
+            **next_inputs,
+            past_key_values=outputs.past_key_values,
+            num_cached_tokens=num_cached_tokens,
+            cache_audio_discrete_codes_mask=outputs.cache_audio_discrete_codes_mask[:, :num_cached_tokens],
+            **generation_kwargs,
+        )
+        prefilled_outputs = model.generate(**next_inputs, past_key_values=DynamicCache(), **generation_kwargs)
+    torch.testing.assert_close(cached_outputs.logits[0], prefilled_outputs.logits[0])
@@ -0,0 +1,64 @@
+import pytest
+import torch
+
+from boson_multimodal.model.higgs_audio.utils import GrowableTensor
+
+
+def test_append_grows_the_capacity_geometrically():
+    values = torch.arange(6).reshape(2, 3)
+    buffer = GrowableTensor(values)
+    assert len(buffer) == 3 and buffer.capacity == 6
+    assert torch.equal(buffer.tensor, values)
+
+    expected = values
+    for step in range(20):
+        new_values = torch.full((2, 1), step)
+        expected = torch.cat([expected, new_values], dim=-1)
+        assert torch.equal(buffer.append(new_values), expected)
+    assert len(buffer) == 23
+    # 6 -> 12 -> 24
+    assert buffer.capacity == 24 and buffer.num_reallocations == 2
+
+    # Appending more values than the doubled capacity allocates just enough.
+    buffer.append(torch.zeros(2, 30, dtype=torch.long))
+    assert len(buffer) == 53 and buffer.capacity == 53 and buffer.num_reallocations == 3
+
+
+@pytest.mark.parametrize(
+    "length, capacity, expected_capacity",
+    [(3, None, 6), (3, 10, 10), (3, 1, 3), (0, None, 1)],
+)
+def test_initial_capacity(length, capacity, expected_capacity):
+    buffer = GrowableTensor(torch.zeros(2, length), capacity=capacity)
+    assert buffer.capacity == expected_capacity
+    assert buffer.tensor.shape == (2, length)
+
+
+def test_views_are_unchanged_by_reallocations():
+    buffer = GrowableTensor(torch.tensor([[1, 2]]), capacity=2)
+    view = buffer.tensor
+    # The buffer is full, so the appended values are written to a new buffer.
+    assert torch.equal(buffer.append(torch.tensor([[3]])), torch.tensor([[1, 2, 3]]))
+    assert buffer.num_reallocations == 1
+    assert torch.equal(view, torch.tensor([[1, 2]]))
+
+    # Appending within the capacity does not change the previous views either.
+    view = buffer.tensor
+    buffer.append(torch.tensor([[4]]))
+    assert buffer.num_reallocations == 1
+    assert torch.equal(view, torch.tensor([[1, 2, 3]]))
+    assert view.data_ptr() == buffer.tensor.data_ptr()
+
+
+def test_truncate_drops_the_last_values():
+    buffer = GrowableTensor(torch.tensor([[1, 2, 3, 4]]))
+    view = buffer.tensor
+    assert torch.equal(buffer.truncate(2), torch.tensor([[1, 2]]))
+    assert len(buffer) == 2 and buffer.capacity == 8
+    # Truncating beyond the length keeps all the values.
+    assert torch.equal(buffer.truncate(10), torch.tensor([[1, 2]]))
+
+    # The appended values overwrite the truncated ones, which the previous views see.
+    assert torch.equal(buffer.append(torch.tensor([[5]])), torch.tensor([[1, 2, 5]]))
+    assert torch.equal(view, torch.tensor([[1, 2, 5, 4]]))
+    assert buffer.num_reallocations == 0
@@ -0,0 +1,161 @@
+import random
+
+import pytest
+import torch
+
+from boson_multimodal.model.higgs_audio import modeling_higgs_audio
+from boson_multimodal.model.higgs_audio.utils import merge_input_ids_with_audio_features
+
+from . import reference_merge
+from .utils import (
+    AUDIO_IN_TOKEN_IDX,
+    AUDIO_OUT_BOS_TOKEN_ID,
+    AUDIO_OUT_TOKEN_IDX,
+    AUDIO_STREAM_BOS_ID,
+    PAD_TOKEN_ID,
+    tiny_inputs,
+    tiny_model,
+)
+
+
+EMBED_DIM = 4
+
+
+def _random_case(rng: random.Random, with_features, with_audio_in, with_audio_out, left_padding, with_labels):
+    batch_size = rng.randint(1, 4)
+    placeholders = [
+        tok
+        for tok, enabled in [
+            (AUDIO_IN_TOKEN_IDX, with_features or with_audio_in),
+            (AUDIO_OUT_TOKEN_IDX, with_audio_out),
+        ]
+        if enabled
+    ]
+    rows = []
+    for _ in range(batch_size):
+        rows.append(
+            [
+                rng.choice(placeholders) if placeholders and rng.random() < 0.3 else rng.randint(0, 40)
+                for _ in range(rng.randint(1, 8))
+            ]
+        )
+    max_len = max(len(row) for row in rows)
+    input_ids = torch.full((batch_size, max_len), PAD_TOKEN_ID)
+    attention_mask = torch.zeros((batch_size, max_len), dtype=torch.long)
+    for b, row in enumerate(rows):
+        start = max_len - len(row) if left_padding else 0
+        input_ids[b, start : start + len(row)] = torch.tensor(row)
+        attention_mask[b, start : start + len(row)] = 1
+
+    def _randn(*shape):
+        return torch.tensor([rng.gauss(0, 1) for _ in range(torch.Size(shape).numel())]).view(*shape)
+
+    def _codes(num_audios, min_length):
+        lengths = [rng.randint(min_length, 4) for _ in range(num_audios)]
+        starts = torch.tensor([sum(lengths[:i]) for i in range(num_audios)], dtype=torch.long)
+        return _randn(sum(lengths), EMBED_DIM), starts
+
+    num_audio_in = int((input_ids == AUDIO_IN_TOKEN_IDX).sum())
+    num_audio_out = int((input_ids == AUDIO_OUT_TOKEN_IDX).sum())
+    audio_features_embed = audio_features_length = None
+    if with_features and num_audio_in > 0:
+        audio_features_length = torch.tensor([rng.randint(1, 5) for _ in range(num_audio_in)])
+        audio_features_embed = _randn(num_audio_in, int(audio_features_length.max()), EMBED_DIM)
+    audio_in_embed = audio_in_ids_start = None
+    if with_audio_in and num_audio_in > 0:
+        # An audio can have no discrete codes when it also has features.
+        audio_in_embed, audio_in_ids_start = _codes(num_audio_in, min_length=0 if with_features else 1)
+    audio_out_embed = audio_out_ids_start = None
+    if with_audio_out and num_audio_out > 0:
+        audio_out_embed, audio_out_ids_start = _codes(num_audio_out, min_length=1)
+
+    return dict(
+        audio_features_embed=audio_features_embed,
+        audio_features_length=audio_features_length,
+        audio_in_embed=audio_in_embed,
+        audio_in_ids_start=audio_in_ids_start,
+        audio_out_embed=audio_out_embed,
+        audio_out_ids_start=audio_out_ids_start,
+        audio_in_token_idx=AUDIO_IN_TOKEN_IDX,
+        audio_out_token_idx=AUDIO_OUT_TOKEN_IDX,
+        inputs_embeds=_randn(batch_size, max_len, EMBED_DIM),
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        label_ids=input_ids.masked_fill(attention_mask == 0, -100) if with_labels else None,
+        pad_token_id=PAD_TOKEN_ID,
+    )
+
+
+def _assert_equal(outputs, expected):
+    assert len(outputs) == len(expected)
+    for output, expected_output in zip(outputs, expected):
+        if expected_output is None:
+            assert output is None
+        else:
+            assert output.dtype == expected_output.dtype
+            assert torch.equal(output, expected_output)
+
+
+@pytest.mark.parametrize("with_features", [False, True])
+@pytest.mark.parametrize("with_audio_in", [False, True])
+@pytest.mark.parametrize("with_audio_out", [False, True])
+@pytest.mark.parametrize("left_padding", [False, True])
+@pytest.mark.parametrize("with_labels", [False, True])
+@pytest.mark.parametrize("round_to", [1, 8])
+def test_merge_matches_reference(with_features, with_audio_in, with_audio_out, left_padding, with_labels, round_to):
+    rng = random.Random(0)
+    for _ in range(20):
+        case = _random_case(rng, with_features, with_audio_in, with_audio_out, left_padding, with_labels)
+        outputs = merge_input_ids_with_audio_features(**case, round_to=round_to, left_padding=left_padding)
+        expected = reference_merge.merge_input_ids_with_audio_features(
+            **case, round_to=round_to, left_padding=left_padding
+        )
+        *outputs, max_num_text_tokens = outputs
+        _assert_equal(outputs, expected)
+        assert max_num_text_tokens == _max_num_text_tokens(expected)
+
+
+def _max_num_text_tokens(outputs):
+    """The positions that are not audio discrete codes, which the fast-forward layers process in the prefill."""
+    audio_in_discrete_codes_mask, audio_out_mask = outputs[6], outputs[7]
+    return (~(audio_in_discrete_codes_mask | audio_out_mask)).sum(dim=1).max().item()
+
+
+def _reference_merge(*args, **kwargs):
+    outputs = reference_merge.merge_input_ids_with_audio_features(*args, **kwargs)
+    return (*outputs, _max_num_text_tokens(outputs))
+
+
+def test_generate_matches_reference(monkeypatch):
+    model = tiny_model()
+    model.generation_config.eos_token_id = None
+    audio_out_ids = torch.randint(0, 16, (4, 20), generator=torch.Generator().manual_seed(0))
+    audio_out_ids[:, 0] = AUDIO_STREAM_BOS_ID
+    inputs = tiny_inputs([1, AUDIO_OUT_BOS_TOKEN_ID, AUDIO_OUT_TOKEN_IDX, 2, 3, AUDIO_OUT_BOS_TOKEN_ID], audio_out_ids)
+
+    def _generate():
+        with torch.inference_mode():
+            return model.generate(
+                **inputs,
+                max_new_tokens=30,
+                do_sample=True,
+                top_k=5,
+                seed=0,
+                return_dict_in_generate=True,
+                output_logits=True,
+            )
+
+    outputs = _generate()
+    monkeypatch.setattr(
+        modeling_higgs_audio,
+        "merge_input_ids_with_audio_features",
+        _reference_merge,
+    )
+    expected = _generate()
+
+    assert torch.equal(outputs.sequences, expected.sequences)
+    assert len(outputs.audio_sequences) == len(expected.audio_sequences) > 0
+    for audio_ids, expected_audio_ids in zip(outputs.audio_sequences, expected.audio_sequences):
+        assert torch.equal(audio_ids, expected_audio_ids)
+    for logits, expected_logits in zip(outputs.logits, expected.logits):
+        assert torch.equal(logits, expected_logits)
@@ -0,0 +1,86 @@
+from collections import OrderedDict
+from copy import deepcopy
+
+import pytest
+import torch
+from transformers.cache_utils import StaticCache
+
+from boson_multimodal.model.higgs_audio import PagedKVCache
+
+from .utils import AUDIO_OUT_BOS_TOKEN_ID, AUDIO_OUT_TOKEN_IDX, tiny_inputs, tiny_model
+
+
+CACHE_LENGTHS = [16, 64]
+
+
+def _cache_config(model):
+    # Same as `HiggsAudioServeEngine`, the audio attention layers of the dual-FFN layers have their own KV cache.
+    cache_config = deepcopy(model.config.text_config)
+    cache_config.num_hidden_layers += len(model.config.audio_dual_ffn_layers)
+    return cache_config
+
+
+def _generate(model, inputs, **kwargs):
+    with torch.inference_mode():
+        outputs = model.generate(
+            **inputs,
+            max_new_tokens=48,
+            use_cache=True,
+            do_sample=True,
+            top_k=5,
+            ras_win_len=3,
+            seed=0,
+            return_dict_in_generate=True,
+            output_logits=True,
+            **kwargs,
+        )
+    return outputs
+
+
+def _assert_equal(outputs, expected):
+    assert torch.equal(outputs.sequences, expected.sequences)
+    assert len(outputs.audio_sequences) == len(expected.audio_sequences)
+    for audio_ids, expected_audio_ids in zip(outputs.audio_sequences, expected.audio_sequences):
+        assert torch.equal(audio_ids, expected_audio_ids)
+    assert len(outputs.logits) == len(expected.logits)
+    for logits, expected_logits in zip(outputs.logits, expected.logits):
+        assert torch.equal(logits, expected_logits)
+
+
+@pytest.mark.parametrize("audio_adapter_type", ["dual_ffn", "dual_ffn_fast_forward"])
+def test_paged_kv_cache_matches_static_cache_buckets(audio_adapter_type):
+    model = tiny_model(audio_adapter_type=audio_adapter_type)
+    model.generation_config.eos_token_id = None
+    cache_config = _cache_config(model)
+    audio_out_ids = torch.randint(0, 16, (4, 5), generator=torch.Generator().manual_seed(0))
+    audio_out_ids[:, 0] = 16
+    prompts = [
+        # Voice clone: the reference audio, then the generated audio.
+        tiny_inputs([1, 2, AUDIO_OUT_BOS_TOKEN_ID, AUDIO_OUT_TOKEN_IDX, 3, 4, AUDIO_OUT_BOS_TOKEN_ID], audio_out_ids),
+        tiny_inputs([1, 2, 3, 4]),
+    ]
+
+    buckets = OrderedDict(
+        (length, StaticCache(config=cache_config, max_batch_size=1, max_cache_len=length)) for length in CACHE_LENGTHS
+    )
+    paged_kv_cache = PagedKVCache(
+        config=cache_config, num_blocks=max(CACHE_LENGTHS) // 8, block_size=8, cache_lengths=CACHE_LENGTHS
+    )
+    for inputs in prompts:
+        for cache in buckets.values():
+            cache.reset()
+        expected = _generate(model, inputs, past_key_values_buckets=buckets)
+        # The generation crosses the first cache length.
+        assert inputs["input_ids"].shape[1] + len(expected.logits) > CACHE_LENGTHS[0]
+
+        # The cache is reset and reused between the requests, like in `HiggsAudioServeEngine`.
+        paged_kv_cache.reset()
+        _assert_equal(_generate(model, inputs, past_key_values=paged_kv_cache), expected)
+        assert paged_kv_cache.is_contiguous
+        assert paged_kv_cache.max_cache_len == CACHE_LENGTHS[1]
+
+        # The keys and values are gathered through the block tables when the blocks are not contiguous.
+        paged_kv_cache.reset()
+        paged_kv_cache._free_blocks.reverse()
+        _assert_equal(_generate(model, inputs, past_key_values=paged_kv_cache), expected)
+        assert not paged_kv_cache.is_contiguous
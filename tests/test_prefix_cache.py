@@ -0,0 +1,101 @@
+import torch
+
+from boson_multimodal.serve.prefix_cache import PrefixCacheEntry, PrefixKVCache, get_prefix_inputs
+
+from .utils import AUDIO_IN_TOKEN_IDX, AUDIO_OUT_TOKEN_IDX
+
+
+def _inputs():
+    """Two turns, each with a reference audio given as features and codes (<|AUDIO|>) and one as codes (<|AUDIO_OUT|>)."""
+    input_ids = torch.tensor(
+        [[1, AUDIO_IN_TOKEN_IDX, 2, AUDIO_OUT_TOKEN_IDX, 3, 4, AUDIO_IN_TOKEN_IDX, AUDIO_OUT_TOKEN_IDX]]
+    )
+    generator = torch.Generator().manual_seed(0)
+    return dict(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        audio_features=torch.randn(2, 128, 10, generator=generator),
+        audio_feature_attention_mask=torch.ones(2, 10, dtype=torch.long),
+        audio_in_ids=torch.randint(0, 16, (4, 3 + 5), generator=generator),
+        audio_in_ids_start=torch.tensor([0, 3]),
+        audio_out_ids=torch.randint(0, 16, (4, 4 + 6), generator=generator),
+        audio_out_ids_start=torch.tensor([0, 4]),
+    )
+
+
+def test_get_prefix_inputs_keeps_the_audio_of_the_prefix():
+    inputs = _inputs()
+    prefix_inputs = get_prefix_inputs(inputs, 5, AUDIO_IN_TOKEN_IDX, AUDIO_OUT_TOKEN_IDX)
+
+    assert torch.equal(prefix_inputs["input_ids"], inputs["input_ids"][:, :5])
+    assert torch.equal(prefix_inputs["attention_mask"], inputs["attention_mask"][:, :5])
+    assert torch.equal(prefix_inputs["audio_in_ids"], inputs["audio_in_ids"][:, :3])
+    assert torch.equal(prefix_inputs["audio_in_ids_start"], torch.tensor([0]))
+    assert torch.equal(prefix_inputs["audio_out_ids"], inputs["audio_out_ids"][:, :4])
+    assert torch.equal(prefix_inputs["audio_out_ids_start"], torch.tensor([0]))
+    assert torch.equal(prefix_inputs["audio_features"], inputs["audio_features"][:1])
+    assert torch.equal(prefix_inputs["audio_feature_attention_mask"], inputs["audio_feature_attention_mask"][:1])
+
+
+def test_get_prefix_inputs_of_the_whole_sample():
+    inputs = _inputs()
+    prefix_inputs = get_prefix_inputs(inputs, inputs["input_ids"].shape[1], AUDIO_IN_TOKEN_IDX, AUDIO_OUT_TOKEN_IDX)
+
+    assert prefix_inputs.keys() == inputs.keys()
+    for name, value in inputs.items():
+        assert torch.equal(prefix_inputs[name], value), name
+
+
+def test_get_prefix_inputs_without_audio():
+    inputs = _inputs()
+    prefix_inputs = get_prefix_inputs(inputs, 1, AUDIO_IN_TOKEN_IDX, AUDIO_OUT_TOKEN_IDX)
+
+    assert prefix_inputs["audio_in_ids"].shape == (4, 0)
+    assert prefix_inputs["audio_in_ids_start"].shape == (0,)
+    assert prefix_inputs["audio_out_ids"].shape == (4, 0)
+    assert prefix_inputs["audio_out_ids_start"].shape == (0,)
+    assert prefix_inputs["audio_features"].shape[0] == 0
+
+
+def test_compute_key_depends_on_the_audio_codes():
+    inputs = _inputs()
+    key = PrefixKVCache.compute_key(inputs)
+    assert PrefixKVCache.compute_key(_inputs()) == key
+
+    inputs["audio_out_ids"][0, 0] += 1
+    assert PrefixKVCache.compute_key(inputs) != key
+
+
+def _entry(num_tokens: int) -> PrefixCacheEntry:
+    """An entry of one layer, whose KV states take 8 bytes per token."""
+    return PrefixCacheEntry(
+        key_states=[torch.zeros(1, num_tokens, 1)],
+        value_states=[torch.zeros(1, num_tokens, 1)],
+        audio_discrete_codes_mask=torch.zeros(1, num_tokens, dtype=torch.bool),
+        num_prompt_tokens=num_tokens,
+    )
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = PrefixKVCache(max_bytes=8 * 30)
+    for key in ["a", "b", "c"]:
+        cache.put(key, _entry(10))
+    assert len(cache) == 3 and cache.num_bytes == 8 * 30
+
+    # "a" becomes the most recently used entry, so "b" and "c" are evicted to make room for "d".
+    assert cache.get("a") is not None
+    cache.put("d", _entry(15))
+    assert cache.get("b") is None
+    assert cache.get("c") is None
+    assert cache.get("a") is not None
+    assert cache.get("d") is not None
+    assert cache.num_bytes == 8 * 25
+    assert (cache.num_hits, cache.num_misses) == (3, 2)
+
+    # An entry larger than the budget is not cached, and does not evict the others.
+    cache.put("e", _entry(31))
+    assert cache.get("e") is None
+    assert len(cache) == 2 and cache.num_bytes == 8 * 25
+
+    cache.clear()
+    assert len(cache) == 0 and cache.num_bytes == 0
@@ -0,0 +1,39 @@
+import torch
+
+from .utils import tiny_model
+
+
+def test_table_matches_rotary_embedding():
+    model = tiny_model()
+    table = model.rotary_emb_table
+    like = torch.zeros(1, 1, model.config.text_config.hidden_size)
+    table.reserve(10, like)
+
+    position_ids = torch.tensor([[0, 3, 9]])
+    cos, sin = table.get(position_ids)
+    expected_cos, expected_sin = model.rotary_emb(like, position_ids)
+    assert torch.equal(cos, expected_cos)
+    assert torch.equal(sin, expected_sin)
+
+
+def test_tables_are_never_reallocated():
+    # The captured CUDA graphs keep reading the tensors of the time of their capture.
+    model = tiny_model()
+    table = model.rotary_emb_table
+    table.reserve(10, torch.zeros(1, dtype=torch.float32))
+    cos, sin = table.cos, table.sin
+    expected_cos, expected_sin = cos.clone(), sin.clone()
+
+    # Casting the model to another dtype uses another table, and casting it back reuses the first one.
+    table.reserve(10, torch.zeros(1, dtype=torch.bfloat16))
+    assert table.cos.dtype == torch.bfloat16
+    table.reserve(10, torch.zeros(1, dtype=torch.float32))
+    assert table.cos is cos and table.sin is sin
+
+    # Growing the table keeps the previous one alive and untouched.
+    table.reserve(100, torch.zeros(1, dtype=torch.float32))
+    assert table.cos.shape[0] >= 100
+    assert any(replaced_cos is cos for replaced_cos, _ in table._replaced_tables)
+    assert torch.equal(cos, expected_cos)
+    assert torch.equal(sin, expected_sin)
+    assert torch.equal(table.cos[:10], expected_cos)
@@ -0,0 +1,125 @@
+import pytest
+import torch
+
+from boson_multimodal.model.higgs_audio.modeling_higgs_audio import GenerationMode
+from boson_multimodal.model.higgs_audio.utils import HostSyncCounter
+from boson_multimodal.serve.prefix_cache import PrefixKVCache
+from boson_multimodal.serve.scheduler import HiggsAudioScheduler
+
+from .utils import AUDIO_EOS_TOKEN_ID, AUDIO_OUT_BOS_TOKEN_ID, AUDIO_OUT_TOKEN_IDX, tiny_inputs, tiny_model
+
+
+def _prompts():
+    audio_out_ids = torch.randint(0, 16, (4, 6), generator=torch.Generator().manual_seed(0))
+    audio_out_ids[:, 0] = 16
+    return [
+        # Continue an audio segment, start an audio segment, generate text.
+        tiny_inputs([1, 2, AUDIO_OUT_BOS_TOKEN_ID, AUDIO_OUT_TOKEN_IDX], audio_out_ids),
+        tiny_inputs([1, 2, 3, 4, AUDIO_OUT_BOS_TOKEN_ID]),
+        tiny_inputs([5, 6, 7]),
+    ]
+
+
+def _run(scheduler, seeded):
+    for i, inputs in enumerate(_prompts() * 2):
+        scheduler.add_request(
+            f"request-{i}",
+            inputs,
+            max_new_tokens=30 + i,
+            top_k=5,
+            stop_token_ids=[AUDIO_EOS_TOKEN_ID],
+            ras_win_len=3 if i % 2 else None,
+            seed=i if seeded else None,
+        )
+    return {seq.request_id: seq for seq in scheduler.run()}
+
+
+@pytest.mark.parametrize("audio_adapter_type", ["dual_ffn", "dual_ffn_fast_forward"])
+def test_seeded_requests_do_not_depend_on_the_batch(audio_adapter_type):
+    model = tiny_model(audio_adapter_type=audio_adapter_type)
+    batched = _run(HiggsAudioScheduler(model, max_batch_size=4), seeded=True)
+    sequential = _run(HiggsAudioScheduler(model, max_batch_size=1), seeded=True)
+
+    assert batched.keys() == sequential.keys()
+    for request_id, seq in batched.items():
+        assert seq.output_token_ids == sequential[request_id].output_token_ids
+        assert len(seq.audio_sequences) == len(sequential[request_id].audio_sequences)
+        for audio_ids, expected_audio_ids in zip(seq.audio_sequences, sequential[request_id].audio_sequences):
+            assert torch.equal(audio_ids, expected_audio_ids)
+
+
+@pytest.mark.parametrize("audio_adapter_type", ["dual_ffn", "dual_ffn_fast_forward"])
+def test_batched_sampling(audio_adapter_type):
+    model = tiny_model(audio_adapter_type=audio_adapter_type)
+    finished = _run(HiggsAudioScheduler(model, max_batch_size=4), seeded=False)
+
+    assert len(finished) == 6
+    for seq in finished.values():
+        assert seq.finish_reason in ("stop", "length")
+        assert len(seq.output_token_ids) <= seq.max_new_tokens
+        for audio_ids in seq.audio_sequences:
+            assert audio_ids.shape[0] == model.audio_num_codebooks
+            assert ((audio_ids >= 0) & (audio_ids < model.audio_codebook_size + 2)).all()
+
+
+@pytest.mark.parametrize("audio_adapter_type", ["dual_ffn", "dual_ffn_fast_forward"])
+def test_sampling_reads_the_host_once_per_step(audio_adapter_type):
+    model = tiny_model(audio_adapter_type=audio_adapter_type)
+    scheduler = HiggsAudioScheduler(model, max_batch_size=4)
+    for i, inputs in enumerate(_prompts() + [tiny_inputs([8, 9])]):
+        scheduler.add_request(f"request-{i}", inputs, max_new_tokens=100, top_k=5, ras_win_len=3)
+    scheduler.step()
+
+    counters = []
+    sample_next_tokens = scheduler._sample_next_tokens
+
+    def _sample_next_tokens(*args, **kwargs):
+        with HostSyncCounter() as counter:
+            sample_next_tokens(*args, **kwargs)
+        counters.append(counter)
+
+    scheduler._sample_next_tokens = _sample_next_tokens
+    for _ in range(5):
+        generation_modes = {seq.generation_mode for seq in scheduler.running}
+        scheduler.step()
+        assert len(scheduler.running) == 4
+        assert counters[-1].counts == {"Tensor.tolist": 1}
+    assert GenerationMode.TEXT in generation_modes and GenerationMode.AUDIO_IN_PROGRESS in generation_modes
+
+
+@pytest.mark.parametrize("audio_adapter_type", ["dual_ffn", "dual_ffn_fast_forward"])
+def test_prefix_cache_hit_matches_cold_prefill(audio_adapter_type):
+    model = tiny_model(audio_adapter_type=audio_adapter_type)
+    model.generation_config.eos_token_id = None
+    audio_out_ids = torch.randint(0, 16, (4, 6), generator=torch.Generator().manual_seed(0))
+    audio_out_ids[:, 0] = 16
+    # The requests share a reference audio, which ends the first 4 input ids.
+    prompts = [
+        tiny_inputs(
+            [1, AUDIO_OUT_BOS_TOKEN_ID, AUDIO_OUT_TOKEN_IDX, 2] + user_ids + [AUDIO_OUT_BOS_TOKEN_ID], audio_out_ids
+        )
+        for user_ids in [[3, 4], [5, 6, 7], [3, 4]]
+    ]
+
+    def _run(prefix_cache):
+        scheduler = HiggsAudioScheduler(model, max_batch_size=2, prefix_cache=prefix_cache)
+        # The seeds make the resampling of the repetition aware sampling reproducible.
+        seqs = [
+            scheduler.add_request(f"request-{i}", inputs, max_new_tokens=20, temperature=0.0, seed=i, prefix_len=4)
+            for i, inputs in enumerate(prompts)
+        ]
+        scheduler.run()
+        return seqs
+
+    cold_seqs = _run(None)
+    prefix_cache = PrefixKVCache(1024**2)
+    seqs = _run(prefix_cache)
+
+    for seq, cold_seq in zip(seqs, cold_seqs):
+        assert seq.output_token_ids == cold_seq.output_token_ids
+        assert len(seq.audio_sequences) == len(cold_seq.audio_sequences) > 0
+        for audio_ids, cold_audio_ids in zip(seq.audio_sequences, cold_seq.audio_sequences):
+            assert torch.equal(audio_ids, cold_audio_ids)
+    assert [seq.num_cached_prompt_tokens for seq in cold_seqs] == [0, 0, 0]
+    assert [seq.num_cached_prompt_tokens for seq in seqs] == [0, 4, 4]
+    assert (prefix_cache.num_hits, prefix_cache.num_misses) == (2, 1)
@@ -0,0 +1,290 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+
+import numpy as np
+import pytest
+import torch
+
+from boson_multimodal.data_types import ChatMLSample, Message
+from boson_multimodal.model.higgs_audio import PagedKVCache
+from boson_multimodal.serve.prefix_cache import PrefixKVCache
+from boson_multimodal.serve import serve_engine
+from boson_multimodal.serve.serve_engine import HiggsAudioServeEngine
+
+from .utils import (
+    AUDIO_EOS_TOKEN_ID,
+    AUDIO_IN_TOKEN_IDX,
+    AUDIO_OUT_BOS_TOKEN_ID,
+    AUDIO_OUT_TOKEN_IDX,
+    AUDIO_STREAM_BOS_ID,
+    tiny_config,
+    tiny_inputs,
+    tiny_model,
+    tiny_tokenizer,
+)
+
+
+CLONE_PREPARE_SECONDS = 0.5
+TEXT_SAMPLE = ChatMLSample(messages=[Message(role="user", content="Hello")])
+# Stands for a voice clone request, which loads and tokenizes its reference audio.
+CLONE_SAMPLE = ChatMLSample(messages=[Message(role="user", content="Clone")])
+
+
+class _AudioTokenizer:
+    sampling_rate = 24000
+
+    def decode(self, codes):
+        return np.zeros((1, 1, 4 * codes.shape[-1]), dtype=np.float32)
+
+
+def _engine(monkeypatch, model=None, prefix_cache_max_bytes=0) -> HiggsAudioServeEngine:
+    """An engine around the tiny model, with the same KV cache and executors as the real one."""
+    if model is None:
+        model = tiny_model()
+    model.generation_config.eos_token_id = None
+    cache_config = deepcopy(model.config.text_config)
+    cache_config.num_hidden_layers += len(model.config.audio_dual_ffn_layers)
+
+    engine = HiggsAudioServeEngine.__new__(HiggsAudioServeEngine)
+    engine.model = model
+    engine.tokenizer = tiny_tokenizer()
+    engine.audio_tokenizer = _AudioTokenizer()
+    engine.audio_codebook_size = model.config.audio_codebook_size
+    engine.kv_cache = PagedKVCache(config=cache_config, num_blocks=64, block_size=16, cache_lengths=[1024])
+    engine.prefix_cache = PrefixKVCache(prefix_cache_max_bytes) if prefix_cache_max_bytes > 0 else None
+    engine._preprocess_executor = ThreadPoolExecutor(max_workers=2)
+    engine._execute_lock = threading.Lock()
+
+    def _prepare_inputs(chat_ml_sample, force_audio_gen=False):
+        if chat_ml_sample is CLONE_SAMPLE:
+            time.sleep(CLONE_PREPARE_SECONDS)
+        return tiny_inputs([1, 2, 3])
+
+    monkeypatch.setattr(engine, "_prepare_inputs", _prepare_inputs)
+    return engine
+
+
+async def _collect(stream):
+    return [delta async for delta in stream]
+
+
+def test_preparation_does_not_stall_other_streams(monkeypatch):
+    engine = _engine(monkeypatch)
+
+    async def main():
+        times = []
+        clone_request = None
+        async for _ in engine.generate_delta_stream(TEXT_SAMPLE, max_new_tokens=900, seed=0):
+            times.append(time.monotonic())
+            if clone_request is None:
+                clone_request = asyncio.create_task(
+                    _collect(engine.generate_delta_stream(CLONE_SAMPLE, max_new_tokens=4, seed=0))
+                )
+        clone_deltas = await clone_request
+        return times, clone_deltas
+
+    times, clone_deltas = asyncio.run(main())
+    assert len(clone_deltas) > 0
+    assert times[-1] - times[0] > CLONE_PREPARE_SECONDS, "the stream ended before the clone request was prepared"
+    # The deltas of the running stream keep flowing while the clone request is prepared.
+    assert max(b - a for a, b in zip(times, times[1:])) < CLONE_PREPARE_SECONDS / 2
+
+
+@pytest.mark.parametrize("failing_step", ["prefix", "generate"])
+def test_failed_execution_ends_the_stream(monkeypatch, failing_step):
+    engine = _engine(monkeypatch)
+    generate = engine.model.generate
+
+    def _fail(*args, **kwargs):
+        raise RuntimeError("execution failed")
+
+    def _generate_then_fail(*args, **kwargs):
+        generate(*args, **{**kwargs, "max_new_tokens": 3})
+        raise RuntimeError("execution failed")
+
+    async def main():
+        deltas = []
+        with monkeypatch.context() as m:
+            if failing_step == "prefix":
+                m.setattr(engine, "_prepare_prefix_kv_cache", _fail)
+            else:
+                m.setattr(engine.model, "generate", _generate_then_fail)
+            with pytest.raises(RuntimeError, match="execution failed"):
+                async for delta in engine.generate_delta_stream(TEXT_SAMPLE, max_new_tokens=8, seed=0):
+                    deltas.append(delta)
+        if failing_step == "generate":
+            # The deltas generated before the failure are streamed first.
+            assert len(deltas) > 0
+
+        # The lock is released, so the next request runs.
+        return await asyncio.wait_for(
+            _collect(engine.generate_delta_stream(TEXT_SAMPLE, max_new_tokens=8, seed=0)), timeout=10
+        )
+
+    assert len(asyncio.run(main())) > 0
+    assert not engine._execute_lock.locked()
+
+
+def test_failed_preparation_raises(monkeypatch):
+    engine = _engine(monkeypatch)
+
+    def _fail(chat_ml_sample, force_audio_gen=False):
+        raise ValueError("preparation failed")
+
+    monkeypatch.setattr(engine, "_prepare_inputs", _fail)
+
+    async def main():
+        with pytest.raises(ValueError, match="preparation failed"):
+            await _collect(engine.generate_delta_stream(TEXT_SAMPLE, max_new_tokens=8, seed=0))
+
+    asyncio.run(main())
+    assert not engine._execute_lock.locked()
+
+
+def _voice_clone_inputs(user_ids):
+    """A system message with a reference audio given as codes, a reference turn whose answer is a reference voice, and
+    a user message with `user_ids`, followed by the start of the generated audio."""
+    eot_id = tiny_tokenizer().convert_tokens_to_ids("<|eot_id|>")
+    input_ids = (
+        [1, 2, AUDIO_IN_TOKEN_IDX, 3, eot_id]
+        + [4, 5, eot_id]
+        + [AUDIO_OUT_BOS_TOKEN_ID, AUDIO_OUT_TOKEN_IDX, AUDIO_EOS_TOKEN_ID, eot_id]
+        + user_ids
+        + [eot_id, 6, AUDIO_OUT_BOS_TOKEN_ID]
+    )
+    generator = torch.Generator().manual_seed(0)
+    audio_in_ids = torch.randint(0, 16, (4, 6), generator=generator)
+    audio_out_ids = torch.randint(0, 16, (4, 8), generator=generator)
+    audio_out_ids[:, 0] = AUDIO_STREAM_BOS_ID
+    inputs = tiny_inputs(input_ids, audio_out_ids)
+    inputs["audio_in_ids"] = audio_in_ids
+    inputs["audio_in_ids_start"] = torch.tensor([0])
+    return inputs
+
+
+def test_prefix_cache_hit_matches_cold_prefill(monkeypatch):
+    # The model embeds the ids of the special tokens of the tokenizer, e.g. <|eot_id|>.
+    text_config = tiny_config().text_config.to_dict()
+    text_config["vocab_size"] = len(tiny_tokenizer())
+    requests = {
+        "a": (ChatMLSample(messages=[Message(role="user", content="a")]), _voice_clone_inputs([7, 8])),
+        "b": (ChatMLSample(messages=[Message(role="user", content="b")]), _voice_clone_inputs([9, 10, 11])),
+    }
+
+    def _run(prefix_cache_max_bytes, request_names):
+        engine = _engine(monkeypatch, tiny_model(text_config=text_config), prefix_cache_max_bytes)
+        monkeypatch.setattr(engine, "_prepare_inputs", lambda chat_ml_sample, force_audio_gen=False: inputs)
+        generate = engine.model.generate
+        results = []
+        for name in request_names:
+            chat_ml_sample, inputs = requests[name]
+            outputs = []
+            monkeypatch.setattr(
+                engine.model,
+                "generate",
+                lambda **kwargs: (
+                    outputs.append(generate(**kwargs, output_logits=True, return_dict_in_generate=True)) or outputs[-1]
+                ),
+            )
+            response = engine.generate(chat_ml_sample, max_new_tokens=12, temperature=0.0, seed=0)
+            results.append((response, outputs[0]))
+        return results
+
+    cold_results = dict(zip("ab", _run(0, "ab")))
+    cached_results = _run(1024**2, "aba")
+
+    for name, (response, outputs) in zip("aba", cached_results):
+        cold_response, cold_outputs = cold_results[name]
+        assert torch.equal(outputs.sequences, cold_outputs.sequences)
+        assert len(outputs.audio_sequences) == len(cold_outputs.audio_sequences) == 1
+        assert torch.equal(outputs.audio_sequences[0], cold_outputs.audio_sequences[0])
+        assert len(outputs.logits) == len(cold_outputs.logits)
+        for logits, cold_logits in zip(outputs.logits, cold_outputs.logits):
+            torch.testing.assert_close(logits, cold_logits)
+        assert cold_response.usage["cached_tokens"] == 0
+    # The prefix ends with the reference turn, after the second to last <|eot_id|>.
+    assert [response.usage["cached_tokens"] for response, _ in cached_results] == [0, 12, 12]
+    assert [response.usage["prefix_cache_misses"] for response, _ in cached_results] == [1, 1, 1]
+    assert [response.usage["prefix_cache_hits"] for response, _ in cached_results] == [0, 1, 2]
+
+
+def test_generate_batch_shares_the_prefix_cache_with_generate(monkeypatch):
+    text_config = tiny_config().text_config.to_dict()
+    text_config["vocab_size"] = len(tiny_tokenizer())
+    model = tiny_model(text_config=text_config)
+    # Both requests share the system message and the reference turn.
+    requests = {
+        "a": (ChatMLSample(messages=[Message(role="user", content="a")]), _voice_clone_inputs([7, 8])),
+        "b": (ChatMLSample(messages=[Message(role="user", content="b")]), _voice_clone_inputs([9, 10, 11])),
+    }
+    samples = {id(chat_ml_sample): inputs for chat_ml_sample, inputs in requests.values()}
+    batch = [requests[name][0] for name in "aba"]
+
+    def _engine_with_prefix_cache(prefix_cache_max_bytes):
+        engine = _engine(monkeypatch, model, prefix_cache_max_bytes)
+        monkeypatch.setattr(
+            engine, "_prepare_inputs", lambda chat_ml_sample, force_audio_gen=False: samples[id(chat_ml_sample)]
+        )
+        return engine
+
+    def _generate_batch(engine):
+        return engine.generate_batch(batch, max_new_tokens=12, temperature=0.0, seed=0)
+
+    def _generate(engine):
+        return engine.generate(requests["a"][0], max_new_tokens=12, temperature=0.0, seed=0)
+
+    cold_engine = _engine_with_prefix_cache(0)
+    cold_responses = _generate_batch(cold_engine)
+    cold_response = _generate(cold_engine)
+    assert cold_response.usage["cached_tokens"] == 0
+    assert [response.usage["cached_tokens"] for response in cold_responses] == [0, 0, 0]
+
+    # The entry is added from the `DynamicCache` of a prefill of the batch, then read into the `PagedKVCache`.
+    engine = _engine_with_prefix_cache(1024**2)
+    responses = _generate_batch(engine)
+    response = _generate(engine)
+    # The prefix ends with the reference turn, after the second to last <|eot_id|>.
+    assert sorted(response.usage["cached_tokens"] for response in responses) == [0, 12, 12]
+    assert response.usage["cached_tokens"] == 12
+    assert (response.usage["prefix_cache_hits"], response.usage["prefix_cache_misses"]) == (3, 1)
+    assert np.array_equal(response.generated_audio_tokens, cold_response.generated_audio_tokens)
+
+    # The entry is added from the `PagedKVCache`, then read into the `DynamicCache` of each prefill of the batch.
+    engine = _engine_with_prefix_cache(1024**2)
+    _generate(engine)
+    cached_responses = _generate_batch(engine)
+    assert [response.usage["cached_tokens"] for response in cached_responses] == [12, 12, 12]
+    usage = cached_responses[-1].usage
+    assert (usage["prefix_cache_hits"], usage["prefix_cache_misses"]) == (3, 1)
+
+    for batch_responses in [responses, cached_responses]:
+        for response, cold_response in zip(batch_responses, cold_responses):
+            assert np.array_equal(response.generated_text_tokens, cold_response.generated_text_tokens)
+            assert np.array_equal(response.generated_audio_tokens, cold_response.generated_audio_tokens)
+
+
+def test_generate_batch_decodes_while_the_samples_are_prepared(monkeypatch):
+    engine = _engine(monkeypatch)
+    events = []
+
+    class _RecordingScheduler(serve_engine.HiggsAudioScheduler):
+        def add_request(self, request_id, *args, **kwargs):
+            events.append(("add", request_id))
+            return super().add_request(request_id, *args, **kwargs)
+
+        def step(self):
+            events.append(("step", len(self.running)))
+            return super().step()
+
+    monkeypatch.setattr(serve_engine, "HiggsAudioScheduler", _RecordingScheduler)
+    responses = engine.generate_batch([CLONE_SAMPLE, TEXT_SAMPLE], max_new_tokens=100, temperature=0.0, seed=0)
+
+    # The text request is admitted first and decoded while the reference audio of the voice clone request is prepared.
+    assert events[0] == ("add", "1")
+    clone_admission = events.index(("add", "0"))
+    assert ("step", 1) in events[:clone_admission]
+    assert all(response.metrics["finish_reason"] == "length" for response in responses)
+    assert not engine._execute_lock.locked()
@@ -0,0 +1,176 @@
+import itertools
+
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+from boson_multimodal.audio_processing import higgs_audio_tokenizer
+from boson_multimodal.audio_processing.higgs_audio_tokenizer import HiggsAudioTokenizer
+from boson_multimodal.model.higgs_audio.utils import revert_delay_pattern
+from boson_multimodal.serve.audio_streaming import StreamingAudioDecoder
+
+
+NUM_CODEBOOKS = 4
+CODEBOOK_SIZE = 16
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    monkeypatch = pytest.MonkeyPatch()
+    # The semantic model is only used to encode audio, so a random module replaces the pretrained one.
+    monkeypatch.setattr(higgs_audio_tokenizer.AutoModel, "from_pretrained", lambda *args, **kwargs: nn.Linear(1, 1))
+    torch.manual_seed(0)
+    tokenizer = HiggsAudioTokenizer(D=32, n_q=NUM_CODEBOOKS, bins=CODEBOOK_SIZE, device="cpu").eval()
+    monkeypatch.undo()
+    with torch.no_grad():
+        # Move the weight norm gains and the snake alphas away from their initial values, so that the streaming
+        # decoder has to recompute the weights.
+        for name, param in tokenizer.decoder_2.named_parameters():
+            if name.endswith("weight_g") or name.endswith("alpha"):
+                param.mul_(torch.empty_like(param).uniform_(0.5, 1.5))
+    return tokenizer
+
+
+def _chunks(num_frames, chunk_size):
+    sizes = itertools.cycle([1, 3, 7, 2, 11] if chunk_size == "ragged" else [chunk_size])
+    start = 0
+    while start < num_frames:
+        end = min(start + next(sizes), num_frames)
+        yield start, end
+        start = end
+
+
+@pytest.mark.parametrize("num_frames", [1, 13, 50])
+@pytest.mark.parametrize("chunk_size", [1, 4, 16, "ragged", 100])
+def test_decode_chunk_matches_decode(tokenizer, num_frames, chunk_size):
+    codes = torch.randint(0, CODEBOOK_SIZE, (1, NUM_CODEBOOKS, num_frames), generator=torch.Generator().manual_seed(1))
+    with torch.no_grad():
+        expected = tokenizer.decode(codes)
+        streaming_decoder = tokenizer.create_streaming_decoder()
+        outputs = []
+        for start, end in _chunks(num_frames, chunk_size):
+            outputs.append(tokenizer.decode_chunk(codes[..., start:end], streaming_decoder))
+        outputs.append(tokenizer.decode_chunk(codes[..., :0], streaming_decoder, is_final=True))
+    output = np.concatenate(outputs, axis=-1)
+
+    assert output.shape == expected.shape
+    np.testing.assert_allclose(output, expected, rtol=0, atol=1e-5 * np.abs(expected).max())
+
+
+def test_streaming_decoder_is_reset_after_the_final_chunk(tokenizer):
+    codes = torch.randint(0, CODEBOOK_SIZE, (1, NUM_CODEBOOKS, 20), generator=torch.Generator().manual_seed(2))
+    with torch.no_grad():
+        streaming_decoder = tokenizer.create_streaming_decoder()
+        first = tokenizer.decode_chunk(codes, streaming_decoder, is_final=True)
+        second = tokenizer.decode_chunk(codes, streaming_decoder, is_final=True)
+    np.testing.assert_array_equal(first, second)
+
+
+class _WindowedTokenizer:
+    """Hides the chunked decoding of the tokenizer, so that `StreamingAudioDecoder` decodes overlapping windows."""
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.hop_length = tokenizer.hop_length
+
+    def decode(self, codes):
+        return self.tokenizer.decode(codes)
+
+
+def _delayed_segment(codes):
+    """The delayed columns of an audio segment of codes of shape (num_codebooks, num_frames), between a stream bos
+    frame and a stream eos frame."""
+    num_frames = codes.shape[1] + 2
+    delayed = torch.full((NUM_CODEBOOKS, num_frames + NUM_CODEBOOKS - 1), CODEBOOK_SIZE + 1)
+    for i in range(NUM_CODEBOOKS):
+        delayed[i, :i] = CODEBOOK_SIZE
+        delayed[i, i] = CODEBOOK_SIZE
+        delayed[i, i + 1 : i + num_frames - 1] = codes[i]
+    return delayed
+
+
+def _stream(decoder, delayed, chunk_size):
+    outputs = []
+    for start, end in _chunks(delayed.shape[1], chunk_size):
+        columns = delayed[:, start] if chunk_size == 1 else delayed[:, start:end]
+        outputs.append(decoder.put(columns))
+    outputs.append(decoder.flush())
+    return np.concatenate([output for output in outputs if output is not None] or [np.zeros(0, np.float32)])
+
+
+def _audio_decoder(tokenizer, **kwargs):
+    samples_per_frame = int(tokenizer.hop_length)
+    return StreamingAudioDecoder(
+        tokenizer,
+        num_codebooks=NUM_CODEBOOKS,
+        codebook_size=CODEBOOK_SIZE,
+        samples_per_frame=samples_per_frame,
+        hamming_window_len=4 * samples_per_frame,
+        **kwargs,
+    )
+
+
+def _expected_audio(tokenizer, delayed):
+    codes = revert_delay_pattern(delayed)[:, 1:-1]
+    if codes.shape[1] == 0:
+        return np.zeros(0, dtype=np.float32)
+    return tokenizer.decode(codes.unsqueeze(0))[0, 0]
+
+
+@pytest.mark.parametrize("num_frames", [0, 1, 13, 50])
+@pytest.mark.parametrize("chunk_size", [1, 4, "ragged"])
+def test_streaming_audio_decoder_matches_decode(tokenizer, num_frames, chunk_size):
+    codes = torch.randint(0, CODEBOOK_SIZE, (NUM_CODEBOOKS, num_frames), generator=torch.Generator().manual_seed(3))
+    delayed = _delayed_segment(codes)
+    decoder = _audio_decoder(tokenizer, chunk_frames=4)
+    with torch.no_grad():
+        expected = _expected_audio(tokenizer, delayed)
+        output = _stream(decoder, delayed, chunk_size)
+        # `flush()` resets the decoder for the next audio segment.
+        next_output = _stream(decoder, delayed, chunk_size)
+
+    # The stream bos and eos frames are dropped, and every frame is decoded once by the stateful decoder.
+    assert output.shape == expected.shape
+    np.testing.assert_allclose(output, expected, rtol=0, atol=1e-5 * max(np.abs(expected).max(initial=0), 1))
+    np.testing.assert_array_equal(next_output, output)
+
+
+@pytest.mark.parametrize("num_frames", [0, 1, 13, 50])
+@pytest.mark.parametrize("chunk_size", [1, 4, "ragged"])
+@pytest.mark.parametrize("lookahead_frames", [None, 0])
+def test_windowed_streaming_audio_decoder_matches_decode(tokenizer, num_frames, chunk_size, lookahead_frames):
+    codes = torch.randint(0, CODEBOOK_SIZE, (NUM_CODEBOOKS, num_frames), generator=torch.Generator().manual_seed(4))
+    delayed = _delayed_segment(codes)
+    decoder = _audio_decoder(
+        _WindowedTokenizer(tokenizer), chunk_frames=4, context_frames=8, lookahead_frames=lookahead_frames
+    )
+    with torch.no_grad():
+        expected = _expected_audio(tokenizer, delayed)
+        output = _stream(decoder, delayed, chunk_size)
+        next_output = _stream(decoder, delayed, chunk_size)
+
+    # The windows only see a bounded context, and their overlaps are cross-faded.
+    assert output.shape == expected.shape
+    # Without lookahead, the last frames of a window are decoded without their right context.
+    tolerance = 0.02 if lookahead_frames is None else 0.1
+    np.testing.assert_allclose(output, expected, rtol=0, atol=tolerance * max(np.abs(expected).max(initial=0), 1e-3))
+    np.testing.assert_array_equal(next_output, output)
+
+
+def test_flush_returns_the_held_back_frames(tokenizer):
+    decoder = _audio_decoder(_WindowedTokenizer(tokenizer), chunk_frames=4, lookahead_frames=0)
+    samples_per_frame = decoder.samples_per_frame
+    assert decoder.flush() is None
+
+    codes = torch.randint(0, CODEBOOK_SIZE, (NUM_CODEBOOKS, 12), generator=torch.Generator().manual_seed(5))
+    delayed = _delayed_segment(codes)
+    with torch.no_grad():
+        expected = _expected_audio(tokenizer, delayed)
+        # All the frames are decoded by the last window, but its overlap is held back to be cross-faded.
+        output = decoder.put(delayed)
+        assert output.shape[0] == (12 - decoder.overlap_frames) * samples_per_frame
+        tail = decoder.flush()
+    assert tail.shape[0] == decoder.overlap_frames * samples_per_frame
+    np.testing.assert_allclose(np.concatenate([output, tail]), expected, rtol=0, atol=0.1 * np.abs(expected).max())
+    assert decoder.flush() is None
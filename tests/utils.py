@@ -0,0 +1,116 @@
+"""Helpers shared by the tests and the benchmarks, built around a tiny randomly initialized HiggsAudio model."""
+
+from typing import List, Optional
+
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import PreTrainedTokenizerFast
+
+from boson_multimodal.model.higgs_audio import HiggsAudioConfig, HiggsAudioModel
+
+AUDIO_IN_TOKEN_IDX = 50
+AUDIO_OUT_TOKEN_IDX = 51
+AUDIO_OUT_BOS_TOKEN_ID = 52
+AUDIO_EOS_TOKEN_ID = 53
+PAD_TOKEN_ID = 63
+AUDIO_STREAM_BOS_ID = 16
+AUDIO_STREAM_EOS_ID = 17
+
+
+def tiny_config(**kwargs) -> HiggsAudioConfig:
+    """A config with 2 layers, 4 codebooks of 16 codes and a vocabulary of 64 tokens. `kwargs` override the fields."""
+    text_config = dict(
+        model_type="llama",
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=512,
+        pad_token_id=PAD_TOKEN_ID,
+    )
+    audio_encoder_config = dict(
+        num_mel_bins=128,
+        encoder_layers=1,
+        encoder_attention_heads=2,
+        encoder_ffn_dim=32,
+        d_model=16,
+        max_source_positions=1500,
+        pad_token_id=PAD_TOKEN_ID,
+    )
+    config = dict(
+        text_config=text_config,
+        audio_encoder_config=audio_encoder_config,
+        audio_adapter_type="dual_ffn",
+        audio_ffn_hidden_size=32,
+        audio_ffn_intermediate_size=64,
+        audio_dual_ffn_layers=[1],
+        encode_whisper_embed=False,
+        encode_audio_in_tokens=True,
+        use_delay_pattern=True,
+        skip_audio_tower=True,
+        audio_num_codebooks=4,
+        audio_codebook_size=16,
+        audio_stream_bos_id=AUDIO_STREAM_BOS_ID,
+        audio_stream_eos_id=AUDIO_STREAM_EOS_ID,
+        audio_in_token_idx=AUDIO_IN_TOKEN_IDX,
+        audio_out_token_idx=AUDIO_OUT_TOKEN_IDX,
+        pad_token_id=PAD_TOKEN_ID,
+        audio_out_bos_token_id=AUDIO_OUT_BOS_TOKEN_ID,
+        audio_eos_token_id=AUDIO_EOS_TOKEN_ID,
+    )
+    config.update(kwargs)
+    return HiggsAudioConfig(**config)
+
+
+def tiny_model(seed: int = 0, **kwargs) -> HiggsAudioModel:
+    """A randomly initialized model in eval mode, with the audio special tokens set."""
+    torch.manual_seed(seed)
+    model = HiggsAudioModel(tiny_config(**kwargs)).eval()
+    model.audio_out_bos_token_id = AUDIO_OUT_BOS_TOKEN_ID
+    model.audio_eos_token_id = AUDIO_EOS_TOKEN_ID
+    return model
+
+
+def tiny_inputs(input_ids: List[int], audio_out_ids: Optional[torch.Tensor] = None) -> dict:
+    """The model inputs of a single sample, in the format returned by the collator.
+
+    `audio_out_ids` has shape (num_codebooks, num_steps). It is assigned to the single <|AUDIO_OUT|> token of
+    `input_ids`, if any.
+    """
+    input_ids = torch.tensor([input_ids], dtype=torch.long)
+    if audio_out_ids is not None:
+        audio_out_ids_start = torch.tensor([0], dtype=torch.long)
+    else:
+        audio_out_ids_start = None
+    return dict(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        audio_features=None,
+        audio_feature_attention_mask=None,
+        audio_in_ids=None,
+        audio_in_ids_start=None,
+        audio_out_ids=audio_out_ids,
+        audio_out_ids_start=audio_out_ids_start,
+    )
+
+
+def tiny_tokenizer() -> PreTrainedTokenizerFast:
+    """A byte-level BPE tokenizer trained on a few English, CJK and emoji sentences, so that many characters are split
+    over several tokens. The special tokens `<|end_of_text|>` and `<|eot_id|>` come after the 256 byte tokens."""
+    corpus = [
+        "Hello world, this is a tiny tokenizer.",
+        "你好，世界。今天天气很好。",
+        "こんにちは、世界。",
+        "안녕하세요 세계",
+        "Emoji: 😀🎉👍🏽 and 🇫🇷.",
+    ]
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=300, initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(corpus, trainer)
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer)
+    tokenizer.add_special_tokens({"additional_special_tokens": ["<|end_of_text|>", "<|eot_id|>"]})
+    return tokenizer